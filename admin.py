@@ -9,6 +9,7 @@ from sqlalchemy import func
 import logging
 import os
 import mimetypes
+import threading
 import markdown
 
 # Создание blueprint для админки
@@ -141,10 +142,9 @@ def dashboard():
     """Admin dashboard with statistics"""
     try:
         # Импорт моделей и базы данных (отложенный импорт для избежания циклов)
-        from models import UserQuery, Document, WebSource, KnowledgeBase, AgentKnowledgeBase, db
+        from models import UserQuery, Document, WebSource, KnowledgeBase, AgentKnowledgeBase
+        from statistics_rollups import statistics_rollups
 
-        # Получение статистики
-        total_queries = UserQuery.query.count()
         total_documents = Document.query.filter_by(is_active=True).count()
         total_web_sources = WebSource.query.filter_by(is_active=True).count()
         total_kb_chunks = KnowledgeBase.query.filter_by(is_active=True).count()
@@ -153,45 +153,16 @@ def dashboard():
         # Последние 10 запросов пользователей
         recent_queries = UserQuery.query.order_by(UserQuery.created_at.desc()).limit(10).all()
 
-        # Статистика по дням за последнюю неделю
-        week_ago = datetime.utcnow() - timedelta(days=7)
-        daily_stats = db.session.query(
-            func.date(UserQuery.created_at).label('date'),
-            func.count(UserQuery.id).label('count')
-        ).filter(
-            UserQuery.created_at >= week_ago
-        ).group_by(
-            func.date(UserQuery.created_at)
-        ).all()
-
-        # Среднее время ответа
-        avg_response_time = db.session.query(
-            func.avg(UserQuery.response_time)
-        ).scalar() or 0
-
-        # Статистика оценок
-        total_ratings = db.session.query(func.count(UserQuery.id)).filter(
-            UserQuery.user_rating.isnot(None)
-        ).scalar() or 0
-
-        total_likes = db.session.query(func.count(UserQuery.id)).filter(
-            UserQuery.user_rating == 'like'
-        ).scalar() or 0
-
-        satisfaction_rate = round((total_likes / total_ratings * 100) if total_ratings > 0 else 0, 1)
+        # Счетчики запросов и оценок из материализованных агрегатов
+        query_stats = statistics_rollups.dashboard_summary()
 
         return render_template('admin/dashboard.html',
-                             total_queries=total_queries,
                              total_documents=total_documents,
                              total_web_sources=total_web_sources,
                              total_kb_chunks=total_kb_chunks,
                              total_agent_knowledge=total_agent_knowledge,
                              recent_queries=recent_queries,
-                             daily_stats=daily_stats,
-                             avg_response_time=round(avg_response_time, 2),
-                             total_ratings=total_ratings,
-                             total_likes=total_likes,
-                             satisfaction_rate=satisfaction_rate)
+                             **query_stats)
     except Exception as e:
         logger.error(f"Error in admin dashboard: {str(e)}")
         flash('Ошибка при загрузке панели управления', 'error')
@@ -383,78 +354,10 @@ def logout():
 def agent_analytics():
     """Get agent usage analytics"""
     try:
-        from models import UserQuery
-        from models import db
-
-        # Get agent usage statistics
-        agent_stats = db.session.query(
-            UserQuery.agent_type,
-            UserQuery.agent_name,
-            func.count(UserQuery.id).label('total_queries'),
-            func.avg(UserQuery.response_time).label('avg_response_time'),
-            func.avg(UserQuery.agent_confidence).label('avg_confidence')
-        ).filter(
-            UserQuery.agent_type.isnot(None)
-        ).group_by(
-            UserQuery.agent_type, UserQuery.agent_name
-        ).all()
+        from statistics_rollups import statistics_rollups
 
-        # Get language distribution by agent
-        language_stats = db.session.query(
-            UserQuery.agent_type,
-            UserQuery.language,
-            func.count(UserQuery.id).label('count')
-        ).filter(
-            UserQuery.agent_type.isnot(None)
-        ).group_by(
-            UserQuery.agent_type, UserQuery.language
-        ).all()
-
-        # Get daily usage for the last 30 days
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-
-        daily_stats = db.session.query(
-            func.date(UserQuery.created_at).label('date'),
-            UserQuery.agent_type,
-            func.count(UserQuery.id).label('count')
-        ).filter(
-            UserQuery.created_at >= thirty_days_ago,
-            UserQuery.agent_type.isnot(None)
-        ).group_by(
-            func.date(UserQuery.created_at), UserQuery.agent_type
-        ).all()
-
-        # Format data for frontend
-        result = {
-            'agent_stats': [
-                {
-                    'agent_type': stat.agent_type,
-                    'agent_name': stat.agent_name,
-                    'total_queries': stat.total_queries,
-                    'avg_response_time': round(stat.avg_response_time or 0, 2),
-                    'avg_confidence': round(stat.avg_confidence or 0, 2)
-                }
-                for stat in agent_stats
-            ],
-            'language_stats': [
-                {
-                    'agent_type': stat.agent_type,
-                    'language': stat.language,
-                    'count': stat.count
-                }
-                for stat in language_stats
-            ],
-            'daily_stats': [
-                {
-                    'date': stat.date.isoformat(),
-                    'agent_type': stat.agent_type,
-                    'count': stat.count
-                }
-                for stat in daily_stats
-            ]
-        }
-
-        return jsonify(result)
+        # Агрегаты из материализованных таблиц, отрисованный ответ кэшируется на STATS_CACHE_TTL
+        return jsonify(statistics_rollups.agent_analytics())
 
     except Exception as e:
         logger.error(f"Error getting agent analytics: {str(e)}")
@@ -466,130 +369,10 @@ def agent_analytics():
 def analytics_summary():
     """Get summary analytics for dashboard"""
     try:
-        from models import UserQuery
-        from models import db
-
-        # Get agent usage data
-        agent_usage = db.session.query(
-            UserQuery.agent_name,
-            func.count(UserQuery.id).label('count'),
-            func.avg(UserQuery.response_time).label('avg_response_time'),
-            func.avg(UserQuery.agent_confidence).label('avg_confidence')
-        ).filter(
-            UserQuery.agent_name.isnot(None)
-        ).group_by(
-            UserQuery.agent_name
-        ).all()
+        from statistics_rollups import statistics_rollups
 
-        # Get language distribution
-        language_distribution = db.session.query(
-            UserQuery.language,
-            func.count(UserQuery.id).label('count')
-        ).group_by(
-            UserQuery.language
-        ).all()
-
-        # Get daily activity for last 30 days
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        daily_activity = db.session.query(
-            func.date(UserQuery.created_at).label('date'),
-            func.count(UserQuery.id).label('count')
-        ).filter(
-            UserQuery.created_at >= thirty_days_ago
-        ).group_by(
-            func.date(UserQuery.created_at)
-        ).order_by(
-            func.date(UserQuery.created_at)
-        ).all()
-
-        # Get rating statistics
-        total_ratings = db.session.query(func.count(UserQuery.id)).filter(
-            UserQuery.user_rating.isnot(None)
-        ).scalar() or 0
-
-        likes = db.session.query(func.count(UserQuery.id)).filter(
-            UserQuery.user_rating == 'like'
-        ).scalar() or 0
-
-        dislikes = db.session.query(func.count(UserQuery.id)).filter(
-            UserQuery.user_rating == 'dislike'
-        ).scalar() or 0
-
-        # Rating distribution by agent
-        rating_by_agent = db.session.query(
-            UserQuery.agent_name,
-            UserQuery.user_rating,
-            func.count(UserQuery.id).label('count')
-        ).filter(
-            UserQuery.user_rating.isnot(None),
-            UserQuery.agent_name.isnot(None)
-        ).group_by(
-            UserQuery.agent_name, UserQuery.user_rating
-        ).all()
-
-        # Daily rating trends for last 30 days
-        daily_ratings = db.session.query(
-            func.date(UserQuery.created_at).label('date'),
-            UserQuery.user_rating,
-            func.count(UserQuery.id).label('count')
-        ).filter(
-            UserQuery.created_at >= thirty_days_ago,
-            UserQuery.user_rating.isnot(None)
-        ).group_by(
-            func.date(UserQuery.created_at), UserQuery.user_rating
-        ).order_by(
-            func.date(UserQuery.created_at)
-        ).all()
-
-        result = {
-            'agent_usage': [
-                {
-                    'name': stat.agent_name or 'Неизвестный агент',
-                    'count': stat.count,
-                    'avg_response_time': round(stat.avg_response_time or 0, 2),
-                    'avg_confidence': round(stat.avg_confidence or 0, 2)
-                }
-                for stat in agent_usage
-            ],
-            'language_distribution': [
-                {
-                    'language': stat.language,
-                    'count': stat.count
-                }
-                for stat in language_distribution
-            ],
-            'daily_activity': [
-                {
-                    'date': stat.date.isoformat() if stat.date else '',
-                    'count': stat.count
-                }
-                for stat in daily_activity
-            ],
-            'rating_stats': {
-                'total_ratings': total_ratings,
-                'likes': likes,
-                'dislikes': dislikes,
-                'satisfaction_rate': round((likes / total_ratings * 100) if total_ratings > 0 else 0, 1)
-            },
-            'rating_by_agent': [
-                {
-                    'agent_name': stat.agent_name or 'Неизвестный агент',
-                    'rating': stat.user_rating,
-                    'count': stat.count
-                }
-                for stat in rating_by_agent
-            ],
-            'daily_ratings': [
-                {
-                    'date': stat.date.isoformat() if stat.date else '',
-                    'rating': stat.user_rating,
-                    'count': stat.count
-                }
-                for stat in daily_ratings
-            ]
-        }
-
-        return jsonify(result)
+        # Агрегаты из материализованных таблиц, отрисованный ответ кэшируется на STATS_CACHE_TTL
+        return jsonify(statistics_rollups.analytics_summary())
 
     except Exception as e:
         logger.error(f"Error getting analytics summary: {str(e)}")
@@ -666,6 +449,7 @@ def add_knowledge():
     try:
         from models import AgentKnowledgeBase
         from models import db
+        from knowledge_snapshot import knowledge_snapshot
 
         data = request.get_json()
 
@@ -697,6 +481,7 @@ def add_knowledge():
 
         db.session.add(knowledge)
         db.session.commit()
+        knowledge_snapshot.bump_version('add_knowledge')
 
         logger.info(f"Added knowledge entry: {knowledge.title} for {knowledge.agent_type}")
         return jsonify({'success': True, 'id': knowledge.id})
@@ -712,12 +497,14 @@ def toggle_featured(knowledge_id):
     try:
         from models import AgentKnowledgeBase
         from models import db
+        from knowledge_snapshot import knowledge_snapshot
 
         knowledge = AgentKnowledgeBase.query.get_or_404(knowledge_id)
         knowledge.is_featured = not knowledge.is_featured
         knowledge.updated_at = datetime.utcnow()
         
         db.session.commit()
+        knowledge_snapshot.bump_version('toggle_featured')
         
         return jsonify({'success': True, 'is_featured': knowledge.is_featured})
 
@@ -733,12 +520,14 @@ def toggle_active(knowledge_id):
     try:
         from models import AgentKnowledgeBase
         from models import db
+        from knowledge_snapshot import knowledge_snapshot
 
         knowledge = AgentKnowledgeBase.query.get_or_404(knowledge_id)
         knowledge.is_active = not knowledge.is_active
         knowledge.updated_at = datetime.utcnow()
         
         db.session.commit()
+        knowledge_snapshot.bump_version('toggle_active')
         
         return jsonify({'success': True, 'is_active': knowledge.is_active})
 
@@ -754,10 +543,12 @@ def delete_knowledge(knowledge_id):
     try:
         from models import AgentKnowledgeBase
         from models import db
+        from knowledge_snapshot import knowledge_snapshot
 
         knowledge = AgentKnowledgeBase.query.get_or_404(knowledge_id)
         db.session.delete(knowledge)
         db.session.commit()
+        knowledge_snapshot.bump_version('delete_knowledge')
         
         logger.info(f"Deleted knowledge entry: {knowledge.title}")
         return jsonify({'success': True})
@@ -803,6 +594,7 @@ def update_knowledge(knowledge_id):
     try:
         from models import AgentKnowledgeBase
         from models import db
+        from knowledge_snapshot import knowledge_snapshot
 
         knowledge = AgentKnowledgeBase.query.get_or_404(knowledge_id)
         data = request.get_json()
@@ -826,6 +618,7 @@ def update_knowledge(knowledge_id):
         knowledge.updated_at = datetime.utcnow()
         
         db.session.commit()
+        knowledge_snapshot.bump_version('update_knowledge')
         
         logger.info(f"Updated knowledge entry: {knowledge.title}")
         return jsonify({'success': True})
@@ -846,6 +639,29 @@ def feedback():
     return render_template('admin/feedback.html')
 
 
+@admin_bp.route('/api/precompute', methods=['GET', 'POST'])
+@admin_required
+def precompute_popular():
+    """Warm-up of popular questions: POST starts a run in the background, GET shows progress"""
+    try:
+        from distributed_system import performance_optimizer
+
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            queries = performance_optimizer.mine_popular_queries(
+                top_n=data.get('top_n'), days=data.get('days', 14), min_count=data.get('min_count', 3)
+            )
+            threading.Thread(target=performance_optimizer.precompute_popular_queries, args=(queries,),
+                             kwargs={'max_llm_calls': data.get('max_llm_calls')}, daemon=True).start()
+            return jsonify({'success': True, 'queued': len(queries), 'queries': queries[:50]})
+
+        return jsonify({'success': True, 'precompute': performance_optimizer.get_precompute_stats()})
+
+    except Exception as e:
+        logger.error(f"Error in precompute endpoint: {str(e)}")
+        return jsonify({'success': False, 'error': 'Ошибка сервера'}), 500
+
+
 @admin_bp.route('/api/feedback/stats')
 @admin_required
 def feedback_stats():
@@ -1373,9 +1189,10 @@ def manage_lessons():
         if group_filter:
             lessons_query = lessons_query.filter(Schedule.group_name.ilike(f'%{group_filter}%'))
         if date_filter:
-            from datetime import datetime
-            date_obj = datetime.strptime(date_filter, '%Y-%m-%d').date()
-            lessons_query = lessons_query.filter(db.func.date(Schedule.start_time) == date_obj)
+            from schedule_service import midnight
+            day_start = midnight(datetime.strptime(date_filter, '%Y-%m-%d').date())
+            lessons_query = lessons_query.filter(Schedule.start_time >= day_start,
+                                                 Schedule.start_time < day_start + timedelta(days=1))
         
         lessons_list = lessons_query.order_by(Schedule.start_time.desc())
         # Простой срез вместо paginate для избежания ошибок
@@ -1405,7 +1222,7 @@ def add_lesson():
     """Добавить новое занятие"""
     try:
         from models import Schedule, db
-        from datetime import datetime, time
+        from schedule_service import schedule_service
         
         group_name = request.form.get('group_name', '').strip()
         title = request.form.get('title', '').strip()
@@ -1431,24 +1248,21 @@ def add_lesson():
             flash('Время окончания должно быть позже времени начала', 'error')
             return redirect(url_for('admin.manage_lessons'))
         
-        admin_id = session.get('admin_id')
-        
         schedule = Schedule(
             group_name=group_name,
             title=title,
             instructor=instructor,
-            date=date_obj,
-            start_time=start_time_obj,
-            end_time=end_time_obj,
-            classroom=classroom,
-            lesson_type=lesson_type,
-            notes=notes,
-            is_active=True,
-            created_by=admin_id
+            start_time=datetime.combine(date_obj, start_time_obj),
+            end_time=datetime.combine(date_obj, end_time_obj),
+            room=classroom,
+            schedule_type=lesson_type,
+            description=notes,
+            is_active=True
         )
         
         db.session.add(schedule)
         db.session.commit()
+        schedule_service.invalidate(group_name)
         
         flash('Занятие успешно добавлено', 'success')
         
@@ -1464,11 +1278,13 @@ def delete_lesson(lesson_id):
     """Удалить занятие"""
     try:
         from models import Schedule, db
+        from schedule_service import schedule_service
         
         lesson = Schedule.query.get(lesson_id)
         if lesson:
             lesson.is_active = False
             db.session.commit()
+            schedule_service.invalidate(lesson.group_name)
             flash('Занятие успешно удалено', 'success')
         else:
             flash('Занятие не найдено', 'error')
@@ -1,12 +1,16 @@
 import logging
 import time
 from abc import ABC, abstractmethod
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 
-from mistral_client import MistralClient
+from mistral_client import mistral_client, async_mistral_client
+from keyword_matcher import keyword_matcher
 
 logger = logging.getLogger(__name__)
 
+# user_id of cache warm-up requests (no personalization or analytics)
+PRECOMPUTE_USER_ID = 'precompute'
+
 class AgentType:
     AI_ABITUR = "ai_abitur"
     KADRAI = "kadrai"
@@ -15,12 +19,31 @@ class AgentType:
     UNIROOM = "uniroom"
 
 class BaseAgent(ABC):
+    # Keyword and phrase lists of the agent, matched through the shared automaton
+    keyword_groups: Dict[str, List[str]] = {}
+
     def __init__(self, agent_type: str, name: str, description: str):
         self.agent_type = agent_type
         self.name = name
         self.description = description
-        # Each agent has its own MistralClient instance
-        self.mistral = MistralClient()
+        # Shared process-wide client: one connection pool and circuit breaker state
+        self.mistral = mistral_client
+        self.async_mistral = async_mistral_client
+
+        for group, phrases in self.keyword_groups.items():
+            keyword_matcher.register(self._group(group), phrases)
+
+    def _group(self, group: str) -> str:
+        """Name of the agent's keyword group in the shared matcher"""
+        return f"agent:{self.agent_type}:{group}"
+
+    def _scan(self, message: str):
+        """Shared single-pass keyword scan of the message (cached per turn)"""
+        return keyword_matcher.scan(message)
+
+    def _is_image_request(self, message: str) -> bool:
+        """Only agents that serve media override this"""
+        return False
 
     @abstractmethod
     def can_handle(self, message: str, language: str = "ru") -> float:
@@ -30,120 +53,262 @@ class BaseAgent(ABC):
     def get_system_prompt(self, language: str = "ru") -> str:
         pass
 
-    def process_message(self, message: str, language: str = "ru", user_id: str = "anonymous") -> Dict[str, Any]:
-        try:
-            start_time = time.time()
+    def process_message(self, message: str, language: str = "ru", user_id: str = "anonymous",
+                        user_context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Answer the raw question; user_context only personalizes the (shared, cacheable) answer"""
+        from response_cache import response_cache
 
+        try:
             # Check if this is an image request first
             if self._is_image_request(message):
                 return self._handle_image_request(message, language, user_id)
 
-            # Import advanced components
-            from analytics_engine import analytics_engine
-            from personalization_engine import personalization_engine
-            from distributed_system import performance_optimizer
-
-            # Check performance optimization first
-            optimization_result = performance_optimizer.optimize_response_generation(
-                message, self.agent_type, language
+            # Single lookup in the tiered response cache; generated answers are stored by it
+            response_data, cached = response_cache.get_or_compute(
+                message, self.agent_type, language,
+                lambda: self._generate_response(message, language, user_id)
             )
+            if cached:
+                response_data = self._cached_result(message, language, user_id, response_data)
+            return self._personalize(response_data, user_id, user_context)
 
-            if optimization_result.get('cached'):
-                # Track cached interaction
-                interaction_data = {
-                    'user_id': user_id,
-                    'message': message,
-                    'agent_type': self.agent_type,
-                    'agent_name': self.name,
-                    'confidence': optimization_result['response'].get('confidence', 1.0),
-                    'response_time': optimization_result['optimization_time'],
-                    'cached': True,
-                    'context_used': True,
-                    'context_confidence': 1.0,
-                    'language': language
-                }
-                analytics_engine.track_interaction(interaction_data)
+        except Exception as e:
+            return self._error_response(message, e)
+
+    def _generate_response(self, message: str, language: str, user_id: str,
+                           track: bool = True) -> Dict[str, Any]:
+        """Context lookup, LLM call and bookkeeping for a cache miss"""
+        prepared = self._prepare_response(message, language, user_id, check_cache=False)
+        if 'result' in prepared:
+            return prepared['result']
+
+        # Use agent-specific system prompt for this message
+        response = self.mistral.get_response_with_system_prompt(
+            message, prepared['context'], language, prepared['system_prompt']
+        )
 
-                return {
-                    **optimization_result['response'],
-                    'cached': True,
-                    'optimization_time': optimization_result['optimization_time']
-                }
+        return self._finalize_response(message, language, user_id, response, prepared, store=False, track=track)
 
-            # Check if async processing is recommended
-            if optimization_result.get('async_processing'):
-                return {
-                    'response': optimization_result['message'],
-                    'confidence': 0.8,
-                    'agent_type': self.agent_type,
-                    'agent_name': self.name,
-                    'cached': False,
-                    'async_processing': True
-                }
+    def precompute_response(self, message: str, language: str = "ru") -> Tuple[Dict[str, Any], bool]:
+        """Warm the shared response cache with a popular question; returns (response, was_cached)
 
-            # Check cache first for performance
-            from response_cache import response_cache
+        Generated like a cache miss of process_message, without per-user
+        tracking, and flagged 'precomputed' so live hits can be attributed.
+        """
+        from response_cache import response_cache
 
-            cached_response = response_cache.get(message, self.agent_type, language)
-            if cached_response:
-                # Update user personalization
-                personalization_engine.update_user_interaction(user_id, {
-                    'message': message,
-                    'agent_type': self.agent_type,
-                    'confidence': cached_response.get('confidence', 1.0),
-                    'cached': True,
-                    'language': language
-                })
-
-                logger.info(f"Returning cached response for {self.name}")
-                return {
-                    **cached_response,
-                    'cached': True
-                }
+        if self._is_image_request(message):
+            return {'skipped': 'image_request'}, False
 
-            # Get agent-specific system prompt
-            system_prompt = self.get_system_prompt(language)
+        def compute():
+            result = self._generate_response(message, language, PRECOMPUTE_USER_ID, track=False)
+            return {**result, 'precomputed': True}
 
-            # Get agent-specific context from knowledge base with semantic search
-            context = self.get_agent_context(message, language)
+        return response_cache.get_or_compute(message, self.agent_type, language, compute)
 
-            # Calculate context confidence for overall response confidence
-            context_confidence = self._assess_context_confidence(context, message)
+    async def process_message_async(self, message: str, language: str = "ru", user_id: str = "anonymous",
+                                    user_context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """asyncio variant of process_message for the ASGI chat path
 
-            # Use agent-specific system prompt for this message
-            response = self.mistral.get_response_with_system_prompt(
-                message, context, language, system_prompt
-            )
+        Context lookup and bookkeeping run in worker threads; only the LLM call
+        is awaited on the event loop, so it holds no thread while waiting.
+        """
+        from app_context import run_in_app_context
+        from response_cache import response_cache
+
+        try:
+            prepared = await run_in_app_context(self._prepare_response, message, language, user_id)
+            if 'result' not in prepared:
+                async def compute():
+                    response = await self.async_mistral.get_response_with_system_prompt(
+                        message, prepared['context'], language, prepared['system_prompt']
+                    )
+                    return await run_in_app_context(self._finalize_response, message, language,
+                                                    user_id, response, prepared)
 
-            # Apply personalization to response
-            personalized_response = personalization_engine.adapt_response_style(user_id, response)
+                # Concurrent identical questions wait for one LLM call
+                result, shared = await response_cache.coalesce_async(message, self.agent_type, language, compute)
+                if shared:
+                    result = await run_in_app_context(self._cached_result, message, language, user_id, result)
+                prepared['result'] = result
 
-            # Calculate overall confidence based on agent matching and context quality
-            base_confidence = self.can_handle(message, language)
-            overall_confidence = self._calculate_overall_confidence(
-                base_confidence, context_confidence, bool(context)
-            )
+            return await run_in_app_context(self._personalize, prepared['result'], user_id, user_context)
+
+        except Exception as e:
+            return self._error_response(message, e)
 
-            # Calculate response time
-            response_time = time.time() - start_time
+    def stream_message(self, message: str, language: str = "ru", user_id: str = "anonymous",
+                       user_context: Optional[Dict[str, Any]] = None) -> Iterator[Tuple[str, Any]]:
+        """Streaming variant of process_message
 
-            response_data = {
-                'response': personalized_response,
-                'confidence': overall_confidence,
+        Yields ('delta', text) while the completion streams, then exactly one
+        ('done', response_data). Personalization, analytics and caching run
+        once the stream has completed; cached, image and async answers are
+        returned as a single 'done' event.
+        """
+        try:
+            prepared = self._prepare_response(message, language, user_id)
+            if 'result' in prepared:
+                yield 'done', self._personalize(prepared['result'], user_id, user_context)
+                return
+
+            parts = []
+            for delta in self.mistral.stream_response_with_system_prompt(
+                message, prepared['context'], language, prepared['system_prompt']
+            ):
+                parts.append(delta)
+                yield 'delta', delta
+
+            response = ''.join(parts).strip()
+            response_data = self._finalize_response(message, language, user_id, response, prepared)
+            yield 'done', self._personalize(response_data, user_id, user_context)
+
+        except Exception as e:
+            yield 'done', self._error_response(message, e)
+
+    def _prepare_response(self, message: str, language: str, user_id: str,
+                          check_cache: bool = True) -> Dict[str, Any]:
+        """Everything before the LLM call: a ready 'result' (cache, images) or the prompt and context"""
+        start_time = time.time()
+
+        # Check if this is an image request first
+        if self._is_image_request(message):
+            return {'result': self._handle_image_request(message, language, user_id)}
+
+        from distributed_system import performance_optimizer
+
+        # Check if async processing is recommended
+        optimization_result = performance_optimizer.optimize_response_generation(
+            message, self.agent_type, language
+        )
+        if optimization_result.get('async_processing'):
+            return {'result': {
+                'response': optimization_result['message'],
+                'confidence': 0.8,
                 'agent_type': self.agent_type,
                 'agent_name': self.name,
-                'context_used': bool(context),
-                'context_confidence': context_confidence,
                 'cached': False,
-                'response_time': response_time,
-                'user_id': user_id
-            }
+                'async_processing': True
+            }}
+
+        if check_cache:
+            from response_cache import response_cache
+
+            found = response_cache.lookup(message, self.agent_type, language)
+            if found is not None:
+                cached_response, match = found
+                return {'result': self._cached_result(message, language, user_id,
+                                                      {**cached_response, 'cache_match': match})}
+
+        # Get agent-specific system prompt
+        system_prompt = self.get_system_prompt(language)
+
+        # Get agent-specific context from knowledge base with semantic search
+        context = self.get_agent_context(message, language)
+
+        # Calculate context confidence for overall response confidence
+        context_confidence = self._assess_context_confidence(context, message)
+
+        return {
+            'start_time': start_time,
+            'system_prompt': system_prompt,
+            'context': context,
+            'context_confidence': context_confidence
+        }
+
+    def _cached_result(self, message: str, language: str, user_id: str,
+                       cached_response: Dict[str, Any]) -> Dict[str, Any]:
+        """Bookkeeping for a response served from the cache"""
+        from analytics_engine import analytics_engine
+        from personalization_engine import personalization_engine
+
+        if cached_response.get('precomputed'):
+            from distributed_system import performance_optimizer
+            performance_optimizer.record_precomputed_hit(self.agent_type, language)
+
+        # Update user personalization
+        personalization_engine.update_user_interaction(user_id, {
+            'message': message,
+            'agent_type': self.agent_type,
+            'confidence': cached_response.get('confidence', 1.0),
+            'cached': True,
+            'language': language
+        })
+
+        # Track cached interaction
+        analytics_engine.track_interaction({
+            'user_id': user_id,
+            'message': message,
+            'agent_type': self.agent_type,
+            'agent_name': self.name,
+            'confidence': cached_response.get('confidence', 1.0),
+            'response_time': 0.0,
+            'cached': True,
+            'context_used': cached_response.get('context_used', True),
+            'context_confidence': cached_response.get('context_confidence', 1.0),
+            'language': language
+        })
+
+        logger.info(f"Returning cached response for {self.name}")
+        return {
+            **cached_response,
+            'cached': True
+        }
+
+    def _personalize(self, response_data: Dict[str, Any], user_id: str,
+                     user_context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Per-user post-processing of a fresh or cached answer; the cached copy stays shared"""
+        if response_data.get('error') or response_data.get('special_response'):
+            return response_data
+        try:
+            from personalization_engine import personalization_engine
+            from user_memory import UserMemoryManager
+
+            text = personalization_engine.adapt_response_style(user_id, response_data['response'])
+            text = UserMemoryManager.personalize_response(text, user_context)
+            personalized = {**response_data, 'response': text, 'user_id': user_id}
 
             # Generate proactive suggestions
-            suggestions = personalization_engine.generate_proactive_suggestions(user_id, context)
+            suggestions = personalization_engine.generate_proactive_suggestions(user_id, response_data['response'])
             if suggestions:
-                response_data['suggestions'] = suggestions
+                personalized['suggestions'] = suggestions
+            return personalized
+        except Exception as e:
+            logger.warning(f"Personalization skipped: {e}")
+            return response_data
+
+    def _finalize_response(self, message: str, language: str, user_id: str, response: str,
+                           prepared: Dict[str, Any], store: bool = True, track: bool = True) -> Dict[str, Any]:
+        """Score, track and (unless the caller caches it) store a generated response"""
+        from analytics_engine import analytics_engine
+        from personalization_engine import personalization_engine
+        from response_cache import response_cache
+
+        context = prepared['context']
+        context_confidence = prepared['context_confidence']
 
+        # Calculate overall confidence based on agent matching and context quality
+        base_confidence = self.can_handle(message, language)
+        overall_confidence = self._calculate_overall_confidence(
+            base_confidence, context_confidence, bool(context)
+        )
+
+        # Calculate response time
+        response_time = time.time() - prepared['start_time']
+
+        # Stored unpersonalized: personalization is applied per user by _personalize()
+        response_data = {
+            'response': response,
+            'confidence': overall_confidence,
+            'agent_type': self.agent_type,
+            'agent_name': self.name,
+            'context_used': bool(context),
+            'context_confidence': context_confidence,
+            'cached': False,
+            'response_time': response_time
+        }
+
+        if track:
             # Update user personalization
             personalization_engine.update_user_interaction(user_id, {
                 'message': message,
@@ -170,38 +335,38 @@ class BaseAgent(ABC):
                 'language': language
             })
 
-            # Cache successful responses
-            if response_cache.should_cache(message, response_data):
-                response_cache.set(message, self.agent_type, response_data, language)
+        # Cache successful responses
+        if store and response_cache.should_cache(message, response_data):
+            response_cache.set(message, self.agent_type, response_data, language)
 
-            return response_data
+        return response_data
 
-        except Exception as e:
-            logger.error(f"Error in {self.name} agent: {str(e)}")
-
-            # Track error
-            try:
-                from analytics_engine import analytics_engine
-                analytics_engine.track_error({
-                    'error_type': 'agent_processing_error',
-                    'agent_type': self.agent_type,
-                    'message': message,
-                    'error_details': str(e),
-                    'user_impact': 'response_fallback'
-                })
-            except:
-                pass  # Don't let analytics errors break the response
+    def _error_response(self, message: str, error: Exception) -> Dict[str, Any]:
+        logger.error(f"Error in {self.name} agent: {str(error)}")
 
-            return {
-                'response': f"Извините, возникла ошибка при обработке запроса по теме '{self.description}'.",
-                'confidence': 0.1,
+        # Track error
+        try:
+            from analytics_engine import analytics_engine
+            analytics_engine.track_error({
+                'error_type': 'agent_processing_error',
                 'agent_type': self.agent_type,
-                'agent_name': self.name,
-                'context_used': False,
-                'context_confidence': 0.0,
-                'cached': False,
-                'error': True
-            }
+                'message': message,
+                'error_details': str(error),
+                'user_impact': 'response_fallback'
+            })
+        except:
+            pass  # Don't let analytics errors break the response
+
+        return {
+            'response': f"Извините, возникла ошибка при обработке запроса по теме '{self.description}'.",
+            'confidence': 0.1,
+            'agent_type': self.agent_type,
+            'agent_name': self.name,
+            'context_used': False,
+            'context_confidence': 0.0,
+            'cached': False,
+            'error': True
+        }
 
     def _assess_context_confidence(self, context: str, message: str) -> float:
         """Assess confidence in the retrieved context"""
@@ -257,23 +422,16 @@ class BaseAgent(ABC):
         try:
             # Import models with error handling
             try:
-                from models import AgentKnowledgeBase
-                from app import db
                 from knowledge_search import knowledge_search_engine
                 from semantic_search import semantic_search_engine
             except ImportError as ie:
                 logger.warning(f"Could not import required modules: {ie}")
                 return self._get_fallback_context(message, language)
 
-            # Search for relevant knowledge entries for this agent
+            # Search for relevant knowledge entries for this agent (in-process snapshot)
             try:
-                from app import create_app
-                app = create_app()
-                with app.app_context():
-                    knowledge_entries = AgentKnowledgeBase.query.filter_by(
-                        agent_type=self.agent_type,
-                        is_active=True
-                    ).order_by(AgentKnowledgeBase.priority.asc()).all()
+                from knowledge_snapshot import knowledge_snapshot
+                knowledge_entries = knowledge_snapshot.get_entries(self.agent_type, language)
             except Exception as db_error:
                 logger.warning(f"Database query failed: {db_error}")
                 return self._get_fallback_context(message, language)
@@ -289,10 +447,14 @@ class BaseAgent(ABC):
                     knowledge_entries=knowledge_entries,
                     language=language,
                     max_results=3,
-                    semantic_threshold=0.2
+                    semantic_threshold=0.2,
+                    corpus_key=knowledge_snapshot.corpus_key(self.agent_type, language)
                 )
 
-                if semantic_results:
+                # Dense nearest neighbours fill in entries without shared concepts
+                dense_results = self._dense_knowledge_results(message, language, knowledge_entries)
+
+                if semantic_results or dense_results:
                     # Format semantic search results
                     context_parts = []
                     for result in semantic_results:
@@ -302,8 +464,18 @@ class BaseAgent(ABC):
 
                         context_parts.append(f"**{title}** (семантическая релевантность: {semantic_score:.2f})\n{content}")
 
+                    seen_ids = {result['entry'].id for result in semantic_results}
+                    for entry, similarity in dense_results:
+                        if len(context_parts) >= 3:
+                            break
+                        if entry.id in seen_ids:
+                            continue
+                        content = entry.content_ru if language == 'ru' else entry.content_kz
+                        context_parts.append(f"**{entry.title}** (векторная релевантность: {similarity:.2f})\n{content}")
+
                     semantic_context = "\n\n".join(context_parts)
-                    logger.info(f"Semantic search found {len(semantic_results)} relevant entries for '{message[:50]}...'")
+                    logger.info(f"Semantic search found {len(semantic_results)} relevant entries "
+                                f"({len(dense_results)} dense) for '{message[:50]}...'")
                     return semantic_context
 
             except Exception as semantic_error:
@@ -316,7 +488,8 @@ class BaseAgent(ABC):
                         knowledge_entries=knowledge_entries,
                         language=language,
                         max_results=3,
-                        min_score=0.1
+                        min_score=0.1,
+                        index_key=(self.agent_type, language)
                     )
 
                     # If enhanced search finds relevant results, use them
@@ -349,6 +522,20 @@ class BaseAgent(ABC):
             logger.error(f"Error getting agent context for {self.agent_type}: {str(e)}")
             return self._get_fallback_context(message, language)
 
+    def _dense_knowledge_results(self, message: str, language: str, knowledge_entries: List,
+                                 limit: int = 3, min_similarity: float = 0.25) -> List[Tuple[Any, float]]:
+        """Approximate nearest entries from the shared on-disk vector store"""
+        try:
+            from vector_store import vector_store, agent_group
+            hits = vector_store.search(agent_group(self.agent_type, language), message, top_k=limit)
+        except Exception as e:
+            logger.warning(f"Vector search failed: {e}")
+            return []
+
+        entries_by_id = {str(entry.id): entry for entry in knowledge_entries}
+        return [(entries_by_id[key], similarity) for key, similarity in hits
+                if similarity >= min_similarity and key in entries_by_id]
+
     def _get_fallback_context(self, message: str, language: str = "ru") -> str:
         """Provide fallback context when knowledge base is unavailable"""
         # This method should be implemented by each agent to provide basic context
@@ -363,33 +550,40 @@ class AIAbiturAgent(BaseAgent):
             "Цифровой помощник для абитуриентов (поступающих в вуз)"
         )
 
-    def can_handle(self, message: str, language: str = "ru") -> float:
-        keywords = [
+    keyword_groups = {
+        'keywords': [
             "поступление", "абитуриент", "документы", "экзамен", "приём", "требования", 
             "специальности", "факультет", "вступительный", "конкурс", "балл", 
             "подача документов", "зачисление", "направление", "изображения", "фото", 
             "картинки", "снимки", "видео", "видеоролик", "альбом", "макет", "здание"
-        ]
-        message_lower = message.lower()
-        matches = sum(1 for k in keywords if k in message_lower)
-
+        ],
         # Специальные фразы для поступления
-        admission_phrases = [
+        'admission_phrases': [
             "как поступить", "документы для поступления", "вступительные экзамены",
             "требования к поступающим", "специальности университета"
-        ]
-        
+        ],
         # Специальные фразы для изображений
-        image_phrases = [
+        'image_phrases': [
             "покажи изображения", "покажи фото", "покажи картинки", "покажи видео",
             "изображения вуза", "фото университета", "как выглядит университет",
             "покажи здание", "покажи макет", "покажи альбом", "покажи видеоролик"
+        ],
+        'image_keywords': [
+            "покажи изображения", "покажи фото", "покажи картинки", "покажи видео",
+            "изображения вуза", "фото университета", "как выглядит университет",
+            "покажи здание", "покажи макет", "покажи альбом", "покажи видеоролик",
+            "фотографии", "картинки", "снимки", "видео", "видеоролик", "альбом", "макет"
         ]
+    }
+
+    def can_handle(self, message: str, language: str = "ru") -> float:
+        scan = self._scan(message)
+        matches = scan.count(self._group('keywords'))
 
-        if any(phrase in message_lower for phrase in admission_phrases):
+        if scan.has(self._group('admission_phrases')):
             return 1.0
             
-        if any(phrase in message_lower for phrase in image_phrases):
+        if scan.has(self._group('image_phrases')):
             return 1.0
 
         return min(1.0, matches * 0.4) if matches > 0 else 0.1
@@ -506,14 +700,7 @@ Your responses should be specific, helpful and supportive. Use Markdown format.
 
     def _is_image_request(self, message: str) -> bool:
         """Check if the message is requesting images"""
-        message_lower = message.lower()
-        image_keywords = [
-            "покажи изображения", "покажи фото", "покажи картинки", "покажи видео",
-            "изображения вуза", "фото университета", "как выглядит университет",
-            "покажи здание", "покажи макет", "покажи альбом", "покажи видеоролик",
-            "фотографии", "картинки", "снимки", "видео", "видеоролик", "альбом", "макет"
-        ]
-        return any(keyword in message_lower for keyword in image_keywords)
+        return self._scan(message).has(self._group('image_keywords'))
 
     def _handle_image_request(self, message: str, language: str, user_id: str) -> Dict[str, Any]:
         """Handle requests for university images"""
@@ -637,28 +824,30 @@ class KadrAIAgent(BaseAgent):
             "Интеллектуальный помощник для поддержки сотрудников и преподавателей в вопросах внутренних кадровых процедур"
         )
 
-    def can_handle(self, message: str, language: str = "ru") -> float:
-        keywords = [
+    keyword_groups = {
+        'keywords': [
             "кадры", "отпуск", "перевод", "приказ", "сотрудник", "преподаватель", 
             "отдел кадров", "трудовой", "зарплата", "кадровые", "увольнение",
             "назначение", "должность", "ставка", "контракт", "трудовая книжка"
-        ]
-        message_lower = message.lower()
-        matches = sum(1 for k in keywords if k in message_lower)
-
+        ],
         # Специальные фразы для кадровых вопросов
-        hr_phrases = [
+        'hr_phrases': [
             "оформить отпуск", "кадровые процедуры", "вопросы по зарплате",
             "трудовой договор", "отдел кадров"
-        ]
+        ],
+        'staff_indicators': ["работаю", "сотрудник", "преподаватель", "коллега"]
+    }
+
+    def can_handle(self, message: str, language: str = "ru") -> float:
+        scan = self._scan(message)
+        matches = scan.count(self._group('keywords'))
 
         # Проверяем, что это сотрудник/преподаватель, а не студент
-        staff_indicators = ["работаю", "сотрудник", "преподаватель", "коллега"]
-        is_staff = any(indicator in message_lower for indicator in staff_indicators)
+        is_staff = scan.has(self._group('staff_indicators'))
 
-        if any(phrase in message_lower for phrase in hr_phrases) and is_staff:
+        if scan.has(self._group('hr_phrases')) and is_staff:
             return 1.0
-        elif any(phrase in message_lower for phrase in hr_phrases):
+        elif scan.has(self._group('hr_phrases')):
             return 0.8
 
         return min(1.0, matches * 0.4) if matches > 0 else 0.1
@@ -775,34 +964,35 @@ class UniNavAgent(BaseAgent):
             "Интерактивный чат-ассистент, обеспечивающий полное сопровождение обучающегося по всем университетским процессам"
         )
 
-    def can_handle(self, message: str, language: str = "ru") -> float:
-        keywords = [
+    keyword_groups = {
+        'keywords': [
             "расписание", "учёб", "занятие", "заявление", "обращение", "деканат", 
             "академический", "экзамен", "зачёт", "вопросы", "система", "поддержк", 
             "студент", "навигация", "процесс", "университет", "лекция", "семинар",
             "практика", "дисциплина", "предмет", "оценка", "пересдача", "справка",
             "восстановление", "перевод", "сессия", "курс", "группа", "семестр"
-        ]
-        message_lower = message.lower()
-        matches = sum(1 for k in keywords if k in message_lower)
-
+        ],
         # Специальные фразы для UniNav (убираем слова о работе)
-        special_phrases = [
+        'special_phrases': [
             "система поддержки студентов", "как работает система поддержки", 
             "университетские процессы", "студенческие вопросы", "навигация по учебе",
             "обучающий процесс", "академические вопросы"
-        ]
-
+        ],
         # Исключаем вопросы о работе/карьере - они должны идти к CareerNavigator
-        work_exclusions = [
+        'work_exclusions': [
             "расскажи о работе", "как найти работу", "где работать", 
             "работа для выпускников", "трудоустройство", "карьерные возможности"
         ]
+    }
+
+    def can_handle(self, message: str, language: str = "ru") -> float:
+        scan = self._scan(message)
+        matches = scan.count(self._group('keywords'))
 
-        if any(exclusion in message_lower for exclusion in work_exclusions):
+        if scan.has(self._group('work_exclusions')):
             return 0.1  # Низкий приоритет для вопросов о работе
 
-        if any(phrase in message_lower for phrase in special_phrases):
+        if scan.has(self._group('special_phrases')):
             return 1.0
 
         return min(1.0, matches * 0.3) if matches > 0 else 0.1
@@ -922,24 +1112,26 @@ class CareerNavigatorAgent(BaseAgent):
             "Интеллектуальный чат-бот для содействия трудоустройству студентов и выпускников"
         )
 
-    def can_handle(self, message: str, language: str = "ru") -> float:
-        keywords = [
+    keyword_groups = {
+        'keywords': [
             "работ", "трудоустройств", "ваканс", "резюме", "карьер", "выпускник", 
             "стажировк", "работодател", "собеседован", "поиск работы", "профессия",
             "навыки", "опыт", "практика", "internship", "cv", "interview", "job",
             "employment", "career"
-        ]
-        message_lower = message.lower()
-        matches = sum(1 for k in keywords if k in message_lower)
-
+        ],
         # Специальные фразы для вопросов о работе
-        work_phrases = [
+        'work_phrases': [
             "расскажи о работе", "как найти работу", "где работать", 
             "работа для выпускников", "трудоустройство", "карьерные возможности",
             "рынок труда", "вакансии"
         ]
+    }
+
+    def can_handle(self, message: str, language: str = "ru") -> float:
+        scan = self._scan(message)
+        matches = scan.count(self._group('keywords'))
 
-        if any(phrase in message_lower for phrase in work_phrases):
+        if scan.has(self._group('work_phrases')):
             return 1.0
 
         return min(1.0, matches * 0.4) if matches > 0 else 0.1
@@ -1059,23 +1251,25 @@ class UniRoomAgent(BaseAgent):
             "Цифровой помощник для студентов, проживающих в общежитии"
         )
 
-    def can_handle(self, message: str, language: str = "ru") -> float:
-        keywords = [
+    keyword_groups = {
+        'keywords': [
             "общежитие", "заселение", "переселение", "бытов", "администрация", 
             "комната", "жилищ", "проживан", "проблем", "общага", "соседи",
             "мебель", "интернет", "питание", "охрана", "пропуск", "посетители",
             "коммунальные", "ремонт"
-        ]
-        message_lower = message.lower()
-        matches = sum(1 for k in keywords if k in message_lower)
-
+        ],
         # Специальные фразы для общежития
-        dorm_phrases = [
+        'dorm_phrases': [
             "проблемы в общежитии", "заселиться в общежитие", "переселение",
             "бытовые вопросы", "администрация общежития", "живу в общежитии"
         ]
+    }
 
-        if any(phrase in message_lower for phrase in dorm_phrases):
+    def can_handle(self, message: str, language: str = "ru") -> float:
+        scan = self._scan(message)
+        matches = scan.count(self._group('keywords'))
+
+        if scan.has(self._group('dorm_phrases')):
             return 1.0
 
         return min(1.0, matches * 0.4) if matches > 0 else 0.1
@@ -1189,7 +1383,6 @@ Your responses should show empathy and understanding. Use Markdown format.
 
 class AgentRouter:
     def __init__(self):
-        # Each agent now creates its own MistralClient instance
         self.agents = [
             AIAbiturAgent(),
             KadrAIAgent(),
@@ -1199,129 +1392,173 @@ class AgentRouter:
         ]
         logger.info(f"AgentRouter initialized with {len(self.agents)} agents")
 
-    def route_message(self, message: str, language: str = "ru", user_id: str = "anonymous") -> Dict[str, Any]:
-        """Enhanced agent routing with self-learning ML system"""
+    def route_message(self, message: str, language: str = "ru", user_id: str = "anonymous",
+                      user_context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Enhanced agent routing with self-learning ML system (routes on the raw question)"""
         try:
-            # Try ML Router first (self-learning system)
-            from ml_router import ml_router
+            agent, routing = self.select_agent(message, language, user_id)
+            if agent is None:
+                return self._no_agent_response()
 
-            # Get ML prediction
-            ml_agent, ml_confidence, ml_explanation = ml_router.predict_best_agent(message, user_id)
+            result = agent.process_message(message, language, user_id, user_context)
+            return self._apply_routing(result, routing, message, user_id)
 
-            # If ML is confident enough, use it
-            if ml_confidence >= 0.6:
-                logger.info(f"ML Router selected {ml_agent} with confidence {ml_confidence:.3f}")
+        except Exception as e:
+            logger.error(f"Error in enhanced routing: {e}")
+            import traceback
+            logger.debug(f"Full traceback: {traceback.format_exc()}")
+            # Fallback to traditional routing
+            return self._traditional_routing(message, language, user_id, user_context)
 
-                # Find the agent instance
-                selected_agent = None
-                for agent in self.agents:
-                    if agent.agent_type == ml_agent or agent.name.lower().replace('-', '_') == ml_agent.lower():
-                        selected_agent = agent
-                        break
+    async def route_message_async(self, message: str, language: str = "ru", user_id: str = "anonymous",
+                                  user_context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """asyncio variant of route_message (agent selection runs in a worker thread)"""
+        from app_context import run_in_app_context
 
-                if selected_agent:
-                    # Generate response using the selected agent
-                    response = selected_agent.process_message(message, language, user_id)
+        try:
+            agent, routing = await run_in_app_context(self.select_agent, message, language, user_id)
+        except Exception as e:
+            logger.error(f"Error in enhanced routing: {e}")
+            agent, routing = self._select_traditional(message, language)
 
-                    # Record this interaction for learning
-                    session_id = f"session_{user_id}_{int(datetime.now().timestamp())}"
-                    ml_router.record_interaction(message, ml_agent, user_id, session_id)
+        if agent is None:
+            return self._no_agent_response()
 
-                    response['routing_method'] = 'ml_self_learning'
-                    response['ml_confidence'] = ml_confidence
-                    response['ml_explanation'] = ml_explanation
+        result = await agent.process_message_async(message, language, user_id, user_context)
+        return await run_in_app_context(self._apply_routing, result, routing, message, user_id)
 
-                    return response
-                else:
-                    logger.warning(f"ML Router selected unknown agent: {ml_agent}")
+    def stream_message(self, message: str, language: str = "ru", user_id: str = "anonymous",
+                       user_context: Optional[Dict[str, Any]] = None) -> Iterator[Tuple[str, Any]]:
+        """Streaming routing: ('agent', info), then the agent's ('delta', text) events and ('done', result)"""
+        try:
+            agent, routing = self.select_agent(message, language, user_id)
+        except Exception as e:
+            logger.error(f"Error in enhanced routing: {e}")
+            agent, routing = self._select_traditional(message, language)
 
-            # Fallback to original ML system
-            from intent_classifier import intent_classifier
-            from personalization_engine import personalization_engine
-            from analytics_engine import analytics_engine
-            from datetime import datetime
+        if agent is None:
+            yield 'done', self._no_agent_response()
+            return
 
-            # Get personalized agent recommendation
-            recommendation_result = personalization_engine.get_agent_recommendation(
-                user_id, message, [agent.agent_type for agent in self.agents]
-            )
-            recommended_agent, recommendation_confidence = recommendation_result if recommendation_result else (None, 0.0)
-
-            # Use ML-based intent classification
-            agent_scores = intent_classifier.classify_intent(message, language)
-
-            # If we have a strong personal recommendation, boost its score
-            if recommended_agent and recommended_agent in agent_scores:
-                original_score = agent_scores[recommended_agent]
-                boosted_score = min(1.0, original_score + recommendation_confidence * 0.2)
-                agent_scores[recommended_agent] = boosted_score
-                logger.info(f"Boosted {recommended_agent} score from {original_score:.3f} to {boosted_score:.3f} based on user preference")
-
-            # Find best agent
-            if agent_scores:
-                best_agent_type = max(agent_scores, key=agent_scores.get)
-                confidence = agent_scores[best_agent_type]
-
-                logger.debug(f"ML classification result: {best_agent_type} with confidence {confidence:.3f}")
-                logger.debug(f"All scores: {agent_scores}")
-
-                # Find the agent instance with improved search
-                best_agent = None
-                available_agent_types = []
-
-                for agent in self.agents:
-                    available_agent_types.append(agent.agent_type)
-                    if agent.agent_type == best_agent_type:
-                        best_agent = agent
-                        break
-
-                # Debug logging
-                logger.debug(f"Available agent types: {available_agent_types}")
-                logger.debug(f"Looking for agent type: {best_agent_type}")
-                logger.debug(f"Agent found: {best_agent is not None}")
-
-                # Check both agent existence and confidence threshold
-                if best_agent is None:
-                    logger.warning(f"Agent type '{best_agent_type}' not found in available agents: {available_agent_types}")
-                elif confidence <= 0.15:
-                    logger.warning(f"Confidence {confidence:.3f} below threshold 0.15 for agent {best_agent_type}")
-                else:
-                    # Success - process with ML routing
-                    logger.info(f"ML router selected {best_agent.name} with confidence {confidence:.3f}")
-
-                    try:
-                        result = best_agent.process_message(message, language, user_id)
-
-                        # Add routing information to result
-                        result['routing_info'] = {
-                            'method': 'ml',
-                            'ml_scores': agent_scores,
-                            'selected_agent': best_agent_type,
-                            'selection_confidence': confidence,
-                            'recommended_agent': recommended_agent,
-                            'recommendation_confidence': recommendation_confidence
-                        }
-
-                        return result
-                    except Exception as processing_error:
-                        logger.error(f"Error processing message with {best_agent_type}: {processing_error}")
-                        # Continue to fallback
+        yield 'agent', {'agent_type': agent.agent_type, 'agent_name': agent.name}
+        for kind, payload in agent.stream_message(message, language, user_id, user_context):
+            if kind == 'done':
+                payload = self._apply_routing(payload, routing, message, user_id)
+            yield kind, payload
+
+    def select_agent(self, message: str, language: str = "ru",
+                     user_id: str = "anonymous") -> Tuple[Optional[BaseAgent], Dict[str, Any]]:
+        """Pick the agent for a message; returns (agent, routing metadata for its result)"""
+        # Try ML Router first (self-learning system)
+        from ml_router import ml_router
+
+        # Get ML prediction
+        ml_agent, ml_confidence, ml_explanation = ml_router.predict_best_agent(message, user_id)
+
+        # If ML is confident enough, use it
+        if ml_confidence >= 0.6:
+            logger.info(f"ML Router selected {ml_agent} with confidence {ml_confidence:.3f}")
+
+            # Find the agent instance
+            for agent in self.agents:
+                if agent.agent_type == ml_agent or agent.name.lower().replace('-', '_') == ml_agent.lower():
+                    return agent, {
+                        'routing_method': 'ml_self_learning',
+                        'ml_agent': ml_agent,
+                        'ml_confidence': ml_confidence,
+                        'ml_explanation': ml_explanation
+                    }
+
+            logger.warning(f"ML Router selected unknown agent: {ml_agent}")
+
+        # Fallback to original ML system
+        from intent_classifier import intent_classifier
+        from personalization_engine import personalization_engine
+
+        # Get personalized agent recommendation
+        recommendation_result = personalization_engine.get_agent_recommendation(
+            user_id, message, [agent.agent_type for agent in self.agents]
+        )
+        recommended_agent, recommendation_confidence = recommendation_result if recommendation_result else (None, 0.0)
+
+        # Use ML-based intent classification
+        agent_scores = intent_classifier.classify_intent(message, language)
+
+        # If we have a strong personal recommendation, boost its score
+        if recommended_agent and recommended_agent in agent_scores:
+            original_score = agent_scores[recommended_agent]
+            boosted_score = min(1.0, original_score + recommendation_confidence * 0.2)
+            agent_scores[recommended_agent] = boosted_score
+            logger.info(f"Boosted {recommended_agent} score from {original_score:.3f} to {boosted_score:.3f} based on user preference")
+
+        # Find best agent
+        if agent_scores:
+            best_agent_type = max(agent_scores, key=agent_scores.get)
+            confidence = agent_scores[best_agent_type]
+
+            logger.debug(f"ML classification result: {best_agent_type} with confidence {confidence:.3f}")
+            logger.debug(f"All scores: {agent_scores}")
+
+            # Find the agent instance with improved search
+            best_agent = None
+            available_agent_types = []
+
+            for agent in self.agents:
+                available_agent_types.append(agent.agent_type)
+                if agent.agent_type == best_agent_type:
+                    best_agent = agent
+                    break
+
+            # Debug logging
+            logger.debug(f"Available agent types: {available_agent_types}")
+            logger.debug(f"Looking for agent type: {best_agent_type}")
+            logger.debug(f"Agent found: {best_agent is not None}")
+
+            # Check both agent existence and confidence threshold
+            if best_agent is None:
+                logger.warning(f"Agent type '{best_agent_type}' not found in available agents: {available_agent_types}")
+            elif confidence <= 0.15:
+                logger.warning(f"Confidence {confidence:.3f} below threshold 0.15 for agent {best_agent_type}")
             else:
-                logger.warning("ML classifier returned empty agent_scores")
+                # Success - process with ML routing
+                logger.info(f"ML router selected {best_agent.name} with confidence {confidence:.3f}")
+                return best_agent, {
+                    'routing_info': {
+                        'method': 'ml',
+                        'ml_scores': agent_scores,
+                        'selected_agent': best_agent_type,
+                        'selection_confidence': confidence,
+                        'recommended_agent': recommended_agent,
+                        'recommendation_confidence': recommendation_confidence
+                    }
+                }
+        else:
+            logger.warning("ML classifier returned empty agent_scores")
 
-            # Fallback to traditional routing if ML fails
-            logger.info("Using traditional routing as fallback")
-            return self._traditional_routing(message, language, user_id)
+        # Fallback to traditional routing if ML fails
+        logger.info("Using traditional routing as fallback")
+        return self._select_traditional(message, language)
 
-        except Exception as e:
-            logger.error(f"Error in enhanced routing: {e}")
-            import traceback
-            logger.debug(f"Full traceback: {traceback.format_exc()}")
-            # Fallback to traditional routing
-            return self._traditional_routing(message, language, user_id)
+    def _apply_routing(self, result: Dict[str, Any], routing: Dict[str, Any],
+                       message: str, user_id: str) -> Dict[str, Any]:
+        """Attach routing metadata to an agent result (and record ML router interactions)"""
+        if routing.get('routing_method') == 'ml_self_learning':
+            from datetime import datetime
+            from ml_router import ml_router
 
-    def _traditional_routing(self, message: str, language: str = "ru", user_id: str = "anonymous") -> Dict[str, Any]:
-        """Traditional keyword-based routing as fallback"""
+            # Record this interaction for learning
+            session_id = f"session_{user_id}_{int(datetime.now().timestamp())}"
+            ml_router.record_interaction(message, routing['ml_agent'], user_id, session_id)
+
+            result['routing_method'] = 'ml_self_learning'
+            result['ml_confidence'] = routing['ml_confidence']
+            result['ml_explanation'] = routing['ml_explanation']
+        elif 'routing_info' in routing:
+            result['routing_info'] = routing['routing_info']
+        return result
+
+    def _select_traditional(self, message: str, language: str = "ru") -> Tuple[Optional[BaseAgent], Dict[str, Any]]:
+        """Traditional keyword-based agent selection"""
         best_conf = 0
         best_agent = None
 
@@ -1331,27 +1568,40 @@ class AgentRouter:
                 best_conf = conf
                 best_agent = agent
 
-        if best_agent:
-            logger.info(f"Traditional router selected {best_agent.name} with confidence {best_conf:.3f}")
-            result = best_agent.process_message(message, language, user_id)
-            result['routing_info'] = {
+        if best_agent is None:
+            return None, {}
+
+        logger.info(f"Traditional router selected {best_agent.name} with confidence {best_conf:.3f}")
+        return best_agent, {
+            'routing_info': {
                 'method': 'traditional',
                 'selected_agent': best_agent.agent_type,
                 'selection_confidence': best_conf
             }
-            return result
-        else:
-            # No agent can handle, return general error
-            return {
-                'response': "Извините, я не смог определить подходящего специалиста для вашего вопроса. Обратитесь в общую информационную службу университета.",
-                'confidence': 0.1,
-                'agent_type': 'none',
-                'agent_name': 'Router',
-                'context_used': False,
-                'context_confidence': 0.0,
-                'cached': False,
-                'routing_error': True
-            }
+        }
+
+    def _traditional_routing(self, message: str, language: str = "ru", user_id: str = "anonymous",
+                             user_context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Traditional keyword-based routing as fallback"""
+        best_agent, routing = self._select_traditional(message, language)
+        if best_agent is None:
+            return self._no_agent_response()
+
+        result = best_agent.process_message(message, language, user_id, user_context)
+        return self._apply_routing(result, routing, message, user_id)
+
+    def _no_agent_response(self) -> Dict[str, Any]:
+        # No agent can handle, return general error
+        return {
+            'response': "Извините, я не смог определить подходящего специалиста для вашего вопроса. Обратитесь в общую информационную службу университета.",
+            'confidence': 0.1,
+            'agent_type': 'none',
+            'agent_name': 'Router',
+            'context_used': False,
+            'context_confidence': 0.0,
+            'cached': False,
+            'routing_error': True
+        }
 
     def provide_feedback(self, user_id: str, message: str, agent_type: str, 
                         user_rating: float, feedback_text: str = ""):
@@ -1394,23 +1644,26 @@ class AgentRouter:
             # Get overall performance metrics
             performance_metrics = analytics_engine.get_performance_metrics(time_window_hours=24)
 
-            # Get agent usage distribution
+            # Get agent usage distribution (one pass over the rollups for all agents)
+            metrics_by_agent = analytics_engine.get_metrics_by_agent(time_window_hours=24)
             agent_usage = {}
             for agent in self.agents:
-                agent_metrics = analytics_engine.get_performance_metrics(
-                    agent_type=agent.agent_type, 
-                    time_window_hours=24
-                )
+                agent_metrics = metrics_by_agent.get(agent.agent_type, {})
                 agent_usage[agent.agent_type] = {
                     'name': agent.name,
                     'interactions': agent_metrics.get('total_interactions', 0),
                     'avg_confidence': agent_metrics.get('performance', {}).get('avg_confidence', 0)
                 }
 
+            # Whole-server counters (the metrics above describe this worker only)
+            from worker_metrics import worker_metrics
+            server_totals = worker_metrics.totals('bolashak_chat_')
+
             return {
                 'ml_classifier_stats': ml_stats,
                 'overall_performance': performance_metrics,
                 'agent_usage': agent_usage,
+                'server_totals': server_totals,
                 'total_agents': len(self.agents)
             }
 
@@ -4,30 +4,41 @@ Analytics and Learning System
 
 This module provides comprehensive analytics, A/B testing capabilities,
 and learning mechanisms for the AI agent system.
+
+Metrics are answered from per-minute / per-hour rollups (analytics_rollups);
+raw interactions and per-agent samples are kept in fixed-size ring buffers.
 """
 
 import logging
 import json
 import time
 from typing import Dict, List, Optional, Any
-from collections import defaultdict, Counter
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
 import random
 import statistics
 
+from analytics_rollups import AnalyticsRollups, combine, distributions
+from worker_metrics import MetricFamily, worker_metrics
+from write_behind import write_behind
+
 logger = logging.getLogger(__name__)
 
 
 class AnalyticsEngine:
     """Comprehensive analytics and learning system"""
     
+    HISTORY_SIZE = 10000  # recent raw interactions
+    SAMPLES_PER_KEY = 1000  # recent samples per agent / error type
+    
     def __init__(self):
-        # Core metrics storage
-        self.interaction_history = []
-        self.agent_performance = defaultdict(list)
-        self.user_satisfaction = defaultdict(list)
-        self.response_times = defaultdict(list)
-        self.error_tracking = defaultdict(list)
+        # Core metrics storage: fixed-size rings, aggregates live in the rollups
+        self.interaction_history = deque(maxlen=self.HISTORY_SIZE)
+        self.agent_performance = defaultdict(lambda: deque(maxlen=self.SAMPLES_PER_KEY))
+        self.user_satisfaction = defaultdict(lambda: deque(maxlen=self.SAMPLES_PER_KEY))
+        self.response_times = defaultdict(lambda: deque(maxlen=self.SAMPLES_PER_KEY))
+        self.error_tracking = defaultdict(lambda: deque(maxlen=self.SAMPLES_PER_KEY))
+        self.rollups = AnalyticsRollups()
         
         # A/B testing framework
         self.ab_tests = {}
@@ -46,10 +57,20 @@ class AnalyticsEngine:
         }
         
     def track_interaction(self, interaction_data: Dict[str, Any]):
-        """Track user interaction with comprehensive metrics"""
+        """Track user interaction with comprehensive metrics (applied by the write-behind flusher)"""
+        write_behind.submit('analytics', {**interaction_data, 'timestamp': time.time()})
+    
+    def _record_interactions(self, events: List[Dict[str, Any]]):
+        """Apply a batch of tracked interactions in arrival order"""
+        for interaction_data in events:
+            self._record_interaction(interaction_data)
+        logger.debug(f"Tracked {len(events)} interactions")
+    
+    def _record_interaction(self, interaction_data: Dict[str, Any]):
+        timestamp = interaction_data.get('timestamp') or time.time()
         interaction = {
-            'timestamp': time.time(),
-            'datetime': datetime.now().isoformat(),
+            'timestamp': timestamp,
+            'datetime': datetime.fromtimestamp(timestamp).isoformat(),
             'user_id': interaction_data.get('user_id', 'anonymous'),
             'message': interaction_data.get('message', ''),
             'agent_type': interaction_data.get('agent_type'),
@@ -67,6 +88,7 @@ class AnalyticsEngine:
         
         # Store interaction
         self.interaction_history.append(interaction)
+        self.rollups.add(interaction)
         
         # Update agent performance metrics
         agent_type = interaction['agent_type']
@@ -86,12 +108,6 @@ class AnalyticsEngine:
         # Track user satisfaction if provided
         if interaction['user_rating'] is not None:
             self.user_satisfaction[agent_type or 'unknown'].append(interaction['user_rating'])
-        
-        # Limit history size to prevent memory issues
-        if len(self.interaction_history) > 10000:
-            self.interaction_history = self.interaction_history[-8000:]  # Keep recent 8000
-        
-        logger.info(f"Tracked interaction: {agent_type} confidence={interaction['confidence']:.2f}")
     
     def track_error(self, error_data: Dict[str, Any]):
         """Track system errors for analysis"""
@@ -106,69 +122,60 @@ class AnalyticsEngine:
         }
         
         self.error_tracking[error['error_type']].append(error)
+        self.rollups.add_error(error['timestamp'])
         logger.warning(f"Tracked error: {error['error_type']} for {error['agent_type']}")
     
     def get_performance_metrics(self, agent_type: Optional[str] = None, 
                               time_window_hours: int = 24) -> Dict[str, Any]:
-        """Get comprehensive performance metrics"""
-        cutoff_time = time.time() - (time_window_hours * 3600)
-        
-        # Filter interactions by time window
-        recent_interactions = [
-            i for i in self.interaction_history 
-            if i['timestamp'] >= cutoff_time
-        ]
-        
-        if agent_type:
-            recent_interactions = [
-                i for i in recent_interactions 
-                if i['agent_type'] == agent_type
-            ]
-        
-        if not recent_interactions:
+        """Get comprehensive performance metrics (from the rollups, O(buckets))"""
+        now = time.time()
+        merged, errors = self.rollups.aggregate(now - time_window_hours * 3600, now, agent_type)
+        return self._build_metrics(merged, errors, time_window_hours)
+    
+    def get_metrics_by_agent(self, time_window_hours: int = 24) -> Dict[str, Dict[str, Any]]:
+        """Performance metrics of every agent from a single pass over the rollups"""
+        now = time.time()
+        merged, errors = self.rollups.aggregate(now - time_window_hours * 3600, now)
+        by_agent = defaultdict(dict)
+        for key, bucket in merged.items():
+            by_agent[key[0]][key] = bucket
+        return {
+            agent_type: self._build_metrics(groups, errors, time_window_hours)
+            for agent_type, groups in by_agent.items()
+        }
+    
+    def _build_metrics(self, merged: Dict, errors: int, time_window_hours: int) -> Dict[str, Any]:
+        total = combine(merged.values())
+        if not total.interactions:
             return {'error': 'No data available for the specified criteria'}
         
         # Calculate metrics
-        total_interactions = len(recent_interactions)
+        total_interactions = total.interactions
         
         # Confidence metrics
-        confidences = [i['confidence'] for i in recent_interactions if i['confidence'] > 0]
-        avg_confidence = statistics.mean(confidences) if confidences else 0
+        avg_confidence = total.confidence_sum / total.confidence_count if total.confidence_count else 0
         
         # Response time metrics
-        response_times = [i['response_time'] for i in recent_interactions if i['response_time'] > 0]
-        avg_response_time = statistics.mean(response_times) if response_times else 0
-        
-        # Cache metrics
-        cached_count = sum(1 for i in recent_interactions if i['cached'])
-        cache_hit_rate = cached_count / total_interactions if total_interactions > 0 else 0
+        avg_response_time = total.response_time_sum / total.response_time_count if total.response_time_count else 0
+        latency = total.latency.percentiles()
         
-        # Context usage metrics
-        context_used_count = sum(1 for i in recent_interactions if i['context_used'])
-        context_usage_rate = context_used_count / total_interactions if total_interactions > 0 else 0
+        # Cache and context usage metrics
+        cache_hit_rate = total.cached / total_interactions
+        context_usage_rate = total.context_used / total_interactions
         
         # Context confidence metrics
-        context_confidences = [i['context_confidence'] for i in recent_interactions if i['context_confidence'] > 0]
-        avg_context_confidence = statistics.mean(context_confidences) if context_confidences else 0
+        avg_context_confidence = (total.context_confidence_sum / total.context_confidence_count
+                                  if total.context_confidence_count else 0)
         
         # User satisfaction metrics
-        ratings = [i['user_rating'] for i in recent_interactions if i['user_rating'] is not None]
-        avg_satisfaction = statistics.mean(ratings) if ratings else None
-        satisfaction_count = len(ratings)
+        avg_satisfaction = total.rating_sum / total.rating_count if total.rating_count else None
+        satisfaction_count = total.rating_count
         
-        # Error rate calculation
-        recent_errors = [
-            e for error_list in self.error_tracking.values() 
-            for e in error_list 
-            if e['timestamp'] >= cutoff_time
-        ]
-        error_rate = len(recent_errors) / total_interactions if total_interactions > 0 else 0
+        # Error rate calculation (errors of all agents in the window)
+        error_rate = errors / total_interactions
         
-        # Agent distribution
-        agent_distribution = Counter(i['agent_type'] for i in recent_interactions if i['agent_type'])
-        
-        # Language distribution
-        language_distribution = Counter(i['language'] for i in recent_interactions)
+        # Agent and language distribution
+        agent_distribution, language_distribution = distributions(merged)
         
         return {
             'time_window_hours': time_window_hours,
@@ -176,6 +183,9 @@ class AnalyticsEngine:
             'performance': {
                 'avg_confidence': round(avg_confidence, 3),
                 'avg_response_time': round(avg_response_time, 3),
+                'p50_response_time': latency['p50'],
+                'p95_response_time': latency['p95'],
+                'p99_response_time': latency['p99'],
                 'cache_hit_rate': round(cache_hit_rate, 3),
                 'context_usage_rate': round(context_usage_rate, 3),
                 'avg_context_confidence': round(avg_context_confidence, 3),
@@ -321,31 +331,36 @@ class AnalyticsEngine:
     def analyze_learning_progress(self, agent_type: str) -> Dict[str, Any]:
         """Analyze learning progress for an agent"""
         # Get recent performance data
-        recent_performance = self.agent_performance.get(agent_type, [])
+        recent_performance = list(self.agent_performance.get(agent_type, ()))
         if len(recent_performance) < 2:
             return {'error': 'Insufficient data for learning analysis'}
         
         # Sort by timestamp
         recent_performance.sort(key=lambda x: x['timestamp'])
         
-        # Calculate trends over time
+        # Calculate trends over time from the hourly rollups
         time_windows = [7, 30, 90]  # days
         current_time = time.time()
         
         trends = {}
+        total_interactions = 0
         for window in time_windows:
-            cutoff = current_time - (window * 24 * 3600)
-            window_data = [p for p in recent_performance if p['timestamp'] >= cutoff]
+            points = [bucket for _, bucket in self.rollups.series(current_time - window * 24 * 3600, agent_type)]
+            window_total = combine(points)
+            total_interactions = max(total_interactions, window_total.interactions)
             
-            if len(window_data) >= 2:
-                confidences = [p['confidence'] for p in window_data]
-                response_times = [p['response_time'] for p in window_data if p['response_time'] > 0]
+            if window_total.interactions >= 2:
+                confidences = [b.confidence_sum / b.confidence_count for b in points if b.confidence_count]
+                response_times = [b.response_time_sum / b.response_time_count
+                                  for b in points if b.response_time_count]
                 
                 trends[f'{window}d'] = {
-                    'interactions': len(window_data),
-                    'avg_confidence': statistics.mean(confidences),
+                    'interactions': window_total.interactions,
+                    'avg_confidence': (window_total.confidence_sum / window_total.confidence_count
+                                       if window_total.confidence_count else 0),
                     'confidence_trend': self._calculate_trend(confidences),
-                    'avg_response_time': statistics.mean(response_times) if response_times else 0,
+                    'avg_response_time': (window_total.response_time_sum / window_total.response_time_count
+                                          if window_total.response_time_count else 0),
                     'response_time_trend': self._calculate_trend(response_times) if response_times else 0
                 }
         
@@ -356,7 +371,7 @@ class AnalyticsEngine:
             'agent_type': agent_type,
             'learning_score': learning_score,
             'trends': trends,
-            'total_interactions': len(recent_performance),
+            'total_interactions': total_interactions,
             'improvement_areas': self._identify_improvement_areas(agent_type, recent_performance)
         }
     
@@ -460,10 +475,11 @@ class AnalyticsEngine:
         
         # Analyze each agent
         agent_insights = {}
-        agent_types = set(i['agent_type'] for i in self.interaction_history if i['agent_type'])
+        metrics_by_agent = self.get_metrics_by_agent(time_window_hours=168)
         
-        for agent_type in agent_types:
-            agent_metrics = self.get_performance_metrics(agent_type, time_window_hours=168)
+        for agent_type, agent_metrics in metrics_by_agent.items():
+            if agent_type == 'unknown':
+                continue
             learning_analysis = self.analyze_learning_progress(agent_type)
             
             agent_insights[agent_type] = {
@@ -541,4 +557,27 @@ class AnalyticsEngine:
 
 
 # Global analytics instance
-analytics_engine = AnalyticsEngine()
\ No newline at end of file
+analytics_engine = AnalyticsEngine()
+write_behind.register('analytics', analytics_engine._record_interactions)
+
+
+def _collect_metrics() -> List[MetricFamily]:
+    totals, errors = analytics_engine.rollups.snapshot_totals()
+    interactions = MetricFamily('bolashak_chat_interactions_total', 'counter', 'Chat answers by agent and language')
+    cached = MetricFamily('bolashak_chat_cached_total', 'counter', 'Chat answers served from cache')
+    ratings = MetricFamily('bolashak_chat_ratings_total', 'counter', 'User ratings received')
+    rating_sum = MetricFamily('bolashak_chat_rating_sum', 'counter', 'Sum of user ratings')
+    latency = MetricFamily('bolashak_chat_response_seconds', 'summary', 'Chat response time')
+    for (agent, language), bucket in totals.items():
+        interactions.add(bucket.interactions, agent=agent, language=language)
+        cached.add(bucket.cached, agent=agent, language=language)
+        ratings.add(bucket.rating_count, agent=agent, language=language)
+        rating_sum.add(bucket.rating_sum, agent=agent, language=language)
+        latency.add(bucket.latency, agent=agent, language=language)
+    return [
+        interactions, cached, ratings, rating_sum, latency,
+        MetricFamily('bolashak_chat_errors_total', 'counter', 'Tracked agent errors').add(errors)
+    ]
+
+
+worker_metrics.register('analytics', _collect_metrics)
\ No newline at end of file
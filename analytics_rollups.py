@@ -0,0 +1,307 @@
+"""
+Time-bucketed Rollups and Latency Sketches for Analytics
+Агрегаты по временным корзинам и скетчи задержек для аналитики
+
+AnalyticsEngine used to keep every interaction in a list and rescan it for
+each metric query. Interactions are now folded into fixed rings of per-minute
+and per-hour buckets, one MetricBucket per (agent, language) in each bucket,
+so a query touches O(buckets) aggregates and memory does not grow with
+traffic.
+
+Latency percentiles come from LatencySketch, a log-bucketed histogram with
+bounded relative error (DDSketch-style): two sketches merge by adding their
+counts, so buckets, agents and worker processes combine without keeping
+samples.
+"""
+
+import math
+import threading
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+GroupKey = Tuple[str, str]  # (agent_type, language)
+
+
+class LatencySketch:
+    """Mergeable quantile sketch: every estimate is within relative_accuracy of a real sample"""
+
+    MIN_VALUE = 1e-4  # seconds; smaller values share the zero bucket
+
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float, count: int = 1):
+        self.count += count
+        self.total += value * count
+        self.max = max(self.max, value)
+        if value <= self.MIN_VALUE:
+            self.zero_count += count
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        # Fold the lowest bins together: only the smallest values lose precision
+        ordered = sorted(self.bins)
+        excess = len(ordered) - self.max_bins + 1
+        folded = sum(self.bins.pop(index) for index in ordered[:excess])
+        target = ordered[excess]
+        self.bins[target] += folded
+
+    def merge(self, other: 'LatencySketch'):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Sketches with different accuracy cannot be merged")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                # Midpoint of the bucket (gamma^(i-1), gamma^i] in the relative sense
+                return min(2 * self._gamma ** index / (self._gamma + 1), self.max)
+        return self.max
+
+    def percentiles(self) -> Dict[str, float]:
+        return {
+            'p50': round(self.quantile(0.50), 4),
+            'p95': round(self.quantile(0.95), 4),
+            'p99': round(self.quantile(0.99), 4)
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'accuracy': self.relative_accuracy, 'zero': self.zero_count, 'count': self.count,
+                'total': self.total, 'max': self.max, 'bins': {str(k): v for k, v in self.bins.items()}}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'LatencySketch':
+        sketch = cls(relative_accuracy=data['accuracy'])
+        sketch.zero_count = data['zero']
+        sketch.count = data['count']
+        sketch.total = data['total']
+        sketch.max = data['max']
+        sketch.bins = {int(k): v for k, v in data['bins'].items()}
+        return sketch
+
+
+class MetricBucket:
+    """Sums and counts of one (agent, language) over one time bucket"""
+
+    __slots__ = ('interactions', 'confidence_sum', 'confidence_count', 'response_time_sum',
+                 'response_time_count', 'cached', 'context_used', 'context_confidence_sum',
+                 'context_confidence_count', 'rating_sum', 'rating_count', 'latency')
+
+    def __init__(self):
+        self.interactions = 0
+        self.confidence_sum = 0.0
+        self.confidence_count = 0
+        self.response_time_sum = 0.0
+        self.response_time_count = 0
+        self.cached = 0
+        self.context_used = 0
+        self.context_confidence_sum = 0.0
+        self.context_confidence_count = 0
+        self.rating_sum = 0.0
+        self.rating_count = 0
+        self.latency = LatencySketch()
+
+    def add(self, interaction: Dict[str, Any]):
+        self.interactions += 1
+        # Zero means "not measured" for these fields, as in the per-interaction metrics before
+        if interaction['confidence'] > 0:
+            self.confidence_sum += interaction['confidence']
+            self.confidence_count += 1
+        if interaction['response_time'] > 0:
+            self.response_time_sum += interaction['response_time']
+            self.response_time_count += 1
+            self.latency.add(interaction['response_time'])
+        if interaction['context_confidence'] > 0:
+            self.context_confidence_sum += interaction['context_confidence']
+            self.context_confidence_count += 1
+        self.cached += bool(interaction['cached'])
+        self.context_used += bool(interaction['context_used'])
+        if interaction['user_rating'] is not None:
+            self.rating_sum += interaction['user_rating']
+            self.rating_count += 1
+
+    def merge(self, other: 'MetricBucket'):
+        for name in self.__slots__:
+            if name == 'latency':
+                self.latency.merge(other.latency)
+            else:
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: (self.latency.to_dict() if name == 'latency' else getattr(self, name))
+                for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'MetricBucket':
+        bucket = cls()
+        for name in cls.__slots__:
+            if name == 'latency':
+                bucket.latency = LatencySketch.from_dict(data['latency'])
+            else:
+                setattr(bucket, name, data[name])
+        return bucket
+
+
+class _Slot:
+    __slots__ = ('start', 'groups', 'errors')
+
+    def __init__(self):
+        self.start = -1
+        self.groups: Dict[GroupKey, MetricBucket] = {}
+        self.errors = 0
+
+
+class TimeBucketedRollup:
+    """Ring of `retention` buckets of `resolution` seconds; old buckets are reused in place"""
+
+    def __init__(self, resolution: int, retention: int):
+        self.resolution = resolution
+        self.retention = retention
+        self._slots = [_Slot() for _ in range(retention)]
+
+    def _slot(self, timestamp: float) -> Optional[_Slot]:
+        start = int(timestamp // self.resolution) * self.resolution
+        slot = self._slots[(start // self.resolution) % self.retention]
+        if slot.start < start:
+            slot.start = start
+            slot.groups = {}
+            slot.errors = 0
+        elif slot.start > start:
+            return None  # older than the ring keeps
+        return slot
+
+    def add(self, interaction: Dict[str, Any]):
+        slot = self._slot(interaction['timestamp'])
+        if slot is None:
+            return
+        key = (interaction['agent_type'] or 'unknown', interaction['language'] or 'ru')
+        bucket = slot.groups.get(key)
+        if bucket is None:
+            bucket = slot.groups[key] = MetricBucket()
+        bucket.add(interaction)
+
+    def add_error(self, timestamp: float):
+        slot = self._slot(timestamp)
+        if slot is not None:
+            slot.errors += 1
+
+    @property
+    def span(self) -> int:
+        return self.resolution * self.retention
+
+    def slots_since(self, cutoff: float) -> Iterable[_Slot]:
+        """Live buckets overlapping [cutoff, now]"""
+        first_start = int(cutoff // self.resolution) * self.resolution
+        return (slot for slot in self._slots if slot.start >= first_start)
+
+
+class AnalyticsRollups:
+    """Per-minute and per-hour rollups; a query reads the finest ring covering its window"""
+
+    def __init__(self, minute_retention: int = 180, hour_retention: int = 24 * 90):
+        self.minutes = TimeBucketedRollup(60, minute_retention)
+        self.hours = TimeBucketedRollup(3600, hour_retention)
+        # Since process start, for monotonic counters (cross-worker metrics)
+        self.totals: Dict[GroupKey, MetricBucket] = {}
+        self.errors_total = 0
+        self._lock = threading.Lock()
+
+    def add(self, interaction: Dict[str, Any]):
+        key = (interaction['agent_type'] or 'unknown', interaction['language'] or 'ru')
+        with self._lock:
+            self.minutes.add(interaction)
+            self.hours.add(interaction)
+            total = self.totals.get(key)
+            if total is None:
+                total = self.totals[key] = MetricBucket()
+            total.add(interaction)
+
+    def add_error(self, timestamp: float):
+        with self._lock:
+            self.minutes.add_error(timestamp)
+            self.hours.add_error(timestamp)
+            self.errors_total += 1
+
+    def snapshot_totals(self) -> Tuple[Dict[GroupKey, MetricBucket], int]:
+        with self._lock:
+            return {key: MetricBucket.from_dict(bucket.to_dict()) for key, bucket in self.totals.items()}, self.errors_total
+
+    def _ring(self, window_seconds: float) -> TimeBucketedRollup:
+        return self.minutes if window_seconds <= self.minutes.span else self.hours
+
+    def aggregate(self, cutoff: float, now: float,
+                  agent_type: Optional[str] = None) -> Tuple[Dict[GroupKey, MetricBucket], int]:
+        """Merged bucket per (agent, language) since cutoff, and the error count"""
+        ring = self._ring(now - cutoff)
+        merged: Dict[GroupKey, MetricBucket] = {}
+        errors = 0
+        with self._lock:
+            for slot in ring.slots_since(cutoff):
+                errors += slot.errors
+                for key, bucket in slot.groups.items():
+                    if agent_type is not None and key[0] != agent_type:
+                        continue
+                    target = merged.get(key)
+                    if target is None:
+                        target = merged[key] = MetricBucket()
+                    target.merge(bucket)
+        return merged, errors
+
+    def series(self, cutoff: float, agent_type: str) -> List[Tuple[int, MetricBucket]]:
+        """Hourly buckets of one agent since cutoff, oldest first"""
+        points = []
+        with self._lock:
+            for slot in self.hours.slots_since(cutoff):
+                bucket = MetricBucket()
+                for key, group in slot.groups.items():
+                    if key[0] == agent_type:
+                        bucket.merge(group)
+                if bucket.interactions:
+                    points.append((slot.start, bucket))
+        return sorted(points, key=lambda point: point[0])
+
+    def agent_types(self) -> List[str]:
+        with self._lock:
+            return sorted({key[0] for slot in self.hours._slots for key in slot.groups if slot.start >= 0})
+
+
+def combine(groups: Iterable[MetricBucket]) -> MetricBucket:
+    total = MetricBucket()
+    for bucket in groups:
+        total.merge(bucket)
+    return total
+
+
+def distributions(merged: Dict[GroupKey, MetricBucket]) -> Tuple[Counter, Counter]:
+    agents, languages = Counter(), Counter()
+    for (agent, language), bucket in merged.items():
+        if agent != 'unknown':
+            agents[agent] += bucket.interactions
+        languages[language] += bucket.interactions
+    return agents, languages
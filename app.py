@@ -120,6 +120,10 @@ def create_app():
             try:
                 db.create_all()
                 logging.info("Database tables created during startup")
+                # Nullable columns declared after their table was created (indexes: db_migrations.py)
+                from db_migrations import apply_columns_locked
+                for item in apply_columns_locked():
+                    logging.info(f"Added column {item['table']}.{item['column']}")
             except Exception as db_e:
                 logging.warning(f"Database initialization deferred: {db_e}")
                 
@@ -127,6 +131,10 @@ def create_app():
             logging.error(f"Model import failed: {e}")
             # Continue anyway - health check endpoint will still work
 
+    # Регистрация приложения как общего для процесса (агенты используют его контекст)
+    from app_context import register_app
+    register_app(app)
+
     return app
 
 
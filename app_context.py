@@ -0,0 +1,68 @@
+# Доступ к контексту приложения для агентов и фоновых компонентов
+# Application context access for agents and background components
+
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+
+from flask import Flask, current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def register_app(app: Flask) -> None:
+    """Запомнить экземпляр приложения как общий для процесса (первый выигрывает)"""
+    global _app
+    with _app_lock:
+        if _app is None:
+            _app = app
+            logger.debug("Process-wide Flask app registered")
+
+
+def get_app() -> Flask:
+    """Get the running Flask app without building a new one"""
+    if has_app_context():
+        return current_app._get_current_object()
+
+    if _app is None:
+        # Импорт модуля app создает приложение ровно один раз на процесс
+        from app import app as flask_app
+        register_app(flask_app)
+
+    return _app
+
+
+@contextmanager
+def app_context():
+    """Reuse the active app context, or push one on the process-wide app.
+
+    Inside a request the existing context (and its db.session) is reused as is;
+    background threads get a context of the already configured application
+    instead of calling create_app() per query.
+    """
+    if has_app_context():
+        yield current_app._get_current_object()
+        return
+
+    app = get_app()
+    with app.app_context():
+        yield app
+
+
+async def run_in_app_context(func, *args, **kwargs):
+    """Await blocking code (DB queries, CPU-bound scoring) from the asyncio chat path.
+
+    The call runs in the loop's default thread pool inside its own app context,
+    so its db.session (and pooled connection) is released when the call returns
+    instead of being held while the coroutine awaits the LLM. The caller's
+    context variables are copied, so a pushed request context stays readable.
+    """
+    def call():
+        with get_app().app_context():
+            return func(*args, **kwargs)
+
+    return await asyncio.to_thread(call)
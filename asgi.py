@@ -0,0 +1,131 @@
+"""
+ASGI entry point: asyncio chat path in front of the Flask application
+Точка входа ASGI: асинхронный чат перед Flask-приложением
+
+POST /api/chat and /chat are served by views.chat_async on the event loop, so
+a worker awaiting OpenRouter holds no thread and can keep hundreds of chats in
+flight. Every other route (pages, admin, SSE streaming) is passed to the Flask
+WSGI app through a2wsgi's thread pool, unchanged.
+
+Run:  uvicorn asgi:application --workers 4
+  or: ASYNC_WORKERS=1 gunicorn -c gunicorn.conf.py   (UvicornWorker)
+"""
+
+import io
+import logging
+import sys
+from urllib.parse import quote
+
+from a2wsgi import WSGIMiddleware
+
+from app import app as flask_app
+from mistral_client import close_async_http_client
+from views import chat_async
+
+logger = logging.getLogger(__name__)
+
+
+def _build_environ(scope, body: bytes) -> dict:
+    """WSGI environ for an ASGI HTTP scope, so Flask can parse the request and session"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': quote(scope['path']),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+class ChatASGIApp:
+    """Routes the chat endpoints to async handlers and everything else to Flask"""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+        self.wsgi = WSGIMiddleware(app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        if scope['type'] == 'http':
+            handler = self.routes.get((scope['method'], scope['path']))
+            if handler is not None:
+                await self._handle(handler, scope, receive, send)
+                return
+
+        await self.wsgi(scope, receive, send)
+
+    async def _handle(self, handler, scope, receive, send):
+        body = await _read_body(receive)
+        ctx = self.app.request_context(_build_environ(scope, body))
+        # The request context is task-local (contextvars), so concurrent chats do not share it
+        ctx.push()
+        try:
+            try:
+                response = self.app.preprocess_request()
+                if response is None:
+                    response = await handler()
+                response = self.app.process_response(self.app.make_response(response))
+            except Exception as e:
+                logger.error(f"Unhandled error in async handler: {str(e)}")
+                response = self.app.make_response(self.app.handle_exception(e))
+        finally:
+            ctx.pop()
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': response.get_data()})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_async_http_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = ChatASGIApp(flask_app, {
+    ('POST', '/api/chat'): chat_async,
+    ('POST', '/chat'): chat_async,
+})
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк получения контекста агента
+Benchmark for BaseAgent.get_agent_context
+
+Сравнивает старый путь (create_app() на каждый запрос) с текущим
+(общий контекст приложения процесса) на временной SQLite базе.
+
+Запуск: python benchmarks/bench_agent_context.py [--turns 50]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix="bench_ctx_")
+os.environ.setdefault("SESSION_SECRET", "bench-secret")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}")
+
+import logging
+logging.disable(logging.CRITICAL)
+
+import app as app_module
+from app import app, create_app, db
+from models import AdminUser, AgentKnowledgeBase
+from agents import UniNavAgent
+
+
+def seed_knowledge(entries: int = 30):
+    """Наполнение базы знаний тестовыми записями"""
+    with app.app_context():
+        db.create_all()
+        admin = AdminUser(username="bench", email="bench@example.com")
+        admin.set_password("bench")
+        db.session.add(admin)
+        db.session.flush()
+        for i in range(entries):
+            db.session.add(AgentKnowledgeBase(
+                agent_type="uninav",
+                title=f"Расписание занятий {i}",
+                content_ru=f"Расписание занятий группы {i}: лекции, семинары, экзамены и сессия.",
+                content_kz=f"{i} тобының сабақ кестесі.",
+                keywords="расписание, занятия, экзамен",
+                priority=i % 5 + 1,
+                created_by=admin.id,
+            ))
+        db.session.commit()
+
+
+def legacy_get_entries(agent_type: str):
+    """Старый путь: новое приложение на каждый запрос"""
+    legacy_app = create_app()
+    with legacy_app.app_context():
+        return AgentKnowledgeBase.query.filter_by(
+            agent_type=agent_type, is_active=True
+        ).order_by(AgentKnowledgeBase.priority.asc()).all()
+
+
+def measure(fn, turns: int):
+    timings = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(label: str, timings):
+    timings = sorted(timings)
+    p95 = timings[max(0, int(len(timings) * 0.95) - 1)]
+    print(f"{label:<34} mean={statistics.mean(timings):8.2f}ms  "
+          f"p50={statistics.median(timings):8.2f}ms  p95={p95:8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+
+    seed_knowledge()
+    agent = UniNavAgent()
+    message = "какое расписание экзаменов в сессию"
+
+    # Подсчет вызовов фабрики приложения во время текущего пути
+    factory_calls = {"count": 0}
+    original_factory = app_module.create_app
+
+    def counting_factory():
+        factory_calls["count"] += 1
+        return original_factory()
+
+    print("=" * 70)
+    print(f"get_agent_context: {args.turns} turns")
+    print("=" * 70)
+
+    legacy = measure(lambda: legacy_get_entries(agent.agent_type), args.turns)
+    report("legacy (create_app per turn)", legacy)
+
+    app_module.create_app = counting_factory
+    try:
+        current = measure(lambda: agent.get_agent_context(message, "ru"), args.turns)
+    finally:
+        app_module.create_app = original_factory
+    report("current (shared app context)", current)
+
+    print(f"\ncreate_app() calls during current path: {factory_calls['count']}")
+    print(f"speedup (mean): {statistics.mean(legacy) / statistics.mean(current):.1f}x")
+
+
+if __name__ == "__main__":
+    main()
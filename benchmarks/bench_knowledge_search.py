@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк поиска по базе знаний: TF-IDF на каждый запрос против индекса BM25
+Benchmark for KnowledgeSearchEngine: per-query TF-IDF vs inverted BM25 index
+
+Для синтетических корпусов (по умолчанию 1k, 10k и 100k фрагментов) измеряет
+построение индекса, инкрементальное обновление и время top-k запроса.
+
+Запуск: python benchmarks/bench_knowledge_search.py [--sizes 1000 10000 100000] [--queries 20]
+"""
+
+import argparse
+import heapq
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging
+logging.disable(logging.CRITICAL)
+
+from bm25_index import BM25Index
+from knowledge_search import KnowledgeSearchEngine
+
+TOPICS = [
+    "поступление", "документы", "аттестат", "экзамен", "общежитие", "стипендия",
+    "расписание", "сессия", "магистратура", "грант", "оплата", "вакансия",
+    "практика", "диплом", "библиотека", "факультет", "кафедра", "преподаватель",
+]
+
+
+def make_corpus(size: int, seed: int = 42):
+    """Синтетические фрагменты с распределением слов, близким к Ципфу"""
+    rng = random.Random(seed)
+    vocabulary = TOPICS + [f"термин{i}" for i in range(20000)]
+    weights = [1.0 / (i + 1) ** 0.9 for i in range(len(vocabulary))]
+    docs = []
+    for i in range(size):
+        words = rng.choices(vocabulary, weights, k=rng.randint(40, 120))
+        docs.append({
+            'id': i,
+            'title': ' '.join(words[:4]),
+            'content': ' '.join(words[4:]),
+            'keywords': ', '.join(words[:2]),
+            'language': 'ru'
+        })
+    queries = [' '.join(rng.choices(TOPICS, k=2) + rng.choices(vocabulary[:2000], k=2))
+               for _ in range(200)]
+    return docs, queries
+
+
+def legacy_top_k(engine, query, docs, top_k):
+    """Текущая реализация: calculate_tf_idf по всему корпусу на каждый запрос"""
+    scores = engine.calculate_tf_idf(engine.preprocess_text(query, 'ru'), docs)
+    return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+
+def run(size: int, queries_count: int, top_k: int):
+    engine = KnowledgeSearchEngine()
+    docs, queries = make_corpus(size)
+    queries = queries[:queries_count]
+
+    start = time.perf_counter()
+    index = BM25Index()
+    for doc in docs:
+        index.add_document(doc['id'], engine.preprocess_text(
+            f"{doc['title']} {doc['content']} {doc['keywords']}", 'ru'
+        ))
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for doc in docs[:100]:
+        index.add_document(doc['id'], engine.preprocess_text(doc['content'] + " обновлено", 'ru'))
+    update_time = (time.perf_counter() - start) / 100
+
+    bm25_times = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(engine.preprocess_text(query, 'ru'), top_k)
+        bm25_times.append(time.perf_counter() - start)
+
+    # Старый путь линейный по корпусу; на больших размерах хватает нескольких запросов
+    legacy_queries = queries[:max(1, min(len(queries), 20000 // size))]
+    legacy_times = []
+    for query in legacy_queries:
+        start = time.perf_counter()
+        legacy_top_k(engine, query, docs, top_k)
+        legacy_times.append(time.perf_counter() - start)
+
+    legacy_ms = statistics.mean(legacy_times) * 1000
+    bm25_ms = statistics.mean(bm25_times) * 1000
+    print(f"{size:>8} | {legacy_ms:>12.2f} | {bm25_ms:>9.3f} | {legacy_ms / bm25_ms:>8.0f}x | "
+          f"{build_time:>8.2f}s | {update_time * 1000:>9.3f}ms | {index.get_stats()['terms']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'chunks':>8} | {'tf-idf ms/q':>12} | {'bm25 ms/q':>9} | {'speedup':>9} | "
+          f"{'build':>9} | {'update/doc':>11} | {'terms':>7}")
+    print("-" * 84)
+    for size in args.sizes:
+        run(size, args.queries, args.top_k)
+
+
+if __name__ == "__main__":
+    main()
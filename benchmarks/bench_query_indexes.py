@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк запросов эндпоинтов до и после миграции индексов
+Benchmark of endpoint queries before and after db_migrations.apply_indexes()
+
+Наполняет временную SQLite базу (по умолчанию 1M строк user_queries, расписание
+и базу знаний агентов), удаляет индексы user_queries / schedules /
+agent_knowledge_base, замеряет запросы в форме views.py, admin.py,
+user_memory.py и фоновых задач, применяет миграцию и замеряет снова.
+Для каждого запроса печатается медиана и план SQLite (SCAN / SEARCH).
+
+Запуск: python benchmarks/bench_query_indexes.py [--queries 1000000] [--repeat 5]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix="bench_idx_")
+os.environ.setdefault("SESSION_SECRET", "bench-secret")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}")
+
+import logging
+logging.disable(logging.CRITICAL)
+
+from sqlalchemy import desc, func
+
+from app import app, db
+from db_migrations import apply_indexes, declared_indexes
+from models import AgentKnowledgeBase, Schedule, UserQuery
+
+MIGRATED_TABLES = ('user_queries', 'schedules', 'agent_knowledge_base')
+AGENTS = [('ai_abitur', 'AI-Abitur'), ('kadrai', 'KadrAI'), ('uniroom', 'UniRoom'), ('uninav', 'UniNav'),
+          ('career_navigator', 'CareerNavigator'), ('bolashak_main', 'Bolashak'), (None, None)]
+CHUNK = 50000
+
+
+def seed(queries: int, sessions: int, groups: int, seed_value: int = 42):
+    """Быстрое наполнение через executemany на сыром соединении"""
+    rng = random.Random(seed_value)
+    now = datetime.utcnow()
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for offset in range(0, queries, CHUNK):
+            rows = []
+            for i in range(offset, min(offset + CHUNK, queries)):
+                agent_type, agent_name = AGENTS[rng.randrange(len(AGENTS))]
+                created_at = now - timedelta(seconds=rng.randrange(365 * 86400))
+                rating = rng.choice(('like', 'like', 'dislike')) if rng.random() < 0.1 else None
+                rated_at = created_at + timedelta(minutes=1) if rating else None
+                rows.append((
+                    f"вопрос {rng.randrange(5000)}", "ответ", 'kz' if rng.random() < 0.3 else 'ru',
+                    rng.uniform(0.2, 3.0), agent_type, agent_name, rng.random(), False, rating,
+                    rated_at and rated_at.isoformat(' '), f"session-{rng.randrange(sessions)}",
+                    created_at.isoformat(' ')
+                ))
+            cursor.executemany(
+                "INSERT INTO user_queries (user_message, bot_response, language, response_time, agent_type,"
+                " agent_name, agent_confidence, context_used, user_rating, rating_timestamp, session_id,"
+                " created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        start_day = date.today() - timedelta(days=120)
+        lessons = []
+        for group in range(groups):
+            for day in range(240):
+                if (start_day + timedelta(days=day)).weekday() == 6:
+                    continue
+                for slot in range(3):
+                    start = datetime.combine(start_day + timedelta(days=day), datetime.min.time()) + \
+                        timedelta(hours=9 + slot * 2)
+                    lessons.append(('lecture', f"Предмет {slot}", f"Группа-{group}", start.isoformat(' '),
+                                    (start + timedelta(minutes=90)).isoformat(' '), True, False))
+        cursor.executemany(
+            "INSERT INTO schedules (schedule_type, title, group_name, start_time, end_time, is_active,"
+            " is_cancelled) VALUES (?, ?, ?, ?, ?, ?, ?)", lessons)
+
+        cursor.executemany(
+            "INSERT INTO agent_knowledge_base (agent_type, title, content_ru, content_kz, priority,"
+            " is_active, created_by) VALUES (?, ?, ?, ?, ?, ?, 1)",
+            [(AGENTS[i % 6][0], f"Запись {i}", "текст", "мәтін", i % 5 + 1, i % 10 != 0) for i in range(5000)])
+        connection.commit()
+        cursor.execute("ANALYZE")
+        connection.commit()
+        return len(lessons)
+    finally:
+        connection.close()
+
+
+def drop_migrated_indexes():
+    """Состояние до миграции: без индексов на измеряемых таблицах"""
+    with db.engine.begin() as connection:
+        for index in declared_indexes():
+            if index.table.name in MIGRATED_TABLES:
+                connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+
+
+def endpoint_queries():
+    """Запросы в той же форме, что и в эндпоинтах (метка -> Query)"""
+    now = datetime.utcnow()
+    day_start = datetime.combine(date.today() - timedelta(days=3), datetime.min.time())
+    return [
+        ("chat history / user memory", db.session.query(UserQuery).filter_by(
+            session_id='session-123').order_by(desc(UserQuery.created_at)).limit(50)),
+        ("rating lookup (latest of session)", db.session.query(UserQuery).filter_by(
+            session_id='session-456').order_by(UserQuery.created_at.desc()).limit(1)),
+        ("admin queries page", db.session.query(UserQuery).order_by(
+            UserQuery.created_at.desc()).limit(20).offset(100)),
+        ("homepage distinct users", db.session.query(func.count(func.distinct(UserQuery.session_id)))),
+        ("homepage agent counts", db.session.query(UserQuery.agent_name, func.count(UserQuery.id)).filter(
+            UserQuery.agent_name.isnot(None)).group_by(UserQuery.agent_name)),
+        ("homepage liked count", db.session.query(func.count(UserQuery.id)).filter(
+            UserQuery.user_rating == 'like')),
+        ("feedback by agent", db.session.query(
+            UserQuery.agent_name, UserQuery.user_rating, func.count(UserQuery.id)
+        ).filter(UserQuery.user_rating.isnot(None), UserQuery.agent_name.isnot(None)).group_by(
+            UserQuery.agent_name, UserQuery.user_rating)),
+        ("latest feedback", db.session.query(UserQuery).filter(UserQuery.user_rating.isnot(None)).order_by(
+            UserQuery.rating_timestamp.desc()).limit(50)),
+        ("admin active sessions 24h", db.session.query(
+            UserQuery.session_id, UserQuery.language, func.count(UserQuery.id), func.max(UserQuery.created_at)
+        ).filter(UserQuery.created_at >= now - timedelta(hours=24), UserQuery.session_id != '').group_by(
+            UserQuery.session_id, UserQuery.language).order_by(func.max(UserQuery.created_at).desc())),
+        ("precompute popular questions 7d", db.session.query(
+            UserQuery.user_message, UserQuery.agent_type, UserQuery.language, func.count(UserQuery.id)
+        ).filter(UserQuery.created_at >= now - timedelta(days=7), UserQuery.agent_type.isnot(None),
+                 UserQuery.agent_type != 'error').group_by(
+            UserQuery.user_message, UserQuery.agent_type, UserQuery.language)),
+        ("rollup day rebuild", db.session.query(
+            UserQuery.created_at, UserQuery.agent_type, UserQuery.user_rating, UserQuery.response_time
+        ).filter(UserQuery.created_at >= day_start, UserQuery.created_at < day_start + timedelta(days=1))),
+        ("rollup rating watermark", db.session.query(UserQuery.created_at, UserQuery.rating_timestamp).filter(
+            UserQuery.rating_timestamp.isnot(None), UserQuery.rating_timestamp > now - timedelta(hours=1))),
+        ("group schedule today", db.session.query(Schedule).filter(
+            Schedule.group_name == 'Группа-17', db.func.date(Schedule.start_time) == date.today(),
+            Schedule.is_active == True, Schedule.is_cancelled == False).order_by(Schedule.start_time)),
+        ("knowledge snapshot load", db.session.query(AgentKnowledgeBase).filter_by(is_active=True).order_by(
+            AgentKnowledgeBase.agent_type.asc(), AgentKnowledgeBase.priority.asc())),
+        ("agent knowledge by agent", db.session.query(AgentKnowledgeBase).filter_by(
+            agent_type='uninav', is_active=True).order_by(AgentKnowledgeBase.priority.asc())),
+    ]
+
+
+def query_plan(query) -> str:
+    """EXPLAIN QUERY PLAN одной строкой"""
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    connection = db.engine.raw_connection()
+    try:
+        rows = connection.cursor().execute(f"EXPLAIN QUERY PLAN {compiled}", params).fetchall()
+    finally:
+        connection.close()
+    return "; ".join(row[-1] for row in rows)
+
+
+def measure(repeat: int):
+    results = {}
+    for label, query in endpoint_queries():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query.all()
+            timings.append((time.perf_counter() - start) * 1000)
+            db.session.expunge_all()
+        results[label] = (statistics.median(timings), query_plan(query))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", type=int, default=1000000)
+    parser.add_argument("--sessions", type=int, default=50000)
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        drop_migrated_indexes()
+        start = time.perf_counter()
+        lessons = seed(args.queries, args.sessions, args.groups)
+        print(f"Seeded {args.queries} user_queries, {lessons} schedules, 5000 knowledge entries "
+              f"in {time.perf_counter() - start:.1f}s")
+
+        before = measure(args.repeat)
+        created = apply_indexes()
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("ANALYZE")
+        print(f"Migration: {len(created)} indexes in {sum(item['seconds'] for item in created):.1f}s")
+        for item in created:
+            print(f"  {item['table']}.{item['index']}: {item['seconds']}s")
+        after = measure(args.repeat)
+
+    print("=" * 70)
+    print(f"{'query':<34} {'before':>10} {'after':>10} {'speedup':>8}")
+    print("=" * 70)
+    for label, (before_ms, before_plan) in before.items():
+        after_ms, after_plan = after[label]
+        print(f"{label:<34} {before_ms:8.2f}ms {after_ms:8.2f}ms {before_ms / max(after_ms, 1e-6):7.1f}x")
+        print(f"    before: {before_plan}")
+        print(f"    after:  {after_plan}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест чата: синхронные воркеры против asyncio-пути
+Load test for the chat pipeline against a local fake LLM server
+
+Fake OpenRouter answers every completion after --llm-latency seconds. The
+sync mode emulates gunicorn sync workers (a pool of --sync-workers threads,
+one chat per worker at a time); the async mode runs AgentRouter.route_message_async
+on a single event loop. With --http the async mode goes end to end through
+asgi:application served by uvicorn instead of calling the router directly.
+
+Run: python benchmarks/load_test_chat.py [--concurrency 1 10 50 200] [--requests 200]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeLLM:
+    """OpenAI-compatible /chat/completions that answers after a fixed delay"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        while (await receive()).get('more_body'):
+            pass
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        body = json.dumps({'choices': [{'message': {'content': "Ответ тестовой модели."}}]}).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def serve_in_thread(app, port: int):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning',
+                                           backlog=4096, timeout_keep_alive=30))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def _message(i: int) -> str:
+    # Unique text so response caches do not short-circuit the LLM call
+    return f"Какие документы нужны для поступления? #{i} {uuid.uuid4().hex[:6]}"
+
+
+def _summary(mode, concurrency, latencies, elapsed, llm):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if len(latencies) > 1 else latencies[0]
+    print(f"{mode:>6} | {concurrency:>11} | {len(latencies):>8} | {elapsed:>7.2f}s | "
+          f"{len(latencies) / elapsed:>8.1f} | {statistics.median(latencies):>7.2f}s | {p95:>7.2f}s | "
+          f"{llm.peak_in_flight:>8}")
+    llm.peak_in_flight = 0
+
+
+def run_sync(router, llm, concurrency, total, workers):
+    # Clients beyond the worker count wait in the accept queue, as with gunicorn sync workers
+    busy_workers = threading.Semaphore(workers)
+
+    def one(i):
+        start = time.perf_counter()
+        with busy_workers:
+            router.route_message(_message(i), 'ru', f"load_{i}")
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, range(total)))
+    _summary('sync', concurrency, latencies, time.perf_counter() - start, llm)
+
+
+async def run_async(router, llm, concurrency, total, http_port=None):
+    semaphore = asyncio.Semaphore(concurrency)
+    client = None
+    if http_port:
+        import httpx
+        client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{http_port}", timeout=120,
+                                   limits=httpx.Limits(max_connections=concurrency))
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            if client is not None:
+                response = await client.post('/api/chat', json={'message': _message(i), 'language': 'ru'})
+                assert response.status_code == 200, response.text
+            else:
+                await router.route_message_async(_message(i), 'ru', f"load_{i}")
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - start
+    if client is not None:
+        await client.aclose()
+    _summary('http' if http_port else 'async', concurrency, latencies, elapsed, llm)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50, 200])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--llm-latency', type=float, default=1.0)
+    parser.add_argument('--sync-workers', type=int, default=4, help="gunicorn sync workers to emulate")
+    parser.add_argument('--http', action='store_true', help="async mode through asgi:application over HTTP")
+    parser.add_argument('--skip-sync', action='store_true')
+    args = parser.parse_args()
+
+    llm = FakeLLM(args.llm_latency)
+    llm_port = _free_port()
+    serve_in_thread(llm, llm_port)
+
+    # The clients read their configuration at import time
+    os.environ['OPENROUTER_BASE_URL'] = f"http://127.0.0.1:{llm_port}"
+    os.environ['OPENROUTER_API_KEY'] = 'load-test'
+    os.environ.setdefault('SESSION_SECRET', 'load-test')
+    os.environ.setdefault('DATABASE_URL', f"sqlite:///{tempfile.mkdtemp()}/load_test.db")
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    from app import app
+    from views import initialize_agent_router
+
+    with app.app_context():
+        router = initialize_agent_router()
+
+    http_port = None
+    if args.http:
+        from asgi import application
+        http_port = _free_port()
+        serve_in_thread(application, http_port)
+
+    print(f"LLM latency {args.llm_latency:.1f}s, {args.requests} requests per run, "
+          f"sync mode = {args.sync_workers} workers")
+    print(f"{'mode':>6} | {'concurrency':>11} | {'requests':>8} | {'wall':>8} | {'req/s':>8} | "
+          f"{'p50':>8} | {'p95':>8} | {'llm peak':>8}")
+    print("-" * 84)
+    for concurrency in args.concurrency:
+        if not args.skip_sync:
+            with app.app_context():
+                run_sync(router, llm, concurrency, args.requests, args.sync_workers)
+        asyncio.run(run_async(router, llm, concurrency, args.requests, http_port))
+
+
+if __name__ == "__main__":
+    main()
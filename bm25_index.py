@@ -0,0 +1,137 @@
+"""
+Incremental Inverted Index with BM25 Scoring
+Инвертированный индекс с ранжированием BM25
+
+Documents are tokenized once when they are added; the index keeps posting
+lists (term -> {doc_id: tf}), document lengths and the running average
+length, so add/remove are proportional to the document size and a query
+only touches the postings of its own terms. Top-k uses MaxScore pruning:
+once the remaining terms cannot lift an unseen document above the current
+k-th score, only already-scored documents are updated.
+"""
+
+import heapq
+import math
+import threading
+from collections import Counter
+from typing import Any, Dict, Hashable, Iterable, List, Tuple
+
+
+class BM25Index:
+    """Posting-list index over pre-tokenized documents"""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[Hashable, int]] = {}
+        self._doc_terms: Dict[Hashable, Counter] = {}
+        self._doc_lengths: Dict[Hashable, int] = {}
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._doc_lengths)
+
+    def __contains__(self, doc_id: Hashable) -> bool:
+        return doc_id in self._doc_lengths
+
+    def add_document(self, doc_id: Hashable, tokens: Iterable[str]):
+        """Add (or replace) a document given its tokens"""
+        term_counts = Counter(tokens)
+        with self._lock:
+            if doc_id in self._doc_lengths:
+                self._remove(doc_id)
+            for term, tf in term_counts.items():
+                self._postings.setdefault(term, {})[doc_id] = tf
+            length = sum(term_counts.values())
+            self._doc_terms[doc_id] = term_counts
+            self._doc_lengths[doc_id] = length
+            self._total_length += length
+
+    def remove_document(self, doc_id: Hashable) -> bool:
+        with self._lock:
+            if doc_id not in self._doc_lengths:
+                return False
+            self._remove(doc_id)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._doc_terms.clear()
+            self._doc_lengths.clear()
+            self._total_length = 0
+
+    def doc_ids(self) -> List[Hashable]:
+        return list(self._doc_lengths)
+
+    def document_frequency(self, term: str) -> int:
+        return len(self._postings.get(term, ()))
+
+    def idf(self, term: str) -> float:
+        """BM25 idf (Lucene variant, always positive)"""
+        df = self.document_frequency(term)
+        n = len(self._doc_lengths)
+        return math.log(1.0 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, query_tokens: Iterable[str], top_k: int = 10) -> List[Tuple[Hashable, float]]:
+        """Top-k (doc_id, score) by BM25, best first"""
+        if top_k <= 0:
+            return []
+
+        with self._lock:
+            n = len(self._doc_lengths)
+            if not n:
+                return []
+            avg_length = self._total_length / n or 1.0
+            k1, b = self.k1, self.b
+            doc_lengths = self._doc_lengths
+
+            terms = []
+            for term, query_tf in Counter(query_tokens).items():
+                postings = self._postings.get(term)
+                if postings:
+                    weight = self.idf(term) * query_tf
+                    # tf / (tf + k) < 1, so weight * (k1 + 1) bounds any document's contribution
+                    terms.append((weight * (k1 + 1), weight, postings))
+            if not terms:
+                return []
+
+            terms.sort(key=lambda item: item[0], reverse=True)
+            remaining = [0.0] * (len(terms) + 1)
+            for i in range(len(terms) - 1, -1, -1):
+                remaining[i] = remaining[i + 1] + terms[i][0]
+
+            scores: Dict[Hashable, float] = {}
+            for i, (_, weight, postings) in enumerate(terms):
+                threshold = heapq.nlargest(top_k, scores.values())[-1] if len(scores) >= top_k else -1.0
+                if remaining[i] > threshold:
+                    # Unseen documents can still reach the top-k: walk the whole posting list
+                    items = postings.items()
+                elif len(scores) < len(postings):
+                    # Only documents already scored can change the result
+                    items = [(doc_id, postings[doc_id]) for doc_id in scores if doc_id in postings]
+                else:
+                    items = [(doc_id, tf) for doc_id, tf in postings.items() if doc_id in scores]
+                for doc_id, tf in items:
+                    norm = k1 * (1.0 - b + b * doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf * (k1 + 1) / (tf + norm)
+
+            return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def get_stats(self) -> Dict[str, Any]:
+        n = len(self._doc_lengths)
+        return {
+            'documents': n,
+            'terms': len(self._postings),
+            'postings': sum(len(p) for p in self._postings.values()),
+            'avg_length': round(self._total_length / n, 2) if n else 0.0
+        }
+
+    def _remove(self, doc_id: Hashable):
+        for term in self._doc_terms.pop(doc_id):
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._doc_lengths.pop(doc_id)
@@ -0,0 +1,187 @@
+"""
+On-disk Snapshots of In-process Caches
+Снимки кэшей процесса на диске
+
+gunicorn recycles every worker after max_requests, and a fresh worker used
+to start with empty caches and send a burst of LLM calls. Caches register a
+dump/load pair here; each worker writes a compressed JSON snapshot
+periodically and from the worker_exit hook, merging with what the other
+workers already wrote, and a new worker loads the snapshots in post_fork.
+Entries keep their absolute expiry time, so TTLs survive the restart.
+
+A source may declare a version (e.g. the knowledge version token); a
+snapshot written under another version is ignored on load.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Optional
+
+try:
+    import fcntl
+except ImportError:  # snapshots are merged without a lock outside POSIX
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+
+
+def _default_snapshot_dir() -> str:
+    """Общий для воркеров каталог снимков (tmpfs, если доступен)"""
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base_dir, 'bolashak_cache_snapshots')
+
+
+@dataclass
+class SnapshotSource:
+    """dump() -> JSON-serializable data, load(data) -> restored entries, merge(old, new) -> data"""
+    name: str
+    dump: Callable[[], Any]
+    load: Callable[[Any], int]
+    merge: Optional[Callable[[Any, Any], Any]] = None
+    version: Optional[Callable[[], Optional[str]]] = None
+
+
+class CacheSnapshotStore:
+    """Registry of cache sources and their snapshot files"""
+
+    def __init__(self, directory: Optional[str] = None, interval: Optional[float] = None):
+        self.directory = directory or os.environ.get('CACHE_SNAPSHOT_DIR') or _default_snapshot_dir()
+        self.interval = interval if interval is not None else float(os.environ.get('CACHE_SNAPSHOT_INTERVAL', '300'))
+        self.sources: Dict[str, SnapshotSource] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self._stop = threading.Event()
+        self.stats = {
+            'saves': 0,
+            'restores': 0,
+            'entries_saved': 0,
+            'entries_restored': 0,
+            'errors': 0,
+            'last_save': None
+        }
+
+    def register(self, name: str, dump: Callable[[], Any], load: Callable[[Any], int],
+                 merge: Optional[Callable[[Any, Any], Any]] = None,
+                 version: Optional[Callable[[], Optional[str]]] = None):
+        self.sources[name] = SnapshotSource(name, dump, load, merge, version)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.json.z")
+
+    def _read(self, path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, 'rb') as f:
+                snapshot = json.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        if snapshot.get('format') != SNAPSHOT_FORMAT:
+            return None
+        return snapshot
+
+    def _source_version(self, source: SnapshotSource) -> Optional[str]:
+        return source.version() if source.version is not None else None
+
+    def save(self, names: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """Write (and merge) snapshots of the registered sources; returns entries per source"""
+        saved = {}
+        os.makedirs(self.directory, exist_ok=True)
+        for name in names or list(self.sources):
+            source = self.sources[name]
+            try:
+                saved[name] = self._save_source(source)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.warning(f"Failed to snapshot cache '{name}': {e}")
+        self.stats['saves'] += 1
+        self.stats['entries_saved'] += sum(saved.values())
+        self.stats['last_save'] = time.time()
+        return saved
+
+    def _save_source(self, source: SnapshotSource) -> int:
+        path = self._path(source.name)
+        version = self._source_version(source)
+        data = source.dump()
+
+        with open(path + '.lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Merge with what the other workers saved under the same version
+            if source.merge is not None:
+                previous = self._read(path)
+                if previous is not None and previous.get('version') == version:
+                    data = source.merge(previous['data'], data)
+
+            payload = zlib.compress(json.dumps({
+                'format': SNAPSHOT_FORMAT,
+                'version': version,
+                'saved_at': time.time(),
+                'pid': os.getpid(),
+                'data': data
+            }, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8'), 6)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f".{source.name}.")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return len(data)
+
+    def restore(self, names: Optional[Iterable[str]] = None) -> Dict[str, int]:
+        """Load the snapshots into the registered sources; returns restored entries per source"""
+        restored = {}
+        for name in names or list(self.sources):
+            source = self.sources[name]
+            try:
+                snapshot = self._read(self._path(name))
+                if snapshot is None:
+                    continue
+                if snapshot.get('version') != self._source_version(source):
+                    logger.info(f"Cache snapshot '{name}' is from another version, skipped")
+                    continue
+                restored[name] = source.load(snapshot['data'])
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.warning(f"Failed to restore cache snapshot '{name}': {e}")
+        self.stats['restores'] += 1
+        self.stats['entries_restored'] += sum(restored.values())
+        if restored:
+            logger.info(f"Restored cache snapshots: {restored}")
+        return restored
+
+    def start_periodic(self):
+        """Save every `interval` seconds from a daemon thread (one per process)"""
+        if self.interval <= 0 or (self._thread is not None and self._thread_pid == os.getpid()):
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='cache-snapshot')
+        self._thread_pid = os.getpid()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.save()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'directory': self.directory,
+            'interval': self.interval,
+            'sources': sorted(self.sources)
+        }
+
+
+# Global snapshot registry; caches register themselves at import time
+cache_snapshots = CacheSnapshotStore()
@@ -0,0 +1,170 @@
+"""
+Database Index Migration
+Миграция индексов базы данных
+
+db.create_all() creates indexes only together with new tables, so databases
+created before an index was declared in models.py never get it. apply_indexes()
+compares the indexes declared on every model with the ones the database has and
+creates the missing ones. On PostgreSQL they are built CONCURRENTLY, so
+user_queries stays writable while a large table is indexed; an interrupted
+concurrent build leaves an INVALID index the planner ignores, so those count as
+missing and are dropped and rebuilt.
+
+New nullable columns (such as user_queries.message_id) are added the same way
+by apply_columns(), which runs first so their indexes can be built. Adding a
+nullable column only changes the catalog, so the app also runs it once at
+startup (apply_columns_locked(), one process at a time); index builds can take
+longer than a request or a worker boot and are left to this script.
+
+Run after deploying a models.py change:
+
+    python db_migrations.py
+"""
+
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List, Set
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def _default_lock_file() -> str:
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base_dir, 'bolashak_db_migrations.lock')
+
+
+def declared_indexes(metadata=None) -> List:
+    """Indexes declared on the models, in table order"""
+    if metadata is None:
+        from models import db
+        metadata = db.metadata
+    return [index for table in metadata.sorted_tables for index in sorted(table.indexes, key=lambda i: i.name)]
+
+
+def invalid_indexes(engine) -> Set[str]:
+    """PostgreSQL indexes left INVALID by an interrupted CREATE INDEX CONCURRENTLY"""
+    if engine.dialect.name != 'postgresql':
+        return set()
+    with engine.connect() as connection:
+        rows = connection.execute(text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE NOT i.indisvalid AND pg_table_is_visible(c.oid)"
+        ))
+        return {name for (name,) in rows}
+
+
+def missing_indexes(engine, metadata=None) -> List:
+    """Declared indexes the database does not have yet or has as INVALID (tables that do not exist are skipped)"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    invalid = invalid_indexes(engine)
+    existing: Dict[str, set] = {}
+    missing = []
+    for index in declared_indexes(metadata):
+        table_name = index.table.name
+        if table_name not in tables:
+            continue
+        if table_name not in existing:
+            existing[table_name] = {i['name'] for i in inspector.get_indexes(table_name)}
+        if index.name not in existing[table_name] or index.name in invalid:
+            missing.append(index)
+    return missing
+
+
+def missing_columns(engine, metadata=None) -> List:
+    """Declared nullable columns missing from existing tables"""
+    if metadata is None:
+        from models import db
+        metadata = db.metadata
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        missing.extend(column for column in table.columns if column.name not in existing and column.nullable)
+    return missing
+
+
+def apply_columns(engine=None, metadata=None) -> List[Dict[str, object]]:
+    """ALTER TABLE ... ADD COLUMN for the missing nullable columns"""
+    if engine is None:
+        from models import db
+        engine = db.engine
+
+    added = []
+    for column in missing_columns(engine, metadata):
+        ddl = str(CreateColumn(column).compile(dialect=engine.dialect))
+        with engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {column.table.name} ADD COLUMN {ddl}"))
+        logger.info(f"Added column {column.table.name}.{column.name}")
+        added.append({'column': column.name, 'table': column.table.name})
+    return added
+
+
+def apply_columns_locked(engine=None, metadata=None, lock_file=None) -> List[Dict[str, object]]:
+    """apply_columns() under a file lock: processes starting together add each column once"""
+    if fcntl is None:
+        return apply_columns(engine, metadata)
+    with open(lock_file or _default_lock_file(), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return apply_columns(engine, metadata)
+
+
+def apply_indexes(engine=None, metadata=None) -> List[Dict[str, object]]:
+    """Create the missing indexes; returns name and build time of each one"""
+    if engine is None:
+        from models import db
+        engine = db.engine
+
+    created = []
+    invalid = invalid_indexes(engine)
+    for index in missing_indexes(engine, metadata):
+        start = time.perf_counter()
+        ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+        if engine.dialect.name == 'postgresql':
+            # CONCURRENTLY cannot run inside a transaction block
+            ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS', 1)
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                if index.name in invalid:
+                    # IF NOT EXISTS would keep the broken one
+                    logger.warning(f"Rebuilding invalid index {index.name} on {index.table.name}")
+                    connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+                connection.execute(text(ddl))
+        else:
+            with engine.begin() as connection:
+                connection.execute(text(ddl))
+        seconds = round(time.perf_counter() - start, 3)
+        logger.info(f"Created index {index.name} on {index.table.name} in {seconds}s")
+        created.append({'index': index.name, 'table': index.table.name, 'seconds': seconds})
+    return created
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    from app_context import app_context
+
+    with app_context():
+        added = apply_columns()
+        created = apply_indexes()
+    print(f"Added {len(added)} column(s)")
+    for item in added:
+        print(f"  {item['table']}.{item['column']}")
+    print(f"Created {len(created)} index(es)")
+    for item in created:
+        print(f"  {item['table']}.{item['index']}: {item['seconds']}s")
+
+
+if __name__ == '__main__':
+    main()
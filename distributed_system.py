@@ -2,296 +2,280 @@
 Distributed Caching and Async Processing System
 Система распределенного кэширования и асинхронной обработки
 
-This module provides enhanced caching with Redis support and
-asynchronous processing capabilities for better scalability.
+This module provides asynchronous processing capabilities and performance
+analysis for better scalability. Response caching (in-process L1 plus the
+optional Redis/SQLite L2) lives in response_cache.TieredResponseCache.
 """
 
 import logging
 import asyncio
-import json
+import os
+import tempfile
 import time
 import threading
-from typing import Dict, List, Optional, Any, Callable
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from queue import Queue, Empty
-import hashlib
+import heapq
+import itertools
+from collections import Counter, OrderedDict, defaultdict, deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Optional, Any, Callable, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+
+try:
+    import fcntl
+except ImportError:  # every worker warms its own cache outside POSIX
+    fcntl = None
+
+from analytics_rollups import LatencySketch
+from response_cache import response_cache
+from worker_metrics import MetricFamily, worker_metrics
 
 logger = logging.getLogger(__name__)
 
 
-class DistributedCache:
-    """Distributed caching system with Redis fallback to in-memory"""
-    
-    def __init__(self, redis_url: Optional[str] = None, default_ttl: int = 3600):
-        self.redis_client = None
-        self.redis_available = False
-        self.default_ttl = default_ttl
-        
-        # Fallback to in-memory cache
-        from response_cache import ResponseCache
-        self.memory_cache = ResponseCache(max_size=1000, default_ttl=default_ttl)
-        
-        # Try to initialize Redis if URL provided
-        if redis_url:
-            self._init_redis(redis_url)
-        
-        # Cache statistics
-        self.stats = {
-            'redis_hits': 0,
-            'redis_misses': 0,
-            'memory_hits': 0,
-            'memory_misses': 0,
-            'redis_errors': 0
-        }
-    
-    def _init_redis(self, redis_url: str):
-        """Initialize Redis connection"""
-        try:
-            import redis
-            self.redis_client = redis.from_url(redis_url, decode_responses=True)
-            
-            # Test connection
-            self.redis_client.ping()
-            self.redis_available = True
-            logger.info("Redis distributed cache initialized successfully")
-            
-        except ImportError:
-            logger.warning("Redis library not available, using memory cache only")
-        except Exception as e:
-            logger.warning(f"Failed to connect to Redis: {e}, using memory cache only")
-            self.redis_client = None
-    
-    def get(self, key: str) -> Optional[Any]:
-        """Get value from distributed cache"""
-        try:
-            # Try Redis first if available
-            if self.redis_available and self.redis_client:
-                try:
-                    value = self.redis_client.get(key)
-                    if value is not None:
-                        self.stats['redis_hits'] += 1
-                        return json.loads(value)
-                    else:
-                        self.stats['redis_misses'] += 1
-                except Exception as e:
-                    logger.error(f"Redis get error: {e}")
-                    self.stats['redis_errors'] += 1
-            
-            # Fallback to memory cache - create a simple key for compatibility
-            simple_key = key.replace(':', '_')
-            result = self.memory_cache.get(simple_key, 'unknown', 'ru')
-            
-            if result:
-                self.stats['memory_hits'] += 1
-                return result
-            else:
-                self.stats['memory_misses'] += 1
-                return None
-            
-        except Exception as e:
-            logger.error(f"Cache get error: {e}")
-            return None
-    
-    def set(self, key: str, value: Any, ttl: Optional[int] = None) -> bool:
-        """Set value in distributed cache"""
-        try:
-            ttl = ttl or self.default_ttl
-            serialized_value = json.dumps(value, ensure_ascii=False)
-            
-            # Try Redis first if available
-            if self.redis_available and self.redis_client:
-                try:
-                    self.redis_client.setex(key, ttl, serialized_value)
-                    logger.debug(f"Cached in Redis: {key}")
-                except Exception as e:
-                    logger.error(f"Redis set error: {e}")
-                    self.stats['redis_errors'] += 1
-            
-            # Always cache in memory as fallback
-            # Create a simple key for memory cache compatibility
-            simple_key = key.replace(':', '_')
-            self.memory_cache.set(simple_key, 'unknown', value, 'ru', ttl)
-            
-            return True
-            
-        except Exception as e:
-            logger.error(f"Cache set error: {e}")
-            return False
-    
-    def delete(self, key: str) -> bool:
-        """Delete value from distributed cache"""
-        try:
-            deleted = False
-            
-            # Delete from Redis if available
-            if self.redis_available and self.redis_client:
-                try:
-                    result = self.redis_client.delete(key)
-                    deleted = result > 0
-                except Exception as e:
-                    logger.error(f"Redis delete error: {e}")
-                    self.stats['redis_errors'] += 1
-            
-            # Note: Memory cache doesn't have direct delete by key
-            # This is a limitation of the fallback approach
-            
-            return deleted
-            
-        except Exception as e:
-            logger.error(f"Cache delete error: {e}")
-            return False
-    
-    def clear(self) -> bool:
-        """Clear all cache"""
-        try:
-            # Clear Redis if available
-            if self.redis_available and self.redis_client:
-                try:
-                    self.redis_client.flushdb()
-                except Exception as e:
-                    logger.error(f"Redis clear error: {e}")
-                    self.stats['redis_errors'] += 1
-            
-            # Clear memory cache
-            self.memory_cache.clear()
-            
-            logger.info("Distributed cache cleared")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Cache clear error: {e}")
-            return False
-    
-    def get_stats(self) -> Dict[str, Any]:
-        """Get cache statistics"""
-        memory_stats = self.memory_cache.get_stats()
-        
-        total_hits = self.stats['redis_hits'] + self.stats['memory_hits']
-        total_misses = self.stats['redis_misses'] + self.stats['memory_misses']
-        total_requests = total_hits + total_misses
-        
-        return {
-            'redis_available': self.redis_available,
-            'redis_stats': {
-                'hits': self.stats['redis_hits'],
-                'misses': self.stats['redis_misses'],
-                'errors': self.stats['redis_errors']
-            },
-            'memory_stats': memory_stats,
-            'combined_stats': {
-                'total_hits': total_hits,
-                'total_misses': total_misses,
-                'hit_rate': round(total_hits / total_requests * 100, 2) if total_requests > 0 else 0,
-                'total_requests': total_requests
-            }
-        }
+def _precompute_config() -> Dict[str, Any]:
+    """Warm-up settings from PRECOMPUTE_* environment variables"""
+    try:
+        start, end = (int(part) for part in os.environ.get('PRECOMPUTE_OFF_PEAK_HOURS', '1-6').split('-'))
+    except ValueError:
+        logger.warning("Invalid PRECOMPUTE_OFF_PEAK_HOURS, using 1-6")
+        start, end = 1, 6
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return {
+        'top_n': int(os.environ.get('PRECOMPUTE_TOP_N', '20')),
+        'concurrency': int(os.environ.get('PRECOMPUTE_CONCURRENCY', '2')),
+        'max_llm_calls': int(os.environ.get('PRECOMPUTE_MAX_LLM_CALLS', '200')),
+        'interval': float(os.environ.get('PRECOMPUTE_INTERVAL', '3600')),
+        'off_peak_hours': (start, end),
+        'lock_file': os.path.join(base_dir, 'bolashak_precompute.lock')
+    }
+
+
+class TaskQueueFullError(Exception):
+    """The task queue is at capacity and the task was not accepted"""
+
+
+class TaskShedError(Exception):
+    """A queued task was dropped to make room for a more important one"""
+
+
+@dataclass(order=True)
+class _QueuedTask:
+    priority: int
+    sequence: int
+    task_id: str = field(compare=False)
+    function: Callable = field(compare=False)
+    args: tuple = field(compare=False)
+    kwargs: dict = field(compare=False)
+    future: Future = field(compare=False)
+    submitted_at: float = field(compare=False)
 
 
 class AsyncTaskProcessor:
-    """Asynchronous task processing system for heavy operations"""
+    """Asynchronous task processing system for heavy operations
+
+    max_workers threads take tasks from a priority queue (lower number runs
+    first; FIFO within a priority). The queue is bounded: when it is full a
+    new task is rejected (policy 'reject') or, with 'shed', the least
+    important queued task is dropped if the new one is more important. Every
+    task is a concurrent.futures.Future, so waiting for a result blocks
+    without polling; uncollected results expire after result_ttl seconds.
+    """
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 5
+    PRIORITY_LOW = 10
+    LATENCY_WINDOW = 500  # recent tasks kept for latency percentiles
     
-    def __init__(self, max_workers: int = 4):
+    def __init__(self, max_workers: int = 4, max_queue_size: int = 100, overflow_policy: str = 'reject',
+                 result_ttl: float = 300.0, max_results: int = 1000):
+        if overflow_policy not in ('reject', 'shed'):
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
         self.max_workers = max_workers
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
-        self.task_queue = Queue()
-        self.results = {}
-        self.task_counter = 0
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.result_ttl = result_ttl
+        self.max_results = max_results
+
+        self._queue: List[_QueuedTask] = []
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self._tasks: Dict[str, Future] = {}
+        self._finished: 'OrderedDict[str, float]' = OrderedDict()  # task_id -> finished_at
+        self._workers: List[threading.Thread] = []
+        self._workers_pid: Optional[int] = None
         self.processing = True
-        
-        # Start background processor
-        self.processor_thread = threading.Thread(target=self._process_tasks, daemon=True)
-        self.processor_thread.start()
+        self.running = 0
+
+        self._queue_waits: Deque[float] = deque(maxlen=self.LATENCY_WINDOW)
+        self._run_times: Deque[float] = deque(maxlen=self.LATENCY_WINDOW)
+        # Cumulative, mergeable across workers (the deques above are a recent window)
+        self.queue_wait_sketch = LatencySketch()
+        self.processing_sketch = LatencySketch()
+        self._sketch_lock = threading.Lock()
         
         # Task statistics
         self.stats = {
             'tasks_submitted': 0,
             'tasks_completed': 0,
             'tasks_failed': 0,
+            'tasks_rejected': 0,
+            'tasks_shed': 0,
+            'results_expired': 0,
+            'peak_queue_size': 0,
             'average_processing_time': 0.0
         }
         
-        logger.info(f"Async task processor initialized with {max_workers} workers")
+        logger.info(f"Async task processor initialized with {max_workers} workers "
+                    f"(queue {max_queue_size}, overflow policy '{overflow_policy}')")
+
+    def _ensure_workers(self):
+        # Started lazily, and again after fork: threads of a preloaded master do not survive it
+        if self._workers_pid == os.getpid():
+            return
+        self._workers_pid = os.getpid()
+        self._workers = [
+            threading.Thread(target=self._worker_loop, daemon=True, name=f"async-task-{i}")
+            for i in range(self.max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
     
-    def submit_task(self, task_func: Callable, *args, **kwargs) -> str:
-        """Submit task for asynchronous processing"""
-        task_id = f"task_{self.task_counter}_{int(time.time())}"
-        self.task_counter += 1
-        
-        task = {
-            'id': task_id,
-            'function': task_func,
-            'args': args,
-            'kwargs': kwargs,
-            'submitted_at': time.time()
-        }
-        
-        self.task_queue.put(task)
-        self.stats['tasks_submitted'] += 1
-        
-        logger.debug(f"Submitted async task: {task_id}")
+    def submit_task(self, task_func: Callable, *args, priority: int = PRIORITY_NORMAL, **kwargs) -> str:
+        """Submit task for asynchronous processing; raises TaskQueueFullError when over capacity"""
+        future: Future = Future()
+        with self._condition:
+            if not self.processing:
+                raise RuntimeError("Async task processor is shut down")
+            self._ensure_workers()
+            self._evict_results()
+
+            sequence = next(self._sequence)
+            task_id = f"task_{sequence}_{int(time.time())}"
+            if len(self._queue) >= self.max_queue_size:
+                self._make_room(priority)
+
+            heapq.heappush(self._queue, _QueuedTask(priority, sequence, task_id, task_func, args, kwargs,
+                                                    future, time.time()))
+            self._tasks[task_id] = future
+            self.stats['tasks_submitted'] += 1
+            self.stats['peak_queue_size'] = max(self.stats['peak_queue_size'], len(self._queue))
+            self._condition.notify()
+        
+        logger.debug(f"Submitted async task: {task_id} (priority {priority})")
         return task_id
+
+    def _make_room(self, priority: int):
+        """Apply the overflow policy to a full queue (called with the lock held)"""
+        if self.overflow_policy == 'shed':
+            # Least important = highest priority number, newest within it
+            victim = max(self._queue)
+            if victim.priority > priority:
+                self._queue.remove(victim)
+                heapq.heapify(self._queue)
+                victim.future.set_exception(TaskShedError(f"Task {victim.task_id} shed from a full queue"))
+                self._mark_finished(victim.task_id)
+                self.stats['tasks_shed'] += 1
+                logger.warning(f"Shed queued task {victim.task_id} (priority {victim.priority})")
+                return
+        self.stats['tasks_rejected'] += 1
+        raise TaskQueueFullError(f"Task queue is full ({self.max_queue_size} tasks)")
+
+    def get_future(self, task_id: str) -> Optional[Future]:
+        """Future of a task (None if unknown or already collected/expired)"""
+        with self._condition:
+            return self._tasks.get(task_id)
     
     def get_result(self, task_id: str, timeout: Optional[float] = None) -> Optional[Any]:
-        """Get result of async task"""
-        start_time = time.time()
-        
-        while True:
-            if task_id in self.results:
-                result = self.results.pop(task_id)
-                if result['status'] == 'completed':
-                    return result['data']
-                elif result['status'] == 'failed':
-                    raise Exception(f"Task failed: {result['error']}")
-            
-            if timeout and (time.time() - start_time) > timeout:
-                return None
-            
-            time.sleep(0.1)  # Small delay to avoid busy waiting
+        """Wait for a task result (None on timeout or unknown task); the result is collected once"""
+        future = self.get_future(task_id)
+        if future is None:
+            return None
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            return None
+        except TaskShedError:
+            self._collect(task_id)
+            raise
+        except Exception as e:
+            self._collect(task_id)
+            raise Exception(f"Task failed: {e}") from e
+        self._collect(task_id)
+        return result
+
+    def _collect(self, task_id: str):
+        with self._condition:
+            self._tasks.pop(task_id, None)
+            self._finished.pop(task_id, None)
     
-    def _process_tasks(self):
-        """Background task processor"""
-        while self.processing:
+    def _worker_loop(self):
+        """Run queued tasks until shutdown"""
+        while True:
+            with self._condition:
+                while self.processing and not self._queue:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                task = heapq.heappop(self._queue)
+                self.running += 1
             try:
-                task = self.task_queue.get(timeout=1.0)
                 self._execute_task(task)
-            except Empty:
-                continue
-            except Exception as e:
-                logger.error(f"Task processor error: {e}")
+            finally:
+                with self._condition:
+                    self.running -= 1
     
-    def _execute_task(self, task: Dict[str, Any]):
+    def _record_run_time(self, processing_time: float):
+        self._run_times.append(processing_time)
+        with self._sketch_lock:
+            self.processing_sketch.add(processing_time)
+
+    def _execute_task(self, task: _QueuedTask):
         """Execute a single task"""
-        task_id = task['id']
+        if not task.future.set_running_or_notify_cancel():
+            self._mark_finished(task.task_id)
+            return
+
         start_time = time.time()
-        
+        self._queue_waits.append(start_time - task.submitted_at)
+        with self._sketch_lock:
+            self.queue_wait_sketch.add(start_time - task.submitted_at)
         try:
             # Execute task function
-            result = task['function'](*task['args'], **task['kwargs'])
-            
-            # Store result
+            result = task.function(*task.args, **task.kwargs)
+        except Exception as e:
             processing_time = time.time() - start_time
-            self.results[task_id] = {
-                'status': 'completed',
-                'data': result,
-                'processing_time': processing_time
-            }
+            self._record_run_time(processing_time)
+            self.stats['tasks_failed'] += 1
+            logger.error(f"Task failed: {task.task_id} - {e}")
+            task.future.set_exception(e)
+        else:
+            processing_time = time.time() - start_time
+            self._record_run_time(processing_time)
             
             # Update statistics
             self.stats['tasks_completed'] += 1
             self._update_average_processing_time(processing_time)
-            
-            logger.debug(f"Task completed: {task_id} in {processing_time:.2f}s")
-            
-        except Exception as e:
-            # Store error
-            self.results[task_id] = {
-                'status': 'failed',
-                'error': str(e),
-                'processing_time': time.time() - start_time
-            }
-            
-            self.stats['tasks_failed'] += 1
-            logger.error(f"Task failed: {task_id} - {e}")
+            logger.debug(f"Task completed: {task.task_id} in {processing_time:.2f}s")
+            task.future.set_result(result)
+        self._mark_finished(task.task_id)
+
+    def _mark_finished(self, task_id: str):
+        with self._condition:
+            if task_id in self._tasks:
+                self._finished[task_id] = time.time()
+                self._finished.move_to_end(task_id)
+
+    def _evict_results(self):
+        """Drop uncollected results older than result_ttl or beyond max_results (lock held)"""
+        deadline = time.time() - self.result_ttl
+        while self._finished:
+            task_id, finished_at = next(iter(self._finished.items()))
+            if finished_at > deadline and len(self._finished) <= self.max_results:
+                break
+            del self._finished[task_id]
+            self._tasks.pop(task_id, None)
+            self.stats['results_expired'] += 1
     
     def _update_average_processing_time(self, new_time: float):
         """Update average processing time"""
@@ -304,34 +288,71 @@ class AsyncTaskProcessor:
             self.stats['average_processing_time'] = (current_avg * 0.9 + new_time * 0.1)
     
     def get_task_status(self, task_id: str) -> str:
-        """Get status of a task"""
-        if task_id in self.results:
-            return self.results[task_id]['status']
-        else:
+        """Get status of a task: pending, running, completed, failed, shed or unknown"""
+        future = self.get_future(task_id)
+        if future is None:
+            return 'unknown'
+        if future.running():
+            return 'running'
+        if not future.done():
             return 'pending'
+        if future.cancelled():
+            return 'cancelled'
+        error = future.exception()
+        if error is None:
+            return 'completed'
+        return 'shed' if isinstance(error, TaskShedError) else 'failed'
+
+    @staticmethod
+    def _percentiles(samples) -> Dict[str, float]:
+        if not samples:
+            return {'avg': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+        ordered = sorted(samples)
+        return {
+            'avg': sum(ordered) / len(ordered),
+            'p50': ordered[len(ordered) // 2],
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            'max': ordered[-1]
+        }
     
     def get_stats(self) -> Dict[str, Any]:
         """Get processor statistics"""
+        with self._condition:
+            self._evict_results()
+            queue_size = len(self._queue)
+            pending_results = len(self._finished)
+            running = self.running
         return {
             'max_workers': self.max_workers,
-            'queue_size': self.task_queue.qsize(),
-            'pending_results': len(self.results),
+            'queue_size': queue_size,
+            'queue_capacity': self.max_queue_size,
+            'overflow_policy': self.overflow_policy,
+            'running': running,
+            'pending_results': pending_results,
+            'latency': {
+                'queue_wait': self._percentiles(list(self._queue_waits)),
+                'processing': self._percentiles(list(self._run_times))
+            },
             'statistics': self.stats.copy()
         }
     
-    def shutdown(self):
-        """Shutdown the processor"""
-        self.processing = False
-        self.executor.shutdown(wait=True)
+    def shutdown(self, wait: bool = True):
+        """Shutdown the processor: queued tasks still run, new ones are refused"""
+        with self._condition:
+            self.processing = False
+            self._condition.notify_all()
+        if wait:
+            for worker in self._workers:
+                if worker.is_alive() and worker is not threading.current_thread():
+                    worker.join()
         logger.info("Async task processor shutdown")
 
 
 class PerformanceOptimizer:
     """Performance optimization coordinator"""
     
-    def __init__(self, distributed_cache: DistributedCache, 
-                 async_processor: AsyncTaskProcessor):
-        self.cache = distributed_cache
+    def __init__(self, cache, async_processor: AsyncTaskProcessor):
+        self.cache = cache
         self.async_processor = async_processor
         
         # Performance thresholds
@@ -339,6 +360,7 @@ class PerformanceOptimizer:
             'slow_response_time': 3.0,  # seconds
             'low_cache_hit_rate': 0.25,  # 25%
             'high_queue_size': 10,      # tasks
+            'slow_queue_wait': 1.0,     # seconds (p95 wait before a worker picks a task up)
             'error_rate_limit': 0.05     # 5%
         }
         
@@ -349,26 +371,35 @@ class PerformanceOptimizer:
             'async_knowledge_search': False,  # Disabled to prevent hanging
             'response_compression': True
         }
+
+        # Popular query warm-up: progress of the last run, cumulative cost and live hits
+        self.precompute_config = _precompute_config()
+        self.precompute_stats = {
+            'running': False,
+            'runs': 0,
+            'last_run_started': None,
+            'last_run_finished': None,
+            'planned': 0,
+            'done': 0,
+            'generated': 0,
+            'already_cached': 0,
+            'skipped': 0,
+            'not_cacheable': 0,
+            'failed': 0,
+            'llm_calls_total': 0,
+            'llm_seconds_total': 0.0,
+            'response_chars_total': 0,
+            'live_hits': 0,
+            'live_hits_by_agent': {}
+        }
+        self._precompute_lock = threading.Lock()
+        self._scheduler_pid: Optional[int] = None
     
     def optimize_response_generation(self, user_message: str, agent_type: str, 
                                    language: str = 'ru') -> Dict[str, Any]:
-        """Optimize response generation with caching and async processing"""
+        """Decide whether a query goes to async processing (cache lookups are done by the agents)"""
         optimization_start = time.time()
         
-        # Generate cache key
-        cache_key = self._generate_cache_key(user_message, agent_type, language)
-        
-        # Check distributed cache first
-        cached_result = self.cache.get(cache_key)
-        if cached_result:
-            logger.debug(f"Cache hit for optimized response: {cache_key}")
-            return {
-                'response': cached_result,
-                'cached': True,
-                'optimization_time': time.time() - optimization_start,
-                'source': 'distributed_cache'
-            }
-        
         # If enabled, submit to async processing for complex queries
         if (self.optimizations['async_knowledge_search'] and 
             len(user_message) > 50):  # Complex query heuristic
@@ -385,50 +416,206 @@ class PerformanceOptimizer:
             'optimization_time': time.time() - optimization_start
         }
     
-    def precompute_popular_queries(self, popular_queries: List[Dict[str, str]]):
-        """Precompute responses for popular queries"""
+    def mine_popular_queries(self, top_n: Optional[int] = None, days: int = 14,
+                             min_count: int = 3) -> List[Dict[str, Any]]:
+        """Most frequent questions per agent and language from user_queries
+
+        Messages are folded by their canonical form (case, punctuation,
+        stop-words, inflection), and each group is represented by its most
+        frequent wording.
+        """
+        from sqlalchemy import func
+        from app_context import app_context
+        from models import UserQuery, db
+        from semantic_cache import canonicalize_question
+
+        top_n = top_n or self.precompute_config['top_n']
+        since = datetime.utcnow() - timedelta(days=days)
+        with app_context():
+            rows = db.session.query(
+                UserQuery.user_message, UserQuery.agent_type, UserQuery.language, func.count(UserQuery.id)
+            ).filter(
+                UserQuery.created_at >= since,
+                UserQuery.agent_type.isnot(None),
+                UserQuery.agent_type != 'error'
+            ).group_by(UserQuery.user_message, UserQuery.agent_type, UserQuery.language).all()
+
+        groups: Dict[Tuple[str, str, Any], Counter] = defaultdict(Counter)
+        for message, agent_type, language, count in rows:
+            message = ' '.join((message or '').split())
+            if len(message) < 10:  # too short to be cached
+                continue
+            tokens, guards = canonicalize_question(message, language)
+            if not tokens:
+                continue
+            groups[(agent_type, language, (tuple(sorted(set(tokens))), guards))][message] += count
+
+        by_agent: Dict[Tuple[str, str], List[Dict[str, Any]]] = defaultdict(list)
+        for (agent_type, language, _), wordings in groups.items():
+            total = sum(wordings.values())
+            if total >= min_count:
+                by_agent[(agent_type, language)].append({
+                    'message': wordings.most_common(1)[0][0],
+                    'agent_type': agent_type,
+                    'language': language,
+                    'count': total
+                })
+
+        popular = []
+        for queries in by_agent.values():
+            popular.extend(sorted(queries, key=lambda q: -q['count'])[:top_n])
+        return sorted(popular, key=lambda q: -q['count'])
+
+    def precompute_popular_queries(self, popular_queries: Optional[List[Dict[str, Any]]] = None,
+                                   concurrency: Optional[int] = None,
+                                   max_llm_calls: Optional[int] = None) -> Dict[str, Any]:
+        """Run popular questions through their agents so the answers are cached ahead of demand
+
+        Mines user_queries when no list is given. At most `concurrency`
+        questions are in flight and at most `max_llm_calls` answers are
+        generated per run; questions already cached cost nothing.
+        """
         if not self.optimizations['precompute_popular_queries']:
+            return self.get_precompute_stats()
+        if not self._precompute_lock.acquire(blocking=False):
+            logger.info("Precomputation already running, skipped")
+            return self.get_precompute_stats()
+
+        try:
+            from views import initialize_agent_router
+
+            queries = popular_queries if popular_queries is not None else self.mine_popular_queries()
+            concurrency = concurrency or self.precompute_config['concurrency']
+            budget = max_llm_calls if max_llm_calls is not None else self.precompute_config['max_llm_calls']
+            agents = {agent.agent_type: agent for agent in initialize_agent_router().agents}
+
+            run = self.precompute_stats
+            run.update({
+                'running': True,
+                'last_run_started': time.time(),
+                'last_run_finished': None,
+                'planned': len(queries),
+                'done': 0,
+                'generated': 0,
+                'already_cached': 0,
+                'skipped': 0,
+                'not_cacheable': 0,
+                'failed': 0
+            })
+            logger.info(f"Precomputing {len(queries)} popular queries (concurrency {concurrency}, "
+                        f"budget {budget} LLM calls)...")
+
+            counters_lock = threading.Lock()
+            reserved = 0  # LLM calls this run has started or finished (the budget)
+
+            def count(**deltas):
+                with counters_lock:
+                    for key, delta in deltas.items():
+                        run[key] += delta
+
+            def precompute(query_data: Dict[str, Any]):
+                nonlocal reserved
+                agent = agents.get(query_data.get('agent_type'))
+                with counters_lock:
+                    # Reserve the call before making it, so concurrent threads cannot overshoot the budget
+                    if agent is None or reserved >= budget:
+                        run['skipped'] += 1
+                        return
+                    reserved += 1
+                start = time.time()
+                try:
+                    response_data, cached = self._compute_response(agent, query_data['message'],
+                                                                   query_data.get('language', 'ru'))
+                except Exception:
+                    count(llm_calls_total=1, llm_seconds_total=time.time() - start)
+                    raise
+                if cached or response_data.get('skipped'):
+                    with counters_lock:
+                        reserved -= 1  # answered without an LLM call: give the slot back
+                        run['already_cached' if cached else 'skipped'] += 1
+                    return
+
+                # Failed generations used the LLM too and count toward the budget
+                count(llm_calls_total=1, llm_seconds_total=time.time() - start)
+                if response_data.get('error'):
+                    count(failed=1)
+                    return
+                count(generated=1, response_chars_total=len(response_data.get('response', '')))
+                if not self.cache.should_cache(query_data['message'], response_data):
+                    count(not_cacheable=1)  # e.g. low confidence: generated but not stored
+
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='precompute') as pool:
+                for future in as_completed([pool.submit(precompute, query) for query in queries]):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        count(failed=1)
+                        logger.warning(f"Precomputation failed: {e}")
+                    count(done=1)
+
+            run['runs'] += 1
+            logger.info(f"Precomputation finished: {run['generated']} generated, "
+                        f"{run['already_cached']} already cached, {run['failed']} failed")
+        finally:
+            self.precompute_stats['running'] = False
+            self.precompute_stats['last_run_finished'] = time.time()
+            self._precompute_lock.release()
+        return self.get_precompute_stats()
+
+    def _compute_response(self, agent, message: str, language: str) -> Tuple[Dict[str, Any], bool]:
+        """Real agent path for one popular question (context, LLM, response cache)"""
+        from app_context import app_context
+
+        with app_context():
+            return agent.precompute_response(message, language)
+
+    def record_precomputed_hit(self, agent_type: str, language: str):
+        """A live request was answered by a precomputed cache entry"""
+        self.precompute_stats['live_hits'] += 1
+        key = f"{agent_type}:{language}"
+        self.precompute_stats['live_hits_by_agent'][key] = self.precompute_stats['live_hits_by_agent'].get(key, 0) + 1
+
+    def is_off_peak(self, now: Optional[datetime] = None) -> bool:
+        """Whether the local hour is inside PRECOMPUTE_OFF_PEAK_HOURS ("start-end", may wrap midnight)"""
+        start, end = self.precompute_config['off_peak_hours']
+        hour = (now or datetime.now()).hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def start_precompute_scheduler(self):
+        """Warm the cache once per interval during off-peak hours (one thread per process)
+
+        With a shared L2 cache only one worker at a time runs the warm-up
+        (file lock); without one, each worker warms its own in-process cache.
+        """
+        if self._scheduler_pid == os.getpid():
             return
-        
-        logger.info(f"Precomputing {len(popular_queries)} popular queries...")
-        
-        for query_data in popular_queries:
-            message = query_data.get('message', '')
-            agent_type = query_data.get('agent_type', '')
-            language = query_data.get('language', 'ru')
-            
-            # Submit for async processing
-            task_id = self.async_processor.submit_task(
-                self._compute_response,
-                message, agent_type, language
-            )
-            
-            logger.debug(f"Submitted precomputation task: {task_id}")
-    
-    def _compute_response(self, message: str, agent_type: str, language: str) -> Dict[str, Any]:
-        """Compute response (placeholder for actual response generation)"""
-        # This would integrate with the actual agent system
-        # For now, return a placeholder
-        time.sleep(0.5)  # Simulate processing time
-        
-        return {
-            'message': message,
-            'agent_type': agent_type,
-            'language': language,
-            'computed_at': time.time(),
-            'precomputed': True
-        }
-    
-    def _generate_cache_key(self, message: str, agent_type: str, language: str) -> str:
-        """Generate optimized cache key"""
-        # Normalize message for better cache hits
-        normalized_message = message.lower().strip()
-        
-        # Create hash for key
-        key_data = f"{normalized_message}:{agent_type}:{language}"
-        key_hash = hashlib.md5(key_data.encode('utf-8')).hexdigest()[:12]
-        
-        return f"optimized:{key_hash}:{agent_type}:{language}"
+        self._scheduler_pid = os.getpid()
+        threading.Thread(target=self._precompute_loop, daemon=True, name='precompute-scheduler').start()
+        logger.info("Popular query precomputation scheduled for off-peak hours")
+
+    def _precompute_loop(self):
+        while True:
+            time.sleep(self.precompute_config['interval'])
+            if not self.is_off_peak():
+                continue
+            try:
+                if getattr(self.cache, 'l2', None) is None or fcntl is None:
+                    self.precompute_popular_queries()
+                    continue
+                with open(self.precompute_config['lock_file'], 'w') as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    self.precompute_popular_queries()
+            except Exception as e:
+                logger.warning(f"Scheduled precomputation failed: {e}")
+
+    def get_precompute_stats(self) -> Dict[str, Any]:
+        stats = dict(self.precompute_stats)
+        stats['live_hits_by_agent'] = dict(stats['live_hits_by_agent'])
+        stats['off_peak_now'] = self.is_off_peak()
+        return stats
     
     def analyze_performance(self) -> Dict[str, Any]:
         """Analyze system performance and suggest optimizations"""
@@ -442,7 +629,7 @@ class PerformanceOptimizer:
         }
         
         # Generate recommendations
-        cache_hit_rate = cache_stats['combined_stats']['hit_rate'] / 100
+        cache_hit_rate = cache_stats['hit_rate'] / 100
         if cache_hit_rate < self.thresholds['low_cache_hit_rate']:
             analysis['recommendations'].append(
                 f"Low cache hit rate ({cache_hit_rate:.1%}). Consider enabling aggressive caching."
@@ -459,18 +646,28 @@ class PerformanceOptimizer:
             analysis['recommendations'].append(
                 f"High queue size ({queue_size}). Consider adding more workers."
             )
+
+        queue_wait_p95 = processor_stats['latency']['queue_wait']['p95']
+        if queue_wait_p95 > self.thresholds['slow_queue_wait']:
+            analysis['recommendations'].append(
+                f"Tasks wait {queue_wait_p95:.2f}s (p95) for a worker. Consider adding more workers."
+            )
+
+        dropped = processor_stats['statistics']['tasks_rejected'] + processor_stats['statistics']['tasks_shed']
+        if dropped:
+            analysis['recommendations'].append(
+                f"{dropped} tasks were rejected or shed by the full queue ({processor_stats['queue_capacity']})."
+            )
         
         return analysis
     
     def _analyze_cache_performance(self, stats: Dict[str, Any]) -> Dict[str, Any]:
         """Analyze cache performance"""
-        combined = stats['combined_stats']
-        
         return {
-            'hit_rate': combined['hit_rate'],
-            'total_requests': combined['total_requests'],
-            'redis_available': stats['redis_available'],
-            'performance_rating': self._calculate_cache_rating(combined['hit_rate'])
+            'hit_rate': stats['hit_rate'],
+            'total_requests': stats['hits'] + stats['misses'],
+            'l2_backend': stats['l2_backend'],
+            'performance_rating': self._calculate_cache_rating(stats['hit_rate'])
         }
     
     def _analyze_processing_performance(self, stats: Dict[str, Any]) -> Dict[str, Any]:
@@ -485,6 +682,12 @@ class PerformanceOptimizer:
             'error_rate': error_rate,
             'average_time': statistics['average_processing_time'],
             'queue_size': stats['queue_size'],
+            'queue_utilization': stats['queue_size'] / stats['queue_capacity'] if stats['queue_capacity'] else 0,
+            'worker_utilization': stats['running'] / stats['max_workers'] if stats['max_workers'] else 0,
+            'queue_wait_p95': stats['latency']['queue_wait']['p95'],
+            'processing_p95': stats['latency']['processing']['p95'],
+            'rejected': statistics['tasks_rejected'],
+            'shed': statistics['tasks_shed'],
             'performance_rating': self._calculate_processing_rating(
                 statistics['average_processing_time'], error_rate
             )
@@ -518,11 +721,38 @@ class PerformanceOptimizer:
             'thresholds': self.thresholds,
             'optimizations_enabled': self.optimizations,
             'cache_stats': self.cache.get_stats(),
-            'processor_stats': self.async_processor.get_stats()
+            'processor_stats': self.async_processor.get_stats(),
+            'precompute': self.get_precompute_stats()
         }
 
 
 # Global instances
-distributed_cache = DistributedCache()
 async_processor = AsyncTaskProcessor(max_workers=4)
-performance_optimizer = PerformanceOptimizer(distributed_cache, async_processor)
\ No newline at end of file
+performance_optimizer = PerformanceOptimizer(response_cache, async_processor)
+
+
+def _collect_metrics() -> List[MetricFamily]:
+    stats = async_processor.stats
+    with async_processor._sketch_lock:
+        queue_wait = LatencySketch.from_dict(async_processor.queue_wait_sketch.to_dict())
+        processing = LatencySketch.from_dict(async_processor.processing_sketch.to_dict())
+    tasks = MetricFamily('bolashak_async_tasks_total', 'counter', 'Background tasks by outcome')
+    for outcome in ('submitted', 'completed', 'failed', 'rejected', 'shed'):
+        tasks.add(stats[f'tasks_{outcome}'], outcome=outcome)
+    precompute = performance_optimizer.precompute_stats
+    return [
+        tasks,
+        MetricFamily('bolashak_async_queue_size', 'gauge', 'Background tasks waiting for a worker thread')
+        .add(len(async_processor._queue)),
+        MetricFamily('bolashak_async_running', 'gauge', 'Background tasks running').add(async_processor.running),
+        MetricFamily('bolashak_async_queue_wait_seconds', 'summary', 'Time tasks waited in the queue')
+        .add(queue_wait),
+        MetricFamily('bolashak_async_processing_seconds', 'summary', 'Task processing time').add(processing),
+        MetricFamily('bolashak_precompute_hits_total', 'counter', 'Live requests answered by precomputed entries')
+        .add(precompute['live_hits']),
+        MetricFamily('bolashak_precompute_llm_calls_total', 'counter', 'LLM calls spent on warm-up')
+        .add(precompute['llm_calls_total']),
+    ]
+
+
+worker_metrics.register('async_processor', _collect_metrics)
\ No newline at end of file
@@ -234,6 +234,7 @@ class KnowledgeBaseUpdater:
                 self.db.session.add(kb_entry)
 
             self.db.session.commit()
+            self._bump_knowledge_version('update_from_document')
             logger.info(f"Updated knowledge base with {len(chunks)} chunks from document {document_id}")
             return True
 
@@ -278,6 +279,7 @@ class KnowledgeBaseUpdater:
                 self.db.session.add(kb_entry)
 
             self.db.session.commit()
+            self._bump_knowledge_version('update_from_web_source')
             logger.info(f"Updated knowledge base with {len(chunks)} chunks from web source {web_source_id}")
             return True
 
@@ -288,6 +290,16 @@ class KnowledgeBaseUpdater:
 
     def get_relevant_content(self, query: str, language: str = 'ru', limit: int = 5) -> List[str]:
         """Get relevant content from knowledge base"""
+        try:
+            from knowledge_search import knowledge_search_engine
+            chunks = (knowledge_search_engine.search_chunks(query, language, limit)
+                      or knowledge_search_engine.dense_chunks(query, limit))
+            if chunks:
+                return [chunk['content'] for chunk in chunks]
+            # Neither index found anything (substrings, vectors not built yet): keyword matching below
+        except Exception as e:
+            logger.warning(f"Chunk index search failed, using keyword matching: {e}")
+
         try:
             query_lower = query.lower()
             keywords = [word for word in query_lower.split() if len(word) > 2]
@@ -312,4 +324,12 @@ class KnowledgeBaseUpdater:
 
         except Exception as e:
             logger.error(f"Error getting relevant content: {str(e)}")
-            return []
\ No newline at end of file
+            return []
+
+    def _bump_knowledge_version(self, reason: str):
+        """Chunk indexes in every worker re-sync changed chunks on next search"""
+        try:
+            from knowledge_snapshot import knowledge_snapshot
+            knowledge_snapshot.bump_version(reason)
+        except Exception as e:
+            logger.warning(f"Could not bump knowledge version: {e}")
@@ -22,6 +22,11 @@ max_requests_jitter = 100
 # Application
 module = "main:application"
 
+# asyncio chat path (asgi.py): one worker keeps hundreds of LLM calls in flight
+if os.environ.get('ASYNC_WORKERS') == '1':
+    worker_class = "uvicorn.workers.UvicornWorker"
+    wsgi_app = "asgi:application"
+
 # Logging
 accesslog = "-"  # Log to stdout
 errorlog = "-"   # Log to stderr
@@ -61,6 +66,60 @@ def pre_fork(server, worker):
 def post_fork(server, worker):
     """Called just after a worker has been forked."""
     server.log.info(f"Worker spawned (pid: {worker.pid})")
+    # Start warm after max_requests recycling: load cache snapshots, keep saving them
+    try:
+        import response_cache  # noqa: F401  (registers its snapshot source)
+        import semantic_search  # noqa: F401
+        from cache_snapshot import cache_snapshots
+        restored = cache_snapshots.restore()
+        cache_snapshots.start_periodic()
+        server.log.info(f"Worker {worker.pid} restored cache snapshots: {restored}")
+    except Exception as e:
+        server.log.warning(f"Cache snapshot restore failed: {e}")
+    # Report this worker's counters to the shared store behind /metrics
+    try:
+        from worker_metrics import worker_metrics, load_default_collectors
+        load_default_collectors()
+        worker_metrics.start_periodic()
+    except Exception as e:
+        server.log.warning(f"Worker metrics reporting failed to start: {e}")
+    # Keep the statistics rollups current (one worker at a time refreshes them)
+    try:
+        from statistics_rollups import statistics_rollups
+        statistics_rollups.start_periodic()
+    except Exception as e:
+        server.log.warning(f"Statistics rollup refresh failed to start: {e}")
+    # Off-peak warm-up of popular questions (spends LLM calls, opt-in)
+    if os.environ.get('PRECOMPUTE_ENABLED') == '1':
+        try:
+            from distributed_system import performance_optimizer
+            performance_optimizer.start_precompute_scheduler()
+        except Exception as e:
+            server.log.warning(f"Precompute scheduler not started: {e}")
+
+def worker_exit(server, worker):
+    """Called just after a worker has exited, in the worker process."""
+    # Queued per-turn writes (user contexts, router history) go first
+    try:
+        from write_behind import write_behind
+        written = write_behind.stop()
+        server.log.info(f"Worker {worker.pid} flushed {written} queued writes")
+    except Exception as e:
+        server.log.warning(f"Write-behind flush failed: {e}")
+    try:
+        from cache_snapshot import cache_snapshots
+        cache_snapshots.stop()
+        saved = cache_snapshots.save()
+        server.log.info(f"Worker {worker.pid} saved cache snapshots: {saved}")
+    except Exception as e:
+        server.log.warning(f"Cache snapshot save failed: {e}")
+    # Final counters of this worker stay in the server totals
+    try:
+        from worker_metrics import worker_metrics
+        worker_metrics.stop()
+        worker_metrics.retire()
+    except Exception as e:
+        server.log.warning(f"Worker metrics retire failed: {e}")
 
 def worker_abort(worker):
     """Called when a worker is killed due to timeout."""
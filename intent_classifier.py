@@ -14,12 +14,25 @@ from collections import Counter, defaultdict
 from difflib import SequenceMatcher
 import math
 
+from keyword_matcher import keyword_matcher
+
 logger = logging.getLogger(__name__)
 
+# Characters that make a training pattern a real regular expression
+_REGEX_META = set('.^$*+?{}[]\\|()')
+
 
 class MLIntentClassifier:
     """Machine Learning-based intent classifier for multi-agent routing"""
     
+    QUESTION_INDICATORS = {
+        'what': ['что', 'какой', 'какая', 'какие'],
+        'how': ['как', 'каким образом'],
+        'when': ['когда', 'во сколько'],
+        'where': ['где', 'куда'],
+        'why': ['почему', 'зачем']
+    }
+    
     def __init__(self):
         self.feature_weights = {
             'keyword_exact': 0.35,
@@ -157,6 +170,23 @@ class MLIntentClassifier:
                 'question_types': ['accommodation', 'room_issues', 'services']
             }
         }
+        self._register_keyword_groups()
+    
+    def _register_keyword_groups(self):
+        """Register training phrase lists with the shared keyword automaton"""
+        self._regex_patterns = {}
+        for agent, data in self.training_data.items():
+            keyword_matcher.register(f'intent:{agent}:keywords', data['keywords'])
+            keyword_matcher.register(f'intent:{agent}:exclusions', data.get('exclusions', []))
+            keyword_matcher.register(f'intent:{agent}:context_indicators', data['context_indicators'])
+            
+            # Literal patterns go to the automaton, real regular expressions stay regex
+            literal = [p for p in data['patterns'] if not _REGEX_META.intersection(p)]
+            self._regex_patterns[agent] = [p for p in data['patterns'] if _REGEX_META.intersection(p)]
+            keyword_matcher.register(f'intent:{agent}:patterns', literal)
+        
+        for q_type, indicators in self.QUESTION_INDICATORS.items():
+            keyword_matcher.register(f'intent:question:{q_type}', indicators)
     
     def _extract_features(self, message: str, language: str = 'ru') -> Dict[str, float]:
         """Extract ML features from user message"""
@@ -168,16 +198,17 @@ class MLIntentClassifier:
         clean_message = re.sub(r'[^\w\s]', ' ', message_lower)
         words = clean_message.split()
         
+        # Single shared keyword scan for all agents' lists
+        scan = keyword_matcher.scan(message_lower)
+        
         # 1. Keyword exact match features with exclusions
         for agent, data in self.training_data.items():
-            exact_matches = sum(1 for keyword in data['keywords'] 
-                              if keyword in message_lower)
+            exact_matches = scan.count(f'intent:{agent}:keywords')
             
             # Check for exclusions
             exclusion_penalty = 0.0
             if 'exclusions' in data:
-                exclusions_found = sum(1 for exclusion in data['exclusions'] 
-                                     if exclusion in message_lower)
+                exclusions_found = scan.count(f'intent:{agent}:exclusions')
                 exclusion_penalty = exclusions_found * 0.5  # Penalty for exclusions
             
             base_score = exact_matches / len(data['keywords'])
@@ -198,29 +229,20 @@ class MLIntentClassifier:
         
         # 3. Domain-specific pattern matching
         for agent, data in self.training_data.items():
-            pattern_matches = 0
-            for pattern in data['patterns']:
+            pattern_matches = scan.count(f'intent:{agent}:patterns')
+            for pattern in self._regex_patterns.get(agent, ()):
                 if re.search(pattern, message_lower):
                     pattern_matches += 1
             features[f'{agent}_patterns'] = pattern_matches / len(data['patterns'])
         
         # 4. Context indicators
         for agent, data in self.training_data.items():
-            context_matches = sum(1 for indicator in data['context_indicators']
-                                if indicator in message_lower)
+            context_matches = scan.count(f'intent:{agent}:context_indicators')
             features[f'{agent}_context'] = context_matches / len(data['context_indicators'])
         
         # 5. Question type analysis
-        question_indicators = {
-            'what': ['что', 'какой', 'какая', 'какие'],
-            'how': ['как', 'каким образом'],
-            'when': ['когда', 'во сколько'],
-            'where': ['где', 'куда'],
-            'why': ['почему', 'зачем']
-        }
-        
-        for q_type, indicators in question_indicators.items():
-            if any(ind in message_lower for ind in indicators):
+        for q_type in self.QUESTION_INDICATORS:
+            if scan.has(f'intent:question:{q_type}'):
                 features[f'question_{q_type}'] = 1.0
             else:
                 features[f'question_{q_type}'] = 0.0
@@ -0,0 +1,220 @@
+"""
+Shared Multi-pattern Keyword Matcher (Aho-Corasick)
+Общий многошаблонный поиск ключевых слов (Ахо-Корасик)
+
+Routing, intent classification, semantic search and user memory all check
+the same message against dozens of keyword and phrase lists. Components
+register their lists here as named groups; a single compiled automaton
+scans the lowercased message once and the result (with offsets) is cached,
+so every component on the same turn reuses one linear pass.
+"""
+
+import logging
+import threading
+from collections import Counter, OrderedDict, defaultdict, deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _is_word_char(ch: str) -> bool:
+    """Same definition as \\w in Python's re module"""
+    return ch.isalnum() or ch == '_'
+
+
+class AhoCorasickAutomaton:
+    """Compiled automaton over a fixed set of phrases"""
+
+    def __init__(self, phrases: Iterable[str]):
+        self.phrases: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Tuple[int, ...]] = [()]
+
+        outputs = [[]]
+        for phrase in phrases:
+            if not phrase:
+                continue
+            node = 0
+            for ch in phrase:
+                next_node = self._goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][ch] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    outputs.append([])
+                node = next_node
+            outputs[node].append(len(self.phrases))
+            self.phrases.append(phrase)
+
+        # Breadth-first construction of failure links; outputs are merged
+        # along the failure chain so scanning never has to follow it
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                outputs[child].extend(outputs[self._fail[child]])
+
+        self._output = [tuple(ids) for ids in outputs]
+
+    def iter_matches(self, text: str):
+        """Yield (start, end, phrase_id) for every occurrence, overlaps included"""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        phrases = self.phrases
+        node = 0
+        for position, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if output[node]:
+                end = position + 1
+                for phrase_id in output[node]:
+                    yield end - len(phrases[phrase_id]), end, phrase_id
+
+
+class ScanResult:
+    """All keyword/phrase hits of one text, grouped by registered group"""
+
+    def __init__(self, text: str, hits: List[Tuple[int, int, str]],
+                 group_members: Dict[str, Counter], phrase_groups: Dict[str, Set[str]]):
+        self.text = text
+        self.hits = hits
+        self._group_members = group_members
+        self._phrases: Dict[str, Set[str]] = defaultdict(set)
+        self._words: Dict[str, Set[str]] = defaultdict(set)
+
+        length = len(text)
+        for start, end, phrase in hits:
+            whole_word = ((start == 0 or not _is_word_char(text[start - 1])) and
+                          (end == length or not _is_word_char(text[end])))
+            for group in phrase_groups.get(phrase, ()):
+                self._phrases[group].add(phrase)
+                if whole_word:
+                    self._words[group].add(phrase)
+
+    def phrases(self, group: str) -> Set[str]:
+        """Phrases of the group found anywhere in the text (substring semantics)"""
+        return self._phrases.get(group, set())
+
+    def words(self, group: str) -> Set[str]:
+        """Phrases of the group found as whole \\w+ tokens"""
+        return self._words.get(group, set())
+
+    def has(self, group: str) -> bool:
+        return bool(self._phrases.get(group))
+
+    def count(self, group: str) -> int:
+        """Number of list items of the group present in the text (duplicates counted)"""
+        members = self._group_members.get(group)
+        if not members:
+            return 0
+        return sum(members[phrase] for phrase in self._phrases.get(group, ()))
+
+    def matched(self, group: str) -> List[str]:
+        """Matched phrases in the group's registration order"""
+        found = self._phrases.get(group, set())
+        members = self._group_members.get(group, {})
+        return [phrase for phrase in members if phrase in found]
+
+    def offsets(self, group: str) -> List[Tuple[int, int, str]]:
+        """(start, end, phrase) of every hit belonging to the group"""
+        members = self._group_members.get(group, {})
+        return [hit for hit in self.hits if hit[2] in members]
+
+
+class KeywordMatcher:
+    """Registry of named phrase groups compiled into one shared automaton"""
+
+    def __init__(self, cache_size: int = 256):
+        self._groups: Dict[str, Tuple[str, ...]] = {}
+        self._automaton: Optional[AhoCorasickAutomaton] = None
+        self._group_members: Dict[str, Counter] = {}
+        self._phrase_groups: Dict[str, Set[str]] = {}
+        self._version = 0
+        self._lock = threading.RLock()
+
+        self._cache: 'OrderedDict[str, ScanResult]' = OrderedDict()
+        self.cache_size = cache_size
+        self.stats = {'scans': 0, 'cache_hits': 0, 'compilations': 0}
+
+    def register(self, group: str, phrases: Iterable[str]):
+        """Register (or replace) a phrase group; the automaton is rebuilt lazily"""
+        phrases = tuple(phrases)
+        with self._lock:
+            if self._groups.get(group) == phrases:
+                return
+            self._groups[group] = phrases
+            self._automaton = None
+
+    def unregister(self, group: str):
+        with self._lock:
+            if self._groups.pop(group, None) is not None:
+                self._automaton = None
+
+    def scan(self, text: str, use_cache: bool = True) -> ScanResult:
+        """Scan lowercased text once and return hits for every registered group"""
+        text = (text or '').lower()
+        with self._lock:
+            if self._automaton is None:
+                self._compile()
+            automaton = self._automaton
+            group_members = self._group_members
+            phrase_groups = self._phrase_groups
+            self.stats['scans'] += 1
+            if use_cache:
+                cached = self._cache.get(text)
+                if cached is not None:
+                    self._cache.move_to_end(text)
+                    self.stats['cache_hits'] += 1
+                    return cached
+
+        phrases = automaton.phrases
+        hits = [(start, end, phrases[phrase_id])
+                for start, end, phrase_id in automaton.iter_matches(text)]
+        result = ScanResult(text, hits, group_members, phrase_groups)
+
+        if use_cache:
+            with self._lock:
+                if automaton is self._automaton:
+                    self._cache[text] = result
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+        return result
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            **self.stats,
+            'groups': len(self._groups),
+            'phrases': len(self._phrase_groups),
+            'cached_scans': len(self._cache)
+        }
+
+    def _compile(self):
+        group_members = {}
+        phrase_groups = defaultdict(set)
+        for group, phrases in self._groups.items():
+            group_members[group] = Counter(phrases)
+            for phrase in phrases:
+                if phrase:
+                    phrase_groups[phrase].add(group)
+
+        self._automaton = AhoCorasickAutomaton(phrase_groups.keys())
+        self._group_members = group_members
+        self._phrase_groups = dict(phrase_groups)
+        self._cache.clear()
+        self._version += 1
+        self.stats['compilations'] += 1
+        logger.debug(f"Keyword automaton compiled: {len(self._groups)} groups, {len(phrase_groups)} phrases")
+
+
+# Global shared matcher instance
+keyword_matcher = KeywordMatcher()
@@ -3,21 +3,34 @@ Enhanced Knowledge Base Search Module
 Модуль улучшенного поиска по базе знаний
 
 This module provides advanced search capabilities for the knowledge base
-including TF-IDF similarity, fuzzy matching, and relevance scoring.
+including BM25 ranking over persistent inverted indexes, fuzzy matching,
+and relevance scoring.
 """
 
 import re
 import logging
-from typing import List, Dict, Tuple, Optional
+import threading
+from typing import Any, List, Dict, Hashable, Tuple, Optional
 from collections import Counter
 from difflib import SequenceMatcher
 import math
 
+from bm25_index import BM25Index
+
 logger = logging.getLogger(__name__)
 
 
 class KnowledgeSearchEngine:
-    """Enhanced search engine for knowledge base with TF-IDF and fuzzy matching"""
+    """Enhanced search engine for knowledge base with BM25 indexes and fuzzy matching"""
+
+    # Candidates taken from the BM25 index per requested result for fuzzy re-ranking
+    CANDIDATES_PER_RESULT = 5
+    MIN_CANDIDATES = 20
+    # Entries fuzzy-scored when the query shares no terms with the corpus (typos)
+    FUZZY_FALLBACK_LIMIT = 200
+    CHUNK_FETCH_BATCH = 500
+    # Cosine floor for chunks found only by the dense vector store
+    DENSE_MIN_SIMILARITY = 0.25
     
     def __init__(self):
         self.stop_words = {
@@ -25,6 +38,19 @@ class KnowledgeSearchEngine:
             'kz': {'және', 'пен', 'бен', 'мен', 'де', 'да', 'те', 'та', 'ке', 'қе', 'ға', 'на', 'нан', 'дан', 'тан', 'ден', 'тен', 'нен', 'мен', 'бен', 'пен', 'жоқ', 'бар', 'емес', 'болу', 'ол', 'бұл', 'сол'}
         }
         self.processed_knowledge = {}  # Cache for processed knowledge entries
+
+        # Persistent BM25 indexes over agent knowledge lists, keyed by caller
+        self.indexes: Dict[Hashable, BM25Index] = {}
+        self._index_state: Dict[Hashable, Dict[str, Any]] = {}
+
+        # Index over KnowledgeBase chunks (documents and web sources)
+        self.chunk_index = BM25Index()
+        self._chunks: Dict[int, Dict[str, Any]] = {}
+        self._chunk_version: Optional[str] = None
+
+        self._lock = threading.RLock()
+        self.stats = {'indexed_searches': 0, 'documents_indexed': 0,
+                      'documents_removed': 0, 'chunk_syncs': 0}
         
     def preprocess_text(self, text: str, language: str = 'ru') -> List[str]:
         """Preprocess text for better search"""
@@ -47,7 +73,7 @@ class KnowledgeSearchEngine:
         return words
     
     def calculate_tf_idf(self, query_words: List[str], documents: List[Dict]) -> Dict[int, float]:
-        """Calculate TF-IDF scores for documents"""
+        """Calculate TF-IDF scores for an ad-hoc document list (re-tokenizes per call; use the BM25 indexes for search)"""
         if not query_words or not documents:
             return {}
             
@@ -124,8 +150,13 @@ class KnowledgeSearchEngine:
         # Combine similarity and word match scores
         return max(similarity, word_match_ratio * 0.8)
     
-    def calculate_relevance_score(self, query: str, entry: Dict, language: str = 'ru') -> float:
-        """Calculate overall relevance score combining multiple factors"""
+    def calculate_relevance_score(self, query: str, entry: Dict, language: str = 'ru',
+                                  bm25_score: Optional[float] = None) -> float:
+        """Calculate overall relevance score combining multiple factors
+
+        bm25_score, when given, is the entry's BM25 score normalized to [0, 1]
+        against the best candidate and replaces the single-document term frequency.
+        """
         
         # Extract text fields
         title = entry.get('title', '')
@@ -154,19 +185,19 @@ class KnowledgeSearchEngine:
         # 4. Content relevance  
         scores['content'] = self.fuzzy_match_score(query, content)
         
-        # 5. TF-IDF score (requires document collection)
-        query_words = self.preprocess_text(query, language)
-        doc_text = f"{title} {content} {keywords}"
-        doc_words = self.preprocess_text(doc_text, language)
-        
-        # Simple term frequency for single document
-        if query_words and doc_words:
-            word_count = Counter(doc_words)
-            doc_length = len(doc_words)
-            tf_score = sum(word_count.get(word, 0) for word in query_words) / doc_length
-            scores['tf'] = tf_score
+        # 5. Term statistics: BM25 from the index, or term frequency for a single document
+        if bm25_score is not None:
+            scores['tf'] = bm25_score
         else:
-            scores['tf'] = 0
+            query_words = self.preprocess_text(query, language)
+            doc_words = self.preprocess_text(f"{title} {content} {keywords}", language)
+            if query_words and doc_words:
+                word_count = Counter(doc_words)
+                doc_length = len(doc_words)
+                tf_score = sum(word_count.get(word, 0) for word in query_words) / doc_length
+                scores['tf'] = tf_score
+            else:
+                scores['tf'] = 0
             
         # 6. Priority boost (higher priority = lower number = higher score)
         priority_score = 1.0 / max(priority, 1)  # Inverse priority
@@ -191,7 +222,8 @@ class KnowledgeSearchEngine:
         return final_score
     
     def search_knowledge_base(self, query: str, knowledge_entries: List, language: str = 'ru', 
-                            max_results: int = 3, min_score: float = 0.1) -> List[Dict]:
+                            max_results: int = 3, min_score: float = 0.1,
+                            index_key: Optional[Hashable] = None) -> List[Dict]:
         """
         Enhanced search through knowledge base entries
         
@@ -201,33 +233,44 @@ class KnowledgeSearchEngine:
             language: Language for processing
             max_results: Maximum number of results to return
             min_score: Minimum relevance score threshold
+            index_key: Key of the persistent BM25 index for this entry list
+                (e.g. agent type and language); defaults to a shared ad-hoc index
             
         Returns:
             List of relevant knowledge entries with scores
         """
         if not query or not knowledge_entries:
             return []
-            
-        # Convert knowledge entries to search format
-        search_docs = []
-        for entry in knowledge_entries:
+
+        if index_key is None:
+            index_key = ('adhoc', language)
+        index = self.index_entries(knowledge_entries, language, index_key)
+        entries_by_id = self._index_state[index_key]['entries']
+
+        # BM25 top-k from posting lists, then fuzzy re-ranking of the candidates only
+        top_k = max(max_results * self.CANDIDATES_PER_RESULT, self.MIN_CANDIDATES)
+        ranked = index.search(self.preprocess_text(query, language), top_k)
+        self.stats['indexed_searches'] += 1
+
+        if ranked:
+            best = ranked[0][1] or 1.0
+            candidates = [(entries_by_id[doc_id], score / best) for doc_id, score in ranked]
+        else:
+            candidates = [(entry, 0.0) for entry in knowledge_entries[:self.FUZZY_FALLBACK_LIMIT]]
+
+        # Calculate relevance scores
+        scored_results = []
+        for entry, bm25_score in candidates:
             doc = {
-                'id': entry.id,
                 'title': entry.title,
-                'content': entry.content_ru if language == 'ru' else entry.content_kz,
+                'content': self._entry_content(entry, language),
                 'keywords': entry.keywords or '',
-                'priority': entry.priority or 1,
-                'entry': entry  # Keep reference to original entry
+                'priority': entry.priority or 1
             }
-            search_docs.append(doc)
-        
-        # Calculate relevance scores
-        scored_results = []
-        for doc in search_docs:
-            score = self.calculate_relevance_score(query, doc, language)
+            score = self.calculate_relevance_score(query, doc, language, bm25_score=bm25_score)
             if score >= min_score:
                 scored_results.append({
-                    'entry': doc['entry'],
+                    'entry': entry,
                     'score': score,
                     'content': doc['content'],
                     'title': doc['title']
@@ -241,6 +284,136 @@ class KnowledgeSearchEngine:
                    f"(max_score: {scored_results[0]['score']:.3f})" if scored_results else "No results")
         
         return scored_results[:max_results]
+
+    def index_entries(self, knowledge_entries: List, language: str, index_key: Hashable) -> BM25Index:
+        """Bring the BM25 index for an entry list up to date (only changed entries are re-tokenized)"""
+        with self._lock:
+            index = self.indexes.get(index_key)
+            state = self._index_state.get(index_key)
+            if index is not None and state['source'] is knowledge_entries:
+                return index
+            if index is None:
+                index = self.indexes[index_key] = BM25Index()
+                state = {'signatures': {}}
+
+            old_signatures = state['signatures']
+            signatures = {}
+            entries_by_id = {}
+            for entry in knowledge_entries:
+                content = self._entry_content(entry, language)
+                signature = (getattr(entry, 'updated_at', None), entry.title, content, entry.keywords)
+                signatures[entry.id] = signature
+                entries_by_id[entry.id] = entry
+                if old_signatures.get(entry.id) != signature:
+                    index.add_document(entry.id, self.preprocess_text(
+                        f"{entry.title} {content} {entry.keywords or ''}", language
+                    ))
+                    self.stats['documents_indexed'] += 1
+
+            for doc_id in old_signatures.keys() - signatures.keys():
+                index.remove_document(doc_id)
+                self.stats['documents_removed'] += 1
+
+            self._index_state[index_key] = {
+                'source': knowledge_entries,
+                'signatures': signatures,
+                'entries': entries_by_id
+            }
+            return index
+
+    def search_chunks(self, query: str, language: str = 'ru', limit: int = 5) -> List[Dict]:
+        """BM25 search over active KnowledgeBase chunks (documents and web sources)"""
+        query_words = self.preprocess_text(query, language)
+        if not query_words:
+            return []
+
+        self._ensure_chunk_index()
+        results = []
+        for chunk_id, score in self.chunk_index.search(query_words, limit):
+            chunk = self._chunks.get(chunk_id)
+            if chunk:
+                results.append({**chunk, 'id': chunk_id, 'score': score})
+        return results
+
+    def dense_chunks(self, query: str, limit: int = 5) -> List[Dict]:
+        """Nearest chunks from the shared vector store (word forms and paraphrases BM25 misses)"""
+        try:
+            from vector_store import vector_store, CHUNK_GROUP
+            hits = vector_store.search(CHUNK_GROUP, query, top_k=limit)
+            if not hits:
+                return []
+            self._ensure_chunk_index()
+        except Exception as e:
+            logger.warning(f"Dense chunk search failed: {e}")
+            return []
+
+        results = []
+        for key, similarity in hits:
+            chunk = self._chunks.get(int(key))
+            if chunk and similarity >= self.DENSE_MIN_SIMILARITY:
+                results.append({**chunk, 'id': int(key), 'score': similarity})
+        return results
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'indexes': {str(key): index.get_stats() for key, index in self.indexes.items()},
+            'chunk_index': self.chunk_index.get_stats(),
+            'chunk_version': self._chunk_version
+        }
+
+    def _entry_content(self, entry, language: str) -> str:
+        return entry.content_ru if language == 'ru' else entry.content_kz
+
+    def _ensure_chunk_index(self):
+        """Sync the chunk index with the DB when the shared knowledge version changes"""
+        from knowledge_snapshot import knowledge_snapshot
+
+        version = knowledge_snapshot.current_version()
+        if version is not None and version == self._chunk_version:
+            return
+
+        with self._lock:
+            if version is not None and version == self._chunk_version:
+                return
+            self._sync_chunks()
+            self._chunk_version = version
+
+    def _sync_chunks(self):
+        from models import KnowledgeBase, db
+        from app_context import app_context
+        from language_detector import language_detector
+
+        with app_context():
+            rows = db.session.query(KnowledgeBase.id, KnowledgeBase.updated_at).filter(
+                KnowledgeBase.is_active == True
+            ).all()
+            current = {chunk_id: updated_at for chunk_id, updated_at in rows}
+
+            for chunk_id in self._chunks.keys() - current.keys():
+                self.chunk_index.remove_document(chunk_id)
+                del self._chunks[chunk_id]
+                self.stats['documents_removed'] += 1
+
+            changed = [chunk_id for chunk_id, updated_at in current.items()
+                       if chunk_id not in self._chunks or self._chunks[chunk_id]['updated_at'] != updated_at]
+            for i in range(0, len(changed), self.CHUNK_FETCH_BATCH):
+                batch = changed[i:i + self.CHUNK_FETCH_BATCH]
+                for row in KnowledgeBase.query.filter(KnowledgeBase.id.in_(batch)).all():
+                    chunk_language, _ = language_detector.detect_language(row.content_chunk)
+                    self.chunk_index.add_document(
+                        row.id, self.preprocess_text(row.content_chunk, chunk_language)
+                    )
+                    self._chunks[row.id] = {
+                        'content': row.content_chunk,
+                        'source_type': row.source_type,
+                        'source_id': row.source_id,
+                        'updated_at': row.updated_at
+                    }
+                    self.stats['documents_indexed'] += 1
+
+        self.stats['chunk_syncs'] += 1
+        logger.info(f"Knowledge chunk index synced: {len(self._chunks)} chunks, {len(changed)} re-indexed")
     
     def format_context(self, search_results: List[Dict], max_length: int = 1500) -> str:
         """Format search results into context string with smart truncation"""
@@ -0,0 +1,236 @@
+"""
+In-process Snapshot of Agent Knowledge Base
+Снимок базы знаний агентов в памяти процесса
+
+Active AgentKnowledgeBase rows are loaded once per version into immutable
+per-agent, per-language lists. Admin edits bump a shared version token (a
+small file on tmpfs), so every gunicorn worker rebuilds its snapshot lazily
+on the next lookup and otherwise serves retrieval without touching the DB.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_LANGUAGES = ('ru', 'kz', 'en')
+
+
+def _default_version_file() -> str:
+    """Общий для воркеров файл версии (tmpfs, если доступен)"""
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base_dir, 'bolashak_knowledge.version')
+
+
+@dataclass(frozen=True)
+class KnowledgeEntry:
+    """Detached, read-only copy of an AgentKnowledgeBase row"""
+    id: int
+    agent_type: str
+    title: str
+    content_ru: str
+    content_kz: str
+    content_en: Optional[str]
+    keywords: Optional[str]
+    priority: int
+    category: Optional[str]
+    tags: Optional[str]
+    is_featured: bool
+    updated_at: Optional[datetime]
+
+    @classmethod
+    def from_model(cls, row) -> 'KnowledgeEntry':
+        return cls(
+            id=row.id,
+            agent_type=row.agent_type,
+            title=row.title,
+            content_ru=row.content_ru,
+            content_kz=row.content_kz,
+            content_en=row.content_en,
+            keywords=row.keywords,
+            priority=row.priority or 1,
+            category=row.category,
+            tags=row.tags,
+            is_featured=bool(row.is_featured),
+            updated_at=row.updated_at
+        )
+
+    def get_content(self, language='ru'):
+        """Get content in specific language with fallback"""
+        if language == 'kz' and self.content_kz:
+            return self.content_kz
+        elif language == 'en' and self.content_en:
+            return self.content_en
+        else:
+            return self.content_ru
+
+
+class KnowledgeSnapshot:
+    """Versioned per-agent, per-language snapshot of active knowledge entries"""
+
+    def __init__(self, version_file: Optional[str] = None, check_interval: float = 1.0):
+        self.version_file = version_file or os.environ.get(
+            'KNOWLEDGE_SNAPSHOT_VERSION_FILE', _default_version_file()
+        )
+        self.check_interval = check_interval
+
+        self._entries: Dict[Tuple[str, str], List[KnowledgeEntry]] = {}
+        self._version: Optional[str] = None
+        self._last_check = 0.0
+        self._lock = threading.RLock()
+
+        self.stats = {
+            'hits': 0,
+            'rebuilds': 0,
+            'version_bumps': 0,
+            'last_rebuild_time': None,
+            'last_rebuild_duration': 0.0
+        }
+
+    def get_entries(self, agent_type: str, language: str = 'ru') -> List[KnowledgeEntry]:
+        """Active entries for an agent ordered by priority (raises if the DB is unavailable)"""
+        self._ensure_fresh()
+        self.stats['hits'] += 1
+        if language not in SUPPORTED_LANGUAGES:
+            language = 'ru'
+        return self._entries.get((agent_type, language), [])
+
+    def all_entries(self) -> List[Tuple[Tuple[str, str], List[KnowledgeEntry]]]:
+        """((agent_type, language), entries) pairs of the current snapshot"""
+        return list(self._entries.items())
+
+    def bump_version(self, reason: str = '') -> str:
+        """Mark the knowledge base as changed for all workers"""
+        token = f"{time.time_ns()}-{os.getpid()}"
+        try:
+            tmp_path = f"{self.version_file}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(token)
+            os.replace(tmp_path, self.version_file)
+        except OSError as e:
+            logger.warning(f"Could not write knowledge version file {self.version_file}: {e}")
+
+        with self._lock:
+            # Текущий воркер перестраивает снимок сразу, не дожидаясь интервала проверки
+            self._version = None
+            self._last_check = 0.0
+            self.stats['version_bumps'] += 1
+
+        logger.info(f"Knowledge snapshot version bumped to {token} ({reason or 'unspecified'})")
+        return token
+
+    def invalidate(self):
+        """Drop the local snapshot; it is rebuilt on next lookup"""
+        with self._lock:
+            self._version = None
+            self._last_check = 0.0
+
+    def get_version(self) -> Optional[str]:
+        return self._version
+
+    def shared_version(self) -> str:
+        """Version token of the shared file, without refreshing the snapshot (no DB access)"""
+        return self._read_shared_version()
+
+    def current_version(self) -> Optional[str]:
+        """Shared version after refreshing the snapshot if it changed"""
+        self._ensure_fresh()
+        return self._version
+
+    def corpus_key(self, agent_type: str, language: str = 'ru') -> Tuple[str, str, Optional[str]]:
+        """Stable key of one snapshot list for search indexes built on top of it"""
+        return (agent_type, language, self._version)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'version': self._version,
+            'agents': len({agent for agent, _ in self._entries}),
+            'entries': sum(len(v) for (_, lang), v in self._entries.items() if lang == 'ru')
+        }
+
+    def _read_shared_version(self) -> str:
+        try:
+            with open(self.version_file) as f:
+                return f.read().strip() or '0'
+        except OSError:
+            return '0'
+
+    def _ensure_fresh(self):
+        now = time.time()
+        if self._version is not None and now - self._last_check < self.check_interval:
+            return
+
+        with self._lock:
+            if self._version is not None and now - self._last_check < self.check_interval:
+                return
+            shared_version = self._read_shared_version()
+            if shared_version != self._version:
+                self._rebuild(shared_version)
+            self._last_check = now
+
+    def _rebuild(self, version: str):
+        from models import AgentKnowledgeBase
+        from app_context import app_context
+
+        start = time.time()
+        with app_context():
+            rows = AgentKnowledgeBase.query.filter_by(is_active=True).order_by(
+                AgentKnowledgeBase.agent_type.asc(),
+                AgentKnowledgeBase.priority.asc()
+            ).all()
+            entries = [KnowledgeEntry.from_model(row) for row in rows]
+
+        by_agent = defaultdict(list)
+        for entry in entries:
+            by_agent[entry.agent_type].append(entry)
+
+        snapshot = {}
+        for agent_type, agent_entries in by_agent.items():
+            for language in SUPPORTED_LANGUAGES:
+                snapshot[(agent_type, language)] = [
+                    entry for entry in agent_entries if entry.get_content(language)
+                ]
+
+        self._entries = snapshot
+        self._version = version
+        self._build_search_indexes()
+        self.stats['rebuilds'] += 1
+        self.stats['last_rebuild_time'] = datetime.now().isoformat()
+        self.stats['last_rebuild_duration'] = time.time() - start
+        logger.info(f"Knowledge snapshot rebuilt: {len(entries)} entries, version {version}")
+
+    def _build_search_indexes(self):
+        """Precompute semantic features and BM25 postings at ingest instead of per query"""
+        try:
+            from semantic_search import semantic_search_engine
+            for (agent_type, language), entries in self._entries.items():
+                semantic_search_engine.index_entries(
+                    entries, language, self.corpus_key(agent_type, language)
+                )
+        except Exception as e:
+            logger.warning(f"Could not build semantic index for knowledge snapshot: {e}")
+
+        try:
+            from knowledge_search import knowledge_search_engine
+            for (agent_type, language), entries in self._entries.items():
+                knowledge_search_engine.index_entries(entries, language, (agent_type, language))
+        except Exception as e:
+            logger.warning(f"Could not build BM25 index for knowledge snapshot: {e}")
+
+        try:
+            from vector_store import vector_store
+            vector_store.schedule_build(self._version)
+        except Exception as e:
+            logger.warning(f"Could not schedule vector store build for knowledge snapshot: {e}")
+
+
+# Global knowledge snapshot instance
+knowledge_snapshot = KnowledgeSnapshot()
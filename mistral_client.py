@@ -1,20 +1,146 @@
 import os
+import json
+import time
+import random
+import asyncio
 import logging
+import threading
+import weakref
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, List, Optional
+
 import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
+# Bounded timeouts: connect fails fast, read applies between bytes (and between streamed chunks)
+CONNECT_TIMEOUT = float(os.environ.get("OPENROUTER_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("OPENROUTER_READ_TIMEOUT", "30"))
+# Wall-clock budget for one completion including retries and backup models; kept below
+# gunicorn's worker timeout (30s), which would otherwise kill a sync worker first
+REQUEST_DEADLINE = float(os.environ.get("OPENROUTER_REQUEST_DEADLINE", "25"))
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Concurrent connections to OpenRouter per event loop on the async path
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("OPENROUTER_ASYNC_MAX_CONNECTIONS", "500"))
+
+_session_lock = threading.Lock()
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+
+
+def get_http_session() -> requests.Session:
+    """Process-wide pooled keep-alive session shared by all clients
+
+    Created lazily and re-created after fork, so gunicorn workers never share
+    sockets inherited from the master process.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                session = requests.Session()
+                # Retries are done by MistralClient (jitter, circuit breaker), not by urllib3
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session, _session_pid = session, pid
+    return _session
+
+
+class ModelCircuitBreaker:
+    """Per-model circuit breaker shared by all clients of the process
+
+    A model is skipped while its circuit is open: after `failure_threshold`
+    consecutive retryable failures (429/5xx/network) for `cooldown` seconds,
+    or immediately after a 404 for `missing_cooldown` seconds. When the
+    cooldown expires one trial request is let through (half-open); success
+    closes the circuit, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 60.0,
+                 missing_cooldown: float = 600.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.missing_cooldown = missing_cooldown
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+        self._half_open: Dict[str, bool] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, model: str) -> bool:
+        with self._lock:
+            open_until = self._open_until.get(model)
+            if open_until is None:
+                return True
+            if time.monotonic() < open_until or self._half_open.get(model):
+                return False
+            self._half_open[model] = True  # Single trial request after the cooldown
+            return True
+
+    def release(self, model: str):
+        """Give back a half-open trial slot that was not used"""
+        with self._lock:
+            self._half_open.pop(model, None)
+
+    def record_success(self, model: str):
+        with self._lock:
+            self._failures.pop(model, None)
+            self._open_until.pop(model, None)
+            self._half_open.pop(model, None)
+
+    def record_failure(self, model: str, missing: bool = False):
+        with self._lock:
+            failures = self._failures.get(model, 0) + 1
+            self._failures[model] = failures
+            if missing or failures >= self.failure_threshold or self._half_open.get(model):
+                cooldown = self.missing_cooldown if missing else self.cooldown
+                self._open_until[model] = time.monotonic() + cooldown
+                self._half_open.pop(model, None)
+                logger.warning(f"Circuit opened for model {model} for {cooldown:.0f}s")
+
+    def is_open(self, model: str) -> bool:
+        with self._lock:
+            open_until = self._open_until.get(model)
+            return open_until is not None and time.monotonic() < open_until
+
+    def reset(self):
+        with self._lock:
+            self._failures.clear()
+            self._open_until.clear()
+            self._half_open.clear()
+
+    def get_stats(self) -> Dict[str, dict]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                model: {
+                    'failures': self._failures.get(model, 0),
+                    'open_for': round(max(0.0, self._open_until[model] - now), 1) if model in self._open_until else 0.0
+                }
+                for model in set(self._failures) | set(self._open_until)
+            }
+
 
 class MistralClient:
     """Client for interacting with OpenRouter API"""
 
-    def __init__(self):
+    # Retries per model for 429/5xx/network errors, with full-jitter exponential backoff
+    MAX_RETRIES = 2
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 4.0
+
+    def __init__(self, base_url: Optional[str] = None, session: Optional[requests.Session] = None,
+                 circuit_breaker: Optional[ModelCircuitBreaker] = None):
         # Ключ берём из окружения
         self.api_key = os.environ.get("OPENROUTER_API_KEY")
         if not self.api_key:
             logger.warning("OPENROUTER_API_KEY not found in environment variables")
 
-        self.base_url = "https://openrouter.ai/api/v1"
+        self.base_url = base_url or os.environ.get("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+        self._session = session
+        self.circuit_breaker = circuit_breaker or model_circuit_breaker
         # Используем рабочую бесплатную модель
         self.model = "microsoft/phi-3-mini-128k-instruct:free"
         self.free_models = [
@@ -43,144 +169,241 @@ class MistralClient:
         }
 
     def get_response(self, user_message: str, context: str = "", language: str = "ru") -> str:
+        return self.get_response_with_system_prompt(user_message, context, language)
+
+    def get_response_with_system_prompt(self,
+                                        user_message: str,
+                                        context: str = "",
+                                        language: str = "ru",
+                                        custom_system_prompt: str = "") -> str:
+        """Get response using enhanced prompt engineering and custom system prompt"""
         try:
             if not self.api_key:
                 logger.error("OpenRouter API key not configured")
                 return self._get_fallback_response(language)
 
-            system_prompt = self.system_prompts.get(language, self.system_prompts['ru'])
-
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Контекст:\n{context}\n\nВопрос пользователя: {user_message}"}
-            ]
-
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://bolashak-chat.replit.app",
-                "X-Title": "Bolashak University AI Chat"
-            }
-
-            data = {
-                "model": self.model,
-                "messages": messages,
-                "max_tokens": 500,
-                "temperature": 0.7,
-                "top_p": 1,
-                "frequency_penalty": 0,
-                "presence_penalty": 0
-            }
-
-            response = requests.post(f"{self.base_url}/chat/completions",
-                                     headers=headers,
-                                     json=data,
-                                     timeout=30)
-
-            # Если модель недоступна, пробуем другие бесплатные модели
-            if response.status_code == 404 and self.model in self.free_models:
-                current_index = self.free_models.index(self.model)
-                for backup_model in self.free_models[current_index + 1:]:
-                    logger.info(f"Trying backup model: {backup_model}")
-                    data["model"] = backup_model
-                    backup_response = requests.post(f"{self.base_url}/chat/completions",
-                                                   headers=headers,
-                                                   json=data,
-                                                   timeout=30)
-                    if backup_response.status_code == 200:
-                        self.model = backup_model  # Обновляем на рабочую модель
-                        logger.info(f"Switched to working model: {backup_model}")
-                        response = backup_response
-                        break
-
-            if response.status_code == 200:
-                result = response.json()
-                if 'choices' in result and len(result['choices']) > 0:
-                    return result['choices'][0]['message']['content'].strip()
-                else:
-                    logger.error("No choices in OpenRouter response")
-                    return self._get_fallback_response(language)
-            else:
-                logger.error(f"OpenRouter API error: {response.status_code} - {response.text}")
+            data = self._completion_payload(user_message, context, language, custom_system_prompt)
+            response = self._post_completion(data)
+            if response is None:
                 return self._get_fallback_response(language)
 
+            return self._completion_text(response.json(), language)
+
         except requests.exceptions.RequestException as e:
             logger.error(f"Request error to OpenRouter API: {str(e)}")
             return self._get_fallback_response(language)
         except Exception as e:
-            logger.error(f"Unexpected error in OpenRouter client: {str(e)}")
+            logger.error(f"Unexpected error in enhanced OpenRouter client: {str(e)}")
             return self._get_fallback_response(language)
 
-    def get_response_with_system_prompt(self,
-                                        user_message: str,
-                                        context: str = "",
-                                        language: str = "ru",
-                                        custom_system_prompt: str = "") -> str:
-        """Get response using enhanced prompt engineering and custom system prompt"""
+    def stream_response_with_system_prompt(self,
+                                           user_message: str,
+                                           context: str = "",
+                                           language: str = "ru",
+                                           custom_system_prompt: str = "") -> Iterator[str]:
+        """Yield completion text deltas as OpenRouter streams them (stream: true)
+
+        Falls back to a single fallback message if nothing was received; a
+        stream broken midway ends with the text produced so far.
+        """
+        if not self.api_key:
+            logger.error("OpenRouter API key not configured")
+            yield self._get_fallback_response(language)
+            return
+
+        data = self._completion_payload(user_message, context, language, custom_system_prompt, stream=True)
+
+        produced = False
         try:
-            if not self.api_key:
-                logger.error("OpenRouter API key not configured")
-                return self._get_fallback_response(language)
+            response = self._open_stream(data)
+            if response is None:
+                yield self._get_fallback_response(language)
+                return
 
-            system_prompt = custom_system_prompt if custom_system_prompt else self.system_prompts.get(language, self.system_prompts['ru'])
+            with response:
+                for delta in self._iter_stream_deltas(response):
+                    if not produced:
+                        # Leading whitespace is stripped like in the blocking methods
+                        delta = delta.lstrip()
+                        if not delta:
+                            continue
+                    produced = True
+                    yield delta
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Streaming request error to OpenRouter API: {str(e)}")
+        except Exception as e:
+            logger.error(f"Unexpected error in streaming OpenRouter client: {str(e)}")
+
+        if not produced:
+            yield self._get_fallback_response(language)
 
-            messages = [
+    def _completion_payload(self, user_message: str, context: str, language: str,
+                            custom_system_prompt: str = "", stream: bool = False) -> dict:
+        system_prompt = custom_system_prompt if custom_system_prompt else self.system_prompts.get(language, self.system_prompts['ru'])
+        data = {
+            "model": self.model,
+            "messages": [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": f"Контекст:\n{context}\n\nВопрос пользователя: {user_message}"}
-            ]
+            ],
+            "max_tokens": 500,
+            "temperature": 0.7,
+            "top_p": 1,
+            "frequency_penalty": 0,
+            "presence_penalty": 0
+        }
+        if stream:
+            data["stream"] = True
+        return data
 
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://bolashak-chat.replit.app",
-                "X-Title": "Bolashak University AI Chat"
-            }
+    def _completion_text(self, result: dict, language: str) -> str:
+        if 'choices' in result and len(result['choices']) > 0:
+            return result['choices'][0]['message']['content'].strip()
+        logger.error("No choices in OpenRouter response")
+        return self._get_fallback_response(language)
 
-            data = {
-                "model": self.model,
-                "messages": messages,
-                "max_tokens": 500,
-                "temperature": 0.7,
-                "top_p": 1,
-                "frequency_penalty": 0,
-                "presence_penalty": 0
-            }
+    def _open_stream(self, data: dict):
+        """POST a streaming completion (see _post_completion)"""
+        return self._post_completion(data, stream=True)
 
-            response = requests.post(f"{self.base_url}/chat/completions",
-                                     headers=headers,
-                                     json=data,
-                                     timeout=30)
-
-            # Если модель недоступна, пробуем другие бесплатные модели
-            if response.status_code == 404 and self.model in self.free_models:
-                current_index = self.free_models.index(self.model)
-                for backup_model in self.free_models[current_index + 1:]:
-                    logger.info(f"Trying backup model in enhanced method: {backup_model}")
-                    data["model"] = backup_model
-                    backup_response = requests.post(f"{self.base_url}/chat/completions",
-                                                   headers=headers,
-                                                   json=data,
-                                                   timeout=30)
-                    if backup_response.status_code == 200:
-                        self.model = backup_model  # Обновляем на рабочую модель
-                        logger.info(f"Switched to working model in enhanced method: {backup_model}")
-                        response = backup_response
-                        break
+    @property
+    def session(self) -> requests.Session:
+        return self._session or get_http_session()
 
-            if response.status_code == 200:
-                result = response.json()
-                if 'choices' in result and len(result['choices']) > 0:
-                    return result['choices'][0]['message']['content'].strip()
-                else:
-                    logger.error("No choices in OpenRouter response")
-                    return self._get_fallback_response(language)
-            else:
-                logger.error(f"OpenRouter API error: {response.status_code} - {response.text}")
-                return self._get_fallback_response(language)
+    def _headers(self, stream: bool = False) -> dict:
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://bolashak-chat.replit.app",
+            "X-Title": "Bolashak University AI Chat"
+        }
+        if stream:
+            headers["Accept"] = "text/event-stream"
+        return headers
 
-        except Exception as e:
-            logger.error(f"Unexpected error in enhanced OpenRouter client: {str(e)}")
-            return self._get_fallback_response(language)
+    def _candidate_models(self) -> List[str]:
+        """Current model followed by the backup free models"""
+        models = [self.model]
+        if self.model in self.free_models:
+            models += self.free_models[self.free_models.index(self.model) + 1:]
+        return models
+
+    def _post_completion(self, data: dict, stream: bool = False) -> Optional[requests.Response]:
+        """POST /chat/completions with retries, model failover and a wall-clock deadline
+
+        Retryable failures (429, 5xx, connection errors, timeouts) are retried
+        with jittered backoff and counted by the circuit breaker; 404 marks the
+        model as missing and moves on to the next free model. Returns the 200
+        response, or None when every candidate failed or the deadline passed.
+        """
+        deadline = time.monotonic() + REQUEST_DEADLINE
+        url = f"{self.base_url}/chat/completions"
+        headers = self._headers(stream)
+
+        for model in self._candidate_models():
+            if not self.circuit_breaker.allow(model):
+                logger.debug(f"Skipping model {model}: circuit open")
+                continue
+            data["model"] = model
+            for attempt in range(self.MAX_RETRIES + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self._deadline_exceeded(model)
+
+                retry_after = None
+                try:
+                    response = self.session.post(url, headers=headers, json=data, stream=stream,
+                                                 timeout=(CONNECT_TIMEOUT, min(READ_TIMEOUT, remaining)))
+                    if response.status_code == 200:
+                        self._on_success(model)
+                        return response
+                    retry_after = response.headers.get("Retry-After")
+                    outcome = self._on_error_status(model, response.status_code, response.text, attempt)
+                    response.close()
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    outcome = self._on_network_error(model, e)
+                except Exception:
+                    # Any other failure (decoding, invalid response...) still ends a half-open trial
+                    self.circuit_breaker.record_failure(model)
+                    raise
+
+                if outcome == 'stop':
+                    return None
+                if outcome == 'next' or attempt == self.MAX_RETRIES or self.circuit_breaker.is_open(model):
+                    break
+                delay = self._backoff_delay(attempt, retry_after)
+                if time.monotonic() + delay >= deadline:
+                    return self._deadline_exceeded(model)
+                time.sleep(delay)
+        return None
+
+    def _on_success(self, model: str):
+        self.circuit_breaker.record_success(model)
+        if model != self.model:
+            self.model = model  # Обновляем на рабочую модель
+            logger.info(f"Switched to working model: {model}")
+
+    def _on_network_error(self, model: str, error: Exception) -> str:
+        logger.warning(f"OpenRouter request to {model} failed: {str(error)}")
+        self.circuit_breaker.record_failure(model)
+        return 'retry'
+
+    def _on_error_status(self, model: str, status: int, error_text: str, attempt: int) -> str:
+        """Outcome of a non-200 answer: 'retry' the model, try the 'next' one, or 'stop'"""
+        if status == 404:
+            logger.info(f"Model {model} unavailable, trying next")
+            self.circuit_breaker.record_failure(model, missing=True)
+            return 'next'
+        if status not in RETRYABLE_STATUSES:
+            # The model answered; the request itself is wrong, another model will not help
+            logger.error(f"OpenRouter API error: {status} - {error_text[:500]}")
+            self.circuit_breaker.record_success(model)
+            return 'stop'
+        logger.warning(f"OpenRouter API {status} from {model} (attempt {attempt + 1})")
+        self.circuit_breaker.record_failure(model)
+        return 'retry'
+
+    def _deadline_exceeded(self, model: str) -> None:
+        logger.error("OpenRouter request deadline exceeded")
+        self.circuit_breaker.release(model)
+        return None
+
+    def _backoff_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Full-jitter exponential backoff, honouring Retry-After when the server sends it"""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.BACKOFF_MAX)
+            except ValueError:
+                try:
+                    return min(max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()),
+                               self.BACKOFF_MAX)
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * (2 ** attempt)))
+
+    @staticmethod
+    def _iter_stream_deltas(response) -> Iterator[str]:
+        """Content deltas from an OpenAI-compatible SSE body"""
+        response.encoding = 'utf-8'  # SSE is always UTF-8; requests leaves bytes undecoded otherwise
+        for line in response.iter_lines(decode_unicode=True):
+            # Blank lines separate events; lines starting with ':' are keep-alive comments
+            if not line or line.startswith(':') or not line.startswith('data:'):
+                continue
+            payload = line[5:].strip()
+            if payload == '[DONE]':
+                break
+            try:
+                chunk = json.loads(payload)
+            except ValueError:
+                logger.debug(f"Skipping malformed stream chunk: {payload[:100]}")
+                continue
+            if 'error' in chunk:
+                logger.error(f"OpenRouter stream error: {chunk['error']}")
+                break
+            for choice in chunk.get('choices', []):
+                content = (choice.get('delta') or {}).get('content')
+                if content:
+                    yield content
 
     def _get_fallback_response(self, language: str = "ru") -> str:
         fallback_responses = {
@@ -197,7 +420,8 @@ class MistralClient:
                 "Content-Type": "application/json"
             }
 
-            response = requests.get(f"{self.base_url}/models", headers=headers)
+            response = self.session.get(f"{self.base_url}/models", headers=headers,
+                                        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
 
             if response.status_code == 200:
                 return response.json()
@@ -212,4 +436,113 @@ class MistralClient:
     def set_model(self, model_name: str):
         """Change the model being used"""
         self.model = model_name
-        logger.info(f"Switched to model: {model_name}")
\ No newline at end of file
+        logger.info(f"Switched to model: {model_name}")
+
+
+class AsyncMistralClient(MistralClient):
+    """asyncio variant of MistralClient for the ASGI chat path
+
+    Same prompts, failover, retries and circuit breaker, but requests go
+    through a pooled httpx.AsyncClient, so one worker can keep hundreds of
+    completions in flight while awaiting OpenRouter.
+    """
+
+    async def get_response(self, user_message: str, context: str = "", language: str = "ru") -> str:
+        return await self.get_response_with_system_prompt(user_message, context, language)
+
+    async def get_response_with_system_prompt(self,
+                                              user_message: str,
+                                              context: str = "",
+                                              language: str = "ru",
+                                              custom_system_prompt: str = "") -> str:
+        try:
+            if not self.api_key:
+                logger.error("OpenRouter API key not configured")
+                return self._get_fallback_response(language)
+
+            data = self._completion_payload(user_message, context, language, custom_system_prompt)
+            response = await self._post_completion_async(data)
+            if response is None:
+                return self._get_fallback_response(language)
+
+            return self._completion_text(response.json(), language)
+
+        except Exception as e:
+            logger.error(f"Unexpected error in async OpenRouter client: {str(e)}")
+            return self._get_fallback_response(language)
+
+    async def _post_completion_async(self, data: dict):
+        """Awaitable counterpart of MistralClient._post_completion"""
+        import httpx
+
+        deadline = time.monotonic() + REQUEST_DEADLINE
+        url = f"{self.base_url}/chat/completions"
+        headers = self._headers()
+        client = get_async_http_client()
+
+        for model in self._candidate_models():
+            if not self.circuit_breaker.allow(model):
+                logger.debug(f"Skipping model {model}: circuit open")
+                continue
+            data["model"] = model
+            for attempt in range(self.MAX_RETRIES + 1):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self._deadline_exceeded(model)
+
+                retry_after = None
+                try:
+                    response = await client.post(url, headers=headers, json=data,
+                                                 timeout=httpx.Timeout(min(READ_TIMEOUT, remaining),
+                                                                       connect=CONNECT_TIMEOUT))
+                    if response.status_code == 200:
+                        self._on_success(model)
+                        return response
+                    retry_after = response.headers.get("Retry-After")
+                    outcome = self._on_error_status(model, response.status_code, response.text, attempt)
+                except (httpx.TransportError, httpx.TimeoutException) as e:
+                    outcome = self._on_network_error(model, e)
+                except Exception:
+                    self.circuit_breaker.record_failure(model)
+                    raise
+
+                if outcome == 'stop':
+                    return None
+                if outcome == 'next' or attempt == self.MAX_RETRIES or self.circuit_breaker.is_open(model):
+                    break
+                delay = self._backoff_delay(attempt, retry_after)
+                if time.monotonic() + delay >= deadline:
+                    return self._deadline_exceeded(model)
+                await asyncio.sleep(delay)
+        return None
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client():
+    """Pooled keep-alive httpx.AsyncClient of the running event loop"""
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=100),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_http_client():
+    """Close the running loop's client (ASGI lifespan shutdown)"""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+# Глобальные экземпляры: общий пул соединений и состояние моделей на процесс
+model_circuit_breaker = ModelCircuitBreaker()
+mistral_client = MistralClient()
+async_mistral_client = AsyncMistralClient()
@@ -8,14 +8,22 @@ import os
 import json
 import logging
 import sqlite3
+import string
+import threading
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple, Optional, Any
+from typing import Dict, List, Set, Tuple, Optional, Any
 from collections import defaultdict
 from dataclasses import dataclass
 import hashlib
 
+from keyword_matcher import keyword_matcher
+from write_behind import write_behind
+
 logger = logging.getLogger(__name__)
 
+# Знаки, отбрасываемые с краев слов для ключей инвертированного индекса
+TOKEN_PUNCTUATION = string.punctuation + '«»—–…'
+
 @dataclass
 class InteractionRecord:
     """Запись о взаимодействии пользователя с агентом"""
@@ -44,7 +52,32 @@ class MLRouter:
     Использует историю взаимодействий для улучшения качества маршрутизации
     """
     
-    def __init__(self, db_path: str = "ml_router_history.db"):
+    # Индикаторы стиля сообщения
+    MESSAGE_INDICATORS = {
+        'question_words': ['как', 'что', 'где', 'когда', 'почему', 'какой'],
+        'urgency_indicators': ['срочно', 'быстро', 'немедленно', 'нужно'],
+        'formal_tone': ['пожалуйста', 'благодарю', 'уважаемый'],
+    }
+    
+    # Доменные ключевые слова
+    DOMAIN_KEYWORDS = {
+        'academic': ['расписание', 'экзамен', 'зачет', 'лекция', 'семинар', 'учеба', 'студент'],
+        'career': ['работа', 'вакансии', 'резюме', 'карьера', 'трудоустройство'],
+        'admission': ['поступление', 'абитуриент', 'документы', 'вступительный'],
+        'hr': ['отпуск', 'зарплата', 'кадры', 'сотрудник', 'преподаватель'],
+        'housing': ['общежитие', 'комната', 'заселение', 'проживание']
+    }
+    
+    # Простые правила на основе доменов для резервного предсказания
+    FALLBACK_RULES = [
+        (['работа', 'трудоустройство', 'вакансии', 'резюме', 'карьера'], 'career_navigator', 0.8),
+        (['расписание', 'экзамен', 'зачет', 'учеба', 'студент', 'система поддержки'], 'uninav', 0.7),
+        (['поступление', 'абитуриент', 'документы', 'вступительный'], 'ai_abitur', 0.7),
+        (['отпуск', 'зарплата', 'кадры', 'сотрудник', 'преподаватель'], 'kadrai', 0.7),
+        (['общежитие', 'комната', 'заселение', 'проживание'], 'uniroom', 0.7)
+    ]
+    
+    def __init__(self, db_path: str = "ml_router_history.db", max_patterns: Optional[int] = None):
         self.db_path = db_path
         self.feature_extractors = []
         self.agent_patterns = defaultdict(list)
@@ -52,6 +85,23 @@ class MLRouter:
         self.min_confidence_threshold = 0.3
         self.learning_rate = 0.1
         
+        # Предел числа паттернов: сверх него отбрасываются наименее ценные (с запасом 10%)
+        if max_patterns is None:
+            max_patterns = int(os.environ.get('ML_ROUTER_MAX_PATTERNS', '5000'))
+        self.max_patterns = max_patterns
+        self.pruned_patterns = 0
+        
+        # Инвертированный индекс: токен -> ключи паттернов; для паттерна заранее
+        # посчитаны строка в нижнем регистре, множество слов и токены индекса
+        self._token_index: Dict[str, Set[str]] = defaultdict(set)
+        self._pattern_terms: Dict[str, Tuple[str, frozenset, frozenset]] = {}
+        # (агент, токены) -> ключ: паттерны из тех же слов сливаются в один
+        self._canonical_patterns: Dict[Tuple[str, frozenset], str] = {}
+        self._index_lock = threading.RLock()
+        
+        # Регистрация списков ключевых слов в общем автомате
+        self._register_keyword_groups()
+        
         # Инициализация базы данных
         self._init_database()
         
@@ -136,67 +186,144 @@ class MLRouter:
                         last_updated=datetime.fromisoformat(last_updated)
                     )
                     
-                    self.performance_cache[f"{agent_name}:{pattern}"] = performance
-                    self.agent_patterns[agent_name].append(pattern)
+                    self._add_pattern(performance)
                 
                 logger.info(f"Loaded {len(self.performance_cache)} performance records")
+            
+            pruned = self._prune_patterns()
+            if pruned:
+                self._delete_patterns_from_db(pruned)
                 
         except Exception as e:
             logger.error(f"Failed to load historical data: {e}")
     
+    def _register_keyword_groups(self):
+        """Регистрация списков ключевых слов в общем автомате Ахо-Корасик"""
+        for feature, words in self.MESSAGE_INDICATORS.items():
+            keyword_matcher.register(f'ml_router:{feature}', words)
+        for domain, keywords in self.DOMAIN_KEYWORDS.items():
+            keyword_matcher.register(f'ml_router:domain_{domain}', keywords)
+        for keywords, agent, _ in self.FALLBACK_RULES:
+            keyword_matcher.register(f'ml_router:fallback_{agent}', keywords)
+    
     def _extract_message_features(self, message: str) -> Dict[str, float]:
         """Извлечение признаков из сообщения"""
         message_lower = message.lower().strip()
         
+        # Один общий проход автомата по сообщению для всех списков
+        scan = keyword_matcher.scan(message_lower)
+        
         features = {
             'length': len(message) / 100.0,  # Нормализованная длина
             'word_count': len(message.split()) / 20.0,  # Нормализованное количество слов
-            'question_words': sum(1 for w in ['как', 'что', 'где', 'когда', 'почему', 'какой'] 
-                                if w in message_lower) / 6.0,
-            'urgency_indicators': sum(1 for w in ['срочно', 'быстро', 'немедленно', 'нужно'] 
-                                    if w in message_lower) / 4.0,
-            'formal_tone': sum(1 for w in ['пожалуйста', 'благодарю', 'уважаемый'] 
-                             if w in message_lower) / 3.0,
         }
+        for feature, words in self.MESSAGE_INDICATORS.items():
+            features[feature] = scan.count(f'ml_router:{feature}') / len(words)
         
         # Доменные признаки
-        domain_keywords = {
-            'academic': ['расписание', 'экзамен', 'зачет', 'лекция', 'семинар', 'учеба', 'студент'],
-            'career': ['работа', 'вакансии', 'резюме', 'карьера', 'трудоустройство'],
-            'admission': ['поступление', 'абитуриент', 'документы', 'вступительный'],
-            'hr': ['отпуск', 'зарплата', 'кадры', 'сотрудник', 'преподаватель'],
-            'housing': ['общежитие', 'комната', 'заселение', 'проживание']
-        }
-        
-        for domain, keywords in domain_keywords.items():
-            features[f'domain_{domain}'] = sum(1 for kw in keywords 
-                                             if kw in message_lower) / len(keywords)
+        for domain, keywords in self.DOMAIN_KEYWORDS.items():
+            features[f'domain_{domain}'] = scan.count(f'ml_router:domain_{domain}') / len(keywords)
         
         return features
     
-    def _calculate_pattern_similarity(self, message: str, pattern: str) -> float:
-        """Вычисление семантического сходства между сообщением и паттерном"""
-        # Простая реализация на основе пересечения слов
-        # В продакшене можно заменить на sentence embeddings
-        
-        message_words = set(message.lower().split())
-        pattern_words = set(pattern.lower().split())
-        
+    @staticmethod
+    def _index_tokens(words) -> frozenset:
+        """Ключи индекса: слова без пунктуации по краям ("работа?" -> "работа")"""
+        tokens = (word.strip(TOKEN_PUNCTUATION) for word in words)
+        return frozenset(token for token in tokens if token)
+    
+    def _add_pattern(self, performance: AgentPerformance):
+        """Добавление паттерна в кэш и инвертированный индекс"""
+        cache_key = f"{performance.agent_name}:{performance.message_pattern}"
+        pattern_lower = performance.message_pattern.lower()
+        pattern_words = frozenset(pattern_lower.split())
+        tokens = self._index_tokens(pattern_words)
+        with self._index_lock:
+            self.performance_cache[cache_key] = performance
+            self.agent_patterns[performance.agent_name].append(performance.message_pattern)
+            self._pattern_terms[cache_key] = (pattern_lower, pattern_words, tokens)
+            for token in tokens:
+                self._token_index[token].add(cache_key)
+            self._canonical_patterns.setdefault((performance.agent_name, tokens), cache_key)
+    
+    @staticmethod
+    def _pattern_weight(performance: AgentPerformance) -> float:
+        """Вес паттерна по исторической производительности"""
+        return (
+            performance.success_rate * 0.4 +
+            (performance.avg_rating / 5.0) * 0.3 +
+            min(performance.interaction_count / 100.0, 1.0) * 0.3
+        )
+    
+    def _prune_patterns(self) -> List[AgentPerformance]:
+        """Сверх max_patterns удаляем наименее ценные паттерны (вес, затем давность) до 90% предела"""
+        with self._index_lock:
+            if self.max_patterns <= 0 or len(self.performance_cache) <= self.max_patterns:
+                return []
+            ranked = sorted(self.performance_cache.items(),
+                            key=lambda item: (self._pattern_weight(item[1]), item[1].last_updated))
+            removed = ranked[:len(ranked) - int(self.max_patterns * 0.9)]
+            agents = set()
+            for cache_key, performance in removed:
+                del self.performance_cache[cache_key]
+                pattern_lower, pattern_words, tokens = self._pattern_terms.pop(cache_key)
+                for token in tokens:
+                    keys = self._token_index.get(token)
+                    if keys is not None:
+                        keys.discard(cache_key)
+                        if not keys:
+                            del self._token_index[token]
+                canonical = (performance.agent_name, tokens)
+                if self._canonical_patterns.get(canonical) == cache_key:
+                    del self._canonical_patterns[canonical]
+                agents.add(performance.agent_name)
+            for agent in agents:
+                self.agent_patterns[agent] = [
+                    pattern for pattern in self.agent_patterns[agent]
+                    if f"{agent}:{pattern}" in self.performance_cache
+                ]
+            self.pruned_patterns += len(removed)
+        logger.info(f"ML Router pruned {len(removed)} low-value patterns")
+        return [performance for _, performance in removed]
+    
+    def _delete_patterns_from_db(self, performances: List[AgentPerformance]):
+        """Удаление отброшенных паттернов из базы данных"""
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.executemany(
+                    "DELETE FROM agent_performance WHERE agent_name = ? AND message_pattern = ?",
+                    [(p.agent_name, p.message_pattern) for p in performances])
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to delete pruned patterns from DB: {e}")
+    
+    @staticmethod
+    def _similarity(message_lower: str, message_words: frozenset,
+                    pattern_lower: str, pattern_words: frozenset) -> float:
+        """Сходство по заранее разобранным сообщению и паттерну"""
         if not message_words or not pattern_words:
             return 0.0
         
-        intersection = len(message_words.intersection(pattern_words))
-        union = len(message_words.union(pattern_words))
+        intersection = len(message_words & pattern_words)
+        union = len(message_words) + len(pattern_words) - intersection
         
         jaccard_similarity = intersection / union if union > 0 else 0.0
         
         # Бонус за точные фразовые совпадения
         phrase_bonus = 0.0
-        if pattern.lower() in message.lower() or message.lower() in pattern.lower():
+        if pattern_lower in message_lower or message_lower in pattern_lower:
             phrase_bonus = 0.3
         
         return min(1.0, jaccard_similarity + phrase_bonus)
     
+    def _calculate_pattern_similarity(self, message: str, pattern: str) -> float:
+        """Вычисление семантического сходства между сообщением и паттерном"""
+        # Простая реализация на основе пересечения слов
+        # В продакшене можно заменить на sentence embeddings
+        message_lower, pattern_lower = message.lower(), pattern.lower()
+        return self._similarity(message_lower, frozenset(message_lower.split()),
+                                pattern_lower, frozenset(pattern_lower.split()))
+    
     def predict_best_agent(self, message: str, user_id: str = "anonymous") -> Tuple[str, float, Dict[str, Any]]:
         """
         Предсказание лучшего агента на основе ML модели и истории
@@ -208,42 +335,43 @@ class MLRouter:
         agent_scores = defaultdict(float)
         explanations = defaultdict(list)
         
-        # Анализируем производительность каждого агента
-        for agent_name, patterns in self.agent_patterns.items():
-            agent_score = 0.0
-            pattern_matches = []
-            
-            for pattern in patterns:
-                cache_key = f"{agent_name}:{pattern}"
-                if cache_key in self.performance_cache:
-                    performance = self.performance_cache[cache_key]
-                    
-                    # Вычисляем сходство с паттерном
-                    similarity = self._calculate_pattern_similarity(message, pattern)
-                    
-                    if similarity > 0.1:  # Минимальное сходство
-                        # Вес основан на исторической производительности
-                        pattern_weight = (
-                            performance.success_rate * 0.4 +
-                            (performance.avg_rating / 5.0) * 0.3 +
-                            min(performance.interaction_count / 100.0, 1.0) * 0.3
-                        )
-                        
-                        pattern_score = similarity * pattern_weight
-                        agent_score += pattern_score
-                        
-                        pattern_matches.append({
-                            'pattern': pattern,
-                            'similarity': similarity,
-                            'performance': performance.success_rate,
-                            'rating': performance.avg_rating,
-                            'count': performance.interaction_count,
-                            'score': pattern_score
-                        })
+        message_lower = message.lower()
+        message_words = frozenset(message_lower.split())
+        
+        # Кандидаты — только паттерны с общим токеном (инвертированный индекс).
+        # Без общих токенов паттерн мог совпасть лишь подстрокой (фразовый бонус,
+        # "работ" в "работа"): тогда они ищутся перебором, как раньше
+        with self._index_lock:
+            candidate_keys = set()
+            for token in self._index_tokens(message_words):
+                candidate_keys.update(self._token_index.get(token, ()))
+            if not candidate_keys and message_words:
+                candidate_keys = {key for key, (pattern_lower, _, _) in self._pattern_terms.items()
+                                  if pattern_lower and (pattern_lower in message_lower or message_lower in pattern_lower)}
+            candidates = [(self.performance_cache[key], self._pattern_terms[key]) for key in candidate_keys]
+            pattern_counts = {agent: len(patterns) for agent, patterns in self.agent_patterns.items()}
+        
+        for performance, (pattern_lower, pattern_words, _) in candidates:
+            # Вычисляем сходство с паттерном
+            similarity = self._similarity(message_lower, message_words, pattern_lower, pattern_words)
             
-            if pattern_matches:
-                agent_scores[agent_name] = agent_score / len(patterns)  # Нормализация
-                explanations[agent_name] = pattern_matches
+            if similarity > 0.1:  # Минимальное сходство
+                # Вес основан на исторической производительности
+                pattern_score = similarity * self._pattern_weight(performance)
+                agent_scores[performance.agent_name] += pattern_score
+                
+                explanations[performance.agent_name].append({
+                    'pattern': performance.message_pattern,
+                    'similarity': similarity,
+                    'performance': performance.success_rate,
+                    'rating': performance.avg_rating,
+                    'count': performance.interaction_count,
+                    'score': pattern_score
+                })
+        
+        for agent_name in agent_scores:
+            agent_scores[agent_name] /= pattern_counts[agent_name]  # Нормализация
+            explanations[agent_name].sort(key=lambda match: match['score'], reverse=True)
         
         # Если ML модель не дала результатов, используем fallback
         if not agent_scores:
@@ -273,24 +401,16 @@ class MLRouter:
     
     def _fallback_prediction(self, message: str, features: Dict[str, float]) -> Tuple[str, float, Dict[str, Any]]:
         """Резервная логика предсказания когда ML модель не уверена"""
-        message_lower = message.lower()
+        scan = keyword_matcher.scan(message)
         
         # Простые правила на основе доменов
-        domain_rules = [
-            (['работа', 'трудоустройство', 'вакансии', 'резюме', 'карьера'], 'career_navigator', 0.8),
-            (['расписание', 'экзамен', 'зачет', 'учеба', 'студент', 'система поддержки'], 'uninav', 0.7),
-            (['поступление', 'абитуриент', 'документы', 'вступительный'], 'ai_abitur', 0.7),
-            (['отпуск', 'зарплата', 'кадры', 'сотрудник', 'преподаватель'], 'kadrai', 0.7),
-            (['общежитие', 'комната', 'заселение', 'проживание'], 'uniroom', 0.7)
-        ]
-        
-        for keywords, agent, base_confidence in domain_rules:
-            matches = sum(1 for kw in keywords if kw in message_lower)
+        for keywords, agent, base_confidence in self.FALLBACK_RULES:
+            matches = scan.count(f'ml_router:fallback_{agent}')
             if matches > 0:
                 confidence = min(0.9, base_confidence * (matches / len(keywords)))
                 explanation = {
                     'method': 'fallback_rules',
-                    'matched_keywords': [kw for kw in keywords if kw in message_lower],
+                    'matched_keywords': [kw for kw in keywords if kw in scan.phrases(f'ml_router:fallback_{agent}')],
                     'match_ratio': matches / len(keywords),
                     'base_confidence': base_confidence
                 }
@@ -310,16 +430,10 @@ class MLRouter:
             message_hash = hashlib.md5(message.encode()).hexdigest()
             timestamp = datetime.now().isoformat()
             
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
-                    INSERT OR REPLACE INTO interactions 
-                    (message_hash, message, selected_agent, user_rating, response_relevance,
-                     timestamp, user_id, session_id)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (message_hash, message, selected_agent, user_rating, 
-                      response_relevance, timestamp, user_id, session_id))
-                
-                conn.commit()
+            # Строка истории пишется пакетом в фоне (write-behind)
+            write_behind.submit('ml_interaction', (self.db_path, (
+                message_hash, message, selected_agent, user_rating,
+                response_relevance, timestamp, user_id, session_id)))
             
             # Асинхронное обновление модели
             self._update_model_async(message, selected_agent, user_rating, response_relevance)
@@ -339,37 +453,46 @@ class MLRouter:
             
             # Обновляем производительность агента для данного паттерна
             cache_key = f"{agent}:{message_pattern}"
+            pruned = []
+            
+            with self._index_lock:
+                if cache_key not in self.performance_cache:
+                    # Паттерн из тех же слов (другой порядок, пунктуация) обновляет существующий
+                    tokens = self._index_tokens(message_pattern.lower().split())
+                    cache_key = self._canonical_patterns.get((agent, tokens), cache_key)
             
-            if cache_key in self.performance_cache:
-                perf = self.performance_cache[cache_key]
+                if cache_key in self.performance_cache:
+                    perf = self.performance_cache[cache_key]
                 
-                # Обновляем метрики с learning rate
-                if rating:
-                    new_rating = perf.avg_rating * (1 - self.learning_rate) + (rating / 5.0) * self.learning_rate
-                    perf.avg_rating = new_rating
+                    # Обновляем метрики с learning rate
+                    if rating:
+                        new_rating = perf.avg_rating * (1 - self.learning_rate) + (rating / 5.0) * self.learning_rate
+                        perf.avg_rating = new_rating
                 
-                if relevance:
-                    new_success_rate = perf.success_rate * (1 - self.learning_rate) + relevance * self.learning_rate
-                    perf.success_rate = new_success_rate
+                    if relevance:
+                        new_success_rate = perf.success_rate * (1 - self.learning_rate) + relevance * self.learning_rate
+                        perf.success_rate = new_success_rate
                 
-                perf.interaction_count += 1
-                perf.last_updated = datetime.now()
-            else:
-                # Создаем новую запись
-                perf = AgentPerformance(
-                    agent_name=agent,
-                    message_pattern=message_pattern,
-                    success_rate=relevance if relevance else 0.5,
-                    avg_rating=(rating / 5.0) if rating else 0.5,
-                    interaction_count=1,
-                    last_updated=datetime.now()
-                )
+                    perf.interaction_count += 1
+                    perf.last_updated = datetime.now()
+                else:
+                    # Создаем новую запись
+                    perf = AgentPerformance(
+                        agent_name=agent,
+                        message_pattern=message_pattern,
+                        success_rate=relevance if relevance else 0.5,
+                        avg_rating=(rating / 5.0) if rating else 0.5,
+                        interaction_count=1,
+                        last_updated=datetime.now()
+                    )
                 
-                self.performance_cache[cache_key] = perf
-                self.agent_patterns[agent].append(message_pattern)
+                    self._add_pattern(perf)
+                    pruned = self._prune_patterns()
             
             # Сохраняем в базу данных
             self._save_performance_to_db(perf)
+            if pruned:
+                self._delete_patterns_from_db(pruned)
             
         except Exception as e:
             logger.error(f"Failed to update model: {e}")
@@ -453,6 +576,9 @@ class MLRouter:
                     'agent_statistics': agent_stats,
                     'model_updates': model_updates,
                     'cached_patterns': len(self.performance_cache),
+                    'indexed_tokens': len(self._token_index),
+                    'max_patterns': self.max_patterns,
+                    'pruned_patterns': self.pruned_patterns,
                     'confidence_threshold': self.min_confidence_threshold,
                     'learning_rate': self.learning_rate
                 }
@@ -489,5 +615,23 @@ class MLRouter:
         except Exception as e:
             logger.error(f"Failed to auto-initialize patterns: {e}")
 
+def _write_interactions(rows: List[Tuple[str, tuple]]):
+    """Пакетная запись истории взаимодействий: одно соединение и commit на базу"""
+    by_db: Dict[str, List[tuple]] = defaultdict(list)
+    for db_path, values in rows:
+        by_db[db_path].append(values)
+    for db_path, values in by_db.items():
+        with sqlite3.connect(db_path) as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO interactions 
+                (message_hash, message, selected_agent, user_rating, response_relevance,
+                 timestamp, user_id, session_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, values)
+            conn.commit()
+
+
+write_behind.register('ml_interaction', _write_interactions)
+
 # Глобальный экземпляр ML Router
 ml_router = MLRouter()
\ No newline at end of file
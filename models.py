@@ -58,6 +58,19 @@ class FAQ(db.Model):
 
 class UserQuery(db.Model):
     __tablename__ = 'user_queries'
+    __table_args__ = (
+        # Chat history, rating lookup and user memory: one session, newest first
+        db.Index('ix_user_queries_session_created', 'session_id', 'created_at'),
+        # Recent queries, admin pagination, 30-day windows, rollup day rebuilds
+        db.Index('ix_user_queries_created_at', 'created_at'),
+        # Per-agent counts and per-agent rating breakdowns
+        db.Index('ix_user_queries_agent_name_rating', 'agent_name', 'user_rating'),
+        # Rating counts; latest feedback and the rollup rating watermark
+        db.Index('ix_user_queries_user_rating', 'user_rating'),
+        db.Index('ix_user_queries_rating_timestamp', 'rating_timestamp'),
+        # Like/dislike of a chat reply by its message_id
+        db.Index('ix_user_queries_message_id', 'message_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_message = db.Column(db.Text, nullable=False)
@@ -76,6 +89,7 @@ class UserQuery(db.Model):
     rating_timestamp = db.Column(db.DateTime)  # When rating was given
     
     session_id = db.Column(db.String(100))
+    message_id = db.Column(db.String(36))  # UUID returned with the chat reply, known before the row is written
     ip_address = db.Column(db.String(45))
     user_agent = db.Column(db.String(500))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -83,6 +97,51 @@ class UserQuery(db.Model):
     def __repr__(self):
         return f'<UserQuery {self.user_message[:30]}...>'
 
+class QueryDailyRollup(db.Model):
+    """Materialized per-day aggregates of user_queries (maintained by statistics_rollups)"""
+    __tablename__ = 'query_daily_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('day', 'agent_type', 'agent_name', 'language', 'rating', name='uq_query_daily_rollup'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, index=True)
+    agent_type = db.Column(db.String(50), nullable=False, default='')  # '' = unknown
+    agent_name = db.Column(db.String(100), nullable=False, default='')
+    language = db.Column(db.String(5), nullable=False)
+    rating = db.Column(db.String(10), nullable=False, default='none')  # 'like', 'dislike' or 'none'
+    query_count = db.Column(db.Integer, nullable=False, default=0)
+    response_time_sum = db.Column(db.Float, nullable=False, default=0.0)
+    response_time_count = db.Column(db.Integer, nullable=False, default=0)
+    confidence_sum = db.Column(db.Float, nullable=False, default=0.0)
+    confidence_count = db.Column(db.Integer, nullable=False, default=0)
+
+class QueryHourlyRollup(db.Model):
+    """Queries per day and hour of day (UTC)"""
+    __tablename__ = 'query_hourly_rollups'
+    __table_args__ = (db.UniqueConstraint('day', 'hour', name='uq_query_hourly_rollup'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, index=True)
+    hour = db.Column(db.Integer, nullable=False)
+    query_count = db.Column(db.Integer, nullable=False, default=0)
+
+class SessionActivity(db.Model):
+    """First/last query time and query count of every chat session"""
+    __tablename__ = 'session_activity'
+    
+    session_id = db.Column(db.String(100), primary_key=True)
+    first_seen = db.Column(db.DateTime, nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False, index=True)
+    query_count = db.Column(db.Integer, nullable=False, default=0)
+
+class RollupState(db.Model):
+    """Watermarks of the incremental statistics refresh"""
+    __tablename__ = 'rollup_state'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.String(64))
+
 class Document(db.Model):
     __tablename__ = 'documents'
     
@@ -137,6 +196,10 @@ class KnowledgeBase(db.Model):
 class AgentKnowledgeBase(db.Model):
     """Agent-specific knowledge base entries"""
     __tablename__ = 'agent_knowledge_base'
+    __table_args__ = (
+        # Active entries of an agent in priority order (knowledge snapshot, agent context)
+        db.Index('ix_agent_knowledge_active_agent_priority', 'is_active', 'agent_type', 'priority'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     agent_type = db.Column(db.String(50), nullable=False)  # Type of agent this knowledge belongs to
@@ -433,6 +496,10 @@ class Teacher(db.Model):
 class Schedule(db.Model):
     """Модель расписания занятий"""
     __tablename__ = 'schedules'
+    __table_args__ = (
+        # Lessons of a group by time
+        db.Index('ix_schedules_group_start', 'group_name', 'start_time'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     
@@ -479,38 +546,54 @@ class Schedule(db.Model):
         """Получить дату из start_time"""
         return self.start_time.date() if self.start_time else None
     
+    LESSON_TYPES = {
+        'lecture': {'ru': 'Лекция', 'kz': 'Дәріс', 'en': 'Lecture'},
+        'practice': {'ru': 'Практика', 'kz': 'Практика', 'en': 'Practice'},
+        'lab': {'ru': 'Лабораторная', 'kz': 'Зертхана', 'en': 'Laboratory'},
+        'exam': {'ru': 'Экзамен', 'kz': 'Емтихан', 'en': 'Exam'},
+        'consultation': {'ru': 'Консультация', 'kz': 'Кеңес', 'en': 'Consultation'}
+    }
+    
+    # Колонки, нужные для row_to_dict (запросы без загрузки ORM-объектов)
+    DICT_COLUMNS = ('id', 'schedule_type', 'title', 'description', 'faculty', 'course_code', 'group_name',
+                    'instructor', 'start_time', 'end_time', 'location', 'room', 'is_recurring',
+                    'recurrence_pattern', 'is_cancelled', 'cancellation_reason')
+    
     def get_lesson_type_display(self, language='ru'):
         """Получить отображаемое название типа занятия"""
-        types = {
-            'lecture': {'ru': 'Лекция', 'kz': 'Дәріс', 'en': 'Lecture'},
-            'practice': {'ru': 'Практика', 'kz': 'Практика', 'en': 'Practice'},
-            'lab': {'ru': 'Лабораторная', 'kz': 'Зертхана', 'en': 'Laboratory'},
-            'exam': {'ru': 'Экзамен', 'kz': 'Емтихан', 'en': 'Exam'},
-            'consultation': {'ru': 'Консультация', 'kz': 'Кеңес', 'en': 'Consultation'}
+        return self.LESSON_TYPES.get(self.schedule_type, {}).get(language, self.schedule_type)
+    
+    @classmethod
+    def row_to_dict(cls, row, language='ru', start_time=None, end_time=None):
+        """Словарь для API из строки запроса с DICT_COLUMNS (или из объекта).
+        
+        start_time/end_time заменяют время строки для повторений регулярного занятия.
+        """
+        start_time = start_time or row.start_time
+        end_time = end_time or row.end_time
+        return {
+            'id': row.id,
+            'date': start_time.date().isoformat() if start_time else None,
+            'start_time': start_time.strftime('%H:%M') if start_time else None,
+            'end_time': end_time.strftime('%H:%M') if end_time else None,
+            'subject_name': row.title,
+            'subject_code': row.course_code,
+            'teacher_name': row.instructor,
+            'classroom': row.room,
+            'lesson_type': row.schedule_type,
+            'lesson_type_display': cls.LESSON_TYPES.get(row.schedule_type, {}).get(language, row.schedule_type),
+            'notes': row.description,
+            'is_cancelled': row.is_cancelled,
+            'cancellation_reason': row.cancellation_reason,
+            'duration_minutes': int((end_time - start_time).total_seconds() / 60) if start_time and end_time else 0,
+            'group_name': row.group_name,
+            'faculty': row.faculty,
+            'location': row.location
         }
-        return types.get(self.schedule_type, {}).get(language, self.schedule_type)
     
     def to_dict(self, language='ru'):
         """Преобразовать в словарь для API"""
-        return {
-            'id': self.id,
-            'date': self.date.isoformat() if self.date else None,
-            'start_time': self.start_time.strftime('%H:%M') if self.start_time else None,
-            'end_time': self.end_time.strftime('%H:%M') if self.end_time else None,
-            'subject_name': self.title,
-            'subject_code': self.course_code,
-            'teacher_name': self.instructor,
-            'classroom': self.room,
-            'lesson_type': self.schedule_type,
-            'lesson_type_display': self.get_lesson_type_display(language),
-            'notes': self.description,
-            'is_cancelled': self.is_cancelled,
-            'cancellation_reason': self.cancellation_reason,
-            'duration_minutes': self.duration_minutes,
-            'group_name': self.group_name,
-            'faculty': self.faculty,
-            'location': self.location
-        }
+        return self.row_to_dict(self, language)
     
     def __repr__(self):
         return f'<Schedule {self.group_name}: {self.title} at {self.start_time}>'
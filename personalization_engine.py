@@ -13,6 +13,8 @@ from typing import Dict, List, Optional, Any, Tuple
 from collections import defaultdict, deque
 import hashlib
 
+from worker_metrics import MetricFamily, worker_metrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -494,4 +496,16 @@ class PersonalizationEngine:
 
 
 # Global personalization engine
-personalization_engine = PersonalizationEngine()
\ No newline at end of file
+personalization_engine = PersonalizationEngine()
+
+
+def _collect_metrics() -> List[MetricFamily]:
+    profiles = list(personalization_engine.user_profiles.values())
+    return [
+        MetricFamily('bolashak_personalization_profiles', 'gauge', 'User profiles held in memory').add(len(profiles)),
+        MetricFamily('bolashak_personalization_interactions', 'gauge', 'Interactions recorded in the held profiles')
+        .add(sum(profile.interaction_count for profile in profiles)),
+    ]
+
+
+worker_metrics.register('personalization', _collect_metrics)
\ No newline at end of file
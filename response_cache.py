@@ -2,52 +2,84 @@
 Simple Response Caching Module
 Модуль кэширования ответов
 
-This module provides basic caching for frequently asked questions
-to improve response times and reduce API calls.
+This module provides caching for frequently asked questions to improve
+response times and reduce API calls: an in-process LRU (L1) in front of an
+optional cross-worker store (L2: Redis or a shared SQLite file), addressed by
+one canonical key and used by the agents through get_or_compute(). On an
+exact miss a near-duplicate index (semantic_cache) can map the question to
+the key of an already cached paraphrase. Concurrent misses for one key are
+coalesced (single flight): one request calls the LLM, the others wait for
+its answer, within the worker and optionally across workers via L2 leases.
 """
 
+import asyncio
 import hashlib
 import json
 import logging
+import os
+import re
+import sqlite3
+import threading
 import time
-from typing import Dict, Optional, Any
+from typing import Awaitable, Callable, Dict, List, Optional, Any, Tuple
 from collections import OrderedDict
 
+from cache_snapshot import cache_snapshots
+from worker_metrics import MetricFamily, worker_metrics
+from semantic_cache import SemanticCacheIndex, get_semantic_index
+
 logger = logging.getLogger(__name__)
 
+_WHITESPACE = re.compile(r"\s+")
+
+
+def make_cache_key(user_message: str, agent_type: str, language: str) -> str:
+    """Canonical response cache key shared by every cache tier"""
+    # Normalize message for better cache hits
+    normalized_message = _WHITESPACE.sub(' ', user_message.lower()).strip()
+    digest = hashlib.blake2b(normalized_message.encode('utf-8'), digest_size=12).hexdigest()
+    return f"resp:{agent_type}:{language}:{digest}"
+
 
 class ResponseCache:
-    """Simple in-memory cache for AI responses with TTL support"""
+    """Simple in-memory cache for AI responses with TTL support
+
+    Bounded both by entry count and by the estimated size of the cached
+    payloads (LRU eviction within the byte budget). Expiry uses a timer
+    wheel: each entry sits in the bucket of the second after it expires, and
+    cleanup drops whole buckets whose time has passed, so expiring an entry
+    costs O(1) instead of a scan of the cache.
+    """
+
+    EXPIRY_GRANULARITY = 1.0  # seconds per timer wheel bucket
+    ENTRY_OVERHEAD = 400  # bytes of dict/OrderedDict bookkeeping per entry
     
-    def __init__(self, max_size: int = 1000, default_ttl: int = 3600):
+    def __init__(self, max_size: int = 1000, default_ttl: int = 3600, max_bytes: int = 64 * 1024 * 1024):
         """
         Initialize cache
         
         Args:
             max_size: Maximum number of cached responses
             default_ttl: Default time-to-live in seconds (1 hour)
+            max_bytes: Budget for the estimated size of cached responses
         """
         self.max_size = max_size
         self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
         self.cache: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self.resident_bytes = 0
         self.hits = 0
         self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected_oversize = 0
+        self._wheel: Dict[int, set] = {}
+        self._wheel_cursor = self._slot(time.time()) - 1
+        self._lock = threading.RLock()
         
     def _generate_cache_key(self, user_message: str, agent_type: str, language: str) -> str:
         """Generate cache key from message parameters"""
-        # Normalize message for better cache hits
-        normalized_message = user_message.lower().strip()
-        
-        # Create unique key
-        key_data = {
-            'message': normalized_message,
-            'agent': agent_type,
-            'language': language
-        }
-        
-        # Use SHA256 hash for consistent key generation
-        key_string = json.dumps(key_data, sort_keys=True, ensure_ascii=False)
-        return hashlib.sha256(key_string.encode('utf-8')).hexdigest()[:16]
+        return make_cache_key(user_message, agent_type, language)
     
     def _is_expired(self, cache_entry: Dict[str, Any]) -> bool:
         """Check if cache entry is expired"""
@@ -55,26 +87,57 @@ class ResponseCache:
             return True
             
         return time.time() > cache_entry['expires_at']
+
+    def _slot(self, timestamp: float) -> int:
+        return int(timestamp // self.EXPIRY_GRANULARITY)
+
+    @staticmethod
+    def estimate_size(cache_key: str, response_data: Dict[str, Any]) -> int:
+        """Approximate resident bytes of an entry: UTF-8 JSON of the payload plus fixed overhead"""
+        payload = json.dumps(response_data, ensure_ascii=False, default=str)
+        return len(payload.encode('utf-8')) + len(cache_key) + ResponseCache.ENTRY_OVERHEAD
+
+    def _remove(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        entry = self.cache.pop(cache_key, None)
+        if entry is not None:
+            self.resident_bytes -= entry['size']
+            bucket = self._wheel.get(entry['slot'])
+            if bucket is not None:
+                bucket.discard(cache_key)
+                if not bucket:
+                    del self._wheel[entry['slot']]
+        return entry
     
     def _cleanup_expired(self):
-        """Remove expired entries from cache"""
-        current_time = time.time()
-        expired_keys = [
-            key for key, entry in self.cache.items() 
-            if current_time > entry.get('expires_at', 0)
-        ]
-        
-        for key in expired_keys:
-            del self.cache[key]
-            
-        if expired_keys:
-            logger.debug(f"Cleaned up {len(expired_keys)} expired cache entries")
+        """Drop the timer wheel buckets that have fully expired"""
+        now_slot = self._slot(time.time())
+        if now_slot <= self._wheel_cursor:
+            return
+        if now_slot - self._wheel_cursor > len(self._wheel):
+            # Long idle gap: visiting the occupied buckets is cheaper than every elapsed slot
+            slots = [slot for slot in self._wheel if slot <= now_slot]
+        else:
+            slots = range(self._wheel_cursor + 1, now_slot + 1)
+        self._wheel_cursor = now_slot
+
+        expired = 0
+        for slot in slots:
+            for cache_key in self._wheel.pop(slot, ()):
+                entry = self.cache.pop(cache_key, None)
+                if entry is not None:
+                    self.resident_bytes -= entry['size']
+                    expired += 1
+        if expired:
+            self.expirations += expired
+            logger.debug(f"Cleaned up {expired} expired cache entries")
     
-    def _evict_oldest(self):
-        """Remove oldest entries to maintain max_size"""
-        while len(self.cache) >= self.max_size:
+    def _evict_oldest(self, incoming_bytes: int = 0):
+        """Remove least recently used entries to fit max_size and the byte budget"""
+        while self.cache and (len(self.cache) >= self.max_size
+                              or self.resident_bytes + incoming_bytes > self.max_bytes):
             oldest_key = next(iter(self.cache))
-            del self.cache[oldest_key]
+            self._remove(oldest_key)
+            self.evictions += 1
             logger.debug(f"Evicted oldest cache entry: {oldest_key}")
     
     def get(self, user_message: str, agent_type: str, language: str = 'ru') -> Optional[Dict[str, Any]]:
@@ -85,11 +148,19 @@ class ResponseCache:
             Cached response dict or None if not found/expired
         """
         try:
-            cache_key = self._generate_cache_key(user_message, agent_type, language)
+            response = self.get_entry(self._generate_cache_key(user_message, agent_type, language))
+            if response is not None:
+                logger.debug(f"Cache hit for message: '{user_message[:50]}...'")
+            return response
             
-            # Clean up expired entries periodically
-            if len(self.cache) > 0 and (self.hits + self.misses) % 10 == 0:
-                self._cleanup_expired()
+        except Exception as e:
+            logger.error(f"Error accessing cache: {e}")
+            return None
+    
+    def get_entry(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Cached response by canonical key (LRU touch on hit)"""
+        with self._lock:
+            self._cleanup_expired()
             
             if cache_key in self.cache:
                 entry = self.cache[cache_key]
@@ -98,19 +169,14 @@ class ResponseCache:
                     # Move to end (LRU behavior)
                     self.cache.move_to_end(cache_key)
                     self.hits += 1
-                    
-                    logger.debug(f"Cache hit for message: '{user_message[:50]}...'")
                     return entry['response']
                 else:
-                    # Remove expired entry
-                    del self.cache[cache_key]
+                    # Expired within the current wheel bucket
+                    self._remove(cache_key)
+                    self.expirations += 1
             
             self.misses += 1
             return None
-            
-        except Exception as e:
-            logger.error(f"Error accessing cache: {e}")
-            return None
     
     def set(self, user_message: str, agent_type: str, response_data: Dict[str, Any], 
             language: str = 'ru', ttl: Optional[int] = None) -> bool:
@@ -129,38 +195,77 @@ class ResponseCache:
         """
         try:
             cache_key = self._generate_cache_key(user_message, agent_type, language)
+            stored = self.set_entry(cache_key, response_data, ttl, agent_type=agent_type, language=language)
             
-            # Calculate expiration time
-            ttl = ttl or self.default_ttl
-            expires_at = time.time() + ttl
+            logger.debug(f"Cached response for message: '{user_message[:50]}...' "
+                        f"(TTL: {ttl or self.default_ttl}s)")
+            return stored
             
+        except Exception as e:
+            logger.error(f"Error caching response: {e}")
+            return False
+    
+    def set_entry(self, cache_key: str, response_data: Dict[str, Any], ttl: Optional[float] = None,
+                  agent_type: str = '', language: str = '') -> bool:
+        """Store a response under its canonical key; False if it alone exceeds the byte budget"""
+        # Calculate expiration time
+        ttl = ttl or self.default_ttl
+        now = time.time()
+        expires_at = now + ttl
+        size = self.estimate_size(cache_key, response_data)
+        
+        with self._lock:
+            self._remove(cache_key)
+            if size > self.max_bytes:
+                self.rejected_oversize += 1
+                logger.debug(f"Response of {size} bytes exceeds the cache budget, not cached")
+                return False
+
+            self._cleanup_expired()
             # Evict old entries if needed
-            self._evict_oldest()
+            self._evict_oldest(size)
             
+            # Bucket of the first wheel slot that starts after expiry
+            slot = max(self._slot(expires_at) + 1, self._wheel_cursor + 1)
+            self._wheel.setdefault(slot, set()).add(cache_key)
+            self.resident_bytes += size
+
             # Store in cache
-            cache_entry = {
+            self.cache[cache_key] = {
                 'response': response_data,
-                'cached_at': time.time(),
+                'cached_at': now,
                 'expires_at': expires_at,
                 'agent_type': agent_type,
-                'language': language
+                'language': language,
+                'size': size,
+                'slot': slot
             }
-            
-            self.cache[cache_key] = cache_entry
-            
-            logger.debug(f"Cached response for message: '{user_message[:50]}...' "
-                        f"(TTL: {ttl}s)")
             return True
-            
-        except Exception as e:
-            logger.error(f"Error caching response: {e}")
-            return False
+    
+    def delete_entry(self, cache_key: str) -> bool:
+        with self._lock:
+            return self._remove(cache_key) is not None
+
+    def export_entries(self) -> List[Dict[str, Any]]:
+        """Live entries in LRU order (oldest first) with their absolute expiry"""
+        with self._lock:
+            self._cleanup_expired()
+            now = time.time()
+            return [{'key': key, 'response': entry['response'], 'expires_at': entry['expires_at'],
+                     'agent_type': entry['agent_type'], 'language': entry['language']}
+                    for key, entry in self.cache.items() if entry['expires_at'] > now]
     
     def clear(self):
         """Clear all cached responses"""
-        self.cache.clear()
-        self.hits = 0
-        self.misses = 0
+        with self._lock:
+            self.cache.clear()
+            self._wheel.clear()
+            self.resident_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+            self.rejected_oversize = 0
         logger.info("Cache cleared")
     
     def get_stats(self) -> Dict[str, Any]:
@@ -173,7 +278,12 @@ class ResponseCache:
             'misses': self.misses,
             'hit_rate': round(hit_rate, 2),
             'cache_size': len(self.cache),
-            'max_size': self.max_size
+            'max_size': self.max_size,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'resident_bytes': self.resident_bytes,
+            'max_bytes': self.max_bytes,
+            'rejected_oversize': self.rejected_oversize
         }
     
     def should_cache(self, user_message: str, response_data: Dict[str, Any]) -> bool:
@@ -196,7 +306,9 @@ class ResponseCache:
         if confidence < 0.5:
             return False
         
-        # Don't cache error responses
+        # Don't cache error responses and async placeholders
+        if response_data.get('error') or response_data.get('async_processing'):
+            return False
         if 'error' in response_data.get('response', '').lower():
             return False
         
@@ -208,5 +320,582 @@ class ResponseCache:
         return True
 
 
+class CacheBackend:
+    """Cross-worker (L2) store for JSON-serializable responses"""
+
+    name = 'none'
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Dict[str, Any], ttl: float):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def acquire_lease(self, key: str, ttl: float) -> bool:
+        """Claim the right to compute key across workers; True without coordination"""
+        return True
+
+    def release_lease(self, key: str):
+        pass
+
+
+class RedisCacheBackend(CacheBackend):
+    """Redis L2 (optional dependency); only keys with our prefix are cleared"""
+
+    name = 'redis'
+
+    def __init__(self, redis_url: str, prefix: str = 'bolashak:'):
+        import redis
+        self.client = redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.prefix = prefix
+        self.client.ping()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: Dict[str, Any], ttl: float):
+        self.client.setex(self.prefix + key, max(1, int(ttl)), json.dumps(value, ensure_ascii=False))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + '*', count=500):
+            self.client.delete(key)
+
+    def acquire_lease(self, key: str, ttl: float) -> bool:
+        return bool(self.client.set(f"{self.prefix}lease:{key}", os.getpid(), nx=True,
+                                    px=max(1, int(ttl * 1000))))
+
+    def release_lease(self, key: str):
+        self.client.delete(f"{self.prefix}lease:{key}")
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """Shared SQLite file as L2 for workers of one host (e.g. in /dev/shm)"""
+
+    name = 'sqlite'
+    PRUNE_EVERY = 200
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS response_cache "
+                         "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS response_cache_leases "
+                         "(key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread (and per process: re-opened after fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            "SELECT value FROM response_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Dict[str, Any], ttl: float):
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                     (key, json.dumps(value, ensure_ascii=False), time.time() + ttl))
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+
+    def delete(self, key: str):
+        self._connection().execute("DELETE FROM response_cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM response_cache")
+
+    def acquire_lease(self, key: str, ttl: float) -> bool:
+        conn = self._connection()
+        now = time.time()
+        # Autocommit mode: each statement is atomic, so only one worker inserts the row
+        conn.execute("DELETE FROM response_cache_leases WHERE key = ? AND expires_at <= ?", (key, now))
+        return conn.execute("INSERT OR IGNORE INTO response_cache_leases (key, expires_at) VALUES (?, ?)",
+                            (key, now + ttl)).rowcount == 1
+
+    def release_lease(self, key: str):
+        self._connection().execute("DELETE FROM response_cache_leases WHERE key = ?", (key,))
+
+
+def _resolve_future(future: 'asyncio.Future', result: Optional[Dict[str, Any]]):
+    if not future.done():
+        future.set_result(result)
+
+
+class _Flight:
+    """One in-flight computation and the requests waiting for it"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+        self.done = False
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, 'asyncio.Future']] = []
+
+
+class SingleFlight:
+    """Coalesces concurrent computations of one key within the process
+
+    The first caller of join() leads and must call finish(); the others wait
+    for its result from threads (wait) or event loops (wait_async). A None
+    result (failure, error answer, timeout) tells followers to compute
+    themselves.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: str) -> Tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def finish(self, key: str, flight: _Flight, result: Optional[Dict[str, Any]]):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.result, flight.done = result, True
+            waiters, flight.waiters = flight.waiters, []
+        flight.event.set()
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve_future, future, result)
+            except RuntimeError:  # loop already closed
+                pass
+
+    def wait(self, flight: _Flight, timeout: float) -> Optional[Dict[str, Any]]:
+        return flight.result if flight.event.wait(timeout) else None
+
+    async def wait_async(self, flight: _Flight, timeout: float) -> Optional[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if flight.done:
+                return flight.result
+            flight.waiters.append((loop, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+
+def get_l2_backend(url: Optional[str] = None) -> Optional[CacheBackend]:
+    """L2 backend from RESPONSE_CACHE_L2_URL: redis://..., sqlite:///path or empty for L1 only"""
+    url = url if url is not None else os.environ.get('RESPONSE_CACHE_L2_URL', '')
+    if not url:
+        return None
+    try:
+        if url.startswith(('redis://', 'rediss://', 'unix://')):
+            return RedisCacheBackend(url)
+        if url.startswith('sqlite:///'):
+            return SQLiteCacheBackend(url[len('sqlite:///'):])
+        logger.warning(f"Unsupported RESPONSE_CACHE_L2_URL scheme: {url.split(':', 1)[0]}")
+    except ImportError:
+        logger.warning("Redis library not available, using in-process cache only")
+    except Exception as e:
+        logger.warning(f"Failed to initialize L2 response cache: {e}, using in-process cache only")
+    return None
+
+
+class TieredResponseCache:
+    """In-process LRU (L1) in front of an optional cross-worker backend (L2)
+
+    Lookups compute the canonical key once and try L1, then L2 (promoting
+    hits to L1 with their remaining TTL). Values are serialized only at the
+    L2 boundary. L2 failures are counted and otherwise ignored. With a
+    semantic index, an exact miss retries with the key of the closest cached
+    question of the same agent and language.
+
+    Misses are coalesced per key: concurrent callers wait up to
+    coalesce_timeout for the first one's answer, then compute on their own.
+    With an L2 backend the first caller also takes a lease in L2, and other
+    workers poll L2 for the answer while the lease is held.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, l1: ResponseCache, l2: Optional[CacheBackend] = None,
+                 semantic: Optional[SemanticCacheIndex] = None,
+                 coalesce_timeout: float = 30.0, coalesce_across_workers: bool = True):
+        self.l1 = l1
+        self.l2 = l2
+        self.semantic = semantic
+        self.default_ttl = l1.default_ttl
+        self.flights = SingleFlight()
+        self.coalesce_timeout = coalesce_timeout
+        self.coalesce_across_workers = coalesce_across_workers
+        self.stats = {
+            'l1_hits': 0,
+            'l2_hits': 0,
+            'semantic_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'coalesce_fallbacks': 0,
+            'sets': 0,
+            'l2_errors': 0
+        }
+
+    def get(self, user_message: str, agent_type: str, language: str = 'ru') -> Optional[Dict[str, Any]]:
+        found = self.lookup(user_message, agent_type, language)
+        return found[0] if found is not None else None
+
+    def lookup(self, user_message: str, agent_type: str,
+               language: str = 'ru') -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """(cached response, match metadata) by exact key, then by near-duplicate question"""
+        key = make_cache_key(user_message, agent_type, language)
+        value, tier = self._get(key)
+        if value is not None:
+            self.stats[f'{tier}_hits'] += 1
+            if self.semantic is not None:
+                # Answers promoted from L2 were cached by another worker
+                self.semantic.add(key, user_message, agent_type, language)
+            return value, {'type': 'exact', 'score': 1.0}
+
+        if self.semantic is not None:
+            match = self.semantic.lookup(user_message, agent_type, language)
+            if match is not None:
+                matched_key, score, matched_question = match
+                value, _ = self._get(matched_key)
+                if value is not None:
+                    self.stats['semantic_hits'] += 1
+                    return value, {'type': 'semantic', 'score': round(score, 4),
+                                   'matched_question': matched_question}
+                self.semantic.discard(matched_key, agent_type, language)
+
+        self.stats['misses'] += 1
+        return None
+
+    def get_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        value, tier = self._get(key)
+        self.stats[f'{tier}_hits' if value is not None else 'misses'] += 1
+        return value
+
+    def _get(self, key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        value = self.l1.get_entry(key)
+        if value is not None:
+            return value, 'l1'
+
+        if self.l2 is not None:
+            try:
+                stored = self.l2.get(key)
+            except Exception as e:
+                self.stats['l2_errors'] += 1
+                logger.warning(f"L2 cache get error: {e}")
+                stored = None
+            if stored is not None:
+                remaining = stored.get('expires_at', 0) - time.time()
+                if remaining > 0:
+                    self.l1.set_entry(key, stored['value'], remaining)
+                    return stored['value'], 'l2'
+
+        return None, None
+
+    def set(self, user_message: str, agent_type: str, response_data: Dict[str, Any],
+            language: str = 'ru', ttl: Optional[int] = None) -> bool:
+        key = make_cache_key(user_message, agent_type, language)
+        self.set_entry(key, response_data, ttl, agent_type=agent_type, language=language)
+        if self.semantic is not None:
+            self.semantic.add(key, user_message, agent_type, language)
+        return True
+
+    def set_entry(self, key: str, response_data: Dict[str, Any], ttl: Optional[float] = None,
+                  agent_type: str = '', language: str = '') -> bool:
+        ttl = ttl or self.default_ttl
+        # Shallow copy: callers go on to decorate the dict they return (routing, feedback)
+        response_data = dict(response_data)
+        self.l1.set_entry(key, response_data, ttl, agent_type=agent_type, language=language)
+        self.stats['sets'] += 1
+        if self.l2 is not None:
+            try:
+                self.l2.set(key, {'value': response_data, 'expires_at': time.time() + ttl}, ttl)
+            except Exception as e:
+                self.stats['l2_errors'] += 1
+                logger.warning(f"L2 cache set error: {e}")
+        return True
+
+    def get_or_compute(self, user_message: str, agent_type: str, language: str,
+                       compute: Callable[[], Dict[str, Any]],
+                       ttl: Optional[int] = None) -> Tuple[Dict[str, Any], bool]:
+        """Cached response or compute() (stored if should_cache); returns (response, was_cached)
+
+        Cached responses carry 'cache_match' ({'type': 'exact'|'semantic', 'score': ...}).
+        """
+        found = self.lookup(user_message, agent_type, language)
+        if found is not None:
+            cached, match = found
+            return {**cached, 'cache_match': match}, True
+
+        def compute_and_store():
+            response_data = compute()
+            if self.should_cache(user_message, response_data):
+                self.set(user_message, agent_type, response_data, language, ttl)
+            return response_data
+
+        return self.coalesce(user_message, agent_type, language, compute_and_store)
+
+    def coalesce(self, user_message: str, agent_type: str, language: str,
+                 compute: Callable[[], Dict[str, Any]]) -> Tuple[Dict[str, Any], bool]:
+        """Run compute() once for concurrent identical questions; returns (response, was_shared)
+
+        compute() is expected to store its answer in the cache; waiting
+        callers receive it marked with cache_match type 'coalesced'.
+        """
+        key = make_cache_key(user_message, agent_type, language)
+        flight, leader = self.flights.join(key)
+        if not leader:
+            shared = self.flights.wait(flight, self.coalesce_timeout)
+            if shared is not None:
+                return self._coalesced(shared), True
+            self.stats['coalesce_fallbacks'] += 1
+            return compute(), False
+
+        result, leased = None, False
+        try:
+            deadline = time.monotonic() + self.coalesce_timeout
+            while True:
+                state, result = self._claim(key)
+                if state != 'wait' or time.monotonic() >= deadline:
+                    break
+                time.sleep(self.POLL_INTERVAL)
+            if state == 'found':
+                return self._coalesced(result), True
+            leased = state == 'leased'
+            result = compute()
+            return result, False
+        finally:
+            self._land(key, flight, result, leased)
+
+    async def coalesce_async(self, user_message: str, agent_type: str, language: str,
+                             compute: Callable[[], Awaitable[Dict[str, Any]]]) -> Tuple[Dict[str, Any], bool]:
+        """coalesce() for the asyncio chat path: waiting holds no thread"""
+        key = make_cache_key(user_message, agent_type, language)
+        flight, leader = self.flights.join(key)
+        if not leader:
+            shared = await self.flights.wait_async(flight, self.coalesce_timeout)
+            if shared is not None:
+                return self._coalesced(shared), True
+            self.stats['coalesce_fallbacks'] += 1
+            return await compute(), False
+
+        result, leased = None, False
+        try:
+            deadline = time.monotonic() + self.coalesce_timeout
+            while True:
+                state, result = 'local', None
+                if self._cross_worker():
+                    state, result = await asyncio.to_thread(self._claim, key)
+                if state != 'wait' or time.monotonic() >= deadline:
+                    break
+                await asyncio.sleep(self.POLL_INTERVAL)
+            if state == 'found':
+                return self._coalesced(result), True
+            leased = state == 'leased'
+            result = await compute()
+            return result, False
+        finally:
+            if leased:
+                await asyncio.to_thread(self._land, key, flight, result, leased)
+            else:
+                self._land(key, flight, result, leased)
+
+    def _cross_worker(self) -> bool:
+        return self.l2 is not None and self.coalesce_across_workers
+
+    def _claim(self, key: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """'leased' / 'local' (compute here), 'found' (another worker stored it) or 'wait'"""
+        if not self._cross_worker():
+            return 'local', None
+        try:
+            leased = self.l2.acquire_lease(key, self.coalesce_timeout)
+            # Checked after the lease too: the previous holder stores the answer before releasing
+            stored, _ = self._get(key)
+            if stored is not None:
+                if leased:
+                    self.l2.release_lease(key)
+                return 'found', stored
+            return ('leased', None) if leased else ('wait', None)
+        except Exception as e:
+            self.stats['l2_errors'] += 1
+            logger.warning(f"L2 cache lease error: {e}")
+            return 'local', None
+
+    def _land(self, key: str, flight: _Flight, result: Optional[Dict[str, Any]], leased: bool):
+        """Release the L2 lease and hand the answer (unless it failed) to the waiting callers"""
+        if leased:
+            try:
+                self.l2.release_lease(key)
+            except Exception as e:
+                self.stats['l2_errors'] += 1
+                logger.warning(f"L2 cache lease error: {e}")
+        if result is not None and result.get('error'):
+            result = None
+        self.flights.finish(key, flight, result)
+
+    def _coalesced(self, response_data: Dict[str, Any]) -> Dict[str, Any]:
+        self.stats['coalesced'] += 1
+        return {**response_data, 'cache_match': {'type': 'coalesced', 'score': 1.0}}
+
+    def delete(self, user_message: str, agent_type: str, language: str = 'ru'):
+        key = make_cache_key(user_message, agent_type, language)
+        self.l1.delete_entry(key)
+        if self.semantic is not None:
+            self.semantic.discard(key, agent_type, language)
+        if self.l2 is not None:
+            try:
+                self.l2.delete(key)
+            except Exception as e:
+                self.stats['l2_errors'] += 1
+                logger.warning(f"L2 cache delete error: {e}")
+
+    def clear(self):
+        self.l1.clear()
+        if self.semantic is not None:
+            self.semantic.clear()
+        if self.l2 is not None:
+            try:
+                self.l2.clear()
+            except Exception as e:
+                self.stats['l2_errors'] += 1
+                logger.warning(f"L2 cache clear error: {e}")
+        for name in self.stats:
+            self.stats[name] = 0
+
+    def should_cache(self, user_message: str, response_data: Dict[str, Any]) -> bool:
+        return self.l1.should_cache(user_message, response_data)
+
+    def export_snapshot(self) -> List[Dict[str, Any]]:
+        """L1 entries plus the questions indexed for them, for cache_snapshot"""
+        entries = self.l1.export_entries()
+        if self.semantic is not None:
+            questions = self.semantic.questions_by_key()
+            for entry in entries:
+                if entry['key'] in questions:
+                    entry['question'] = questions[entry['key']]
+        return entries
+
+    def import_snapshot(self, entries: List[Dict[str, Any]]) -> int:
+        """Restore snapshot entries into L1 with their remaining TTL; returns the number restored"""
+        restored = 0
+        now = time.time()
+        for entry in entries:
+            remaining = entry['expires_at'] - now
+            if remaining <= 0:
+                continue
+            if self.l1.set_entry(entry['key'], entry['response'], remaining,
+                                 agent_type=entry.get('agent_type', ''), language=entry.get('language', '')):
+                restored += 1
+                if self.semantic is not None and entry.get('question'):
+                    self.semantic.add(entry['key'], entry['question'], entry['agent_type'], entry['language'])
+        return restored
+
+    def merge_snapshots(self, previous: List[Dict[str, Any]], current: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Union of two workers' snapshots: latest expiry per key, this worker's entries most recent"""
+        now = time.time()
+        merged: Dict[str, Dict[str, Any]] = {}
+        for entry in list(previous) + list(current):
+            if entry['expires_at'] <= now:
+                continue
+            known = merged.pop(entry['key'], None)
+            if known is not None and known['expires_at'] > entry['expires_at']:
+                entry = {**entry, 'expires_at': known['expires_at']}
+            merged[entry['key']] = entry
+        return list(merged.values())[-self.l1.max_size:]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Unified statistics (keeps the flat keys of ResponseCache.get_stats)"""
+        hits = self.stats['l1_hits'] + self.stats['l2_hits'] + self.stats['semantic_hits']
+        total_requests = hits + self.stats['misses']
+        l1_stats = self.l1.get_stats()
+        return {
+            'hits': hits,
+            'misses': self.stats['misses'],
+            'hit_rate': round(hits / total_requests * 100, 2) if total_requests > 0 else 0,
+            'cache_size': l1_stats['cache_size'],
+            'max_size': l1_stats['max_size'],
+            'evictions': l1_stats['evictions'],
+            'expirations': l1_stats['expirations'],
+            'resident_bytes': l1_stats['resident_bytes'],
+            'max_bytes': l1_stats['max_bytes'],
+            'l1_hits': self.stats['l1_hits'],
+            'l2_hits': self.stats['l2_hits'],
+            'semantic_hits': self.stats['semantic_hits'],
+            'coalesced': self.stats['coalesced'],
+            'coalesce_fallbacks': self.stats['coalesce_fallbacks'],
+            'in_flight': self.flights.in_flight(),
+            'llm_calls_saved': hits + self.stats['coalesced'],
+            'sets': self.stats['sets'],
+            'l2_backend': self.l2.name if self.l2 is not None else 'none',
+            'l2_errors': self.stats['l2_errors'],
+            'semantic_index': self.semantic.get_stats() if self.semantic is not None else None
+        }
+
+
 # Global cache instance
-response_cache = ResponseCache(max_size=500, default_ttl=1800)  # 30 minutes TTL
\ No newline at end of file
+response_cache = TieredResponseCache(
+    ResponseCache(max_size=500, default_ttl=1800,  # 30 minutes TTL
+                  max_bytes=int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))),
+    l2=get_l2_backend(),
+    semantic=get_semantic_index(),
+    coalesce_timeout=float(os.environ.get('RESPONSE_CACHE_COALESCE_TIMEOUT', '30')),
+    coalesce_across_workers=os.environ.get('RESPONSE_CACHE_COALESCE_WORKERS', '1').lower() not in ('0', 'false', 'no')
+)
+
+
+def _knowledge_version() -> Optional[str]:
+    # Answers depend on the knowledge base: snapshots from another version are not loaded
+    from knowledge_snapshot import knowledge_snapshot
+    return knowledge_snapshot.shared_version()
+
+
+cache_snapshots.register('responses', response_cache.export_snapshot, response_cache.import_snapshot,
+                         merge=response_cache.merge_snapshots, version=_knowledge_version)
+
+
+def _collect_metrics() -> List[MetricFamily]:
+    stats = response_cache.get_stats()
+    return [
+        MetricFamily('bolashak_response_cache_hits_total', 'counter', 'Answers served from the response cache')
+        .add(stats['l1_hits'], tier='l1').add(stats['l2_hits'], tier='l2').add(stats['semantic_hits'], tier='semantic'),
+        MetricFamily('bolashak_response_cache_misses_total', 'counter', 'Response cache misses').add(stats['misses']),
+        MetricFamily('bolashak_response_cache_coalesced_total', 'counter',
+                     'Requests that waited for an identical in-flight computation').add(stats['coalesced']),
+        MetricFamily('bolashak_response_cache_sets_total', 'counter', 'Answers stored').add(stats['sets']),
+        MetricFamily('bolashak_response_cache_evictions_total', 'counter', 'L1 evictions and expirations')
+        .add(stats['evictions'], reason='capacity').add(stats['expirations'], reason='ttl'),
+        MetricFamily('bolashak_response_cache_l2_errors_total', 'counter', 'Shared cache backend errors')
+        .add(stats['l2_errors']),
+        MetricFamily('bolashak_response_cache_entries', 'gauge', 'Entries in the in-process caches')
+        .add(stats['cache_size']),
+        MetricFamily('bolashak_response_cache_resident_bytes', 'gauge', 'Estimated bytes of cached answers')
+        .add(stats['resident_bytes']),
+        MetricFamily('bolashak_response_cache_in_flight', 'gauge', 'Computations other requests may wait for')
+        .add(stats['in_flight']),
+    ]
+
+
+worker_metrics.register('response_cache', _collect_metrics)
\ No newline at end of file
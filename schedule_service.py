@@ -0,0 +1,344 @@
+"""
+Schedule Service
+Сервис расписания занятий
+
+Answers the /api/schedule endpoints from half-open datetime ranges on
+(group_name, start_time), so the ix_schedules_group_start index is used instead
+of scanning date(start_time). Rows are fetched as plain columns, never as ORM
+objects.
+
+- Lessons with is_recurring and a recurrence_pattern are expanded once into a
+  materialized timetable per group. It is rebuilt after invalidation or TTL.
+- Payloads are cached per (group, week, language). Day, week and batch requests
+  are all served from those weeks, and one query loads every missing week of
+  several groups.
+- The admin add/delete lesson routes invalidate the affected group. The change
+  is published to the other workers through a shared version file (as the
+  knowledge snapshot does); they drop their cached weeks on the next request.
+- Open-ended recurring lessons are expanded SCHEDULE_RECURRENCE_HORIZON_DAYS
+  ahead of today, and the horizon moves forward with every timetable rebuild.
+
+Recurrence patterns: "daily", "weekly", "biweekly", or RRULE-like
+"FREQ=WEEKLY;INTERVAL=2;UNTIL=2025-12-20;COUNT=15". Unknown patterns are
+treated as one-off lessons.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+FREQUENCIES = {'daily': 1, 'weekly': 7, 'biweekly': 14}
+
+
+def _default_version_file() -> str:
+    """Общий для воркеров файл версии расписания (tmpfs, если доступен)"""
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base_dir, 'bolashak_schedule.version')
+
+
+def week_start(day: date) -> date:
+    """Monday of the week containing day"""
+    return day - timedelta(days=day.weekday())
+
+
+def midnight(day: date) -> datetime:
+    return datetime.combine(day, datetime.min.time())
+
+
+def parse_recurrence(pattern: Optional[str]) -> Optional[Dict[str, Any]]:
+    """{'step_days', 'until', 'count'} of a recurrence pattern, None if not recurring/unknown"""
+    if not pattern or not pattern.strip():
+        return None
+    step_days, interval, until, count = None, 1, None, None
+    try:
+        for token in pattern.replace(',', ';').split(';'):
+            token = token.strip()
+            if not token:
+                continue
+            if '=' not in token:
+                step_days = FREQUENCIES[token.lower()]
+                continue
+            key, value = (part.strip() for part in token.split('=', 1))
+            key = key.upper()
+            if key == 'FREQ':
+                step_days = FREQUENCIES[value.lower()]
+            elif key == 'INTERVAL':
+                interval = max(1, int(value))
+            elif key == 'UNTIL':
+                until = datetime.strptime(value.replace('-', '')[:8], '%Y%m%d').date()
+            elif key == 'COUNT':
+                count = max(1, int(value))
+    except (KeyError, ValueError):
+        logger.warning(f"Unknown recurrence pattern {pattern!r}, treating the lesson as one-off")
+        return None
+    if step_days is None:
+        return None
+    return {'step_days': step_days * interval, 'until': until, 'count': count}
+
+
+def expand_recurrence(start: datetime, end: datetime, pattern: Optional[str],
+                      horizon: datetime) -> Iterator[Tuple[datetime, datetime]]:
+    """Occurrences (start, end) of a lesson up to the horizon (exclusive)"""
+    rule = parse_recurrence(pattern)
+    if rule is None:
+        yield start, end
+        return
+    step = timedelta(days=rule['step_days'])
+    occurrence = 0
+    while start < horizon:
+        if rule['until'] is not None and start.date() > rule['until']:
+            break
+        if rule['count'] is not None and occurrence >= rule['count']:
+            break
+        yield start, end
+        start, end = start + step, end + step
+        occurrence += 1
+
+
+class ScheduleService:
+    """Range queries, materialized recurring timetable and per-week payload cache"""
+
+    def __init__(self, cache_ttl: float = 120.0, recurrence_horizon_days: int = 180, max_entries: int = 5000,
+                 version_file: Optional[str] = None, check_interval: float = 1.0):
+        self.cache_ttl = cache_ttl
+        self.recurrence_horizon_days = recurrence_horizon_days
+        self.max_entries = max_entries
+        self.version_file = version_file or os.environ.get('SCHEDULE_VERSION_FILE', _default_version_file())
+        self.check_interval = check_interval
+        self._version = self._read_shared_version()
+        self._last_check = time.time()
+        self._weeks: 'OrderedDict[Tuple[str, date, str], Tuple[float, Dict[str, List[dict]]]]' = OrderedDict()
+        self._timetable: Optional[Dict[str, Tuple[List[datetime], List[Tuple[datetime, datetime, Any]]]]] = None
+        self._recurring_ids: set = set()
+        self._timetable_expires = 0.0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'queries': 0, 'timetable_builds': 0, 'invalidations': 0,
+                      'remote_invalidations': 0}
+
+    # ------------------------------------------------------------- timetable
+
+    def _columns(self):
+        from models import Schedule
+        return [getattr(Schedule, name) for name in Schedule.DICT_COLUMNS]
+
+    def _get_timetable(self):
+        """Recurring lessons expanded once per group: (sorted starts, occurrences)"""
+        with self._lock:
+            if self._timetable is not None and self._timetable_expires > time.time():
+                return self._timetable
+        from models import Schedule
+
+        rows = Schedule.query.with_entities(*self._columns()).filter(
+            Schedule.is_recurring == True,
+            Schedule.is_active == True,
+            Schedule.is_cancelled == False
+        ).all()
+        self.stats['queries'] += 1
+
+        occurrences = defaultdict(list)
+        recurring_ids = set()
+        now = datetime.now()
+        for row in rows:
+            if parse_recurrence(row.recurrence_pattern) is None:
+                continue  # обычное занятие, его вернет запрос по диапазону
+            recurring_ids.add(row.id)
+            # From today, not from the first lesson: open-ended lessons never run out
+            horizon = max(now, row.start_time) + timedelta(days=self.recurrence_horizon_days)
+            for start, end in expand_recurrence(row.start_time, row.end_time, row.recurrence_pattern, horizon):
+                occurrences[row.group_name].append((start, end, row))
+
+        timetable = {}
+        for group_name, items in occurrences.items():
+            items.sort(key=lambda item: item[0])
+            timetable[group_name] = ([item[0] for item in items], items)
+
+        with self._lock:
+            self._timetable = timetable
+            self._recurring_ids = recurring_ids
+            self._timetable_expires = time.time() + self.cache_ttl
+            self.stats['timetable_builds'] += 1
+        return timetable
+
+    def _recurring_between(self, timetable, group_name: str, start: datetime, end: datetime):
+        starts, items = timetable.get(group_name, ((), ()))
+        index = bisect_left(starts, start)
+        while index < len(items) and items[index][0] < end:
+            yield items[index]
+            index += 1
+
+    # ----------------------------------------------------------------- weeks
+
+    def _load_weeks(self, keys: List[Tuple[str, date, str]]) -> Dict[Tuple[str, date, str], Dict[str, List[dict]]]:
+        """Load (group, week, language) keys with one range query and cache them"""
+        from models import Schedule
+
+        timetable = self._get_timetable()
+        groups = sorted({key[0] for key in keys})
+        range_start = midnight(min(key[1] for key in keys))
+        range_end = midnight(max(key[1] for key in keys) + timedelta(days=7))
+
+        rows = Schedule.query.with_entities(*self._columns()).filter(
+            Schedule.group_name.in_(groups),
+            Schedule.start_time >= range_start,
+            Schedule.start_time < range_end,
+            Schedule.is_active == True,
+            Schedule.is_cancelled == False
+        ).order_by(Schedule.start_time).all()
+        self.stats['queries'] += 1
+
+        by_week = defaultdict(list)
+        for row in rows:
+            if row.id not in self._recurring_ids:
+                by_week[(row.group_name, week_start(row.start_time.date()))].append((row.start_time, row.end_time, row))
+
+        expires = time.time() + self.cache_ttl
+        loaded = {}
+        for group_name, monday, language in keys:
+            lessons = list(by_week.get((group_name, monday), ()))
+            start = midnight(monday)
+            lessons.extend(self._recurring_between(timetable, group_name, start, start + timedelta(days=7)))
+            lessons.sort(key=lambda item: item[0])
+
+            schedule_by_days: Dict[str, List[dict]] = {}
+            for lesson_start, lesson_end, row in lessons:
+                schedule_by_days.setdefault(lesson_start.date().isoformat(), []).append(
+                    Schedule.row_to_dict(row, language, lesson_start, lesson_end))
+            loaded[(group_name, monday, language)] = schedule_by_days
+            with self._lock:
+                self._weeks[(group_name, monday, language)] = (expires, schedule_by_days)
+                self._weeks.move_to_end((group_name, monday, language))
+                while len(self._weeks) > self.max_entries:
+                    self._weeks.popitem(last=False)
+        return loaded
+
+    # -------------------------------------------------------- shared version
+
+    def _read_shared_version(self) -> str:
+        try:
+            with open(self.version_file) as f:
+                return f.read().strip() or '0'
+        except OSError:
+            return '0'
+
+    def _bump_version(self):
+        """Tell the other workers that lessons changed"""
+        token = f"{time.time_ns()}-{os.getpid()}"
+        try:
+            tmp_path = f"{self.version_file}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(token)
+            os.replace(tmp_path, self.version_file)
+        except OSError as e:
+            logger.warning(f"Could not write schedule version file {self.version_file}: {e}")
+            return
+        with self._lock:
+            self._version = token
+
+    def _check_shared_version(self):
+        """Drop everything cached when another worker changed lessons (read at most every check_interval)"""
+        now = time.time()
+        if now - self._last_check < self.check_interval:
+            return
+        shared_version = self._read_shared_version()
+        with self._lock:
+            self._last_check = now
+            if shared_version == self._version:
+                return
+            self._version = shared_version
+            self._weeks.clear()
+            self._timetable = None
+            self.stats['remote_invalidations'] += 1
+
+    def _weeks_for(self, keys: Iterable[Tuple[str, date, str]]) -> Dict[Tuple[str, date, str], Dict[str, List[dict]]]:
+        keys = list(dict.fromkeys(keys))
+        self._check_shared_version()
+        now = time.time()
+        result, missing = {}, []
+        with self._lock:
+            for key in keys:
+                entry = self._weeks.get(key)
+                if entry is not None and entry[0] > now:
+                    result[key] = entry[1]
+                    self._weeks.move_to_end(key)
+                else:
+                    missing.append(key)
+        self.stats['hits'] += len(result)
+        self.stats['misses'] += len(missing)
+        if missing:
+            result.update(self._load_weeks(missing))
+        return result
+
+    # ------------------------------------------------------------ public API
+
+    def lessons_between(self, group_names: List[str], start: date, end: date,
+                        language: str = 'ru') -> Dict[str, Dict[str, List[dict]]]:
+        """{group: {day: lessons}} for days in [start, end)"""
+        mondays = []
+        monday = week_start(start)
+        while monday < end:
+            mondays.append(monday)
+            monday += timedelta(days=7)
+        weeks = self._weeks_for((group, monday, language) for group in group_names for monday in mondays)
+
+        first, last = start.isoformat(), end.isoformat()
+        result = {}
+        for group in group_names:
+            days = {}
+            for monday in mondays:
+                for day_key, lessons in weeks[(group, monday, language)].items():
+                    if first <= day_key < last:
+                        days[day_key] = lessons
+            result[group] = days
+        return result
+
+    def day(self, group_name: str, day: date, language: str = 'ru') -> List[dict]:
+        """Lessons of a group on one day"""
+        weeks = self._weeks_for([(group_name, week_start(day), language)])
+        return weeks[(group_name, week_start(day), language)].get(day.isoformat(), [])
+
+    def week(self, group_name: str, monday: date, language: str = 'ru') -> Dict[str, List[dict]]:
+        """Lessons of a group by day for the week starting at monday"""
+        return self._weeks_for([(group_name, monday, language)])[(group_name, monday, language)]
+
+    def invalidate(self, group_name: Optional[str] = None):
+        """Drop cached weeks of a group (all groups if None) and the recurring timetable, in every worker"""
+        self._bump_version()
+        with self._lock:
+            if group_name is None:
+                self._weeks.clear()
+            else:
+                for key in [key for key in self._weeks if key[0] == group_name]:
+                    del self._weeks[key]
+            self._timetable = None
+            self.stats['invalidations'] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            cached_weeks = len(self._weeks)
+            recurring = len(self._recurring_ids)
+        return {**self.stats, 'cached_weeks': cached_weeks, 'recurring_lessons': recurring,
+                'cache_ttl': self.cache_ttl, 'version': self._version}
+
+
+def _create_service() -> ScheduleService:
+    """Service from SCHEDULE_CACHE_TTL (seconds) / SCHEDULE_RECURRENCE_HORIZON_DAYS"""
+    try:
+        return ScheduleService(
+            cache_ttl=float(os.environ.get('SCHEDULE_CACHE_TTL', '120')),
+            recurrence_horizon_days=int(os.environ.get('SCHEDULE_RECURRENCE_HORIZON_DAYS', '180'))
+        )
+    except ValueError:
+        logger.warning("Invalid SCHEDULE_CACHE_TTL / SCHEDULE_RECURRENCE_HORIZON_DAYS, using defaults")
+        return ScheduleService()
+
+
+# Global schedule service
+schedule_service = _create_service()
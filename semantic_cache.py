@@ -0,0 +1,264 @@
+"""
+Near-duplicate Question Index for the Response Cache
+Индекс близких по смыслу вопросов для кэша ответов
+
+The exact cache key only survives case and whitespace changes. This module
+canonicalizes a question (punctuation, stop-words, light Russian / Kazakh /
+English suffix stripping) and keeps, per (agent, language), a matrix of
+hashed embeddings of the canonical questions already cached. A lookup
+returns the cache key of the closest question when its cosine similarity
+reaches the threshold, so "как поступить в университет?" and "Как
+поступить в университет" share one answer.
+
+Questions that differ in numbers, question words or negation never match,
+whatever the score: "когда экзамен" must not answer "где экзамен".
+"""
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+
+from vector_store import HashingEmbeddingBackend
+
+logger = logging.getLogger(__name__)
+
+_WORD = re.compile(r"\w+")
+_KAZAKH_LETTERS = set('әғқңөұүһі')
+
+# Function words only: question words and negations carry meaning and are kept
+STOP_WORDS = {
+    'ru': {'и', 'в', 'на', 'с', 'по', 'для', 'это', 'то', 'да', 'а', 'но', 'или', 'из', 'у', 'к',
+           'о', 'об', 'от', 'до', 'за', 'при', 'под', 'над', 'между', 'через', 'во', 'со', 'про',
+           'ли', 'же', 'бы', 'мне', 'я', 'мы', 'вы', 'вас', 'нам', 'меня', 'можно', 'нужно', 'надо',
+           'пожалуйста', 'подскажите', 'скажите', 'расскажите', 'хочу', 'хотел', 'хотела', 'ваш',
+           'ваше', 'вашем', 'вашей', 'есть', 'ещё', 'еще', 'вообще', 'там', 'тут', 'здесь'},
+    'kz': {'және', 'пен', 'бен', 'мен', 'де', 'да', 'те', 'та', 'ол', 'бұл', 'сол', 'ма', 'ме',
+           'ба', 'бе', 'па', 'пе', 'ғой', 'ғана', 'маған', 'бізге', 'сізге', 'сіз', 'біз', 'керек',
+           'бола', 'болады', 'айтыңызшы', 'өтінемін'},
+    'en': {'a', 'an', 'the', 'is', 'are', 'do', 'does', 'to', 'of', 'in', 'on', 'for', 'and', 'or',
+           'i', 'me', 'my', 'you', 'your', 'can', 'could', 'please', 'tell', 'about', 'there', 'be'},
+}
+ALL_STOP_WORDS = set().union(*STOP_WORDS.values())
+
+QUESTION_WORDS = {
+    'как', 'что', 'где', 'когда', 'кто', 'сколько', 'почему', 'зачем', 'куда', 'откуда', 'какой',
+    'какая', 'какие', 'какое', 'чем', 'каком',
+    'қалай', 'қайда', 'қашан', 'не', 'кім', 'қанша', 'неге', 'қандай', 'қай', 'қайдан',
+    'how', 'what', 'where', 'when', 'who', 'why', 'which',
+}
+NEGATIONS = {'нет', 'без', 'нельзя', 'емес', 'жоқ', 'not', 'no', 'without'}
+
+# Inflectional endings, longest first; the stem keeps at least MIN_STEM letters
+RU_SUFFIXES = sorted([
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'иях', 'ией', 'ать', 'ять',
+    'ить', 'еть', 'уть', 'ешь', 'ишь',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой', 'ей', 'ую', 'юю', 'ом', 'ем', 'ах',
+    'ях', 'ам', 'ям', 'ов', 'ев', 'ия', 'ии', 'ть', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю',
+    'ь', 'й',
+], key=len, reverse=True)
+RU_REFLEXIVE = ('ся', 'сь')
+KZ_SUFFIXES = sorted([
+    'лардың', 'лердің', 'дардың', 'дердің', 'тардың', 'тердің', 'ларға', 'лерге', 'ларда',
+    'лерде', 'лардан', 'лерден', 'лар', 'лер', 'дар', 'дер', 'тар', 'тер', 'ның', 'нің', 'дың',
+    'дің', 'тың', 'тің', 'ға', 'ге', 'қа', 'ке', 'да', 'де', 'та', 'те', 'дан', 'ден', 'тан',
+    'тен', 'нан', 'нен', 'ды', 'ді', 'ты', 'ті', 'ны', 'ні', 'мен', 'бен', 'пен', 'ымыз',
+    'іміз', 'ым', 'ім', 'ың', 'ің', 'сы', 'сі', 'ы', 'і', 'н',
+], key=len, reverse=True)
+EN_SUFFIXES = ('ing', 'ies', 'es', 'ed', 's')
+MIN_STEM = 3
+
+
+def stem_word(word: str, language: str = 'ru') -> str:
+    """Strip one inflectional ending (two for Kazakh: plural/possessive + case)"""
+    if word.isdigit() or len(word) <= MIN_STEM:
+        return word
+    if word.isascii():
+        suffixes, rounds = EN_SUFFIXES, 1
+    elif language == 'kz' or _KAZAKH_LETTERS.intersection(word):
+        suffixes, rounds = KZ_SUFFIXES, 2
+    else:
+        for ending in RU_REFLEXIVE:
+            if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+                word = word[:-len(ending)]
+                break
+        suffixes, rounds = RU_SUFFIXES, 1
+
+    for _ in range(rounds):
+        for suffix in suffixes:
+            if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM:
+                word = word[:-len(suffix)]
+                break
+        else:
+            break
+    return word
+
+
+def canonicalize_question(text: str, language: str = 'ru') -> Tuple[List[str], FrozenSet[str]]:
+    """Stemmed content words and the guard signature (numbers, question words, negations)"""
+    words = _WORD.findall((text or '').lower().replace('ё', 'е'))
+    tokens = []
+    guards = set()
+    for word in words:
+        if word.isdigit():
+            guards.add(word)
+            tokens.append(word)
+        elif word in QUESTION_WORDS or word in NEGATIONS:
+            guards.add(word)
+        elif word not in ALL_STOP_WORDS and len(word) > 1:
+            tokens.append(stem_word(word, language))
+    # "не" is a Russian negation but also the Kazakh "what"
+    if 'не' in words and language != 'kz':
+        guards.discard('не')
+        guards.add('не:neg')
+    return tokens, frozenset(guards)
+
+
+class _QuestionGroup:
+    """Embedding matrix of the cached questions of one (agent, language)"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((16, dim), dtype=np.float32)
+        self.rows: 'OrderedDict[str, int]' = OrderedDict()  # key -> row, insertion order
+        self.keys: List[str] = []
+        self.guards: List[FrozenSet[str]] = []
+        self.questions: List[str] = []
+
+    def add(self, key: str, vector: np.ndarray, guards: FrozenSet[str], question: str):
+        row = len(self.keys)
+        if row == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+        self.vectors[row] = vector
+        self.rows[key] = row
+        self.keys.append(key)
+        self.guards.append(guards)
+        self.questions.append(question)
+
+    def remove(self, key: str):
+        row = self.rows.pop(key, None)
+        if row is None:
+            return
+        last = len(self.keys) - 1
+        if row != last:
+            # Move the last row into the hole; its key keeps its age in self.rows
+            moved = self.keys[last]
+            self.vectors[row] = self.vectors[last]
+            self.keys[row], self.guards[row], self.questions[row] = moved, self.guards[last], self.questions[last]
+            self.rows[moved] = row
+        self.keys.pop()
+        self.guards.pop()
+        self.questions.pop()
+
+
+class SemanticCacheIndex:
+    """Per (agent, language) similarity index from canonical questions to cache keys"""
+
+    def __init__(self, threshold: float = 0.88, max_entries: int = 2000, dim: int = 512):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.backend = HashingEmbeddingBackend(dim=dim)
+        self.groups: Dict[Tuple[str, str], _QuestionGroup] = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            'lookups': 0,
+            'matches': 0,
+            'rejected_by_guard': 0,
+            'indexed': 0
+        }
+
+    def _embed(self, tokens: List[str]) -> np.ndarray:
+        return self.backend.embed([' '.join(tokens)])[0]
+
+    def add(self, key: str, question: str, agent_type: str, language: str):
+        """Index a cached question; questions with fewer than two content words are skipped"""
+        group_id = (agent_type, language)
+        group = self.groups.get(group_id)
+        if group is not None and key in group.rows:
+            return
+        tokens, guards = canonicalize_question(question, language)
+        if len(tokens) < 2:
+            return
+        vector = self._embed(tokens)
+
+        with self._lock:
+            group = self.groups.get(group_id)
+            if group is None:
+                group = self.groups[group_id] = _QuestionGroup(self.backend.dim)
+            if key in group.rows:
+                return
+            while len(group.keys) >= self.max_entries:
+                group.remove(next(iter(group.rows)))
+            group.add(key, vector, guards, question)
+            self.stats['indexed'] += 1
+
+    def lookup(self, question: str, agent_type: str, language: str) -> Optional[Tuple[str, float, str]]:
+        """(cache key, similarity, cached question) of the best match above the threshold"""
+        group = self.groups.get((agent_type, language))
+        self.stats['lookups'] += 1
+        if group is None:
+            return None
+        tokens, guards = canonicalize_question(question, language)
+        if len(tokens) < 2:
+            return None
+        vector = self._embed(tokens)
+
+        with self._lock:
+            count = len(group.keys)
+            if count == 0:
+                return None
+            scores = group.vectors[:count] @ vector
+            # A handful of candidates is enough: the guard rejects only exact-wording conflicts
+            top = min(count, 5)
+            candidates = np.argpartition(-scores, top - 1)[:top]
+            for row in candidates[np.argsort(-scores[candidates])]:
+                score = float(scores[row])
+                if score < self.threshold:
+                    break
+                if group.guards[row] != guards:
+                    self.stats['rejected_by_guard'] += 1
+                    continue
+                self.stats['matches'] += 1
+                return group.keys[row], score, group.questions[row]
+        return None
+
+    def discard(self, key: str, agent_type: str, language: str):
+        with self._lock:
+            group = self.groups.get((agent_type, language))
+            if group is not None:
+                group.remove(key)
+
+    def questions_by_key(self) -> Dict[str, str]:
+        """Indexed question of every cache key (for cache snapshots)"""
+        with self._lock:
+            return {key: group.questions[row]
+                    for group in self.groups.values() for key, row in group.rows.items()}
+
+    def clear(self):
+        with self._lock:
+            self.groups.clear()
+            for name in self.stats:
+                self.stats[name] = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'threshold': self.threshold,
+            'entries': sum(len(group.keys) for group in self.groups.values()),
+            'groups': len(self.groups)
+        }
+
+
+def get_semantic_index() -> Optional[SemanticCacheIndex]:
+    """Index from SEMANTIC_CACHE_ENABLED / SEMANTIC_CACHE_THRESHOLD (on, 0.88 by default)"""
+    if os.environ.get('SEMANTIC_CACHE_ENABLED', '1').lower() in ('0', 'false', 'no'):
+        return None
+    try:
+        threshold = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.88'))
+    except ValueError:
+        logger.warning("Invalid SEMANTIC_CACHE_THRESHOLD, using 0.88")
+        threshold = 0.88
+    return SemanticCacheIndex(threshold=threshold)
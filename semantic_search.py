@@ -10,12 +10,91 @@ import logging
 import re
 import json
 import math
-from typing import Dict, List, Tuple, Optional, Set, Any
-from collections import defaultdict, Counter
+import threading
+import zlib
+from typing import Dict, List, Tuple, Optional, Set, Any, Hashable
+from collections import defaultdict, Counter, OrderedDict
+from dataclasses import dataclass, field
 import hashlib
 
+from cache_snapshot import cache_snapshots
+
+try:
+    import numpy as np
+except ImportError:  # dict-based scoring is used without NumPy
+    np = None
+
 logger = logging.getLogger(__name__)
 
+# Field order of the stacked per-entry concept matrix
+_VECTOR_FIELDS = ('title', 'content', 'keyword')
+
+# Maximum score an entry can get without any lexical or concept overlap
+# with the query (priority boost only); used for exact candidate pruning
+_MAX_NON_OVERLAP_SCORE = 0.05
+
+
+def _lexical_signature(words: Set[str]) -> int:
+    """64-bit hashed word signature for fast overlap rejection"""
+    signature = 0
+    for word in words:
+        signature |= 1 << (zlib.crc32(word.encode('utf-8')) & 63)
+    return signature
+
+
+@dataclass
+class EntryFeatures:
+    """Precomputed concepts and token sets of one knowledge entry"""
+    entry_id: Any
+    updated_at: Any
+    content: str
+    title_concepts: Set[str]
+    content_concepts: Set[str]
+    keyword_concepts: Set[str]
+    all_concepts: Set[str]
+    title_words: Set[str]
+    content_words: Set[str]
+    keyword_words: Set[str]
+    title_signature: int = 0
+    content_signature: int = 0
+    keyword_signature: int = 0
+
+
+@dataclass
+class CorpusIndex:
+    """Inverted index over a fixed list of knowledge entries"""
+    entries: List[Any]
+    features: List[Optional[EntryFeatures]]
+    source: Any = None
+    concept_postings: Dict[str, Set[int]] = field(default_factory=lambda: defaultdict(set))
+    word_postings: Dict[str, Set[int]] = field(default_factory=lambda: defaultdict(set))
+    # Dense concept matrices for the NumPy path, built on first vectorized query
+    vectors: Optional['CorpusVectors'] = None
+
+
+@dataclass
+class ConceptSpace:
+    """Fixed concept vocabulary with pairwise concept-to-concept score matrices"""
+    concepts: List[str]
+    positions: Dict[str, int]
+    cosine: Any              # V x V embedding cosine similarity
+    relation_jaccard: Any    # V x V Jaccard overlap of related concepts
+    relation_mask: Any       # V x V, 1 where both concepts have relations
+    expansion: Any           # V x V concept expansion boosts (related / same category)
+
+
+@dataclass
+class CorpusVectors:
+    """Concept and word matrices of a corpus over one ConceptSpace"""
+    space: ConceptSpace
+    fields: Any              # (3 * N) x V binary concepts, stacked in _VECTOR_FIELDS order
+    all_concepts: Any        # N x V binary concepts of title + content + keywords
+    concept_counts: Any      # 3 * N
+    word_counts: Any         # 3 * N
+    word_postings: List[Dict[str, Any]]  # per field: word -> positions array
+    priority_boost: Any      # N
+    valid: Any               # N, False for entries without content
+
 
 class SemanticSearchEngine:
     """Advanced semantic search with embeddings simulation and knowledge graphs"""
@@ -31,6 +110,17 @@ class SemanticSearchEngine:
         
         # Semantic similarity cache
         self.similarity_cache = {}
+
+        # Precomputed entry features keyed by (entry id, language), validated by updated_at
+        self.entry_features: Dict[Tuple[Any, str], EntryFeatures] = {}
+        self.corpus_indexes: 'OrderedDict[Hashable, CorpusIndex]' = OrderedDict()
+        self.max_corpus_indexes = 64
+        self._concept_neighbours: Optional[Dict[str, Set[str]]] = None
+        self._concept_space: Optional[ConceptSpace] = None
+        self._index_lock = threading.RLock()
+
+        # Batched NumPy scoring of the whole corpus; the dict path is the fallback
+        self.use_vectorized = np is not None
         
     def _initialize_domain_knowledge(self):
         """Initialize domain-specific knowledge graph and concepts"""
@@ -95,6 +185,7 @@ class SemanticSearchEngine:
         
         # Simulate embeddings using simple word co-occurrence
         self._generate_concept_embeddings()
+        self._register_matcher_groups()
     
     def _generate_concept_embeddings(self):
         """Generate simple embeddings for concepts based on relationships"""
@@ -151,26 +242,39 @@ class SemanticSearchEngine:
         
         return similarity
     
-    def _extract_concepts(self, text: str) -> Set[str]:
+    def _register_matcher_groups(self):
+        """Register concept, synonym and concept-word lists with the shared matcher"""
+        from keyword_matcher import keyword_matcher
+
+        self._concept_word_index = defaultdict(set)
+        for concept in self.knowledge_graph:
+            for word in concept.split():
+                self._concept_word_index[word].add(concept)
+
+        # Words of the text are \w+ tokens, so only such keys can ever match them
+        keyword_matcher.register('semantic:concepts', self.knowledge_graph.keys())
+        keyword_matcher.register('semantic:synonyms',
+                                 [w for w in self.concept_synonyms if re.fullmatch(r'\w+', w)])
+        keyword_matcher.register('semantic:concept_words',
+                                 [w for w in self._concept_word_index if re.fullmatch(r'\w+', w)])
+
+    def _extract_concepts(self, text: str, use_cache: bool = True) -> Set[str]:
         """Extract known concepts from text"""
+        from keyword_matcher import keyword_matcher
+
         concepts = set()
-        text_words = set(re.findall(r'\b\w+\b', text.lower()))
+        scan = keyword_matcher.scan(text, use_cache=use_cache)
         
         # Direct concept matches
-        for concept in self.knowledge_graph:
-            if concept in text:
-                concepts.add(concept)
+        concepts.update(scan.phrases('semantic:concepts'))
         
-        # Synonym matches
-        for word in text_words:
-            if word in self.concept_synonyms:
-                concepts.update(self.concept_synonyms[word])
+        # Synonym matches (whole words only)
+        for word in scan.words('semantic:synonyms'):
+            concepts.update(self.concept_synonyms.get(word, ()))
         
         # Partial matches for compound concepts
-        for concept in self.knowledge_graph:
-            concept_words = set(concept.split())
-            if concept_words.intersection(text_words):
-                concepts.add(concept)
+        for word in scan.words('semantic:concept_words'):
+            concepts.update(self._concept_word_index.get(word, ()))
         
         return concepts
     
@@ -264,7 +368,8 @@ class SemanticSearchEngine:
     
     def semantic_search(self, query: str, knowledge_entries: List, 
                        language: str = 'ru', max_results: int = 5,
-                       semantic_threshold: float = 0.2) -> List[Dict]:
+                       semantic_threshold: float = 0.2,
+                       corpus_key: Optional[Hashable] = None) -> List[Dict]:
         """
         Perform semantic search on knowledge entries
         
@@ -274,6 +379,8 @@ class SemanticSearchEngine:
             language: Query language
             max_results: Maximum results to return
             semantic_threshold: Minimum semantic similarity threshold
+            corpus_key: Stable key of an unchanging entry list (e.g. agent, language
+                and snapshot version) to reuse its index across queries
             
         Returns:
             List of ranked results with semantic scores
@@ -281,21 +388,67 @@ class SemanticSearchEngine:
         if not query or not knowledge_entries:
             return []
         
-        scored_results = []
+        corpus = self.index_entries(knowledge_entries, language, corpus_key)
+
+        query_lower = query.lower()
+        query_concepts = self._extract_concepts(query_lower)
+        query_words = set(re.findall(r'\b\w+\b', query_lower))
+
+        scored_results = None
+        if self.use_vectorized:
+            try:
+                scored_results = self._score_vectorized(corpus, query_concepts, query_words,
+                                                        semantic_threshold)
+            except Exception as e:
+                logger.warning(f"Vectorized semantic scoring failed, using dict path: {e}")
+
+        if scored_results is None:
+            scored_results = self._score_entries(corpus, query_concepts, query_words,
+                                                 semantic_threshold)
+        
+        # Sort by semantic score
+        scored_results.sort(key=lambda x: x['semantic_score'], reverse=True)
+        
+        logger.info(f"Semantic search for '{query}': {len(scored_results)} results "
+                   f"(best score: {scored_results[0]['semantic_score']:.3f})" if scored_results else "No results")
         
-        for entry in knowledge_entries:
-            # Get content based on language
-            content = entry.content_ru if language == 'ru' else entry.content_kz
-            if not content:
+        return scored_results[:max_results]
+
+    def _score_entries(self, corpus: CorpusIndex, query_concepts: Set[str],
+                       query_words: Set[str], semantic_threshold: float) -> List[Dict]:
+        """Per-entry scoring over concept sets (fallback for the vectorized path)"""
+        query_signature = _lexical_signature(query_words)
+
+        # Entries without any lexical or concept overlap can only get the priority boost
+        if semantic_threshold > _MAX_NON_OVERLAP_SCORE:
+            candidate_positions = self._candidate_positions(corpus, query_words, query_concepts)
+        else:
+            candidate_positions = range(len(corpus.entries))
+
+        scored_results = []
+
+        for position in sorted(candidate_positions):
+            entry = corpus.entries[position]
+            features = corpus.features[position]
+            if features is None:
                 continue
+            content = features.content
             
             # Calculate semantic similarity
-            title_similarity = self.calculate_semantic_similarity(query, entry.title)
-            content_similarity = self.calculate_semantic_similarity(query, content)
+            title_similarity = self._similarity_from_features(
+                query_concepts, query_words, query_signature,
+                features.title_concepts, features.title_words, features.title_signature
+            )
+            content_similarity = self._similarity_from_features(
+                query_concepts, query_words, query_signature,
+                features.content_concepts, features.content_words, features.content_signature
+            )
             
             # Calculate keyword semantic similarity
-            keywords = entry.keywords or ''
-            keyword_similarity = self.calculate_semantic_similarity(query, keywords)
+            keyword_similarity = self._similarity_from_features(
+                query_concepts, query_words, query_signature,
+                features.keyword_concepts, features.keyword_words, features.keyword_signature
+            )
             
             # Weighted semantic score
             semantic_score = (
@@ -305,8 +458,7 @@ class SemanticSearchEngine:
             )
             
             # Add concept expansion boost
-            query_concepts = self._extract_concepts(query.lower())
-            entry_concepts = self._extract_concepts(f"{entry.title} {content} {keywords}".lower())
+            entry_concepts = features.all_concepts
             
             if query_concepts and entry_concepts:
                 concept_expansion_score = self._calculate_concept_expansion_score(
@@ -329,14 +481,307 @@ class SemanticSearchEngine:
                     'content': content,
                     'title': entry.title
                 })
-        
-        # Sort by semantic score
-        scored_results.sort(key=lambda x: x['semantic_score'], reverse=True)
-        
-        logger.info(f"Semantic search for '{query}': {len(scored_results)} results "
-                   f"(best score: {scored_results[0]['semantic_score']:.3f})" if scored_results else "No results")
-        
-        return scored_results[:max_results]
+
+        return scored_results
+
+    def _score_vectorized(self, corpus: CorpusIndex, query_concepts: Set[str],
+                          query_words: Set[str], semantic_threshold: float) -> Optional[List[Dict]]:
+        """Score every entry of the corpus at once with matrix products (None if not applicable)"""
+        vectors = self._get_corpus_vectors(corpus)
+        if vectors is None:
+            return None
+        space = vectors.space
+        if any(concept not in space.positions for concept in query_concepts):
+            return None
+
+        n = len(corpus.entries)
+        if not n:
+            return []
+
+        # Lexical Jaccard per field from word postings
+        lexical = np.zeros(len(_VECTOR_FIELDS) * n)
+        if query_words:
+            intersection = np.zeros(len(_VECTOR_FIELDS) * n)
+            for field_index, postings in enumerate(vectors.word_postings):
+                offset = field_index * n
+                for word in query_words:
+                    positions = postings.get(word)
+                    if positions is not None:
+                        intersection[positions + offset] += 1
+            union = len(query_words) + vectors.word_counts - intersection
+            np.divide(intersection, union, out=lexical, where=union > 0)
+
+        field_scores = lexical
+        expansion = np.zeros(n)
+        if query_concepts:
+            query_positions = [space.positions[concept] for concept in query_concepts]
+
+            # One product gives overlap and relationship sums for all entries and fields
+            query_profile = np.stack([
+                np.bincount(query_positions, minlength=len(space.concepts)).astype(float),
+                space.relation_jaccard[query_positions].sum(axis=0),
+                space.relation_mask[query_positions].sum(axis=0)
+            ], axis=1)
+            overlap, relation_sum, relation_count = (vectors.fields @ query_profile).T
+
+            counts = vectors.concept_counts
+            direct = overlap / np.maximum(np.maximum(counts, len(query_positions)), 1)
+            embedding = (vectors.fields * space.cosine[query_positions].max(axis=0)).max(axis=1)
+            relationship = np.zeros_like(relation_sum)
+            np.divide(relation_sum, relation_count, out=relationship, where=relation_count > 0)
+
+            concept_scores = np.minimum(1.0, direct * 0.5 + embedding * 0.3 + relationship * 0.2)
+            field_scores = np.where(counts > 0, concept_scores, lexical)
+            expansion = np.minimum(1.0, vectors.all_concepts @ space.expansion[query_positions].sum(axis=0))
+
+        title_similarity, content_similarity, keyword_similarity = field_scores.reshape(len(_VECTOR_FIELDS), n)
+        semantic_scores = (title_similarity * 0.4 + content_similarity * 0.4 + keyword_similarity * 0.2)
+        semantic_scores = semantic_scores + expansion * 0.1
+        semantic_scores = semantic_scores + vectors.priority_boost
+
+        scored_results = []
+        for position in np.flatnonzero(vectors.valid & (semantic_scores >= semantic_threshold)):
+            entry = corpus.entries[position]
+            scored_results.append({
+                'entry': entry,
+                'semantic_score': float(semantic_scores[position]),
+                'title_similarity': float(title_similarity[position]),
+                'content_similarity': float(content_similarity[position]),
+                'keyword_similarity': float(keyword_similarity[position]),
+                'content': corpus.features[position].content,
+                'title': entry.title
+            })
+        return scored_results
+
+    def _get_corpus_vectors(self, corpus: CorpusIndex) -> Optional[CorpusVectors]:
+        """Pack the corpus concept sets into dense matrices over the fixed concept vocabulary"""
+        space = self._get_concept_space()
+        vectors = corpus.vectors
+        if vectors is not None and vectors.space is space:
+            return vectors
+
+        n = len(corpus.entries)
+        fields = np.zeros((len(_VECTOR_FIELDS) * n, len(space.concepts)))
+        all_concepts = np.zeros((n, len(space.concepts)))
+        word_counts = np.zeros(len(_VECTOR_FIELDS) * n)
+        word_postings = [defaultdict(list) for _ in _VECTOR_FIELDS]
+        priority_boost = np.zeros(n)
+        valid = np.zeros(n, dtype=bool)
+
+        for position, (entry, features) in enumerate(zip(corpus.entries, corpus.features)):
+            if features is None:
+                continue
+            field_sets = (
+                (features.title_concepts, features.title_words),
+                (features.content_concepts, features.content_words),
+                (features.keyword_concepts, features.keyword_words)
+            )
+            for field_index, (concepts, words) in enumerate(field_sets):
+                row = field_index * n + position
+                for concept in concepts:
+                    if concept not in space.positions:
+                        return None
+                    fields[row, space.positions[concept]] = 1.0
+                word_counts[row] = len(words)
+                for word in words:
+                    word_postings[field_index][word].append(position)
+            for concept in features.all_concepts:
+                if concept not in space.positions:
+                    return None
+                all_concepts[position, space.positions[concept]] = 1.0
+            priority_boost[position] = 1.0 / max(entry.priority or 1, 1) * 0.05
+            valid[position] = True
+
+        vectors = CorpusVectors(
+            space=space,
+            fields=fields,
+            all_concepts=all_concepts,
+            concept_counts=fields.sum(axis=1),
+            word_counts=word_counts,
+            word_postings=[{word: np.array(positions) for word, positions in postings.items()}
+                           for postings in word_postings],
+            priority_boost=priority_boost,
+            valid=valid
+        )
+        corpus.vectors = vectors
+        return vectors
+
+    def _get_concept_space(self) -> ConceptSpace:
+        """Concept vocabulary and pairwise score matrices, rebuilt when the graph changes"""
+        with self._index_lock:
+            if self._concept_space is not None:
+                return self._concept_space
+
+            universe = set(self.knowledge_graph)
+            for values in self.concept_synonyms.values():
+                universe.update(values)
+            universe.update(self.entity_relationships.keys())
+            concepts = sorted(universe)
+            positions = {concept: i for i, concept in enumerate(concepts)}
+
+            # Embeddings packed into a V x F matrix over the embedding feature vocabulary
+            features = sorted({f for embedding in self.concept_embeddings.values() for f in embedding})
+            feature_positions = {f: i for i, f in enumerate(features)}
+            embeddings = np.zeros((len(concepts), len(features)))
+            for concept, embedding in self.concept_embeddings.items():
+                for f, value in embedding.items():
+                    embeddings[positions[concept], feature_positions[f]] = value
+            norms = np.linalg.norm(embeddings, axis=1)
+            norms[norms == 0] = 1.0
+            normalized = embeddings / norms[:, None]
+            cosine = normalized @ normalized.T
+
+            related = [self.entity_relationships.get(concept, set()) for concept in concepts]
+            categories = [self.knowledge_graph.get(concept, {}).get('category') for concept in concepts]
+            relation_jaccard = np.zeros((len(concepts), len(concepts)))
+            relation_mask = np.zeros((len(concepts), len(concepts)))
+            expansion = np.zeros((len(concepts), len(concepts)))
+            for i, c1 in enumerate(concepts):
+                for j, c2 in enumerate(concepts):
+                    if related[i] and related[j]:
+                        relation_mask[i, j] = 1.0
+                        relation_jaccard[i, j] = len(related[i] & related[j]) / len(related[i] | related[j])
+                    if c2 in related[i]:
+                        expansion[i, j] += 0.5
+                    if categories[i] and categories[i] == categories[j]:
+                        expansion[i, j] += 0.3
+
+            self._concept_space = ConceptSpace(
+                concepts=concepts,
+                positions=positions,
+                cosine=cosine,
+                relation_jaccard=relation_jaccard,
+                relation_mask=relation_mask,
+                expansion=expansion
+            )
+            return self._concept_space
+
+    def index_entries(self, knowledge_entries: List, language: str = 'ru',
+                      corpus_key: Optional[Hashable] = None) -> CorpusIndex:
+        """Build (or reuse) the concept/word index for a list of entries"""
+        with self._index_lock:
+            if corpus_key is not None:
+                corpus = self.corpus_indexes.get(corpus_key)
+                if corpus is not None and corpus.source is knowledge_entries:
+                    self.corpus_indexes.move_to_end(corpus_key)
+                    return corpus
+
+            corpus = CorpusIndex(entries=list(knowledge_entries), features=[], source=knowledge_entries)
+            for position, entry in enumerate(corpus.entries):
+                features = self._get_entry_features(entry, language)
+                corpus.features.append(features)
+                if features is None:
+                    continue
+                for concept in (features.all_concepts | features.title_concepts |
+                                features.content_concepts | features.keyword_concepts):
+                    corpus.concept_postings[concept].add(position)
+                for word in features.title_words | features.content_words | features.keyword_words:
+                    corpus.word_postings[word].add(position)
+
+            if corpus_key is not None:
+                self.corpus_indexes[corpus_key] = corpus
+                while len(self.corpus_indexes) > self.max_corpus_indexes:
+                    self.corpus_indexes.popitem(last=False)
+
+            return corpus
+
+    def _get_entry_features(self, entry, language: str) -> Optional[EntryFeatures]:
+        """Concepts and token sets of an entry, recomputed only when updated_at changes"""
+        content = entry.content_ru if language == 'ru' else entry.content_kz
+        if not content:
+            return None
+
+        entry_id = getattr(entry, 'id', None)
+        updated_at = getattr(entry, 'updated_at', None)
+        cache_key = (entry_id, language)
+        if entry_id is not None:
+            cached = self.entry_features.get(cache_key)
+            if cached is not None and cached.updated_at == updated_at and cached.content == content:
+                return cached
+
+        title = entry.title or ''
+        keywords = entry.keywords or ''
+        title_words = set(re.findall(r'\b\w+\b', title.lower()))
+        content_words = set(re.findall(r'\b\w+\b', content.lower()))
+        keyword_words = set(re.findall(r'\b\w+\b', keywords.lower()))
+
+        features = EntryFeatures(
+            entry_id=entry_id,
+            updated_at=updated_at,
+            content=content,
+            title_concepts=self._extract_concepts(title.lower(), use_cache=False),
+            content_concepts=self._extract_concepts(content.lower(), use_cache=False),
+            keyword_concepts=self._extract_concepts(keywords.lower(), use_cache=False),
+            all_concepts=self._extract_concepts(f"{title} {content} {keywords}".lower(), use_cache=False),
+            title_words=title_words,
+            content_words=content_words,
+            keyword_words=keyword_words,
+            title_signature=_lexical_signature(title_words),
+            content_signature=_lexical_signature(content_words),
+            keyword_signature=_lexical_signature(keyword_words)
+        )
+
+        if entry_id is not None:
+            self.entry_features[cache_key] = features
+        return features
+
+    def _similarity_from_features(self, query_concepts: Set[str], query_words: Set[str],
+                                  query_signature: int, text_concepts: Set[str],
+                                  text_words: Set[str], text_signature: int) -> float:
+        """Same result as calculate_semantic_similarity, computed from precomputed sets"""
+        if not query_concepts or not text_concepts:
+            if not query_words or not text_words or not (query_signature & text_signature):
+                return 0.0
+            intersection = len(query_words.intersection(text_words))
+            union = len(query_words) + len(text_words) - intersection
+            return intersection / union if union > 0 else 0.0
+
+        return self._calculate_concept_similarity(query_concepts, text_concepts)
+
+    def _candidate_positions(self, corpus: CorpusIndex, query_words: Set[str],
+                             query_concepts: Set[str]) -> Set[int]:
+        """Entries sharing a word or a (related) concept with the query"""
+        candidates = set()
+        for word in query_words:
+            candidates.update(corpus.word_postings.get(word, ()))
+
+        neighbours = self._get_concept_neighbours()
+        for query_concept in query_concepts:
+            for concept in neighbours.get(query_concept, {query_concept}):
+                candidates.update(corpus.concept_postings.get(concept, ()))
+        return candidates
+
+    def _get_concept_neighbours(self) -> Dict[str, Set[str]]:
+        """Concepts that can give a non-zero similarity or expansion score to each other"""
+        with self._index_lock:
+            if self._concept_neighbours is not None:
+                return self._concept_neighbours
+
+            universe = set(self.knowledge_graph)
+            for values in self.concept_synonyms.values():
+                universe.update(values)
+            universe.update(self.entity_relationships.keys())
+
+            neighbours = {}
+            for c1 in universe:
+                related1 = self.entity_relationships.get(c1, set())
+                category1 = self.knowledge_graph.get(c1, {}).get('category')
+                embedding1 = self.concept_embeddings.get(c1)
+                close = {c1}
+                for c2 in universe:
+                    if c2 == c1:
+                        continue
+                    related2 = self.entity_relationships.get(c2, set())
+                    category2 = self.knowledge_graph.get(c2, {}).get('category')
+                    embedding2 = self.concept_embeddings.get(c2)
+                    if (c2 in related1 or c1 in related2 or related1 & related2 or
+                            (category1 and category1 == category2) or
+                            (embedding1 and embedding2 and self._cosine_similarity(embedding1, embedding2) > 0)):
+                        close.add(c2)
+                neighbours[c1] = close
+
+            self._concept_neighbours = neighbours
+            return neighbours
     
     def _calculate_concept_expansion_score(self, query_concepts: Set[str], 
                                          entry_concepts: Set[str]) -> float:
@@ -463,6 +908,14 @@ class SemanticSearchEngine:
         
         # Regenerate embeddings for updated concept
         self._generate_concept_embeddings()
+        self._register_matcher_groups()
+
+        # Concepts of indexed entries depend on the graph, so drop the index
+        with self._index_lock:
+            self._concept_neighbours = None
+            self._concept_space = None
+            self.entry_features.clear()
+            self.corpus_indexes.clear()
         
         logger.info(f"Updated knowledge graph with concept: {concept}")
     
@@ -473,6 +926,9 @@ class SemanticSearchEngine:
             'total_relationships': sum(len(rels) for rels in self.entity_relationships.values()) // 2,
             'total_synonyms': sum(len(syns) for syns in self.concept_synonyms.values()),
             'cache_size': len(self.similarity_cache),
+            'indexed_entries': len(self.entry_features),
+            'indexed_corpora': len(self.corpus_indexes),
+            'vectorized_scoring': self.use_vectorized,
             'categories': list(set(
                 data.get('category', 'unknown') 
                 for data in self.knowledge_graph.values()
@@ -481,4 +937,26 @@ class SemanticSearchEngine:
 
 
 # Global semantic search engine
-semantic_search_engine = SemanticSearchEngine()
\ No newline at end of file
+semantic_search_engine = SemanticSearchEngine()
+
+# Most recent pair similarities kept across worker restarts
+SIMILARITY_SNAPSHOT_LIMIT = 50000
+
+
+def _dump_similarity_cache() -> Dict[str, float]:
+    items = list(semantic_search_engine.similarity_cache.items())
+    return dict(items[-SIMILARITY_SNAPSHOT_LIMIT:])
+
+
+def _load_similarity_cache(data: Dict[str, float]) -> int:
+    semantic_search_engine.similarity_cache.update(data)
+    return len(data)
+
+
+def _merge_similarity_cache(previous: Dict[str, float], current: Dict[str, float]) -> Dict[str, float]:
+    merged = {**previous, **current}
+    return dict(list(merged.items())[-SIMILARITY_SNAPSHOT_LIMIT:])
+
+
+cache_snapshots.register('semantic_similarity', _dump_similarity_cache, _load_similarity_cache,
+                         merge=_merge_similarity_cache)
\ No newline at end of file
@@ -0,0 +1,544 @@
+"""
+Materialized Statistics Rollups
+Материализованные агрегаты статистики запросов
+
+/api/statistics (called by the homepage) and the admin dashboard used to run
+a dozen full-table aggregates over user_queries per request. This module
+keeps three small tables up to date instead:
+
+- query_daily_rollups: day x agent x language x rating, with counts and the
+  sums behind average response time and confidence;
+- query_hourly_rollups: queries per day and hour (hour-of-day and weekday
+  histograms);
+- session_activity: first/last query time and count of every session.
+
+refresh() is incremental: rows above the id watermark and rows rated since
+the rating watermark mark their day dirty, and only dirty days (and the
+sessions of the new rows) are rebuilt from user_queries. Ids can commit out of
+order under several writers, so the last LOOKBACK_IDS ids below the watermark
+are fingerprinted (count and id sum) and rescanned when a late row appears.
+Deleting a session's queries (/api/chat/clear) goes through forget_session(),
+which drops its activity row and marks its days dirty for the next refresh.
+It runs from a background thread in every worker (one at
+a time through a lock file) and before building a payload when the rollups
+are older than the refresh interval. Rendered payloads are cached per
+process for a short TTL.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func
+
+try:
+    import fcntl
+except ImportError:  # every worker refreshes on its own outside POSIX
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+STATE_LAST_ID = 'user_queries.last_id'
+STATE_LAST_RATING = 'user_queries.last_rating_at'
+STATE_WINDOW = 'user_queries.window'  # "floor:count:id_sum" of the ids just below the watermark
+DIRTY_DAY_PREFIX = 'dirty_day.'
+LOOKBACK_IDS = 1000
+SCAN_CHUNK = 5000
+IN_CHUNK = 500
+
+DAY_NAMES = {0: 'Воскресенье', 1: 'Понедельник', 2: 'Вторник', 3: 'Среда', 4: 'Четверг', 5: 'Пятница', 6: 'Суббота'}
+
+
+def _default_lock_file() -> str:
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base_dir, 'bolashak_statistics_rollups.lock')
+
+
+def _ratio(total: float, count: int) -> float:
+    return total / count if count else 0.0
+
+
+class StatisticsRollups:
+    """Incremental rollups of user_queries and TTL-cached statistics payloads"""
+
+    def __init__(self, refresh_interval: float = 60.0, cache_ttl: float = 30.0, lock_file: Optional[str] = None):
+        self.refresh_interval = refresh_interval
+        self.cache_ttl = cache_ttl
+        self.lock_file = lock_file or _default_lock_file()
+        self._payloads: Dict[str, Tuple[float, Any]] = {}
+        self._last_refresh = 0.0
+        self._refresh_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self.stats = {
+            'refreshes': 0,
+            'rows_scanned': 0,
+            'days_rebuilt': 0,
+            'payload_hits': 0,
+            'payload_misses': 0,
+            'errors': 0,
+            'last_refresh_ms': 0.0
+        }
+
+    # ---------------------------------------------------------------- refresh
+
+    def refresh(self) -> Dict[str, int]:
+        """Fold new and re-rated user_queries into the rollups (needs an app context)"""
+        from models import db, RollupState
+
+        start = time.perf_counter()
+        with self._refresh_lock:
+            try:
+                state = {row.name: row.value for row in RollupState.query.all()}
+                last_id = int(state.get(STATE_LAST_ID) or 0)
+                last_rating = state.get(STATE_LAST_RATING)
+                last_rating = datetime.fromisoformat(last_rating) if last_rating else None
+                marked = {name: value for name, value in state.items() if name.startswith(DIRTY_DAY_PREFIX)}
+
+                scan_from = self._late_rows_floor(last_id, state.get(STATE_WINDOW))
+                dirty_days, sessions, new_last_id, scanned = self._scan_new_rows(scan_from)
+                new_last_id = max(new_last_id, last_id)
+                rated_days, new_last_rating = self._scan_new_ratings(last_rating)
+                dirty_days |= rated_days
+                dirty_days |= {date.fromisoformat(name[len(DIRTY_DAY_PREFIX):]) for name in marked}
+
+                for day in sorted(dirty_days):
+                    self._rebuild_day(day)
+                self._rebuild_sessions(sessions)
+
+                for name, value in marked.items():
+                    # A day marked again meanwhile (new value) stays dirty for the next refresh
+                    RollupState.query.filter_by(name=name, value=value).delete()
+                db.session.merge(RollupState(name=STATE_LAST_ID, value=str(new_last_id)))
+                db.session.merge(RollupState(name=STATE_WINDOW, value=self._window(new_last_id)))
+                if new_last_rating is not None:
+                    db.session.merge(RollupState(name=STATE_LAST_RATING, value=new_last_rating.isoformat()))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                self.stats['errors'] += 1
+                raise
+
+            self._last_refresh = time.time()
+            self._payloads.clear()
+            self.stats['refreshes'] += 1
+            self.stats['rows_scanned'] += scanned
+            self.stats['days_rebuilt'] += len(dirty_days)
+            self.stats['last_refresh_ms'] = (time.perf_counter() - start) * 1000
+            return {'rows': scanned, 'days': len(dirty_days), 'sessions': len(sessions)}
+
+    @staticmethod
+    def _window_fingerprint(floor: int, last_id: int) -> Tuple[int, int]:
+        from models import db, UserQuery
+
+        count, id_sum = db.session.query(func.count(UserQuery.id), func.coalesce(func.sum(UserQuery.id), 0)).filter(
+            UserQuery.id > floor, UserQuery.id <= last_id
+        ).one()
+        return int(count), int(id_sum)
+
+    def _window(self, last_id: int) -> str:
+        floor = max(0, last_id - LOOKBACK_IDS)
+        count, id_sum = self._window_fingerprint(floor, last_id)
+        return f"{floor}:{count}:{id_sum}"
+
+    def _late_rows_floor(self, last_id: int, window: Optional[str]) -> int:
+        """Where to start scanning: the window floor if rows appeared (or vanished) below the watermark"""
+        if not window:
+            return last_id
+        floor, count, id_sum = (int(part) for part in window.split(':'))
+        if self._window_fingerprint(floor, last_id) != (count, id_sum):
+            logger.info(f"Rows committed below the rollup watermark {last_id}, rescanning from id {floor}")
+            return floor
+        return last_id
+
+    def _scan_new_rows(self, last_id: int) -> Tuple[Set[date], Set[str], int, int]:
+        from models import db, UserQuery
+
+        dirty_days: Set[date] = set()
+        sessions: Set[str] = set()
+        scanned = 0
+        while True:
+            rows = db.session.query(UserQuery.id, UserQuery.created_at, UserQuery.session_id).filter(
+                UserQuery.id > last_id
+            ).order_by(UserQuery.id).limit(SCAN_CHUNK).all()
+            if not rows:
+                break
+            for _, created_at, session_id in rows:
+                created_at = created_at or datetime.utcnow()
+                dirty_days.add(created_at.date())
+                if session_id:
+                    sessions.add(session_id)
+            scanned += len(rows)
+            last_id = rows[-1].id
+        return dirty_days, sessions, last_id, scanned
+
+    def _scan_new_ratings(self, last_rating: Optional[datetime]) -> Tuple[Set[date], Optional[datetime]]:
+        from models import db, UserQuery
+
+        query = db.session.query(UserQuery.created_at, UserQuery.rating_timestamp).filter(
+            UserQuery.rating_timestamp.isnot(None)
+        )
+        if last_rating is not None:
+            query = query.filter(UserQuery.rating_timestamp > last_rating)
+        days: Set[date] = set()
+        newest = last_rating
+        for created_at, rated_at in query:
+            if created_at is not None:
+                days.add(created_at.date())
+            newest = rated_at if newest is None else max(newest, rated_at)
+        return days, newest
+
+    def _rebuild_day(self, day: date):
+        """Recompute one day's rollup rows from user_queries"""
+        from models import db, UserQuery, QueryDailyRollup, QueryHourlyRollup
+
+        day_start = datetime.combine(day, datetime.min.time())
+        rows = db.session.query(
+            UserQuery.created_at, UserQuery.agent_type, UserQuery.agent_name, UserQuery.language,
+            UserQuery.user_rating, UserQuery.response_time, UserQuery.agent_confidence
+        ).filter(UserQuery.created_at >= day_start, UserQuery.created_at < day_start + timedelta(days=1))
+
+        daily: Dict[Tuple[str, str, str, str], Dict[str, Any]] = {}
+        hourly: Counter = Counter()
+        for created_at, agent_type, agent_name, language, rating, response_time, confidence in rows:
+            key = (agent_type or '', agent_name or '', language or 'ru', rating or 'none')
+            bucket = daily.get(key)
+            if bucket is None:
+                bucket = daily[key] = {'query_count': 0, 'response_time_sum': 0.0, 'response_time_count': 0,
+                                       'confidence_sum': 0.0, 'confidence_count': 0}
+            bucket['query_count'] += 1
+            if response_time is not None:
+                bucket['response_time_sum'] += response_time
+                bucket['response_time_count'] += 1
+            if confidence is not None:
+                bucket['confidence_sum'] += confidence
+                bucket['confidence_count'] += 1
+            hourly[created_at.hour] += 1
+
+        QueryDailyRollup.query.filter_by(day=day).delete()
+        QueryHourlyRollup.query.filter_by(day=day).delete()
+        if daily:
+            db.session.execute(QueryDailyRollup.__table__.insert(), [
+                {'day': day, 'agent_type': key[0], 'agent_name': key[1], 'language': key[2], 'rating': key[3], **bucket}
+                for key, bucket in daily.items()
+            ])
+            db.session.execute(QueryHourlyRollup.__table__.insert(), [
+                {'day': day, 'hour': hour, 'query_count': count} for hour, count in hourly.items()
+            ])
+
+    def _rebuild_sessions(self, sessions: Set[str]):
+        """Recompute the activity rows of these sessions (idempotent, so rescans never double count)"""
+        from models import db, SessionActivity, UserQuery
+
+        session_ids = sorted(sessions)
+        for offset in range(0, len(session_ids), IN_CHUNK):
+            chunk = session_ids[offset:offset + IN_CHUNK]
+            totals = {
+                session_id: (first_seen, last_seen, count)
+                for session_id, first_seen, last_seen, count in db.session.query(
+                    UserQuery.session_id, func.min(UserQuery.created_at), func.max(UserQuery.created_at),
+                    func.count(UserQuery.id)
+                ).filter(UserQuery.session_id.in_(chunk)).group_by(UserQuery.session_id)
+            }
+            existing = {
+                activity.session_id: activity
+                for activity in SessionActivity.query.filter(SessionActivity.session_id.in_(chunk))
+            }
+            for session_id in chunk:
+                activity = existing.get(session_id)
+                if session_id not in totals:
+                    if activity is not None:
+                        db.session.delete(activity)
+                    continue
+                first_seen, last_seen, count = totals[session_id]
+                first_seen = first_seen or datetime.utcnow()
+                last_seen = last_seen or first_seen
+                if activity is None:
+                    db.session.add(SessionActivity(session_id=session_id, first_seen=first_seen,
+                                                   last_seen=last_seen, query_count=count))
+                else:
+                    activity.first_seen, activity.last_seen, activity.query_count = first_seen, last_seen, count
+
+    def forget_session(self, session_id: str, days: Set[date]):
+        """Before deleting a session's queries: drop its activity and mark its days dirty (caller commits)"""
+        from models import SessionActivity, RollupState, db
+
+        SessionActivity.query.filter_by(session_id=session_id).delete()
+        stamp = f"{time.time():.6f}"
+        for day in days:
+            db.session.merge(RollupState(name=f"{DIRTY_DAY_PREFIX}{day.isoformat()}", value=stamp))
+        # This worker refreshes on its next payload build instead of after the interval
+        self._last_refresh = 0.0
+
+    def refresh_if_stale(self) -> bool:
+        """Refresh when older than the interval, unless another worker is refreshing right now"""
+        if time.time() - self._last_refresh < self.refresh_interval:
+            return False
+        try:
+            if fcntl is None:
+                self.refresh()
+                return True
+            with open(self.lock_file, 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                self.refresh()
+                return True
+        except Exception as e:
+            logger.warning(f"Statistics rollup refresh failed: {e}")
+            return False
+
+    def start_periodic(self):
+        """Refresh every interval from a daemon thread (one per process)"""
+        if self.refresh_interval <= 0 or (self._thread is not None and self._thread_pid == os.getpid()):
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True, name='statistics-rollups')
+        self._thread_pid = os.getpid()
+        self._thread.start()
+
+    def _run(self):
+        from app_context import app_context
+
+        while True:
+            time.sleep(self.refresh_interval)
+            with app_context():
+                self.refresh_if_stale()
+
+    # --------------------------------------------------------------- payloads
+
+    def cached(self, name: str, build: Callable[[], Any]) -> Any:
+        """Payload rendered at most once per cache_ttl in this process"""
+        entry = self._payloads.get(name)
+        if entry is not None and entry[0] > time.time():
+            self.stats['payload_hits'] += 1
+            return entry[1]
+        self.stats['payload_misses'] += 1
+        self.refresh_if_stale()
+        payload = build()
+        self._payloads[name] = (time.time() + self.cache_ttl, payload)
+        return payload
+
+    @staticmethod
+    def _grouped(*columns, since: Optional[date] = None, rated_only: bool = False, where=()):
+        """Sums of the daily rollups grouped by the given columns"""
+        from models import db, QueryDailyRollup as R
+
+        query = db.session.query(
+            *columns,
+            func.sum(R.query_count).label('count'),
+            func.sum(R.response_time_sum).label('response_time_sum'),
+            func.sum(R.response_time_count).label('response_time_count'),
+            func.sum(R.confidence_sum).label('confidence_sum'),
+            func.sum(R.confidence_count).label('confidence_count')
+        )
+        if since is not None:
+            query = query.filter(R.day >= since)
+        if rated_only:
+            query = query.filter(R.rating != 'none')
+        for condition in where:
+            query = query.filter(condition)
+        if columns:
+            query = query.group_by(*columns).order_by(*columns)
+        return query.all()
+
+    def _rating_totals(self) -> Dict[str, int]:
+        from models import QueryDailyRollup as R
+
+        return {row.rating: int(row.count or 0) for row in self._grouped(R.rating)}
+
+    def _usage_patterns(self) -> Tuple[List[Dict[str, int]], List[Dict[str, Any]]]:
+        from models import db, QueryHourlyRollup as H
+
+        hours = db.session.query(H.hour, func.sum(H.query_count).label('count')).group_by(H.hour).all()
+        hourly = sorted(({'hour': int(row.hour), 'count': int(row.count)} for row in hours),
+                        key=lambda item: item['count'], reverse=True)
+
+        weekdays: Counter = Counter()
+        for row in db.session.query(H.day, func.sum(H.query_count).label('count')).group_by(H.day):
+            weekdays[(row.day.weekday() + 1) % 7] += int(row.count)  # 0 = Sunday, as extract('dow')
+        daily = [{'day': DAY_NAMES[dow], 'count': count} for dow, count in sorted(weekdays.items())]
+        return hourly, daily
+
+    def homepage_statistics(self) -> Dict[str, Any]:
+        """The `statistics` object of /api/statistics"""
+        return self.cached('homepage', self._build_homepage)
+
+    def _build_homepage(self) -> Dict[str, Any]:
+        from models import AgentKnowledgeBase, SessionActivity, QueryDailyRollup as R
+
+        now = datetime.utcnow()
+        totals = self._grouped()[0]
+        total_queries = int(totals.count or 0)
+        recent_queries = int(self._grouped(since=(now - timedelta(days=30)).date())[0].count or 0)
+        ratings = self._rating_totals()
+        rated = ratings.get('like', 0) + ratings.get('dislike', 0)
+        satisfaction_rate = round((ratings.get('like', 0) / rated * 100) if rated > 0 else 95, 1)
+        avg_response_time = _ratio(totals.response_time_sum or 0, totals.response_time_count or 0)
+
+        total_users = SessionActivity.query.count()
+        active_users_24h = SessionActivity.query.filter(SessionActivity.last_seen >= now - timedelta(days=1)).count()
+        active_users_7d = SessionActivity.query.filter(SessionActivity.last_seen >= now - timedelta(days=7)).count()
+        hourly, daily = self._usage_patterns()
+
+        return {
+            'total_students': 15000,  # Константа или из другой таблицы
+            'total_queries': total_queries,
+            'recent_queries': recent_queries,
+            'total_knowledge': AgentKnowledgeBase.query.filter_by(is_active=True).count(),
+            'satisfaction_rate': satisfaction_rate,
+            'avg_response_time': round(avg_response_time, 2) if avg_response_time else 1.5,
+            'user_stats': {
+                'total_users': total_users,
+                'active_users_24h': active_users_24h,
+                'active_users_7d': active_users_7d,
+                'avg_queries_per_user': round(total_queries / total_users, 1) if total_users > 0 else 0,
+                'user_growth': {
+                    'daily_retention': round((active_users_24h / total_users * 100) if total_users > 0 else 0, 1),
+                    'weekly_retention': round((active_users_7d / total_users * 100) if total_users > 0 else 0, 1)
+                }
+            },
+            'usage_patterns': {
+                'hourly_stats': hourly[:5],  # Топ 5 часов
+                'daily_stats': daily
+            },
+            'agent_stats': [
+                {
+                    'name': row.agent_name,
+                    'count': int(row.count),
+                    'avg_time': round(_ratio(row.response_time_sum, row.response_time_count), 2),
+                    'avg_confidence': round(_ratio(row.confidence_sum, row.confidence_count), 2)
+                }
+                for row in self._grouped(R.agent_name, where=(R.agent_name != '',))
+            ],
+            'language_stats': [
+                {'language': row.language, 'count': int(row.count)}
+                for row in self._grouped(R.language)
+            ]
+        }
+
+    def dashboard_summary(self) -> Dict[str, Any]:
+        """Query counters of the admin dashboard page"""
+        return self.cached('dashboard', self._build_dashboard)
+
+    def _build_dashboard(self) -> Dict[str, Any]:
+        from models import QueryDailyRollup as R
+
+        totals = self._grouped()[0]
+        ratings = self._rating_totals()
+        total_ratings = ratings.get('like', 0) + ratings.get('dislike', 0)
+        week_ago = (datetime.utcnow() - timedelta(days=7)).date()
+        return {
+            'total_queries': int(totals.count or 0),
+            'daily_stats': [{'date': row.day.isoformat(), 'count': int(row.count)}
+                            for row in self._grouped(R.day, since=week_ago)],
+            'avg_response_time': round(_ratio(totals.response_time_sum or 0, totals.response_time_count or 0), 2),
+            'total_ratings': total_ratings,
+            'total_likes': ratings.get('like', 0),
+            'satisfaction_rate': round((ratings.get('like', 0) / total_ratings * 100) if total_ratings > 0 else 0, 1)
+        }
+
+    def agent_analytics(self) -> Dict[str, Any]:
+        """Payload of /admin/api/analytics/agents"""
+        return self.cached('agent_analytics', self._build_agent_analytics)
+
+    def _build_agent_analytics(self) -> Dict[str, Any]:
+        from models import QueryDailyRollup as R
+
+        known_agent = (R.agent_type != '',)
+        thirty_days_ago = (datetime.utcnow() - timedelta(days=30)).date()
+        return {
+            'agent_stats': [
+                {
+                    'agent_type': row.agent_type,
+                    'agent_name': row.agent_name or None,
+                    'total_queries': int(row.count),
+                    'avg_response_time': round(_ratio(row.response_time_sum, row.response_time_count), 2),
+                    'avg_confidence': round(_ratio(row.confidence_sum, row.confidence_count), 2)
+                }
+                for row in self._grouped(R.agent_type, R.agent_name, where=known_agent)
+            ],
+            'language_stats': [
+                {'agent_type': row.agent_type, 'language': row.language, 'count': int(row.count)}
+                for row in self._grouped(R.agent_type, R.language, where=known_agent)
+            ],
+            'daily_stats': [
+                {'date': row.day.isoformat(), 'agent_type': row.agent_type, 'count': int(row.count)}
+                for row in self._grouped(R.day, R.agent_type, since=thirty_days_ago, where=known_agent)
+            ]
+        }
+
+    def analytics_summary(self) -> Dict[str, Any]:
+        """Payload of /admin/api/analytics/summary"""
+        return self.cached('analytics_summary', self._build_analytics_summary)
+
+    def _build_analytics_summary(self) -> Dict[str, Any]:
+        from models import QueryDailyRollup as R
+
+        thirty_days_ago = (datetime.utcnow() - timedelta(days=30)).date()
+        ratings = self._rating_totals()
+        likes, dislikes = ratings.get('like', 0), ratings.get('dislike', 0)
+        total_ratings = likes + dislikes
+        named_agent = (R.agent_name != '',)
+        return {
+            'agent_usage': [
+                {
+                    'name': row.agent_name,
+                    'count': int(row.count),
+                    'avg_response_time': round(_ratio(row.response_time_sum, row.response_time_count), 2),
+                    'avg_confidence': round(_ratio(row.confidence_sum, row.confidence_count), 2)
+                }
+                for row in self._grouped(R.agent_name, where=named_agent)
+            ],
+            'language_distribution': [
+                {'language': row.language, 'count': int(row.count)}
+                for row in self._grouped(R.language)
+            ],
+            'daily_activity': [
+                {'date': row.day.isoformat(), 'count': int(row.count)}
+                for row in self._grouped(R.day, since=thirty_days_ago)
+            ],
+            'rating_stats': {
+                'total_ratings': total_ratings,
+                'likes': likes,
+                'dislikes': dislikes,
+                'satisfaction_rate': round((likes / total_ratings * 100) if total_ratings > 0 else 0, 1)
+            },
+            'rating_by_agent': [
+                {'agent_name': row.agent_name, 'rating': row.rating, 'count': int(row.count)}
+                for row in self._grouped(R.agent_name, R.rating, rated_only=True, where=named_agent)
+            ],
+            'daily_ratings': [
+                {'date': row.day.isoformat(), 'rating': row.rating, 'count': int(row.count)}
+                for row in self._grouped(R.day, R.rating, since=thirty_days_ago, rated_only=True)
+            ]
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'refresh_interval': self.refresh_interval,
+            'cache_ttl': self.cache_ttl,
+            'last_refresh': self._last_refresh or None
+        }
+
+
+def _create_rollups() -> StatisticsRollups:
+    """Rollups from STATS_ROLLUP_INTERVAL / STATS_CACHE_TTL (seconds)"""
+    try:
+        return StatisticsRollups(
+            refresh_interval=float(os.environ.get('STATS_ROLLUP_INTERVAL', '60')),
+            cache_ttl=float(os.environ.get('STATS_CACHE_TTL', '30'))
+        )
+    except ValueError:
+        logger.warning("Invalid STATS_ROLLUP_INTERVAL / STATS_CACHE_TTL, using defaults")
+        return StatisticsRollups()
+
+
+# Global statistics rollups
+statistics_rollups = _create_rollups()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Тест агрегатов аналитики по временным корзинам и скетчей задержек
+"""
+
+import random
+import sys
+import time
+sys.path.append('.')
+
+from analytics_rollups import AnalyticsRollups, LatencySketch
+
+
+def test_latency_sketch():
+    """Перцентили в пределах относительной ошибки, слияние = сумма скетчей"""
+    print("=" * 70)
+    print("ТЕСТ СКЕТЧА ЗАДЕРЖЕК")
+    print("=" * 70)
+
+    rng = random.Random(7)
+    samples = [rng.lognormvariate(0, 1) for _ in range(20000)]
+    left, right = LatencySketch(), LatencySketch()
+    for i, value in enumerate(samples):
+        (left if i % 2 else right).add(value)
+    left.merge(right)
+    assert left.count == len(samples)
+
+    ordered = sorted(samples)
+    for q in (0.5, 0.95, 0.99):
+        exact = ordered[int(q * (len(ordered) - 1))]
+        estimate = left.quantile(q)
+        assert abs(estimate - exact) / exact < 0.03, f"q={q}: {estimate} vs {exact}"
+        print(f"q={q}: точно {exact:.3f}, скетч {estimate:.3f}")
+
+    restored = LatencySketch.from_dict(left.to_dict())
+    assert restored.percentiles() == left.percentiles()
+    assert len(left.bins) < 1000, "Память скетча ограничена числом корзин"
+
+
+def test_rollup_windows():
+    """Минутные и часовые корзины, окна запросов, кольцо не растет"""
+    rollups = AnalyticsRollups(minute_retention=60, hour_retention=48)
+    now = time.time()
+
+    def interaction(ts, agent, language='ru', response_time=1.0):
+        return {'timestamp': ts, 'agent_type': agent, 'language': language, 'confidence': 0.8,
+                'response_time': response_time, 'cached': False, 'context_used': True,
+                'context_confidence': 0.5, 'user_rating': None}
+
+    for minute in range(120):
+        rollups.add(interaction(now - minute * 60, 'uniroom', 'ru', 0.5 + minute / 100))
+        rollups.add(interaction(now - minute * 60, 'ai_abitur', 'kz'))
+    rollups.add(interaction(now - 100 * 3600, 'uniroom'))  # старше кольца: игнорируется
+
+    merged, _ = rollups.aggregate(now - 30 * 60, now)
+    last_half_hour = sum(b.interactions for b in merged.values())
+    assert 60 <= last_half_hour <= 62, last_half_hour
+    merged, _ = rollups.aggregate(now - 30 * 60, now, agent_type='uniroom')
+    assert set(merged) == {('uniroom', 'ru')}
+
+    merged, _ = rollups.aggregate(now - 24 * 3600, now)
+    assert sum(b.interactions for b in merged.values()) == 240
+    assert len(rollups.minutes._slots) == 60 and len(rollups.hours._slots) == 48
+    print(f"За 30 минут: {last_half_hour}, за сутки: 240, агенты: {rollups.agent_types()}")
+
+
+def test_engine_metrics():
+    """AnalyticsEngine отвечает из агрегатов, включая p50/p95/p99 и разбивку по агентам"""
+    from analytics_engine import AnalyticsEngine
+
+    engine = AnalyticsEngine()
+    for i in range(500):
+        engine._record_interaction({
+            'agent_type': 'uniroom' if i % 5 else 'career_navigator',
+            'agent_name': 'UniRoom', 'confidence': 0.9, 'response_time': 0.1 + (i % 100) / 100,
+            'cached': i % 4 == 0, 'context_used': True, 'context_confidence': 0.7,
+            'language': 'ru' if i % 3 else 'kz', 'user_rating': 5 if i % 10 == 0 else None
+        })
+    engine.track_error({'error_type': 'timeout', 'agent_type': 'uniroom'})
+
+    metrics = engine.get_performance_metrics(time_window_hours=24)
+    performance = metrics['performance']
+    assert metrics['total_interactions'] == 500
+    assert metrics['distributions']['agents'] == {'uniroom': 400, 'career_navigator': 100}
+    assert performance['cache_hit_rate'] == 0.25 and performance['error_rate'] == 0.002
+    assert performance['p50_response_time'] <= performance['p95_response_time'] <= performance['p99_response_time']
+    assert abs(performance['p95_response_time'] - 1.04) < 0.05
+    assert metrics['user_satisfaction']['rating_count'] == 50
+
+    by_agent = engine.get_metrics_by_agent(time_window_hours=24)
+    assert by_agent['uniroom']['total_interactions'] == engine.get_performance_metrics('uniroom')['total_interactions']
+    assert engine.get_performance_metrics('nobody') == {'error': 'No data available for the specified criteria'}
+
+    learning = engine.analyze_learning_progress('uniroom')
+    assert learning['total_interactions'] == 400 and '7d' in learning['trends']
+    report = engine.generate_insights_report()
+    assert set(report['agent_insights']) == {'uniroom', 'career_navigator'}
+    assert len(engine.agent_performance['uniroom']) <= engine.SAMPLES_PER_KEY
+    print(f"Метрики: {performance}")
+
+
+if __name__ == "__main__":
+    test_latency_sketch()
+    test_rollup_windows()
+    test_engine_metrics()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Тест общего контекста приложения для агентов
+"""
+
+import sys
+sys.path.append('.')
+
+import app as app_module
+from app_context import app_context, get_app
+
+
+def test_shared_app_context():
+    """Агенты не должны пересоздавать приложение на каждый запрос"""
+    from agents import UniNavAgent
+
+    print("=" * 70)
+    print("ТЕСТ ОБЩЕГО КОНТЕКСТА ПРИЛОЖЕНИЯ")
+    print("=" * 70)
+
+    assert get_app() is app_module.app
+
+    with app_context() as outer:
+        with app_context() as inner:
+            assert inner is outer
+
+    calls = []
+    original_factory = app_module.create_app
+    app_module.create_app = lambda: calls.append(1) or original_factory()
+    try:
+        agent = UniNavAgent()
+        for _ in range(3):
+            agent.get_agent_context("расписание занятий", "ru")
+    finally:
+        app_module.create_app = original_factory
+
+    print(f"create_app() вызовов: {len(calls)}")
+    assert not calls
+
+
+if __name__ == "__main__":
+    test_shared_app_context()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Тест асинхронного пути чата (asyncio + ASGI)
+"""
+
+import asyncio
+import sys
+sys.path.append('.')
+
+import httpx
+
+
+def test_route_message_async():
+    """Асинхронная маршрутизация возвращает тот же набор полей, что и синхронная"""
+    print("=" * 70)
+    print("ТЕСТ АСИНХРОННОГО ЧАТА")
+    print("=" * 70)
+
+    from agents import AgentRouter
+
+    router = AgentRouter()
+
+    async def many():
+        return await asyncio.gather(*(
+            router.route_message_async(f"Какие документы нужны для поступления? {i}", 'ru', f"async_{i}")
+            for i in range(5)
+        ))
+
+    results = asyncio.run(many())
+    for result in results:
+        assert result['response'] and result['agent_name']
+        assert 'confidence' in result and 'agent_type' in result
+    print(f"Агенты: {[r['agent_name'] for r in results]}")
+
+
+def test_asgi_application():
+    """Чат обслуживается асинхронно, остальные маршруты уходят во Flask"""
+    from asgi import application
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            response = await client.post('/api/chat', json={'message': "Где находится общежитие?",
+                                                            'language': 'ru'})
+            assert response.status_code == 200
+            data = response.json()
+            assert data['success'] and data['message_id'] and data['detected_language'] == 'ru'
+            assert 'session' in response.cookies
+
+            assert (await client.post('/api/chat', json={})).status_code == 400
+            assert (await client.get('/health')).status_code == 200
+            return data
+
+    data = asyncio.run(scenario())
+    print(f"Ответ через ASGI: {data['agent_name']}, {data['response_time']:.2f}s")
+
+
+if __name__ == "__main__":
+    test_route_message_async()
+    test_asgi_application()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Тест пула фоновых задач: параллельность, приоритеты, ограниченная очередь
+и истечение невостребованных результатов
+"""
+
+import sys
+import threading
+import time
+sys.path.append('.')
+
+from distributed_system import AsyncTaskProcessor, PerformanceOptimizer, TaskQueueFullError, TaskShedError
+from response_cache import ResponseCache, TieredResponseCache
+
+
+def test_parallel_execution_and_blocking_wait():
+    """Задачи выполняются всеми воркерами, ожидание результата без опроса"""
+    print("=" * 70)
+    print("ТЕСТ ПУЛА ФОНОВЫХ ЗАДАЧ")
+    print("=" * 70)
+
+    processor = AsyncTaskProcessor(max_workers=4)
+    start = time.time()
+    task_ids = [processor.submit_task(time.sleep, 0.2) for _ in range(4)]
+    for task_id in task_ids:
+        processor.get_result(task_id, timeout=2)
+    elapsed = time.time() - start
+    print(f"4 задачи по 0.2с: {elapsed:.2f}с")
+    assert elapsed < 0.5
+
+    failing = processor.submit_task(lambda: 1 / 0)
+    try:
+        processor.get_result(failing, timeout=2)
+        assert False, "ошибка задачи должна пробрасываться"
+    except Exception as e:
+        assert "Task failed" in str(e)
+
+    slow = processor.submit_task(time.sleep, 0.3)
+    assert processor.get_result(slow, timeout=0.05) is None and processor.get_task_status(slow) == 'running'
+    assert processor.get_result(slow, timeout=1) is None and processor.get_task_status(slow) == 'unknown'
+    processor.shutdown()
+
+
+def test_priorities_and_overflow_policies():
+    """Важные задачи идут первыми; переполнение отклоняет или вытесняет менее важные"""
+    gate = threading.Event()
+    order = []
+    processor = AsyncTaskProcessor(max_workers=1, max_queue_size=3, overflow_policy='shed')
+    processor.submit_task(gate.wait)
+    time.sleep(0.05)  # единственный воркер занят
+
+    low = processor.submit_task(order.append, 'low', priority=AsyncTaskProcessor.PRIORITY_LOW)
+    normal = processor.submit_task(order.append, 'normal')
+    processor.submit_task(order.append, 'high-1', priority=AsyncTaskProcessor.PRIORITY_HIGH)
+    high = processor.submit_task(order.append, 'high-2', priority=AsyncTaskProcessor.PRIORITY_HIGH)  # вытесняет low
+    try:
+        processor.submit_task(order.append, 'low-2', priority=AsyncTaskProcessor.PRIORITY_LOW)
+        assert False, "менее важная задача не должна попасть в полную очередь"
+    except TaskQueueFullError:
+        pass
+
+    gate.set()
+    processor.get_result(high, timeout=2)
+    processor.get_result(normal, timeout=2)
+    print(f"Порядок: {order}")
+    assert order == ['high-1', 'high-2', 'normal']
+    try:
+        processor.get_result(low, timeout=1)
+        assert False
+    except TaskShedError:
+        pass
+
+    stats = processor.get_stats()
+    assert stats['statistics']['tasks_shed'] == 1 and stats['statistics']['tasks_rejected'] == 1
+    assert stats['latency']['queue_wait']['max'] > 0
+    processor.shutdown()
+
+
+def test_results_expire_and_metrics_feed_analysis():
+    """Невостребованные результаты удаляются по TTL; метрики очереди видны в анализе"""
+    processor = AsyncTaskProcessor(max_workers=2, result_ttl=0.1)
+    task_ids = [processor.submit_task(sum, [1, 2]) for _ in range(5)]
+    time.sleep(0.3)
+    stats = processor.get_stats()
+    assert stats['pending_results'] == 0 and stats['statistics']['results_expired'] == 5
+    assert processor.get_result(task_ids[0], timeout=0.1) is None
+
+    optimizer = PerformanceOptimizer(TieredResponseCache(ResponseCache()), processor)
+    optimizer.thresholds['slow_queue_wait'] = -1
+    analysis = optimizer.analyze_performance()
+    print(f"Анализ: {analysis['processing_performance']}")
+    assert 'queue_wait_p95' in analysis['processing_performance']
+    assert any('wait' in r for r in analysis['recommendations'])
+    processor.shutdown()
+
+
+if __name__ == "__main__":
+    test_parallel_execution_and_blocking_wait()
+    test_priorities_and_overflow_policies()
+    test_results_expire_and_metrics_feed_analysis()
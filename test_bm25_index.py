@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Тест инвертированного индекса BM25 и поиска по базе знаний
+"""
+
+import math
+import random
+import sys
+import uuid
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+sys.path.append('.')
+
+from bm25_index import BM25Index
+from knowledge_search import KnowledgeSearchEngine
+
+
+def _brute_force(docs, query, k1=1.5, b=0.75):
+    """Полный перебор BM25 по всем документам"""
+    avg_length = sum(len(t) for t in docs.values()) / len(docs)
+    df = Counter(term for tokens in docs.values() for term in set(tokens))
+    scores = {}
+    for doc_id, tokens in docs.items():
+        counts = Counter(tokens)
+        score = 0.0
+        for term, query_tf in Counter(query).items():
+            tf = counts.get(term, 0)
+            if tf:
+                idf = math.log(1 + (len(docs) - df[term] + 0.5) / (df[term] + 0.5))
+                score += query_tf * idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(tokens) / avg_length))
+        if score:
+            scores[doc_id] = score
+    return scores
+
+
+def test_pruned_top_k_matches_brute_force():
+    """Top-k с отсечением MaxScore совпадает с полным перебором"""
+    print("=" * 70)
+    print("ТЕСТ ИНДЕКСА BM25")
+    print("=" * 70)
+
+    random.seed(7)
+    vocabulary = [f"слово{i}" for i in range(300)]
+    weights = [1.0 / (i + 1) for i in range(len(vocabulary))]
+    docs = {i: random.choices(vocabulary, weights, k=random.randint(5, 40)) for i in range(500)}
+
+    index = BM25Index()
+    for doc_id, tokens in docs.items():
+        index.add_document(doc_id, tokens)
+
+    # Инкрементальное обновление: удаление и замена документов
+    for doc_id in range(0, 500, 7):
+        index.remove_document(doc_id)
+        del docs[doc_id]
+    for doc_id in range(1, 500, 11):
+        if doc_id in docs:
+            docs[doc_id] = random.choices(vocabulary, weights, k=12)
+            index.add_document(doc_id, docs[doc_id])
+    assert len(index) == len(docs)
+
+    for _ in range(100):
+        query = random.choices(vocabulary, weights, k=random.randint(1, 5))
+        expected = _brute_force(docs, query)
+        actual = index.search(query, top_k=10)
+        top_expected = sorted(expected.values(), reverse=True)[:10]
+        assert len(actual) == len(top_expected)
+        for (doc_id, score), reference in zip(actual, top_expected):
+            assert abs(score - reference) < 1e-9
+            assert abs(expected[doc_id] - score) < 1e-9
+
+    print(f"Статистика индекса: {index.get_stats()}")
+
+
+def test_search_knowledge_base_incremental():
+    """Поиск по записям агента переиндексирует только измененные записи"""
+    engine = KnowledgeSearchEngine()
+
+    def entry(entry_id, title, content, keywords='', updated_at=datetime(2025, 1, 1)):
+        return SimpleNamespace(id=entry_id, title=title, content_ru=content, content_kz=content,
+                               keywords=keywords, priority=1, updated_at=updated_at)
+
+    entries = [
+        entry(1, "Поступление", "Документы для поступления: аттестат и справки", "аттестат, документы"),
+        entry(2, "Общежитие", "Заселение в общежитие и оплата проживания", "общежитие"),
+        entry(3, "Стипендия", "Стипендия назначается по итогам сессии", "стипендия"),
+    ]
+
+    results = engine.search_knowledge_base("какие документы нужны", entries, 'ru', index_key='agent')
+    print(f"Результаты: {[(r['title'], round(r['score'], 3)) for r in results]}")
+    assert results[0]['entry'].id == 1
+    assert engine.stats['documents_indexed'] == 3
+
+    # Тот же список не переиндексируется, измененная запись — да
+    engine.search_knowledge_base("стипендия", entries, 'ru', index_key='agent')
+    assert engine.stats['documents_indexed'] == 3
+    entries = [entries[0], entries[1], entry(3, "Стипендия", "Повышенная стипендия отличникам",
+                                                "стипендия", updated_at=datetime(2025, 2, 1))]
+    results = engine.search_knowledge_base("повышенная стипендия", entries[:2] + entries[2:], 'ru', index_key='agent')
+    assert results[0]['entry'].id == 3
+    assert engine.stats['documents_indexed'] == 4
+
+    engine.search_knowledge_base("общежитие", entries[1:], 'ru', index_key='agent')
+    assert engine.stats['documents_removed'] == 1 and 1 not in engine.indexes['agent']
+
+
+def test_chunk_index_sync():
+    """Индекс фрагментов синхронизируется с базой после смены версии"""
+    from app import app, db
+    from models import KnowledgeBase
+    from knowledge_snapshot import knowledge_snapshot
+
+    marker = f"маркер{uuid.uuid4().hex[:8]}"
+    with app.app_context():
+        chunk = KnowledgeBase(source_type='document', source_id=1,
+                              content_chunk=f"Правила приема {marker} в магистратуру")
+        db.session.add(chunk)
+        db.session.commit()
+        chunk_id = chunk.id
+    knowledge_snapshot.bump_version('test')
+
+    engine = KnowledgeSearchEngine()
+    results = engine.search_chunks(f"{marker} магистратура", 'ru')
+    assert results and results[0]['id'] == chunk_id
+
+    # Часть слова индекс не находит: срабатывает прежний поиск по подстроке
+    from utils import get_knowledge_base_context
+    assert not engine.search_chunks(marker[:-2], 'ru')
+    with app.app_context():
+        context = get_knowledge_base_context(marker[:-2], 'ru')
+    assert any(marker in part for part in context), context
+
+    with app.app_context():
+        db.session.delete(db.session.get(KnowledgeBase, chunk_id))
+        db.session.commit()
+    knowledge_snapshot.bump_version('test cleanup')
+    assert not engine.search_chunks(marker, 'ru')
+
+
+if __name__ == "__main__":
+    test_pruned_top_k_matches_brute_force()
+    test_search_knowledge_base_incremental()
+    test_chunk_index_sync()
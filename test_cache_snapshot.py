@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Тест снимков кэшей: перезапущенный воркер стартует с теплым кэшем
+"""
+
+import sys
+import tempfile
+import time
+sys.path.append('.')
+
+from cache_snapshot import CacheSnapshotStore
+from response_cache import ResponseCache, TieredResponseCache
+from semantic_cache import SemanticCacheIndex
+
+ANSWER = {'response': "Для поступления нужны аттестат, удостоверение личности и медицинская справка.",
+          'confidence': 0.9}
+
+
+def _worker(store_dir, version='v1'):
+    """Кэш одного воркера и реестр снимков с его источником"""
+    cache = TieredResponseCache(ResponseCache(default_ttl=60), semantic=SemanticCacheIndex())
+    store = CacheSnapshotStore(directory=store_dir, interval=0)
+    store.register('responses', cache.export_snapshot, cache.import_snapshot,
+                   merge=cache.merge_snapshots, version=lambda: version)
+    return cache, store
+
+
+def test_snapshot_round_trip():
+    """TTL сохраняется, снимки воркеров объединяются, другая версия не загружается"""
+    print("=" * 70)
+    print("ТЕСТ СНИМКОВ КЭША")
+    print("=" * 70)
+
+    store_dir = tempfile.mkdtemp()
+    worker_a, store_a = _worker(store_dir)
+    worker_b, store_b = _worker(store_dir)
+    worker_a.set("Какие документы нужны для поступления?", 'ai_abitur', ANSWER, 'ru', ttl=30)
+    worker_a.set("Истекающий вопрос про общежитие", 'uniroom', ANSWER, 'ru', ttl=0.2)
+    worker_b.set("Где находится общежитие?", 'uniroom', ANSWER, 'ru')
+    assert store_a.save() == {'responses': 2}
+    assert store_b.save() == {'responses': 3}
+
+    time.sleep(0.3)
+    recycled, store = _worker(store_dir)
+    restored = store.restore()
+    print(f"Восстановлено: {restored}")
+    assert restored == {'responses': 2}
+    assert recycled.get("Какие документы нужны для поступления?", 'ai_abitur', 'ru') == ANSWER
+    assert recycled.get("где находится общежитие", 'uniroom', 'ru') == ANSWER  # вопрос восстановлен и в индексе
+    entry = recycled.l1.cache[next(iter(recycled.l1.cache))]
+    assert entry['expires_at'] - time.time() < 30  # TTL не начинается заново
+
+    other_version, store = _worker(store_dir, version='v2')
+    assert store.restore() == {}
+    assert store.get_stats()['entries_restored'] == 0
+
+
+def test_similarity_cache_registered():
+    """Кэш семантического сходства тоже попадает в снимок"""
+    import semantic_search
+    from cache_snapshot import cache_snapshots
+
+    assert {'responses', 'semantic_similarity'} <= set(cache_snapshots.sources)
+    semantic_search.semantic_search_engine.calculate_semantic_similarity("общежитие", "проживание студентов")
+    data = semantic_search._dump_similarity_cache()
+    assert data and semantic_search._load_similarity_cache(data) == len(data)
+
+
+if __name__ == "__main__":
+    test_snapshot_round_trip()
+    test_similarity_cache_registered()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Тест потоковой выдачи ответа чата через SSE
+"""
+
+import json
+import sys
+sys.path.append('.')
+
+from mistral_client import MistralClient
+
+
+class _FakeStreamResponse:
+    def __init__(self, lines):
+        self.lines = lines
+        self.encoding = None
+
+    def iter_lines(self, decode_unicode=False):
+        for line in self.lines:
+            yield line.decode(self.encoding) if decode_unicode else line
+
+
+def test_iter_stream_deltas():
+    """Разбор тела SSE от OpenRouter: комментарии, пустые дельты и [DONE]"""
+    print("=" * 70)
+    print("ТЕСТ ПОТОКОВОГО ОТВЕТА")
+    print("=" * 70)
+
+    def chunk(content):
+        return ("data: " + json.dumps({'choices': [{'delta': {'content': content}}]})).encode('utf-8')
+
+    response = _FakeStreamResponse([
+        b": OPENROUTER PROCESSING",
+        b"",
+        chunk("Документы "),
+        b"data: " + json.dumps({'choices': [{'delta': {'role': 'assistant'}}]}).encode('utf-8'),
+        chunk("для поступления"),
+        b"data: [DONE]",
+        chunk("после конца"),
+    ])
+    deltas = list(MistralClient._iter_stream_deltas(response))
+    print(f"Дельты: {deltas}")
+    assert deltas == ["Документы ", "для поступления"]
+
+
+def _parse_sse(body):
+    events = []
+    for frame in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in frame.split("\n"))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+def test_chat_stream_endpoint():
+    """Эндпоинт отдает дельты и итоговое событие с теми же полями, что /api/chat"""
+    from app import app
+
+    client = app.test_client()
+    response = client.post('/api/chat/stream', json={'message': "Какие документы нужны для поступления?",
+                                                      'language': 'ru'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+
+    events = _parse_sse(response.get_data(as_text=True))
+    kinds = [kind for kind, _ in events]
+    print(f"События: {kinds}")
+    assert kinds[-1] == 'done'
+
+    done = events[-1][1]
+    assert done['success'] and done['message_id'] and done['agent_name']
+    streamed = ''.join(data['text'] for kind, data in events if kind == 'delta')
+    if streamed:
+        assert done['response'].startswith(streamed.strip()[:20])
+
+    assert client.post('/api/chat/stream', json={'message': "  "}).status_code == 400
+
+
+if __name__ == "__main__":
+    test_iter_stream_deltas()
+    test_chat_stream_endpoint()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Тест миграции индексов (db_migrations.apply_indexes)
+"""
+
+import os
+import sys
+import tempfile
+sys.path.append('.')
+
+from sqlalchemy import create_engine, inspect
+
+from db_migrations import (apply_columns, apply_columns_locked, apply_indexes, declared_indexes, invalid_indexes,
+                           missing_indexes)
+from models import db
+
+
+def test_apply_indexes_on_existing_database():
+    """Индексы, объявленные после создания таблиц, добавляются; повторный запуск ничего не делает"""
+    print("=" * 70)
+    print("ТЕСТ МИГРАЦИИ ИНДЕКСОВ")
+    print("=" * 70)
+
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'old.db')}")
+    db.metadata.create_all(engine)
+    # База, созданная до появления индексов
+    with engine.begin() as connection:
+        for name in ('ix_user_queries_session_created', 'ix_user_queries_created_at', 'ix_schedules_group_start'):
+            connection.exec_driver_sql(f"DROP INDEX {name}")
+        connection.exec_driver_sql("DROP TABLE rollup_state")  # отсутствующие таблицы пропускаются
+        connection.exec_driver_sql("DROP INDEX ix_user_queries_message_id")
+        connection.exec_driver_sql("ALTER TABLE user_queries DROP COLUMN message_id")
+
+    # Новая колонка добавляется до индексов по ней
+    lock_file = os.path.join(tempfile.mkdtemp(), 'migrations.lock')
+    assert apply_columns_locked(engine, db.metadata, lock_file) == [{'column': 'message_id', 'table': 'user_queries'}]
+    assert apply_columns(engine, db.metadata) == []
+
+    assert {index.name for index in missing_indexes(engine, db.metadata)} == {
+        'ix_user_queries_session_created', 'ix_user_queries_created_at', 'ix_schedules_group_start',
+        'ix_user_queries_message_id'}
+    created = apply_indexes(engine, db.metadata)
+    print(f"Созданы: {[item['index'] for item in created]}")
+    assert len(created) == 4
+    assert 'ix_user_queries_session_created' in {i['name'] for i in inspect(engine).get_indexes('user_queries')}
+    assert apply_indexes(engine, db.metadata) == []
+    assert invalid_indexes(engine) == set()  # только PostgreSQL оставляет INVALID индексы
+
+    declared = {index.name for index in declared_indexes(db.metadata)}
+    assert {'ix_user_queries_agent_name_rating', 'ix_agent_knowledge_active_agent_priority'} <= declared
+
+
+if __name__ == "__main__":
+    test_apply_indexes_on_existing_database()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Тест общего автомата Ахо-Корасик для ключевых слов
+"""
+
+import random
+import sys
+sys.path.append('.')
+
+from keyword_matcher import AhoCorasickAutomaton, KeywordMatcher
+
+
+def test_automaton_matches_substring_search():
+    """Автомат находит те же вхождения, что и поиск подстрок"""
+    print("=" * 70)
+    print("ТЕСТ АВТОМАТА АХО-КОРАСИК")
+    print("=" * 70)
+
+    random.seed(42)
+    alphabet = "аборт "
+    phrases = list({''.join(random.choices(alphabet, k=random.randint(1, 4))) for _ in range(60)})
+    automaton = AhoCorasickAutomaton(phrases)
+
+    for _ in range(200):
+        text = ''.join(random.choices(alphabet, k=random.randint(0, 40)))
+        expected = sorted(
+            (i, i + len(p), p) for p in phrases
+            for i in range(len(text) - len(p) + 1) if text.startswith(p, i)
+        )
+        actual = sorted((s, e, automaton.phrases[pid]) for s, e, pid in automaton.iter_matches(text))
+        assert actual == expected
+
+
+def test_matcher_groups():
+    """Группы, повторы в списках, целые слова и кеш результата"""
+    matcher = KeywordMatcher()
+    matcher.register('career', ["работ", "вакансии", "работ"])
+    matcher.register('schedule', ["расписание", "расписание занятий"])
+    matcher.register('words', ["job", "работа"])
+
+    scan = matcher.scan("Где найти РАБОТУ и расписание занятий? job-fair")
+    print(f"Совпадения: {scan.hits}")
+
+    assert scan.count('career') == 2  # "работ" дважды в списке, как в исходном sum()
+    assert scan.has('schedule') and scan.matched('schedule') == ["расписание", "расписание занятий"]
+    assert scan.words('words') == {"job"}  # "работа" не встречается как целое слово
+    assert scan.offsets('career') == [(10, 15, "работ")]
+
+    assert matcher.scan("где найти работу и расписание занятий? job-fair") is scan
+    matcher.register('housing', ["общежитие"])
+    assert not matcher.scan("общежитие").has('career')
+    assert matcher.get_stats()['compilations'] == 2
+
+
+if __name__ == "__main__":
+    test_automaton_matches_substring_search()
+    test_matcher_groups()
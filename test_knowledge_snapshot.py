@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Тест снимка базы знаний агентов в памяти процесса
+"""
+
+import os
+import sys
+import tempfile
+import uuid
+sys.path.append('.')
+
+from app import app, db
+from models import AdminUser, AgentKnowledgeBase
+from knowledge_snapshot import KnowledgeSnapshot
+
+
+def _seed_entry(agent_type, title, priority=1):
+    with app.app_context():
+        admin = AdminUser(username=f"snap_{uuid.uuid4().hex[:8]}", email=f"{uuid.uuid4().hex[:8]}@example.com")
+        admin.set_password("test")
+        db.session.add(admin)
+        db.session.flush()
+        entry = AgentKnowledgeBase(
+            agent_type=agent_type, title=title, priority=priority,
+            content_ru=f"{title} содержание", content_kz=f"{title} мазмұны",
+            created_by=admin.id
+        )
+        db.session.add(entry)
+        db.session.commit()
+        return entry.id
+
+
+def test_snapshot_versioning():
+    """Снимок перестраивается только после смены версии"""
+    print("=" * 70)
+    print("ТЕСТ СНИМКА БАЗЫ ЗНАНИЙ")
+    print("=" * 70)
+
+    agent_type = f"test_agent_{uuid.uuid4().hex[:6]}"
+    version_file = os.path.join(tempfile.mkdtemp(), 'knowledge.version')
+
+    worker_a = KnowledgeSnapshot(version_file=version_file, check_interval=0)
+    worker_b = KnowledgeSnapshot(version_file=version_file, check_interval=0)
+
+    _seed_entry(agent_type, "Вторая", priority=2)
+    _seed_entry(agent_type, "Первая", priority=1)
+
+    entries = worker_a.get_entries(agent_type, 'ru')
+    assert [e.title for e in entries] == ["Первая", "Вторая"]
+    worker_b.get_entries(agent_type, 'kz')
+
+    # Повторные запросы не обращаются к базе
+    for _ in range(5):
+        worker_a.get_entries(agent_type, 'ru')
+    assert worker_a.stats['rebuilds'] == 1
+
+    # Изменение в одном воркере видно в другом
+    new_id = _seed_entry(agent_type, "Третья", priority=3)
+    worker_a.bump_version('test')
+    titles_b = [e.title for e in worker_b.get_entries(agent_type, 'ru')]
+    print(f"Воркер B после смены версии: {titles_b}")
+    assert "Третья" in titles_b
+    assert worker_b.stats['rebuilds'] == 2
+
+    with app.app_context():
+        db.session.delete(db.session.get(AgentKnowledgeBase, new_id))
+        db.session.commit()
+    worker_b.bump_version('cleanup')
+    assert "Третья" not in [e.title for e in worker_a.get_entries(agent_type, 'ru')]
+
+
+if __name__ == "__main__":
+    test_snapshot_versioning()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Тест клиента OpenRouter против локального stub-сервера: пул соединений,
+повторы на 429/5xx и circuit breaker по моделям
+"""
+
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append('.')
+
+import requests
+
+import mistral_client as mc
+from mistral_client import MistralClient, ModelCircuitBreaker
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        server.calls.append((body['model'], self.client_address[1]))
+        script = server.script.get(body['model'], [])
+        status = script.pop(0) if script else 404
+        payload = {'choices': [{'message': {'content': f" ответ {body['model']}"}}]} if status == 200 else {'error': status}
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_stub(script):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.script = script
+    server.calls = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _client(server, breaker):
+    client = MistralClient(base_url=f"http://127.0.0.1:{server.server_port}",
+                           session=requests.Session(), circuit_breaker=breaker)
+    client.api_key = 'test-key'
+    client.BACKOFF_BASE = 0.01
+    return client
+
+
+def test_retries_and_keep_alive():
+    """429 и 503 повторяются, соединение переиспользуется"""
+    print("=" * 70)
+    print("ТЕСТ КЛИЕНТА OPENROUTER")
+    print("=" * 70)
+
+    model = MistralClient().model
+    server = _start_stub({model: [429, 503, 200, 200]})
+    try:
+        client = _client(server, ModelCircuitBreaker())
+        assert client.get_response("вопрос") == f"ответ {model}"
+        assert client.get_response("вопрос") == f"ответ {model}"
+        print(f"Вызовы: {server.calls}")
+        assert [m for m, _ in server.calls] == [model] * 4
+        assert len({port for _, port in server.calls}) == 1  # один keep-alive сокет
+    finally:
+        server.shutdown()
+
+
+def test_circuit_breaker_skips_failing_models():
+    """404 и повторяющиеся 5xx открывают circuit, модель больше не запрашивается"""
+    client_model, backup, last = MistralClient().free_models[:3]
+    server = _start_stub({client_model: [404], backup: [500, 500, 500], last: [200, 200]})
+    breaker = ModelCircuitBreaker(failure_threshold=3, cooldown=60)
+    try:
+        client = _client(server, breaker)
+        client.model = client_model
+        assert client.get_response("вопрос") == f"ответ {last}"
+        assert client.model == last
+        assert breaker.is_open(client_model) and breaker.is_open(backup)
+        calls = len(server.calls)
+
+        # Следующий запрос сразу идет в рабочую модель
+        client.model = client_model
+        assert client.get_response("вопрос") == f"ответ {last}"
+        assert [m for m, _ in server.calls[calls:]] == [last]
+        print(f"Состояние: {breaker.get_stats()}")
+    finally:
+        server.shutdown()
+
+
+def test_half_open_and_deadline():
+    """После cooldown пропускается один пробный запрос; общий дедлайн ограничивает время"""
+    breaker = ModelCircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure('m')
+    assert not breaker.allow('m')
+    time.sleep(0.06)
+    assert breaker.allow('m') and not breaker.allow('m')
+    breaker.record_success('m')
+    assert breaker.allow('m')
+
+    model = MistralClient().free_models[-1]
+    server = _start_stub({model: [503] * 10})
+    deadline = mc.REQUEST_DEADLINE
+    mc.REQUEST_DEADLINE = 0.3
+    try:
+        client = _client(server, ModelCircuitBreaker(failure_threshold=10))
+        client.model = model
+        client.MAX_RETRIES = 10
+        client.BACKOFF_BASE = 0.1
+        start = time.monotonic()
+        assert "недоступен" in client.get_response("вопрос")
+        assert time.monotonic() - start < 1.0
+    finally:
+        mc.REQUEST_DEADLINE = deadline
+        server.shutdown()
+
+
+def test_half_open_slot_released_on_any_error():
+    """Ошибка не из числа сетевых (ChunkedEncodingError) не занимает пробный слот навсегда"""
+    class _BrokenSession(requests.Session):
+        def post(self, *args, **kwargs):
+            raise requests.exceptions.ChunkedEncodingError("обрыв ответа")
+
+    assert mc.REQUEST_DEADLINE < 30  # меньше timeout воркера gunicorn
+
+    model = MistralClient().free_models[-1]
+    breaker = ModelCircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure(model)
+    time.sleep(0.06)
+    client = MistralClient(session=_BrokenSession(), circuit_breaker=breaker)
+    client.api_key = 'test-key'
+    client.model = model
+    assert "недоступен" in client.get_response("вопрос")
+    assert breaker.is_open(model)  # пробный запрос не удался - circuit снова открыт
+    time.sleep(0.06)
+    assert breaker.allow(model), "Модель заблокирована навсегда"
+
+
+if __name__ == "__main__":
+    test_retries_and_keep_alive()
+    test_circuit_breaker_skips_failing_models()
+    test_half_open_and_deadline()
+    test_half_open_slot_released_on_any_error()
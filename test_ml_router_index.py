@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Тест инвертированного индекса паттернов ML Router и ограничения их числа
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+sys.path.append('.')
+
+from ml_router import MLRouter
+
+WORDS = ['общежитие', 'заселение', 'работа', 'вакансии', 'резюме', 'расписание', 'экзамен', 'поступление',
+         'документы', 'зарплата', 'отпуск', 'стипендия', 'библиотека', 'столовая', 'практика', 'диплом',
+         'магистратура', 'грант', 'кафедра', 'деканат']
+AGENTS = ['uniroom', 'career_navigator', 'uninav', 'ai_abitur', 'kadrai']
+
+
+def _router(max_patterns=100000):
+    return MLRouter(db_path=os.path.join(tempfile.mkdtemp(), 'router.db'), max_patterns=max_patterns)
+
+
+def _brute_force_scores(router, message):
+    """Прежний полный перебор всех паттернов всех агентов"""
+    scores = {}
+    for agent_name, patterns in router.agent_patterns.items():
+        total, matched = 0.0, False
+        for pattern in patterns:
+            performance = router.performance_cache[f"{agent_name}:{pattern}"]
+            similarity = router._calculate_pattern_similarity(message, pattern)
+            if similarity > 0.1:
+                total += similarity * router._pattern_weight(performance)
+                matched = True
+        if matched:
+            scores[agent_name] = total / len(patterns)
+    return scores
+
+
+def test_index_matches_full_scan():
+    """Индекс дает те же оценки агентов, что и полный перебор"""
+    print("=" * 70)
+    print("ТЕСТ ИНДЕКСА ПАТТЕРНОВ ML ROUTER")
+    print("=" * 70)
+
+    router = _router()
+    rng = random.Random(3)
+    for _ in range(400):
+        message = ' '.join(rng.sample(WORDS, rng.randint(1, 5)))
+        router._update_model_async(message, rng.choice(AGENTS), rng.randint(1, 5), rng.random())
+
+    for _ in range(50):
+        message = ' '.join(rng.sample(WORDS, rng.randint(1, 4)))
+        expected = _brute_force_scores(router, message)
+        agent, confidence, explanation = router.predict_best_agent(message)
+        if explanation['method'] == 'ml_history':
+            actual = explanation['all_scores']
+        else:
+            actual = {}
+            assert not expected or max(expected.values()) < router.min_confidence_threshold
+            continue
+        assert actual.keys() == expected.keys()
+        for name in expected:
+            assert abs(actual[name] - expected[name]) < 1e-9, (message, name)
+
+    # Слово с пунктуацией находит паттерн без нее
+    agent, _, explanation = router.predict_best_agent("общежитие?")
+    assert explanation.get('method') != 'default_fallback'
+    print(f"Паттернов: {len(router.performance_cache)}, токенов в индексе: {len(router._token_index)}")
+
+
+def test_substring_only_patterns():
+    """Паттерн без общих слов, совпавший подстрокой, оценивается как при полном переборе"""
+    router = _router()
+    router._update_model_async("стажировк", 'career_navigator', 5, 1.0)
+    router._update_model_async("вакансии стипендия", 'kadrai', 5, 1.0)
+    # "стажировк" внутри сообщения; сообщение "ваканс" внутри паттерна
+    for message in ("стажировка", "ваканс"):
+        expected = _brute_force_scores(router, message)
+        assert expected, message
+        _, _, explanation = router.predict_best_agent(message)
+        assert explanation['method'] == 'ml_history', (message, explanation)
+        assert explanation['all_scores'].keys() == expected.keys()
+        for name in expected:
+            assert abs(explanation['all_scores'][name] - expected[name]) < 1e-9, (message, name)
+
+
+def test_merge_and_prune():
+    """Паттерны из тех же слов сливаются; число паттернов ограничено"""
+    router = _router(max_patterns=50)
+    router._update_model_async("общежитие заселение", 'uniroom', 5, 1.0)
+    count = router.performance_cache['uniroom:общежитие заселение'].interaction_count
+    router._update_model_async("заселение, общежитие", 'uniroom', 5, 1.0)
+    keys = [key for key in router.performance_cache if key.startswith('uniroom:') and 'заселение' in key]
+    assert len(keys) == 1 and router.performance_cache[keys[0]].interaction_count == count + 1
+
+    rng = random.Random(5)
+    for i in range(300):
+        message = f"{rng.choice(WORDS)} вопрос{i} {rng.choice(WORDS)}"
+        router._update_model_async(message, rng.choice(AGENTS), 1, 0.1)
+    assert len(router.performance_cache) <= 50
+    assert router.pruned_patterns > 0
+    assert sum(len(p) for p in router.agent_patterns.values()) == len(router.performance_cache)
+    indexed = {key for keys in router._token_index.values() for key in keys}
+    assert indexed == set(router.performance_cache)
+    with sqlite3.connect(router.db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM agent_performance").fetchone()[0] <= 50
+    # Ценный паттерн (высокий рейтинг, несколько взаимодействий) пережил отсев
+    assert keys[0] in router.performance_cache
+    stats = router.get_learning_statistics()
+    assert stats['model_updates'] and sum(u['pattern_count'] for u in stats['model_updates'].values()) <= 50
+    print(f"Отброшено паттернов: {router.pruned_patterns}")
+
+
+def test_prediction_cost_with_history():
+    """Предсказание на большой истории не перебирает все паттерны"""
+    router = _router()
+    rng = random.Random(11)
+    for i in range(5000):
+        message = f"{rng.choice(WORDS)} тема{i} раздел{i % 997}"
+        router._update_model_async(message, rng.choice(AGENTS), 4, 0.8)
+
+    message = "общежитие заселение"
+    start = time.perf_counter()
+    for _ in range(20):
+        indexed = router.predict_best_agent(message)
+    indexed_ms = (time.perf_counter() - start) / 20 * 1000
+    start = time.perf_counter()
+    _brute_force_scores(router, message)
+    full_ms = (time.perf_counter() - start) * 1000
+    assert indexed[0] in AGENTS
+    print(f"Паттернов: {len(router.performance_cache)}, индекс {indexed_ms:.2f}мс, перебор {full_ms:.2f}мс")
+
+
+if __name__ == "__main__":
+    test_index_matches_full_scan()
+    test_substring_only_patterns()
+    test_merge_and_prune()
+    test_prediction_cost_with_history()
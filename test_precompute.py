@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Тест прогрева кэша популярными вопросами из user_queries
+"""
+
+import sys
+import threading
+import time
+import uuid
+sys.path.append('.')
+
+
+class FakeLLM:
+    calls = 0
+
+    def get_response_with_system_prompt(self, message, context, language, system_prompt):
+        FakeLLM.calls += 1
+        return ("Заселение в общежитие проходит после зачисления: подайте заявление коменданту "
+                "и оплатите проживание за семестр.")
+
+
+def test_precompute_popular_queries():
+    """Частые вопросы группируются по канонической форме, ответы попадают в кэш, живые попадания учитываются"""
+    print("=" * 70)
+    print("ТЕСТ ПРОГРЕВА ПОПУЛЯРНЫХ ВОПРОСОВ")
+    print("=" * 70)
+
+    from app import app
+    from models import UserQuery, db
+    from distributed_system import performance_optimizer
+    from views import initialize_agent_router
+
+    tag = uuid.uuid4().hex[:8]
+    popular = f"Как заселиться в общежитие университета? {tag}"
+    wordings = [popular] * 3 + [f"как заселиться в  общежитие университета {tag}",
+                                f"Как заселиться в общежитие университета! {tag}"]
+    rare = f"Где найти расписание экзаменов {tag}?"
+
+    with app.app_context():
+        for message, agent_type in [(m, 'uniroom') for m in wordings] + [(rare, 'uninav')]:
+            db.session.add(UserQuery(user_message=message, bot_response="ответ", language='ru',
+                                     agent_type=agent_type))
+        db.session.commit()
+
+        mined = [q for q in performance_optimizer.mine_popular_queries(min_count=3) if tag in q['message']]
+        print(f"Популярные: {mined}")
+        assert mined == [{'message': popular, 'agent_type': 'uniroom', 'language': 'ru', 'count': 5}]
+
+        router = initialize_agent_router()
+        agent = next(a for a in router.agents if a.agent_type == 'uniroom')
+        original, agent.mistral = agent.mistral, FakeLLM()
+        try:
+            stats = performance_optimizer.precompute_popular_queries(mined, concurrency=2)
+            assert stats['generated'] == 1 and FakeLLM.calls == 1 and not stats['running']
+            stats = performance_optimizer.precompute_popular_queries(mined)
+            assert stats['already_cached'] == 1 and FakeLLM.calls == 1
+
+            hits = performance_optimizer.get_precompute_stats()['live_hits']
+            live = agent.process_message(f"как заселиться в общежитие университета {tag}", 'ru', 'student')
+            assert live['cached'] and FakeLLM.calls == 1
+        finally:
+            agent.mistral = original
+
+    stats = performance_optimizer.get_precompute_stats()
+    print(f"Статистика: {stats}")
+    assert stats['live_hits'] == hits + 1 and stats['llm_calls_total'] >= 1
+
+
+def test_budget_with_concurrency_and_errors():
+    """Бюджет LLM-вызовов не превышается параллельными потоками; неудачные вызовы тоже считаются"""
+    from distributed_system import performance_optimizer
+
+    calls = []
+    calls_lock = threading.Lock()
+
+    def compute(agent, message, language):
+        with calls_lock:
+            calls.append(message)
+            number = len(calls)
+        time.sleep(0.02)
+        if number % 2:
+            return {'error': True, 'response': ''}, False
+        return {'response': f"Ответ про общежитие номер {number} для прогрева кэша", 'confidence': 0.9}, False
+
+    queries = [{'message': f"Вопрос о заселении номер {i}", 'agent_type': 'uniroom', 'language': 'ru'}
+               for i in range(20)]
+    before = performance_optimizer.get_precompute_stats()['llm_calls_total']
+    performance_optimizer._compute_response = compute
+    try:
+        stats = performance_optimizer.precompute_popular_queries(queries, concurrency=8, max_llm_calls=5)
+    finally:
+        del performance_optimizer._compute_response
+    print(f"Бюджет 5: вызовов {len(calls)}, {stats['generated']} успешно, {stats['failed']} с ошибкой")
+    assert len(calls) == 5
+    assert stats['llm_calls_total'] - before == 5
+    assert stats['generated'] + stats['failed'] == 5 and stats['failed'] >= 2
+    assert stats['skipped'] == 15 and stats['done'] == 20
+
+
+def test_off_peak_hours():
+    """Окно непиковых часов, в том числе через полночь"""
+    from datetime import datetime
+    from distributed_system import performance_optimizer
+
+    config = performance_optimizer.precompute_config
+    hours = config['off_peak_hours']
+    try:
+        config['off_peak_hours'] = (22, 6)
+        assert performance_optimizer.is_off_peak(datetime(2026, 1, 1, 23))
+        assert performance_optimizer.is_off_peak(datetime(2026, 1, 1, 3))
+        assert not performance_optimizer.is_off_peak(datetime(2026, 1, 1, 12))
+    finally:
+        config['off_peak_hours'] = hours
+
+
+if __name__ == "__main__":
+    test_precompute_popular_queries()
+    test_budget_with_concurrency_and_errors()
+    test_off_peak_hours()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Тест многоуровневого кэша ответов (L1 в процессе + общий L2)
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append('.')
+
+from response_cache import ResponseCache, SQLiteCacheBackend, TieredResponseCache, make_cache_key
+
+ANSWER = {'response': "Для поступления нужны аттестат, удостоверение личности и медицинская справка.",
+          'confidence': 0.9}
+
+
+def test_get_or_compute_single_lookup():
+    """compute вызывается один раз, ключ не зависит от регистра и пробелов"""
+    print("=" * 70)
+    print("ТЕСТ КЭША ОТВЕТОВ")
+    print("=" * 70)
+
+    cache = TieredResponseCache(ResponseCache(max_size=2, default_ttl=60))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return dict(ANSWER)
+
+    first, cached = cache.get_or_compute("Какие документы нужны?", 'ai_abitur', 'ru', compute)
+    assert not cached and len(calls) == 1
+    first['routing_info'] = {'method': 'ml'}  # изменения вызывающего кода не попадают в кэш
+
+    second, cached = cache.get_or_compute("  какие   ДОКУМЕНТЫ нужны? ", 'ai_abitur', 'ru', compute)
+    assert cached and len(calls) == 1 and 'routing_info' not in second
+    assert make_cache_key("А  б", 'x', 'ru') == make_cache_key("а б", 'x', 'ru')
+
+    # Короткие и ошибочные ответы не кэшируются
+    cache.get_or_compute("Какие документы нужны?", 'uniroom', 'ru', lambda: {'response': "error", 'confidence': 1})
+    assert cache.get("Какие документы нужны?", 'uniroom', 'ru') is None
+
+    # LRU-вытеснение в L1
+    cache.set("вопрос номер два", 'ai_abitur', ANSWER)
+    cache.set("вопрос номер три", 'ai_abitur', ANSWER)
+    stats = cache.get_stats()
+    print(f"Статистика: {stats}")
+    assert stats['evictions'] == 1 and stats['l1_hits'] == 1 and stats['l2_backend'] == 'none'
+
+
+def test_expiry_wheel_and_byte_budget():
+    """Истекшие записи удаляются корзинами таймера, объем ограничен бюджетом в байтах"""
+    class FastWheel(ResponseCache):
+        EXPIRY_GRANULARITY = 0.05
+
+    cache = FastWheel(max_size=100, default_ttl=60)
+    for i in range(10):
+        cache.set(f"короткоживущий вопрос {i}", 'ai_abitur', ANSWER, ttl=0.1)
+    cache.set("долгоживущий вопрос", 'ai_abitur', ANSWER)
+    time.sleep(0.25)
+    assert cache.get("долгоживущий вопрос", 'ai_abitur') == ANSWER
+    stats = cache.get_stats()
+    assert stats['cache_size'] == 1 and stats['expirations'] == 10 and len(cache._wheel) == 1
+    assert stats['resident_bytes'] == ResponseCache.estimate_size(
+        make_cache_key("долгоживущий вопрос", 'ai_abitur', 'ru'), ANSWER)
+
+    long_answer = {**ANSWER, 'response': ANSWER['response'] * 40, 'suggestions': ["Стоимость обучения"] * 20}
+    size = ResponseCache.estimate_size(make_cache_key("вопрос 0", 'ai_abitur', 'ru'), long_answer)
+    cache = ResponseCache(max_size=100, default_ttl=60, max_bytes=size * 3)
+    for i in range(5):
+        assert cache.set(f"вопрос {i}", 'ai_abitur', long_answer)
+    assert cache.set("маленький вопрос", 'ai_abitur', ANSWER)
+    assert not cache.set("огромный вопрос", 'ai_abitur', {**long_answer, 'response': "x" * size * 4})
+    stats = cache.get_stats()
+    print(f"Бюджет: {stats}")
+    assert stats['resident_bytes'] <= stats['max_bytes'] and stats['cache_size'] == 3
+    assert stats['evictions'] == 3 and stats['rejected_oversize'] == 1
+    assert cache.get("вопрос 0", 'ai_abitur') is None and cache.get("вопрос 4", 'ai_abitur') == long_answer
+
+
+def test_l2_shared_between_workers():
+    """Ответ, сохраненный одним воркером, находится другим через L2"""
+    path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+    worker_a = TieredResponseCache(ResponseCache(default_ttl=60), SQLiteCacheBackend(path))
+    worker_b = TieredResponseCache(ResponseCache(default_ttl=60), SQLiteCacheBackend(path))
+
+    worker_a.set("Где находится общежитие?", 'uniroom', ANSWER, 'ru')
+    assert worker_b.get("где находится общежитие?", 'uniroom', 'ru') == ANSWER
+    assert worker_b.get("где находится общежитие?", 'uniroom', 'ru') == ANSWER
+    stats = worker_b.get_stats()
+    assert stats['l2_hits'] == 1 and stats['l1_hits'] == 1 and stats['l2_backend'] == 'sqlite'
+
+    worker_a.delete("Где находится общежитие?", 'uniroom', 'ru')
+    assert TieredResponseCache(ResponseCache(), SQLiteCacheBackend(path)).get(
+        "Где находится общежитие?", 'uniroom', 'ru') is None
+
+
+def test_semantic_near_duplicates():
+    """Перефразированный вопрос получает кэшированный ответ с оценкой сходства"""
+    from semantic_cache import SemanticCacheIndex, canonicalize_question
+
+    assert canonicalize_question("Как поступить в университет?") == \
+        canonicalize_question("как  поступить в университете")
+    cache = TieredResponseCache(ResponseCache(default_ttl=60), semantic=SemanticCacheIndex(threshold=0.88))
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return dict(ANSWER)
+
+    cache.get_or_compute("Как поступить в университет?", 'ai_abitur', 'ru', compute)
+    answer, cached = cache.get_or_compute("как поступить в Университет", 'ai_abitur', 'ru', compute)
+    print(f"Совпадение: {answer['cache_match']}")
+    assert cached and len(calls) == 1 and answer['cache_match']['type'] == 'semantic'
+    assert answer['cache_match']['score'] >= 0.88 and 'cache_match' not in cache.l1.get_entry(
+        make_cache_key("Как поступить в университет?", 'ai_abitur', 'ru'))
+
+    cache.set("Жатақханалар қайда орналасқан?", 'uniroom', ANSWER, 'kz')
+    assert cache.get("Жатақхана қайда орналасқан", 'uniroom', 'kz') == ANSWER
+    assert cache.get("Жатақхана қайда орналасқан", 'uniroom', 'ru') is None  # другой язык
+
+    # Другие вопросительные слова, числа и отрицание не совпадают
+    cache.set("Где проходит экзамен по математике?", 'ai_abitur', ANSWER, 'ru')
+    assert cache.get("Когда проходит экзамен по математике?", 'ai_abitur', 'ru') is None
+    cache.set("Стоимость обучения на 1 курсе", 'ai_abitur', ANSWER, 'ru')
+    assert cache.get("Стоимость обучения на 2 курсе", 'ai_abitur', 'ru') is None
+
+    # Удаленный ответ больше не находится через индекс
+    cache.delete("Как поступить в университет?", 'ai_abitur', 'ru')
+    assert cache.get("как поступить в Университет", 'ai_abitur', 'ru') is None
+
+    stats = cache.get_stats()
+    print(f"Статистика: {stats}")
+    assert stats['semantic_hits'] == 2 and stats['llm_calls_saved'] == 2
+
+
+def _slow_compute(calls, delay=0.3):
+    def compute():
+        calls.append(1)
+        time.sleep(delay)
+        return dict(ANSWER)
+    return compute
+
+
+def test_single_flight_coalescing():
+    """Одновременные одинаковые вопросы вызывают LLM один раз — в потоках, в asyncio и между воркерами"""
+    cache = TieredResponseCache(ResponseCache(default_ttl=60))
+    calls = []
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        results = list(pool.map(lambda _: cache.get_or_compute(
+            "Когда будут результаты зачисления?", 'ai_abitur', 'ru', _slow_compute(calls)), range(10)))
+    shared = [r for r, cached in results if cached]
+    print(f"Потоки: вызовов LLM {len(calls)}, ожидали {len(shared)}")
+    assert len(calls) == 1 and len(shared) == 9
+    assert all(r['cache_match']['type'] == 'coalesced' for r in shared)
+
+    async def many():
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return dict(ANSWER)
+        return await asyncio.gather(*(cache.coalesce_async("Сколько мест в общежитии?", 'uniroom', 'ru', compute)
+                                      for _ in range(20)))
+
+    calls.clear()
+    results = asyncio.run(many())
+    assert len(calls) == 1 and sum(cached for _, cached in results) == 19
+
+    # Ожидание ограничено таймаутом, затем запрос считает ответ сам
+    impatient = TieredResponseCache(ResponseCache(default_ttl=60), coalesce_timeout=0.05)
+    calls.clear()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        list(pool.map(lambda _: impatient.get_or_compute(
+            "Когда будут результаты зачисления?", 'ai_abitur', 'ru', _slow_compute(calls)), range(2)))
+    assert len(calls) == 2 and impatient.get_stats()['coalesce_fallbacks'] == 1
+
+    # Второй воркер ждет ответа первого через аренду в общем L2
+    path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+    worker_a = TieredResponseCache(ResponseCache(default_ttl=60), SQLiteCacheBackend(path))
+    worker_b = TieredResponseCache(ResponseCache(default_ttl=60), SQLiteCacheBackend(path))
+    calls.clear()
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        first = pool.submit(worker_a.get_or_compute, "Где узнать результаты зачисления?", 'ai_abitur', 'ru',
+                            _slow_compute(calls))
+        time.sleep(0.05)
+        second = pool.submit(worker_b.get_or_compute, "Где узнать результаты зачисления?", 'ai_abitur', 'ru',
+                             _slow_compute(calls))
+        (_, first_cached), (answer, second_cached) = first.result(), second.result()
+    print(f"Воркеры: вызовов LLM {len(calls)}, статистика B {worker_b.get_stats()['coalesced']}")
+    assert len(calls) == 1 and not first_cached and second_cached
+    assert answer['cache_match']['type'] == 'coalesced'
+
+
+def test_cached_answer_shared_across_users():
+    """Ключ строится по вопросу; имя пользователя добавляется поверх общего ответа"""
+    from agents import UniRoomAgent
+    from app import app
+    from response_cache import response_cache
+
+    class FakeLLM:
+        calls = 0
+
+        def get_response_with_system_prompt(self, message, context, language, system_prompt):
+            FakeLLM.calls += 1
+            return ("Заселение в общежитие проходит после зачисления: подайте заявление коменданту "
+                    "и оплатите проживание за семестр.")
+
+    agent = UniRoomAgent()
+    agent.mistral = FakeLLM()
+    question = f"Как заселиться в общежитие университета? {uuid.uuid4().hex[:6]}"
+
+    with app.app_context():
+        first = agent.process_message(question, 'ru', 'user_a', {'name': "Айгерим"})
+        second = agent.process_message(question, 'ru', 'user_b', {'name': "Данияр"})
+
+    print(f"Ответы: {first['response'][:40]!r} / {second['response'][:40]!r}")
+    assert FakeLLM.calls == 1 and second['cached']
+    assert first['response'].startswith("Айгерим, заселение") and second['response'].startswith("Данияр")
+    assert "Айгерим" not in response_cache.get(question, agent.agent_type, 'ru')['response']
+
+
+if __name__ == "__main__":
+    test_get_or_compute_single_lookup()
+    test_expiry_wheel_and_byte_budget()
+    test_l2_shared_between_workers()
+    test_semantic_near_duplicates()
+    test_single_flight_coalescing()
+    test_cached_answer_shared_across_users()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Тест сервиса расписания: диапазоны, регулярные занятия, кэш недель и пакетный эндпоинт
+"""
+
+import os
+import sys
+import tempfile
+import uuid
+from datetime import date, datetime, timedelta
+sys.path.append('.')
+
+from schedule_service import ScheduleService, expand_recurrence, parse_recurrence, week_start
+
+
+def _lesson(group_name, start, minutes=90, **kwargs):
+    from models import Schedule
+    return Schedule(schedule_type=kwargs.pop('schedule_type', 'lecture'), title=kwargs.pop('title', 'Базы данных'),
+                    group_name=group_name, start_time=start, end_time=start + timedelta(minutes=minutes),
+                    room='101', instructor='Алия Нурканова', **kwargs)
+
+
+def test_recurrence_patterns():
+    """Разбор паттернов повторения и развертка до горизонта"""
+    print("=" * 70)
+    print("ТЕСТ СЕРВИСА РАСПИСАНИЯ")
+    print("=" * 70)
+
+    assert parse_recurrence('weekly')['step_days'] == 7
+    assert parse_recurrence('FREQ=WEEKLY;INTERVAL=2;COUNT=3') == {'step_days': 14, 'until': None, 'count': 3}
+    assert parse_recurrence('FREQ=DAILY;UNTIL=20251220')['until'] == date(2025, 12, 20)
+    assert parse_recurrence('каждый вторник') is None and parse_recurrence(None) is None
+
+    start = datetime(2025, 9, 1, 9, 0)
+    occurrences = list(expand_recurrence(start, start + timedelta(minutes=90), 'weekly;until=2025-09-29',
+                                         start + timedelta(days=365)))
+    assert [o[0].day for o in occurrences] == [1, 8, 15, 22, 29]
+    assert len(list(expand_recurrence(start, start, 'daily', start + timedelta(days=10)))) == 10
+
+
+def test_service_ranges_recurring_and_cache():
+    """День/неделя из кэша недель, регулярные занятия, инвалидация группы"""
+    from app_context import app_context
+    from models import db
+
+    service = ScheduleService(cache_ttl=600)
+    group = f"ТЕСТ-{uuid.uuid4().hex[:6]}"
+    other = f"ТЕСТ-{uuid.uuid4().hex[:6]}"
+    monday = week_start(date.today())
+    at = lambda day, hour: datetime.combine(monday + timedelta(days=day), datetime.min.time()) + timedelta(hours=hour)
+
+    with app_context():
+        db.session.add_all([
+            _lesson(group, at(0, 9)),
+            _lesson(group, at(0, 23), minutes=30, title='Поздняя консультация', schedule_type='consultation'),
+            _lesson(group, at(1, 0), title='Полночь'),  # граница суток: только вторник
+            _lesson(group, at(2, 11), is_cancelled=True),
+            _lesson(group, at(3, 11), is_active=False),
+            _lesson(group, at(-14, 13), title='Физика', is_recurring=True, recurrence_pattern='weekly;count=4'),
+            _lesson(other, at(4, 10), title='Экономика'),
+        ])
+        db.session.commit()
+
+        week = service.week(group, monday, 'kz')
+        days = {day: [lesson['subject_name'] for lesson in lessons] for day, lessons in week.items()}
+        assert days == {
+            monday.isoformat(): ['Базы данных', 'Физика', 'Поздняя консультация'],
+            (monday + timedelta(days=1)).isoformat(): ['Полночь']
+        }, days
+        assert week[monday.isoformat()][0]['lesson_type_display'] == 'Дәріс'
+        physics = week[monday.isoformat()][1]
+        assert physics['date'] == monday.isoformat() and physics['start_time'] == '13:00'
+        print(f"Неделя {group}: {days}")
+
+        # День берется из закэшированной недели без нового запроса
+        queries = service.stats['queries']
+        assert [l['subject_name'] for l in service.day(group, monday + timedelta(days=1), 'kz')] == ['Полночь']
+        assert service.stats['queries'] == queries
+
+        # Несколько групп и недель одним запросом к БД
+        span = service.lessons_between([group, other], monday - timedelta(days=14), monday + timedelta(days=14))
+        assert sum(len(v) for v in span[group].values()) == 4 + 3  # 4 повторения "Физики" и 3 занятия недели
+        assert list(span[other]) == [(monday + timedelta(days=4)).isoformat()]
+        assert service.stats['queries'] == queries + 1
+
+        # Повторений ровно count=4: через неделю последнее, через две — нет
+        next_week = service.week(group, monday + timedelta(days=7), 'ru')
+        assert [l['subject_name'] for l in next_week[(monday + timedelta(days=7)).isoformat()]] == ['Физика']
+        assert service.week(group, monday + timedelta(days=14), 'ru') == {}
+
+        db.session.add(_lesson(group, at(5, 9), title='Суббота'))
+        db.session.commit()
+        assert (monday + timedelta(days=5)).isoformat() not in service.week(group, monday, 'kz')
+        service.invalidate(group)
+        assert (monday + timedelta(days=5)).isoformat() in service.week(group, monday, 'kz')
+
+
+def test_open_ended_recurrence_and_shared_invalidation():
+    """Бессрочное еженедельное занятие не пропадает через горизонт; изменение видно другому воркеру"""
+    from app_context import app_context
+    from models import db
+
+    version_file = os.path.join(tempfile.mkdtemp(), 'schedule.version')
+    worker_a = ScheduleService(cache_ttl=600, recurrence_horizon_days=30, version_file=version_file, check_interval=0)
+    worker_b = ScheduleService(cache_ttl=600, recurrence_horizon_days=30, version_file=version_file, check_interval=0)
+    group = f"ТЕСТ-{uuid.uuid4().hex[:6]}"
+    monday = week_start(date.today())
+    first = datetime.combine(monday - timedelta(days=7 * 40), datetime.min.time()) + timedelta(hours=15)
+
+    with app_context():
+        db.session.add(_lesson(group, first, title='Философия', is_recurring=True, recurrence_pattern='weekly'))
+        db.session.commit()
+
+        # Начато 40 недель назад, горизонт 30 дней: все равно есть на этой и через 3 недели
+        for service in (worker_a, worker_b):
+            assert [l['subject_name'] for l in service.day(group, monday, 'ru')] == ['Философия']
+        assert worker_a.day(group, monday + timedelta(days=21), 'ru')
+
+        db.session.add(_lesson(group, datetime.combine(monday, datetime.min.time()) + timedelta(hours=9)))
+        db.session.commit()
+        worker_a.invalidate(group)
+        # Второй воркер сбрасывает свой кэш по общему файлу версии
+        assert len(worker_b.day(group, monday, 'ru')) == 2
+        assert worker_b.stats['remote_invalidations'] == 1 and worker_a.stats['remote_invalidations'] == 0
+    print(f"Общая версия расписания: {worker_b.get_stats()['version']}")
+
+
+def test_batch_endpoint():
+    """/api/schedule/batch: несколько групп и периодов одним ответом"""
+    from app import app
+    from app_context import app_context
+    from models import db
+
+    group = f"ТЕСТ-{uuid.uuid4().hex[:6]}"
+    today = date.today()
+    with app_context():
+        db.session.add(_lesson(group, datetime.combine(today, datetime.min.time()) + timedelta(hours=10)))
+        db.session.commit()
+
+    client = app.test_client()
+    response = client.post('/api/schedule/batch', json={'requests': [
+        {'groups': [group, 'НЕТ-ТАКОЙ'], 'start': today.isoformat(), 'end': today.isoformat()},
+        {'group': group, 'start': (today + timedelta(days=1)).isoformat(),
+         'end': (today + timedelta(days=30)).isoformat()},
+    ]})
+    payload = response.get_json()
+    assert response.status_code == 200 and payload['success'], payload
+    assert [r['total_lessons'] for r in payload['results']] == [1, 0, 0]
+    print(f"Пакет: {[(r['group'], r['total_lessons']) for r in payload['results']]}")
+
+    today_payload = client.get(f'/api/schedule/today/{group}').get_json()
+    assert today_payload['total'] == 1 and today_payload['schedules'][0]['start_time'] == '10:00'
+
+    assert client.post('/api/schedule/batch', json={'group': group, 'start': '2025-13-01'}).status_code == 400
+    assert client.post('/api/schedule/batch', json={'group': group, 'start': '2025-01-01',
+                                                    'end': '2025-06-01'}).status_code == 400
+
+
+if __name__ == "__main__":
+    test_recurrence_patterns()
+    test_service_ranges_recurring_and_cache()
+    test_open_ended_recurrence_and_shared_invalidation()
+    test_batch_endpoint()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Тест предвычисленного индекса концептов семантического поиска
+"""
+
+import random
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+sys.path.append('.')
+
+from semantic_search import SemanticSearchEngine
+
+
+def _entry(entry_id, title, content, keywords='', priority=1, updated_at=None):
+    return SimpleNamespace(
+        id=entry_id, title=title, content_ru=content, content_kz=content,
+        keywords=keywords, priority=priority, updated_at=updated_at or datetime(2025, 1, 1)
+    )
+
+
+def _reference_score(engine, query, entry):
+    """Оценка без индекса через calculate_semantic_similarity"""
+    content = entry.content_ru
+    score = (engine.calculate_semantic_similarity(query, entry.title) * 0.4 +
+             engine.calculate_semantic_similarity(query, content) * 0.4 +
+             engine.calculate_semantic_similarity(query, entry.keywords or '') * 0.2)
+    query_concepts = engine._extract_concepts(query.lower())
+    entry_concepts = engine._extract_concepts(f"{entry.title} {content} {entry.keywords or ''}".lower())
+    if query_concepts and entry_concepts:
+        score += engine._calculate_concept_expansion_score(query_concepts, entry_concepts) * 0.1
+    return score + 1.0 / max(entry.priority or 1, 1) * 0.05
+
+
+def test_indexed_search_matches_reference():
+    """Индексированный поиск дает те же оценки, признаки считаются один раз"""
+    print("=" * 70)
+    print("ТЕСТ ИНДЕКСА КОНЦЕПТОВ")
+    print("=" * 70)
+
+    engine = SemanticSearchEngine()
+    entries = [
+        _entry(1, "Поступление", "Документы для поступления: аттестат и справки", "приём, экзамены"),
+        _entry(2, "Общежитие", "Заселение в общежитие и комнаты", "проживание", priority=2),
+        _entry(3, "Стипендия", "Выплаты стипендии зависят от успеваемости", "льготы"),
+        _entry(4, "Столовая", "Меню и часы работы столовой"),
+    ]
+
+    for query in ["какие документы нужны для поступления", "как получить стипендию",
+                  "заселение в общежитие", "меню"]:
+        results = engine.semantic_search(query, entries, 'ru', max_results=10,
+                                         semantic_threshold=0.2, corpus_key='test')
+        expected = sorted(
+            [(e.id, _reference_score(engine, query, e)) for e in entries
+             if _reference_score(engine, query, e) >= 0.2],
+            key=lambda item: item[1], reverse=True
+        )
+        actual = [(r['entry'].id, r['semantic_score']) for r in results]
+        print(f"'{query}': {actual}")
+        assert [i for i, _ in actual] == [i for i, _ in expected]
+        for (_, a), (_, b) in zip(actual, expected):
+            assert abs(a - b) < 1e-9
+
+    assert len(engine.entry_features) == len(entries)
+
+    # Изменение записи пересчитывает только ее признаки
+    old_features = engine.entry_features[(1, 'ru')]
+    entries[0] = _entry(1, "Поступление", "Новые правила приёма", updated_at=datetime(2025, 1, 1) + timedelta(days=1))
+    engine.semantic_search("правила приёма", entries, 'ru', corpus_key='test-v2')
+    assert engine.entry_features[(1, 'ru')] is not old_features
+    assert engine.entry_features[(2, 'ru')] is not None
+
+
+def test_vectorized_scoring_matches_dict_path():
+    """Пакетный расчет NumPy совпадает с поэлементным путем на словарях"""
+    vectorized = SemanticSearchEngine()
+    fallback = SemanticSearchEngine()
+    fallback.use_vectorized = False
+    assert vectorized.use_vectorized
+
+    random.seed(3)
+    words = list(vectorized.knowledge_graph) + ["зачисление", "справки", "аттестат", "график",
+                                                 "занятия", "выплаты", "каникулы", "меню", "столовая"]
+    entries = [
+        _entry(i, ' '.join(random.sample(words, 2)), ' '.join(random.sample(words, random.randint(0, 6))),
+               ', '.join(random.sample(words, random.randint(0, 2))), priority=random.randint(1, 5))
+        for i in range(120)
+    ]
+
+    for _ in range(40):
+        query = ' '.join(random.sample(words, random.randint(1, 3)))
+        for threshold in (0.0, 0.2):
+            expected = fallback.semantic_search(query, entries, 'ru', max_results=200,
+                                                semantic_threshold=threshold, corpus_key='fallback')
+            actual = vectorized.semantic_search(query, entries, 'ru', max_results=200,
+                                                semantic_threshold=threshold, corpus_key='vectorized')
+            expected_scores = {r['entry'].id: r['semantic_score'] for r in expected}
+            actual_scores = {r['entry'].id: r['semantic_score'] for r in actual}
+            # Порядок суммирования отличается в последних битах: оценки ровно на пороге могут разойтись
+            for entry_id in expected_scores.keys() ^ actual_scores.keys():
+                score = expected_scores.get(entry_id, actual_scores.get(entry_id))
+                assert abs(score - threshold) < 1e-9
+            for entry_id in expected_scores.keys() & actual_scores.keys():
+                assert abs(actual_scores[entry_id] - expected_scores[entry_id]) < 1e-9
+
+    print(f"Словарь концептов: {len(vectorized._get_concept_space().concepts)} концептов")
+
+
+if __name__ == "__main__":
+    test_indexed_search_matches_reference()
+    test_vectorized_scoring_matches_dict_path()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Тест материализованных агрегатов статистики (/api/statistics и админка)
+"""
+
+import os
+import sys
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+sys.path.append('.')
+
+from sqlalchemy import func
+
+
+def _insert_queries(count, now):
+    """Запросы за несколько дней: разные агенты, языки, сессии и оценки"""
+    from models import db, UserQuery
+
+    agents = [('uniroom', 'UniRoom'), ('ai_abitur', 'AI-Abitur'), (None, None)]
+    tag = uuid.uuid4().hex[:8]
+    rows = []
+    for i in range(count):
+        agent_type, agent_name = agents[i % 3]
+        rows.append(UserQuery(
+            user_message=f"вопрос {i}", bot_response="ответ", language='kz' if i % 4 == 0 else 'ru',
+            response_time=0.5 + (i % 5) / 10, agent_type=agent_type, agent_name=agent_name,
+            agent_confidence=0.8, user_rating='like' if i % 7 == 0 else ('dislike' if i % 11 == 0 else None),
+            rating_timestamp=now if i % 7 == 0 or i % 11 == 0 else None,
+            session_id=f"{tag}-{i % 10}", created_at=now - timedelta(hours=i * 5)
+        ))
+    db.session.add_all(rows)
+    db.session.commit()
+    return rows
+
+
+def test_rollups_match_direct_aggregates():
+    """Агрегаты совпадают с прямыми запросами к user_queries, оценка пересчитывает только свой день"""
+    print("=" * 70)
+    print("ТЕСТ МАТЕРИАЛИЗОВАННОЙ СТАТИСТИКИ")
+    print("=" * 70)
+
+    from app_context import app_context
+    from models import db, UserQuery
+    from statistics_rollups import StatisticsRollups
+
+    rollups = StatisticsRollups(refresh_interval=0, cache_ttl=0,
+                                lock_file=os.path.join(tempfile.mkdtemp(), 'rollups.lock'))
+    with app_context():
+        now = datetime.utcnow()
+        rows = _insert_queries(120, now)
+        first = rollups.refresh()
+        assert first['rows'] >= 120
+        print(f"Первое обновление: {first}")
+
+        stats = rollups.homepage_statistics()
+        assert stats['total_queries'] == UserQuery.query.count()
+        direct_agents = dict(db.session.query(UserQuery.agent_name, func.count(UserQuery.id)).filter(
+            UserQuery.agent_name.isnot(None), UserQuery.agent_name != '').group_by(UserQuery.agent_name).all())
+        assert {a['name']: a['count'] for a in stats['agent_stats']} == direct_agents
+        liked = UserQuery.query.filter_by(user_rating='like').count()
+        rated = UserQuery.query.filter(UserQuery.user_rating.isnot(None)).count()
+        assert stats['satisfaction_rate'] == round(liked / rated * 100, 1)
+        total_users = db.session.query(func.count(func.distinct(UserQuery.session_id))).scalar()
+        assert stats['user_stats']['total_users'] == total_users
+        assert sum(d['count'] for d in stats['usage_patterns']['daily_stats']) == stats['total_queries']
+        assert len(stats['usage_patterns']['hourly_stats']) <= 5
+
+        # Ничего нового: обновление ничего не пересчитывает
+        assert rollups.refresh() == {'rows': 0, 'days': 0, 'sessions': 0}
+
+        # Оценка старого запроса пересчитывает только его день
+        old = next(row for row in rows if row.user_rating is None and row.created_at < now - timedelta(days=5))
+        old.user_rating = 'dislike'
+        old.rating_timestamp = datetime.utcnow() + timedelta(seconds=1)
+        db.session.commit()
+        second = rollups.refresh()
+        assert second['days'] == 1 and second['rows'] == 0, second
+        summary = rollups.analytics_summary()
+        assert summary['rating_stats']['dislikes'] == UserQuery.query.filter_by(user_rating='dislike').count()
+        assert all(isinstance(day['date'], str) for day in summary['daily_activity'])
+
+        agents = rollups.agent_analytics()
+        assert {s['agent_type'] for s in agents['agent_stats']} >= {'uniroom', 'ai_abitur'}
+        print(f"Сводка оценок: {summary['rating_stats']}")
+
+
+def test_clear_and_late_rows():
+    """Очистка чата уменьшает агрегаты; строка, закоммиченная ниже водяного знака, учитывается"""
+    from app import app
+    from app_context import app_context
+    from models import db, SessionActivity, UserQuery
+    from statistics_rollups import StatisticsRollups
+
+    rollups = StatisticsRollups(refresh_interval=0, cache_ttl=0,
+                                lock_file=os.path.join(tempfile.mkdtemp(), 'rollups.lock'))
+    with app_context():
+        rows = _insert_queries(30, datetime.utcnow())
+        session_id = rows[0].session_id
+        # Строка с зарезервированным id еще не закоммичена (как при нескольких воркерах)
+        late = {column: getattr(rows[-2], column) for column in ('id', 'user_message', 'bot_response', 'language',
+                                                                  'session_id', 'created_at', 'agent_name')}
+        db.session.delete(rows[-2])
+        db.session.commit()
+        rollups.refresh()
+        db.session.execute(UserQuery.__table__.insert(), [late])
+        db.session.commit()
+        rollups.refresh()
+        assert rollups.homepage_statistics()['total_queries'] == UserQuery.query.count()
+        activity = db.session.get(SessionActivity, late['session_id'])
+        assert activity.query_count == UserQuery.query.filter_by(session_id=late['session_id']).count()
+
+    client = app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session['session_id'] = session_id
+    assert client.post('/api/chat/clear').get_json()['success']
+
+    with app_context():
+        rollups.refresh()
+        assert rollups.homepage_statistics()['total_queries'] == UserQuery.query.count()
+        assert db.session.get(SessionActivity, session_id) is None
+        # Ничего нового после очистки: повторное обновление ничего не пересчитывает
+        assert rollups.refresh() == {'rows': 0, 'days': 0, 'sessions': 0}
+    print(f"После очистки сессии {session_id}: агрегаты совпадают с user_queries")
+
+
+def test_payload_cache():
+    """Отрисованный ответ отдается из кэша до истечения TTL"""
+    from app_context import app_context
+    from statistics_rollups import StatisticsRollups
+
+    rollups = StatisticsRollups(refresh_interval=3600, cache_ttl=60,
+                                lock_file=os.path.join(tempfile.mkdtemp(), 'rollups.lock'))
+    with app_context():
+        first = rollups.dashboard_summary()
+        second = rollups.dashboard_summary()
+    assert first is second
+    assert rollups.stats['payload_hits'] == 1 and rollups.stats['refreshes'] == 1
+
+    from app import app
+    response = app.test_client().get('/api/statistics')
+    payload = response.get_json()
+    assert response.status_code == 200 and payload['success']
+    print(f"/api/statistics: {payload['statistics']['total_queries']} запросов")
+
+
+if __name__ == "__main__":
+    test_rollups_match_direct_aggregates()
+    test_clear_and_late_rows()
+    test_payload_cache()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Тест локального векторного хранилища с memory-mapped матрицей
+"""
+
+import fcntl
+import os
+import sys
+import tempfile
+import time
+import uuid
+sys.path.append('.')
+
+import numpy as np
+
+from vector_store import VectorStore, HashingEmbeddingBackend, CHUNK_GROUP, agent_group
+
+
+def test_hashing_backend():
+    """Словоформы одного слова ближе, чем разные темы"""
+    print("=" * 70)
+    print("ТЕСТ ВЕКТОРНОГО ХРАНИЛИЩА")
+    print("=" * 70)
+
+    backend = HashingEmbeddingBackend()
+    a, b, c = backend.embed(["заселение в общежитие", "заселение в общежития", "стипендия за сессию"])
+    print(f"Сходство словоформ: {a @ b:.3f}, разных тем: {a @ c:.3f}")
+    assert abs(np.linalg.norm(a) - 1.0) < 1e-5
+    assert a @ b > 0.6 > a @ c
+
+
+def test_generations_shared_between_workers():
+    """Второй воркер открывает готовое поколение без повторного построения"""
+    base_dir = tempfile.mkdtemp()
+    items = [
+        (agent_group('uniroom', 'ru'), '1', "Общежитие: заселение и оплата проживания"),
+        (agent_group('uniroom', 'ru'), '2', "Правила проживания в общежитии"),
+        (agent_group('ai_abitur', 'ru'), '3', "Документы для поступления"),
+        (CHUNK_GROUP, '10', "Расписание экзаменов зимней сессии"),
+    ]
+
+    worker_a = VectorStore(base_dir=base_dir, track_knowledge_version=False)
+    assert worker_a.build('v1', items)
+    worker_a.refresh('v1')
+    hits = worker_a.search(agent_group('uniroom', 'ru'), "как заселиться в общежитие")
+    print(f"Результаты: {hits}")
+    assert hits[0][0] == '1' and len(hits) == 2
+
+    worker_b = VectorStore(base_dir=base_dir, track_knowledge_version=False)
+    worker_b.refresh('v1')
+    assert worker_b.stats['builds'] == 0
+    assert isinstance(worker_b._generation.vectors, np.memmap)
+    assert worker_b.search(CHUNK_GROUP, "экзамены")[0][0] == '10'
+
+    # Новая версия: неизменные тексты не эмбеддятся повторно
+    assert worker_a.build('v2', items + [(CHUNK_GROUP, '11', "Пересдача экзаменов")])
+    assert worker_a.stats['embedded'] == 5 and worker_a.stats['reused'] == 4
+
+
+def test_ivf_recall():
+    """Приближенный поиск по спискам IVF находит почти все точные соседи"""
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(40, 32))
+    vectors = (centers[rng.integers(0, 40, 4000)] + rng.normal(scale=0.3, size=(4000, 32))).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    class FixedBackend(HashingEmbeddingBackend):
+        def __init__(self):
+            super().__init__(dim=32)
+
+        def embed(self, texts):
+            return vectors[[int(t) for t in texts]]
+
+    store = VectorStore(base_dir=tempfile.mkdtemp(), backend=FixedBackend(), track_knowledge_version=False)
+    store.build('v1', [(CHUNK_GROUP, str(i), str(i)) for i in range(len(vectors))])
+    store.refresh('v1')
+    generation = store._generation
+    assert generation.groups[CHUNK_GROUP].get('list_offsets')
+
+    recall = []
+    for query in vectors[:50] + rng.normal(scale=0.05, size=(50, 32)).astype(np.float32):
+        exact = set(np.argsort(-(vectors @ query))[:10].astype(str))
+        approximate = {key for key, _ in generation.search(CHUNK_GROUP, query, 10, store.nprobe)}
+        recall.append(len(exact & approximate) / 10)
+    print(f"Полнота IVF@10: {np.mean(recall):.3f}")
+    assert np.mean(recall) > 0.9
+
+
+def test_build_lock_backoff():
+    """Пока поколение строит другой воркер, поиск не запускает поток сборки на каждый запрос"""
+    base_dir = tempfile.mkdtemp()
+    store = VectorStore(base_dir=base_dir, track_knowledge_version=False, build_retry_interval=60)
+    with open(os.path.join(base_dir, '.build.lock'), 'w') as other_worker:
+        fcntl.flock(other_worker, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        for _ in range(20):
+            store.schedule_build('v1')
+            if store._build_thread is not None:
+                store._build_thread.join()
+    assert store.stats['builds_deferred'] == 1 and store.stats['builds'] == 0
+
+    store._build_retry_at = time.time() - 1
+    store.schedule_build('v1')
+    store._build_thread.join()
+    assert store.stats['builds'] == 1
+
+
+def test_dense_chunk_search():
+    """Фрагменты базы знаний ищутся по векторам, когда BM25 ничего не нашел"""
+    import vector_store as vector_store_module
+    from app import app, db
+    from knowledge_search import KnowledgeSearchEngine
+    from knowledge_snapshot import knowledge_snapshot
+    from models import KnowledgeBase
+
+    marker = f"корпус{uuid.uuid4().hex[:6]}"
+    with app.app_context():
+        chunk = KnowledgeBase(source_type='web', source_id=1, content_chunk=f"Заселение в общежития {marker}")
+        db.session.add(chunk)
+        db.session.commit()
+        chunk_id = chunk.id
+    knowledge_snapshot.bump_version('test')
+
+    store = VectorStore(base_dir=tempfile.mkdtemp(), track_knowledge_version=False)
+    store.build('v1', [(CHUNK_GROUP, str(chunk_id), f"Заселение в общежития {marker}")])
+    store.refresh('v1')
+    shared_store, vector_store_module.vector_store = vector_store_module.vector_store, store
+    try:
+        engine = KnowledgeSearchEngine()
+        assert not engine.search_chunks("заселиться общежитие", 'ru')
+        hits = engine.dense_chunks("заселиться в общежитие")
+        print(f"Векторный поиск фрагментов: {[(h['id'], round(h['score'], 3)) for h in hits]}")
+        assert hits and hits[0]['id'] == chunk_id and hits[0]['source_type'] == 'web'
+    finally:
+        vector_store_module.vector_store = shared_store
+        with app.app_context():
+            db.session.delete(db.session.get(KnowledgeBase, chunk_id))
+            db.session.commit()
+        knowledge_snapshot.bump_version('test cleanup')
+
+
+if __name__ == "__main__":
+    test_hashing_backend()
+    test_generations_shared_between_workers()
+    test_ivf_recall()
+    test_build_lock_backoff()
+    test_dense_chunk_search()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Тест общих для воркеров метрик и эндпоинта /metrics
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+sys.path.append('.')
+
+from analytics_rollups import LatencySketch
+from worker_metrics import MetricFamily, WorkerMetricsStore
+
+
+def _worker(path, worker_number, retire):
+    """Процесс-воркер: свои счетчики, свой скетч, публикация в общий файл"""
+    store = WorkerMetricsStore(path=path, interval=0)
+    sketch = LatencySketch()
+    for i in range(100):
+        sketch.add(0.1 * (worker_number + 1) + i / 1000)
+    store.register('test', lambda: [
+        MetricFamily('test_requests_total', 'counter', 'Requests').add(10 * (worker_number + 1), route='chat'),
+        MetricFamily('test_in_flight', 'gauge', 'In flight').add(1),
+        MetricFamily('test_latency_seconds', 'summary', 'Latency').add(sketch),
+    ])
+    store.publish()
+    if retire:
+        store.retire()
+
+
+def test_cross_worker_merge():
+    """Счетчики суммируются, ушедший воркер остается в итогах, gauge — только живые"""
+    print("=" * 70)
+    print("ТЕСТ МЕТРИК НЕСКОЛЬКИХ ВОРКЕРОВ")
+    print("=" * 70)
+
+    path = os.path.join(tempfile.mkdtemp(), 'metrics.db')
+    context = multiprocessing.get_context('fork')
+    for worker_number, retire in ((0, False), (1, False), (2, True)):
+        process = context.Process(target=_worker, args=(path, worker_number, retire))
+        process.start()
+        process.join()
+        assert process.exitcode == 0
+
+    scraper = WorkerMetricsStore(path=path, interval=0)
+    aggregated = scraper.aggregate()
+    families = aggregated['families']
+    # Живые: два воркера и сам процесс, собирающий метрики; ушедший не считается
+    assert aggregated['workers'] == 3, aggregated['workers']
+    assert families['test_requests_total']['samples']['{"route": "chat"}'] == 60
+    assert families['test_in_flight']['samples']['{}'] == 2
+    sketch = LatencySketch.from_dict(families['test_latency_seconds']['samples']['{}'])
+    assert sketch.count == 300
+    assert 0.2 < sketch.quantile(0.5) < 0.25 and sketch.quantile(0.99) > 0.3
+    print(f"Воркеров: {aggregated['workers']}, p50={sketch.quantile(0.5):.3f}, p99={sketch.quantile(0.99):.3f}")
+
+    text = scraper.render_prometheus()
+    assert '# TYPE test_requests_total counter' in text
+    assert 'test_requests_total{route="chat"} 60' in text
+    assert 'test_latency_seconds{quantile="0.95"}' in text and 'test_latency_seconds_count 300' in text
+    assert 'bolashak_workers_reporting 3' in text
+    print(text)
+
+    totals = scraper.totals('test_')
+    assert totals['requests_total'] == {'route=chat': 60} and totals['in_flight'] == 2
+
+
+def test_metrics_endpoint():
+    """/metrics отдает метрики компонентов в текстовом формате Prometheus"""
+    from app import app
+
+    client = app.test_client()
+    client.post('/api/chat', json={'message': "Где находится общежитие?", 'language': 'ru'})
+    from write_behind import write_behind
+    write_behind.flush()
+
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    for name in ('bolashak_response_cache_misses_total', 'bolashak_chat_interactions_total',
+                 'bolashak_async_tasks_total', 'bolashak_write_behind_items_total',
+                 'bolashak_personalization_profiles', 'bolashak_workers_reporting'):
+        assert f"# TYPE {name} " in text, name
+    print(f"/metrics: {len(text.splitlines())} строк")
+
+    stats = client.get('/api/cache-stats').get_json()
+    assert stats['server']['workers'] >= 1 and 'misses_total' in stats['server']
+
+
+if __name__ == "__main__":
+    test_cross_worker_merge()
+    test_metrics_endpoint()
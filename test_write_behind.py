@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Тест отложенной пакетной записи (write-behind)
+"""
+
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+sys.path.append('.')
+
+from write_behind import WriteBehindQueue
+
+
+def _recording_queue(**kwargs):
+    queue = WriteBehindQueue(**kwargs)
+    batches = []
+    queue.register('event', lambda payloads: batches.append(list(payloads)))
+    return queue, batches
+
+
+def test_batching_and_ordering():
+    """Пакет по размеру и по времени, порядок записей сессии сохраняется"""
+    print("=" * 70)
+    print("ТЕСТ WRITE-BEHIND ОЧЕРЕДИ")
+    print("=" * 70)
+
+    queue, batches = _recording_queue(batch_size=5, flush_interval=60)
+    for i in range(5):
+        assert queue.submit('event', ('s1' if i % 2 else 's2', i))
+    deadline = time.time() + 5
+    while not batches and time.time() < deadline:
+        time.sleep(0.01)
+    assert batches and len(batches[0]) == 5, "Полный пакет должен записаться сразу"
+    print(f"Пакет по размеру: {len(batches[0])} записей")
+
+    queue, batches = _recording_queue(batch_size=100, flush_interval=0.1)
+    for i in range(20):
+        queue.submit('event', (f"s{i % 3}", i))
+    deadline = time.time() + 5
+    while sum(map(len, batches)) < 20 and time.time() < deadline:
+        time.sleep(0.01)
+    written = [item for batch in batches for item in batch]
+    assert len(written) == 20, "Неполный пакет должен записаться по таймеру"
+    for session in ('s0', 's1', 's2'):
+        order = [i for s, i in written if s == session]
+        assert order == sorted(order), f"Порядок сессии {session} нарушен: {order}"
+    print(f"Пакетов по таймеру: {len(batches)}, порядок сессий сохранен")
+    queue.stop()
+
+
+def test_stop_drains_and_fallbacks():
+    """Остановка дописывает очередь; переполнение и ошибки не теряют записи"""
+    queue, batches = _recording_queue(batch_size=1000, flush_interval=60)
+    for i in range(30):
+        queue.submit('event', i)
+    assert queue.pending() == 30
+    assert queue.stop() == 30 and queue.pending() == 0
+    assert [item for batch in batches for item in batch] == list(range(30))
+
+    queue, batches = _recording_queue(batch_size=1000, flush_interval=60, max_pending=3)
+    results = [queue.submit('event', i) for i in range(5)]
+    # Переполнение пишется в потоке вызова вместе с очередью, следующая запись снова в очередь
+    assert results == [True, True, True, False, True], results
+    assert queue.stats['applied_inline'] == 1 and queue.pending() == 1
+    assert [item for batch in batches for item in batch] == [0, 1, 2, 3]
+    queue.stop()
+
+    queue = WriteBehindQueue(batch_size=1000, flush_interval=60)
+    stored = []
+
+    def flaky(payloads):
+        if any(p == 'bad' for p in payloads):
+            raise ValueError("bad row")
+        stored.extend(payloads)
+
+    queue.register('flaky', flaky)
+    for payload in ('a', 'bad', 'b'):
+        queue.submit('flaky', payload)
+    assert queue.flush() == 2 and stored == ['a', 'b'] and queue.stats['failed'] == 1
+    print(f"Статистика: {queue.get_stats()}")
+
+    # Concurrent submitters never lose an item
+    queue, batches = _recording_queue(batch_size=50, flush_interval=0.05)
+    threads = [threading.Thread(target=lambda n=n: [queue.submit('event', (n, i)) for i in range(200)])
+               for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.stop()
+    assert sum(map(len, batches)) == 800
+
+
+def test_inline_order_and_flush_for():
+    """Запись в потоке вызова идет после уже стоящих в очереди; flush_for пишет только при надобности"""
+    queue, batches = _recording_queue(batch_size=1000, flush_interval=60, max_pending=2)
+    for i in range(4):
+        queue.submit('event', {'session_id': 's1', 'n': i})
+    written = [item['n'] for batch in batches for item in batch]
+    assert written == [0, 1, 2], f"Порядок сессии нарушен при переполнении: {written}"
+    assert queue.pending() == 1
+    queue.flush()
+
+    queue.enabled = True
+    queue.max_pending = 100
+    queue.submit('event', {'session_id': 's2', 'n': 10})
+    assert queue.flush_for(session_id='s1') == 0 and queue.pending() == 1
+    assert queue.flush_for(session_id='s2') == 1 and queue.pending() == 0
+    queue.stop()
+
+
+def test_chat_turn_writes():
+    """UserContext и история ML Router пишутся пакетом, UserQuery оценивается сразу"""
+    from app import app, db
+    from models import UserQuery, UserContext
+    from ml_router import ml_router
+    from user_memory import user_memory  # noqa: F401  (registers the writers)
+    from write_behind import write_behind
+
+    session_id = f"wb_{time.time_ns()}"
+    with app.app_context():
+        for i, message in enumerate(["меня зовут Алия", "Где общежитие?", "Какая стипендия?"]):
+            now = datetime.utcnow()
+            db.session.add(UserQuery(
+                message_id=f"{session_id}-{i}", user_message=message, bot_response=f"Ответ {i}", language='ru',
+                agent_type='uniroom', agent_name='UniRoom', session_id=session_id, created_at=now
+            ))
+            db.session.commit()
+            write_behind.submit('user_context', {
+                'session_id': session_id, 'user_message': message, 'agent_name': 'UniRoom', 'timestamp': now
+            })
+        ml_router.record_interaction(f"тест write-behind {session_id}", 'uniroom', 'test_user', session_id)
+        write_behind.flush()
+
+        context = UserContext.query.filter_by(session_id=session_id).one()
+        assert context.total_messages == 3
+        assert context.name == "Алия" and 'общежитие' in (context.interests or [])
+        assert context.preferences['agent_usage'] == {'UniRoom': 3}
+        print(f"Контекст: {context.to_dict()}")
+        first_id = UserQuery.query.filter_by(message_id=f"{session_id}-0").one().id
+
+    # Оценка ответа по id строки и по message_id; неизвестный message_id сразу дает 404
+    client = app.test_client()
+    response = client.post(f'/api/rate/{first_id}', json={'rating': 'like'})
+    assert response.status_code == 200 and response.get_json()['query_id'] == first_id, response.get_json()
+    response = client.post(f'/api/rate/message/{session_id}-1', json={'rating': 'dislike'})
+    assert response.status_code == 200, response.get_json()
+    start = time.time()
+    response = client.post(f'/api/rate/message/{session_id}-missing', json={'rating': 'like'})
+    assert response.status_code == 404 and time.time() - start < 0.5
+
+    with app.app_context():
+        ratings = {q.message_id: q.user_rating for q in UserQuery.query.filter_by(session_id=session_id)}
+        assert ratings == {f"{session_id}-0": 'like', f"{session_id}-1": 'dislike', f"{session_id}-2": None}, ratings
+
+        db.session.query(UserQuery).filter_by(session_id=session_id).delete()
+        db.session.query(UserContext).filter_by(session_id=session_id).delete()
+        db.session.commit()
+
+    with sqlite3.connect(ml_router.db_path) as conn:
+        rows = conn.execute("SELECT selected_agent FROM interactions WHERE session_id = ?", (session_id,)).fetchall()
+    assert rows == [('uniroom',)]
+    print(f"Записано через очередь: {write_behind.get_stats()}")
+
+
+if __name__ == "__main__":
+    test_batching_and_ordering()
+    test_stop_drains_and_fallbacks()
+    test_inline_order_and_flush_for()
+    test_chat_turn_writes()
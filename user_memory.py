@@ -6,15 +6,37 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
 from models import UserContext, UserQuery, db
 from sqlalchemy import func, desc
+from keyword_matcher import keyword_matcher
+from write_behind import write_behind
 
 logger = logging.getLogger(__name__)
 
 class UserMemoryManager:
     """Manages user context and memory across chat sessions"""
     
+    INTEREST_KEYWORDS = {
+        'поступление': ['поступление', 'поступить', 'подача документов', 'зачисление'],
+        'стипендия': ['стипендия', 'грант', 'финансовая помощь'],
+        'общежитие': ['общежитие', 'жатақхана', 'проживание', 'комната'],
+        'расписание': ['расписание', 'занятия', 'лекции', 'пары'],
+        'карьера': ['работа', 'трудоустройство', 'карьера', 'практика', 'стажировка'],
+        'академические': ['экзамены', 'зачеты', 'оценки', 'кредиты', 'семестр']
+    }
+    
+    # Checked in order: the first language with a hit wins
+    LANGUAGE_HINTS = {
+        'kz': ['казахский', 'қазақша', 'казахский язык'],
+        'en': ['английский', 'english', 'english language']
+    }
+    
     def __init__(self):
         self.context_cache = {}  # In-memory cache for active sessions
         
+        for interest, keywords in self.INTEREST_KEYWORDS.items():
+            keyword_matcher.register(f'memory:interest:{interest}', keywords)
+        for language, words in self.LANGUAGE_HINTS.items():
+            keyword_matcher.register(f'memory:language:{language}', words)
+        
     def get_or_create_context(self, session_id: str, user_id: str = 'anonymous') -> UserContext:
         """Get existing user context or create new one"""
         try:
@@ -59,29 +81,21 @@ class UserMemoryManager:
                     extracted_info['name'] = potential_name.title()
                     break
         
-        # Extract interests/topics
-        interest_keywords = {
-            'поступление': ['поступление', 'поступить', 'подача документов', 'зачисление'],
-            'стипендия': ['стипендия', 'грант', 'финансовая помощь'],
-            'общежитие': ['общежитие', 'жатақхана', 'проживание', 'комната'],
-            'расписание': ['расписание', 'занятия', 'лекции', 'пары'],
-            'карьера': ['работа', 'трудоустройство', 'карьера', 'практика', 'стажировка'],
-            'академические': ['экзамены', 'зачеты', 'оценки', 'кредиты', 'семестр']
-        }
-        
-        detected_interests = []
-        for interest, keywords in interest_keywords.items():
-            if any(keyword in message_lower for keyword in keywords):
-                detected_interests.append(interest)
+        # Extract interests/topics (shared keyword scan)
+        scan = keyword_matcher.scan(message_lower)
+        detected_interests = [
+            interest for interest in self.INTEREST_KEYWORDS
+            if scan.has(f'memory:interest:{interest}')
+        ]
         
         if detected_interests:
             extracted_info['interests'] = detected_interests
         
         # Extract preferences
-        if any(word in message_lower for word in ['казахский', 'қазақша', 'казахский язык']):
-            extracted_info['language_preference'] = 'kz'
-        elif any(word in message_lower for word in ['английский', 'english', 'english language']):
-            extracted_info['language_preference'] = 'en'
+        for language, words in self.LANGUAGE_HINTS.items():
+            if scan.has(f'memory:language:{language}'):
+                extracted_info['language_preference'] = language
+                break
         
         return extracted_info
     
@@ -90,59 +104,7 @@ class UserMemoryManager:
         """Update user context with new interaction"""
         try:
             context = self.get_or_create_context(session_id)
-            
-            # Extract information from user message
-            extracted_info = self.extract_user_info(user_message, context)
-            
-            # Update name if extracted
-            if 'name' in extracted_info and not context.name:
-                context.name = extracted_info['name']
-            
-            # Update interests
-            if 'interests' in extracted_info:
-                current_interests = context.interests or []
-                new_interests = extracted_info['interests']
-                # Merge interests without duplicates
-                merged_interests = list(set(current_interests + new_interests))
-                context.interests = merged_interests
-            
-            # Update language preference
-            if 'language_preference' in extracted_info:
-                context.language_preference = extracted_info['language_preference']
-            
-            # Update preferences
-            if not context.preferences:
-                context.preferences = {}
-            
-            # Track favorite agent
-            if agent_name:
-                agent_usage = context.preferences.get('agent_usage', {})
-                agent_usage[agent_name] = agent_usage.get(agent_name, 0) + 1
-                context.preferences['agent_usage'] = agent_usage
-                
-                # Set favorite agent
-                context.favorite_agent = max(agent_usage.items(), key=lambda x: x[1])[0]
-            
-            # Update context summary (keep last 3 interactions summary)
-            summary_parts = []
-            if context.context_summary:
-                summary_parts.append(context.context_summary)
-            
-            # Add current interaction summary
-            interaction_summary = f"Пользователь спрашивал о: {user_message[:100]}..."
-            summary_parts.append(interaction_summary)
-            
-            # Keep only last 3 summaries to avoid too long context
-            if len(summary_parts) > 3:
-                summary_parts = summary_parts[-3:]
-            
-            context.context_summary = " | ".join(summary_parts)
-            
-            # Update counters and timestamps
-            context.total_messages += 1
-            context.last_interaction = datetime.utcnow()
-            context.updated_at = datetime.utcnow()
-            
+            self._apply_interaction(context, user_message, agent_name)
             db.session.commit()
             
             # Cache the context
@@ -156,51 +118,123 @@ class UserMemoryManager:
             logger.error(f"Error updating user context: {str(e)}")
             return self.get_or_create_context(session_id)
     
-    def get_context_for_ai(self, session_id: str) -> str:
-        """Get formatted context for AI agent"""
+    def update_contexts(self, interactions: List[Dict[str, Any]]):
+        """Bulk upsert for the write-behind queue: one SELECT and one commit per batch.
+        
+        Each item has session_id, user_message, agent_name and timestamp; the
+        interactions of a session are applied in the order given.
+        """
+        session_ids = {item['session_id'] for item in interactions}
+        contexts = {
+            context.session_id: context
+            for context in UserContext.query.filter(UserContext.session_id.in_(session_ids))
+        }
+        
+        for item in interactions:
+            session_id = item['session_id']
+            context = contexts.get(session_id)
+            if context is None:
+                context = UserContext(
+                    session_id=session_id,
+                    user_id=item.get('user_id', 'anonymous'),
+                    total_messages=0,
+                    first_interaction=item['timestamp'],
+                    last_interaction=item['timestamp']
+                )
+                db.session.add(context)
+                contexts[session_id] = context
+            self._apply_interaction(context, item['user_message'], item.get('agent_name'), item['timestamp'])
+        
+        db.session.commit()
+        logger.debug(f"Updated {len(contexts)} user contexts from {len(interactions)} interactions")
+    
+    def _apply_interaction(self, context: UserContext, user_message: str, agent_name: str = None,
+                           timestamp: Optional[datetime] = None):
+        """Apply one interaction to a context object (the caller commits)"""
+        timestamp = timestamp or datetime.utcnow()
+        
+        # Extract information from user message
+        extracted_info = self.extract_user_info(user_message, context)
+        
+        # Update name if extracted
+        if 'name' in extracted_info and not context.name:
+            context.name = extracted_info['name']
+        
+        # Update interests
+        if 'interests' in extracted_info:
+            current_interests = context.interests or []
+            new_interests = extracted_info['interests']
+            # Merge interests without duplicates
+            merged_interests = list(set(current_interests + new_interests))
+            context.interests = merged_interests
+        
+        # Update language preference
+        if 'language_preference' in extracted_info:
+            context.language_preference = extracted_info['language_preference']
+        
+        # Track favorite agent (a new dict, so the JSON column is marked dirty)
+        if agent_name:
+            preferences = dict(context.preferences or {})
+            agent_usage = dict(preferences.get('agent_usage', {}))
+            agent_usage[agent_name] = agent_usage.get(agent_name, 0) + 1
+            preferences['agent_usage'] = agent_usage
+            context.preferences = preferences
+            
+            # Set favorite agent
+            context.favorite_agent = max(agent_usage.items(), key=lambda x: x[1])[0]
+        elif not context.preferences:
+            context.preferences = {}
+        
+        # Update context summary (keep last 3 interactions summary)
+        summary_parts = []
+        if context.context_summary:
+            summary_parts.append(context.context_summary)
+        
+        # Add current interaction summary
+        interaction_summary = f"Пользователь спрашивал о: {user_message[:100]}..."
+        summary_parts.append(interaction_summary)
+        
+        # Keep only last 3 summaries to avoid too long context
+        if len(summary_parts) > 3:
+            summary_parts = summary_parts[-3:]
+        
+        context.context_summary = " | ".join(summary_parts)
+        
+        # Update counters and timestamps
+        context.total_messages = (context.total_messages or 0) + 1
+        context.last_interaction = timestamp
+        context.updated_at = timestamp
+    
+    def get_user_context(self, session_id: str) -> Dict[str, Any]:
+        """User context as separate fields, carried next to the raw question (not inside it)"""
         try:
             context = UserContext.query.filter_by(session_id=session_id).first()
-            
             if not context:
-                return ""
-            
-            context_parts = []
-            
-            # Add user name
-            if context.name:
-                context_parts.append(f"Пользователя зовут {context.name}")
-            
-            # Add interests
-            if context.interests:
-                interests_str = ", ".join(context.interests)
-                context_parts.append(f"Интересуется: {interests_str}")
-            
-            # Add favorite agent
-            if context.favorite_agent:
-                context_parts.append(f"Чаще всего обращается к агенту: {context.favorite_agent}")
-            
-            # Add language preference
-            if context.language_preference and context.language_preference != 'ru':
-                lang_map = {'kz': 'казахский', 'en': 'английский'}
-                lang_name = lang_map.get(context.language_preference, context.language_preference)
-                context_parts.append(f"Предпочитает язык: {lang_name}")
+                return {}
             
-            # Add recent context
-            if context.context_summary:
-                context_parts.append(f"Контекст предыдущих разговоров: {context.context_summary}")
-            
-            # Add interaction stats
-            if context.total_messages > 1:
-                context_parts.append(f"Общался с системой {context.total_messages} раз")
-            
-            if context_parts:
-                return "КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ:\n" + "\n".join(f"- {part}" for part in context_parts) + "\n"
-            
-            return ""
+            return {
+                'name': context.name,
+                'interests': list(context.interests or []),
+                'favorite_agent': context.favorite_agent,
+                'language_preference': context.language_preference,
+                'total_messages': context.total_messages or 0
+            }
             
         except Exception as e:
-            logger.error(f"Error getting context for AI: {str(e)}")
-            return ""
+            logger.error(f"Error getting user context: {str(e)}")
+            return {}
+    
+    @staticmethod
+    def personalize_response(response: str, user_context: Optional[Dict[str, Any]]) -> str:
+        """Cheap per-user touch on a shared (possibly cached) answer: address the user by name"""
+        name = (user_context or {}).get('name')
+        if not name or not response or name.lower() in response[:200].lower():
+            return response
+        
+        first, rest = response[0], response[1:]
+        if first.isalpha() and first.isupper() and rest[:1].islower():
+            return f"{name}, {first.lower()}{rest}"
+        return f"{name}!\n\n{response}"
     
     def get_recent_history(self, session_id: str, limit: int = 5) -> List[Dict]:
         """Get recent chat history for context"""
@@ -243,3 +277,6 @@ class UserMemoryManager:
 
 # Global instance
 user_memory = UserMemoryManager()
+
+# Per-turn writes are batched off the request path
+write_behind.register('user_context', user_memory.update_contexts, needs_app=True)
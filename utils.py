@@ -19,6 +19,17 @@ def get_relevant_context(user_message: str, language: str = "ru", limit: int = 3
 
 def get_knowledge_base_context(user_message: str, language: str = "ru", limit: int = 3) -> List[str]:
     """Get relevant context from knowledge base"""
+    try:
+        from knowledge_search import knowledge_search_engine
+        chunks = (knowledge_search_engine.search_chunks(user_message, language, limit)
+                  or knowledge_search_engine.dense_chunks(user_message, limit))
+        if chunks:
+            return [f"{'Документ' if chunk['source_type'] == 'document' else 'Веб-сайт'} - {chunk['content']}"
+                    for chunk in chunks]
+        # Neither index found anything (substrings, vectors not built yet): keyword matching
+    except Exception as e:
+        logger.warning(f"Chunk index search failed, using keyword matching: {e}")
+
     try:
         user_message_lower = user_message.lower()
         keywords = [word for word in user_message_lower.split() if len(word) > 2]
@@ -0,0 +1,460 @@
+"""
+Local Dense-Embedding Retrieval with an On-disk Vector Store
+Локальный поиск по плотным эмбеддингам с векторным хранилищем на диске
+
+Knowledge entries and KnowledgeBase chunks are embedded on CPU when the
+shared knowledge version changes and written to a generation directory:
+a float32 matrix (vectors.f32), IVF centroids (centroids.f32) and a JSON
+id map. Every gunicorn worker opens the same files with np.memmap, so the
+vectors live once in the OS page cache instead of once per worker. One
+worker builds a new generation under a file lock; the others keep
+serving the previous one until it is published, retrying the lock only
+every build_retry_interval seconds.
+
+Rows are grouped ("agent:<type>:<lang>", "chunks") and, inside large
+groups, ordered by IVF list, so approximate nearest-neighbour search only
+scans the contiguous slices of the lists closest to the query.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # no cross-process build lock outside POSIX
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_GROUP = 'chunks'
+
+
+def _default_store_dir() -> str:
+    return os.path.join(tempfile.gettempdir(), 'bolashak_vectors')
+
+
+def agent_group(agent_type: str, language: str) -> str:
+    return f"agent:{agent_type}:{language}"
+
+
+class EmbeddingBackend:
+    """Turns texts into L2-normalized float32 vectors"""
+
+    name = 'base'
+    dim = 0
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """Dependency-free CPU embedding: signed feature hashing of words and character trigrams
+
+    Trigrams make inflected forms (общежитие / общежития / общежитии) land
+    close to each other; crc32 keeps vectors identical across processes.
+    """
+
+    name = 'hashing'
+
+    def __init__(self, dim: int = 256, word_weight: float = 1.0, trigram_weight: float = 1.0):
+        self.dim = dim
+        self.word_weight = word_weight
+        self.trigram_weight = trigram_weight
+
+    def _features(self, text: str) -> Dict[int, float]:
+        features: Dict[int, float] = {}
+        for word in re.findall(r'\w+', (text or '').lower()):
+            if len(word) < 3:
+                continue
+            tokens = [(word, self.word_weight)]
+            padded = f"<{word}>"
+            trigrams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+            # Trigrams of a word together weigh trigram_weight (in L2 norm)
+            gram_weight = self.trigram_weight / math.sqrt(len(trigrams))
+            tokens.extend((f"#{gram}", gram_weight) for gram in trigrams)
+            for token, weight in tokens:
+                h = zlib.crc32(token.encode('utf-8'))
+                index = h % self.dim
+                features[index] = features.get(index, 0.0) + (weight if h & 0x80000000 else -weight)
+        return features
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for index, value in self._features(text).items():
+                matrix[row, index] = value
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """Local sentence-transformers model (optional dependency, CPU)"""
+
+    name = 'sentence-transformers'
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = 'st-' + re.sub(r'[^\w.-]', '_', model_name)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.model.encode(texts, batch_size=64, normalize_embeddings=True),
+                          dtype=np.float32)
+
+
+def get_embedding_backend() -> EmbeddingBackend:
+    """Backend from EMBEDDING_BACKEND / EMBEDDING_MODEL, hashing by default"""
+    if os.environ.get('EMBEDDING_BACKEND') == 'sentence-transformers':
+        model_name = os.environ.get('EMBEDDING_MODEL', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+        try:
+            return SentenceTransformerBackend(model_name)
+        except Exception as e:
+            logger.warning(f"Could not load sentence-transformers model {model_name}: {e}, using hashing embeddings")
+    return HashingEmbeddingBackend(dim=int(os.environ.get('EMBEDDING_DIM', 256)))
+
+
+def _train_ivf(vectors: np.ndarray, nlist: int, iterations: int = 8,
+               sample_size: int = 20000, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Spherical k-means; returns (centroids, list assignment of every vector)"""
+    rng = np.random.default_rng(seed)
+    train = vectors
+    if len(vectors) > sample_size:
+        train = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = train[rng.choice(len(train), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = np.argmax(train @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, train)
+        counts = np.bincount(assignment, minlength=nlist)
+        norms = np.linalg.norm(sums, axis=1)
+        filled = (counts > 0) & (norms > 0)
+        centroids[filled] = sums[filled] / norms[filled, None]
+
+    assignment = np.concatenate([
+        np.argmax(vectors[i:i + 8192] @ centroids.T, axis=1)
+        for i in range(0, len(vectors), 8192)
+    ])
+    return centroids.astype(np.float32), assignment
+
+
+class VectorGeneration:
+    """One published, read-only generation of the store (memory-mapped)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.version = self.meta['version']
+        self.keys: List[str] = self.meta['keys']
+        self.signatures: List[str] = self.meta['signatures']
+        self.groups: Dict[str, Dict[str, Any]] = self.meta['groups']
+        dim = self.meta['dim']
+
+        count = len(self.keys)
+        self.vectors = np.memmap(os.path.join(path, 'vectors.f32'), dtype=np.float32,
+                                 mode='r', shape=(count, dim)) if count else np.zeros((0, dim), np.float32)
+        centroid_count = self.meta['centroids']
+        self.centroids = np.memmap(os.path.join(path, 'centroids.f32'), dtype=np.float32,
+                                   mode='r', shape=(centroid_count, dim)) if centroid_count else None
+
+    def search(self, group: str, query: np.ndarray, top_k: int, nprobe: int) -> List[Tuple[str, float]]:
+        info = self.groups.get(group)
+        if not info or top_k <= 0:
+            return []
+        start, end = info['start'], info['end']
+
+        list_offsets = info.get('list_offsets')
+        if list_offsets:
+            # IVF: scan only the row ranges of the lists closest to the query
+            centroid_scores = self.centroids[info['centroid_start']:info['centroid_end']] @ query
+            nprobe = min(max(nprobe, len(centroid_scores) // 10), len(centroid_scores))
+            probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            rows = np.concatenate([
+                np.arange(start + list_offsets[l], start + list_offsets[l + 1]) for l in probe
+            ])
+            scores = self.vectors[rows] @ query if len(rows) else np.zeros(0, np.float32)
+        else:
+            rows = np.arange(start, end)
+            scores = self.vectors[start:end] @ query
+
+        if not len(rows):
+            return []
+        k = min(top_k, len(rows))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(self.keys[rows[i]], float(scores[i])) for i in best]
+
+
+class VectorStore:
+    """Versioned, memory-mapped embedding store shared by all workers"""
+
+    def __init__(self, base_dir: Optional[str] = None, backend: Optional[EmbeddingBackend] = None,
+                 ann_min_rows: int = 256, nprobe: int = 8, keep_generations: int = 2,
+                 track_knowledge_version: bool = True, build_retry_interval: float = 5.0):
+        self.base_dir = base_dir or os.environ.get('VECTOR_STORE_DIR', _default_store_dir())
+        # Follow the shared knowledge version on search (off for stores fed explicitly via build)
+        self.track_knowledge_version = track_knowledge_version
+        self.ann_min_rows = ann_min_rows
+        self.nprobe = nprobe
+        self.keep_generations = keep_generations
+        self.build_retry_interval = build_retry_interval
+        self._backend = backend
+        self._generation: Optional[VectorGeneration] = None
+        self._build_thread: Optional[threading.Thread] = None
+        # Another worker holds the build lock: do not try again before this time
+        self._build_retry_at = 0.0
+        self._lock = threading.RLock()
+        self.stats = {'searches': 0, 'builds': 0, 'builds_deferred': 0, 'embedded': 0, 'reused': 0,
+                      'last_build_duration': 0.0}
+
+    @property
+    def backend(self) -> EmbeddingBackend:
+        if self._backend is None:
+            self._backend = get_embedding_backend()
+        return self._backend
+
+    def search(self, group: str, query: str, top_k: int = 3,
+               nprobe: Optional[int] = None) -> List[Tuple[str, float]]:
+        """Approximate nearest neighbours of the query text inside a group: [(key, cosine)]"""
+        generation = self._current()
+        if generation is None or not query:
+            return []
+        self.stats['searches'] += 1
+        query_vector = self.backend.embed([query])[0]
+        return generation.search(group, query_vector, top_k, nprobe or self.nprobe)
+
+    def refresh(self, version: Optional[str] = None) -> Optional[VectorGeneration]:
+        """Open the generation for the knowledge version, building it synchronously if needed"""
+        if version is None:
+            from knowledge_snapshot import knowledge_snapshot
+            version = knowledge_snapshot.current_version()
+        if version is None:
+            return self._generation
+
+        with self._lock:
+            if self._open(version) is None:
+                self.build(version)
+                self._open(version)
+            return self._generation
+
+    def schedule_build(self, version: str):
+        """Embed a new knowledge version in a background thread (ingest path)"""
+        with self._lock:
+            if self._open(version) is not None:
+                return
+            if self._build_thread is not None and self._build_thread.is_alive():
+                return
+            if time.time() < self._build_retry_at:
+                return
+            self._build_thread = threading.Thread(
+                target=self._build_in_background, args=(version,), daemon=True,
+                name='vector-store-build'
+            )
+            self._build_thread.start()
+
+    def build(self, version: str, items: Optional[Iterable[Tuple[str, str, str]]] = None) -> bool:
+        """Embed (group, key, text) items into a new generation; False if another process is building"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        path = self._generation_path(version)
+
+        with open(os.path.join(self.base_dir, '.build.lock'), 'w') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    logger.info("Vector store is being built by another worker, serving previous generation")
+                    return False
+            if os.path.exists(os.path.join(path, 'meta.json')):
+                return True
+
+            start = time.time()
+            items = list(items) if items is not None else self._load_items()
+            self._write_generation(path, version, items)
+            self._cleanup()
+            self.stats['builds'] += 1
+            self.stats['last_build_duration'] = time.time() - start
+            logger.info(f"Vector store generation {os.path.basename(path)} built: {len(items)} vectors "
+                        f"in {self.stats['last_build_duration']:.2f}s")
+            return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        generation = self._generation
+        return {
+            **self.stats,
+            'backend': self.backend.name,
+            'dim': self.backend.dim,
+            'version': generation.version if generation else None,
+            'vectors': len(generation.keys) if generation else 0,
+            'groups': len(generation.groups) if generation else 0
+        }
+
+    def _current(self) -> Optional[VectorGeneration]:
+        """Generation for the current knowledge version, or the previous one while it is built"""
+        if not self.track_knowledge_version:
+            return self._generation
+        try:
+            from knowledge_snapshot import knowledge_snapshot
+            version = knowledge_snapshot.current_version()
+            if version is not None and self._open(version) is None:
+                self.schedule_build(version)
+        except Exception as e:
+            logger.warning(f"Vector store unavailable: {e}")
+        return self._generation
+
+    def _open(self, version: str) -> Optional[VectorGeneration]:
+        """Switch to the published generation of a version if it exists"""
+        generation = self._generation
+        if generation is not None and generation.version == version:
+            return generation
+        path = self._generation_path(version)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return None
+        with self._lock:
+            if self._generation is None or self._generation.version != version:
+                self._generation = VectorGeneration(path)
+            return self._generation
+
+    def _build_in_background(self, version: str):
+        try:
+            if self.build(version):
+                self._open(version)
+            else:
+                # Built elsewhere: its generation is picked up by _open once published
+                self._build_retry_at = time.time() + self.build_retry_interval
+                self.stats['builds_deferred'] += 1
+        except Exception as e:
+            logger.warning(f"Vector store build failed: {e}")
+
+    def _generation_path(self, version: str) -> str:
+        backend = self.backend
+        name = re.sub(r'[^\w.-]', '_', f"{backend.name}-{backend.dim}-{version}")
+        return os.path.join(self.base_dir, name)
+
+    def _load_items(self) -> List[Tuple[str, str, str]]:
+        """Agent knowledge lists from the snapshot and active KnowledgeBase chunks"""
+        from knowledge_snapshot import knowledge_snapshot
+        from models import KnowledgeBase, db
+        from app_context import app_context
+
+        items = []
+        for (agent_type, language), entries in knowledge_snapshot.all_entries():
+            group = agent_group(agent_type, language)
+            for entry in entries:
+                content = entry.content_ru if language == 'ru' else entry.content_kz
+                text = f"{entry.title} {content} {entry.keywords or ''}"
+                items.append((group, str(entry.id), text))
+
+        with app_context():
+            rows = db.session.query(KnowledgeBase.id, KnowledgeBase.content_chunk).filter(
+                KnowledgeBase.is_active == True
+            ).all()
+        items.extend((CHUNK_GROUP, str(chunk_id), content) for chunk_id, content in rows)
+        return items
+
+    def _write_generation(self, path: str, version: str, items: List[Tuple[str, str, str]]):
+        backend = self.backend
+        items = sorted(items, key=lambda item: item[0])
+        signatures = [hashlib.md5(text.encode('utf-8')).hexdigest()[:16] for _, _, text in items]
+
+        # Vectors of unchanged texts are copied from the previous generation
+        vectors = np.zeros((len(items), backend.dim), dtype=np.float32)
+        previous = self._generation if self._generation and self._generation.meta['dim'] == backend.dim else None
+        previous_rows = {sig: row for row, sig in enumerate(previous.signatures)} if previous else {}
+        missing = []
+        for row, signature in enumerate(signatures):
+            previous_row = previous_rows.get(signature)
+            if previous_row is not None:
+                vectors[row] = previous.vectors[previous_row]
+            else:
+                missing.append(row)
+        for i in range(0, len(missing), 512):
+            batch = missing[i:i + 512]
+            vectors[batch] = backend.embed([items[row][2] for row in batch])
+        self.stats['embedded'] += len(missing)
+        self.stats['reused'] += len(items) - len(missing)
+
+        # Group rows contiguously; large groups are reordered by IVF list
+        order = np.arange(len(items))
+        groups: Dict[str, Dict[str, Any]] = {}
+        centroid_blocks = []
+        centroid_count = 0
+        start = 0
+        while start < len(items):
+            group = items[start][0]
+            end = start
+            while end < len(items) and items[end][0] == group:
+                end += 1
+            info = {'start': start, 'end': end}
+            size = end - start
+            if size >= self.ann_min_rows:
+                nlist = max(1, int(np.sqrt(size)))
+                centroids, assignment = _train_ivf(vectors[start:end], nlist)
+                within = np.argsort(assignment, kind='stable')
+                order[start:end] = start + within
+                counts = np.bincount(assignment, minlength=nlist)
+                info.update({
+                    'centroid_start': centroid_count,
+                    'centroid_end': centroid_count + nlist,
+                    'list_offsets': [0] + np.cumsum(counts).tolist()
+                })
+                centroid_blocks.append(centroids)
+                centroid_count += nlist
+            groups[group] = info
+            start = end
+
+        vectors = vectors[order]
+        keys = [items[row][1] for row in order]
+        signatures = [signatures[row] for row in order]
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        vectors.tofile(os.path.join(tmp_path, 'vectors.f32'))
+        if centroid_blocks:
+            np.concatenate(centroid_blocks).astype(np.float32).tofile(os.path.join(tmp_path, 'centroids.f32'))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': version,
+                'backend': backend.name,
+                'dim': backend.dim,
+                'keys': keys,
+                'signatures': signatures,
+                'groups': groups,
+                'centroids': centroid_count,
+                'created_at': time.time()
+            }, f)
+        os.rename(tmp_path, path)
+
+    def _cleanup(self):
+        """Remove all but the newest generations (open mmaps stay valid after unlink)"""
+        try:
+            generations = [
+                os.path.join(self.base_dir, name) for name in os.listdir(self.base_dir)
+                if not name.startswith('.') and not name.endswith('.tmp')
+                and os.path.exists(os.path.join(self.base_dir, name, 'meta.json'))
+            ]
+            generations.sort(key=os.path.getmtime, reverse=True)
+            for stale in generations[self.keep_generations:]:
+                shutil.rmtree(stale, ignore_errors=True)
+        except OSError as e:
+            logger.warning(f"Could not clean up vector store generations: {e}")
+
+
+# Global vector store instance
+vector_store = VectorStore()
@@ -1,9 +1,10 @@
 # Импорт необходимых модулей
+import json
 import time
 import logging
 import uuid
 from datetime import datetime
-from flask import Blueprint, render_template, request, jsonify, session, Response
+from flask import Blueprint, render_template, request, jsonify, session, Response, stream_with_context
 import requests
 import base64
 from sqlalchemy import func, desc
@@ -159,9 +160,19 @@ def clear_chat_history():
         from models import UserQuery
         from app import db
         from user_memory import user_memory
+        from write_behind import write_behind
         
         session_id = session.get('session_id')
         if session_id:
+            # Queued turns of this session would be written back after the delete
+            write_behind.flush_for(session_id=session_id)
+            
+            # Statistics rollups drop the session and recount the days its queries were on
+            from statistics_rollups import statistics_rollups
+            days = {created_at.date() for (created_at,) in db.session.query(UserQuery.created_at).filter(
+                UserQuery.session_id == session_id, UserQuery.created_at.isnot(None)).distinct()}
+            statistics_rollups.forget_session(session_id, days)
+            
             # Delete all queries for this session
             UserQuery.query.filter_by(session_id=session_id).delete()
             db.session.commit()
@@ -263,17 +274,152 @@ def update_user_info():
             'error': 'Failed to update user information'
         }), 500
 
+def _resolve_chat_language(user_message, language):
+    """Requested language, or auto-detected from the message"""
+    # Автоматическое определение языка если не указан
+    if not language or language == 'auto':
+        from language_detector import language_detector
+        detected_lang, confidence = language_detector.detect_language(user_message)
+        logger.info(f"Auto-detected language: {detected_lang} (confidence: {confidence:.2f})")
+        return detected_lang
+    # Валидация переданного языка
+    return language if language in ['ru', 'kz', 'en'] else 'ru'
+
+
+def _find_manual_agent(router, agent_type):
+    """Agent explicitly chosen by the user, or None for automatic routing/unknown type"""
+    for agent in router.agents:
+        if getattr(agent, "agent_type", None) and (agent.agent_type == agent_type):
+            return agent
+    return None
+
+
+def _mark_manual_selection(result, agent):
+    result['agent_type'] = agent.agent_type
+    result['agent_name'] = agent.name
+    result['confidence'] = 1.0  # Максимальная уверенность при ручном выборе
+    result['manually_selected'] = True
+    return result
+
+
+def _agent_unavailable_result(agent_type):
+    # Агент не найден - возвращаем ошибку
+    logger.warning(f"Requested agent type '{agent_type}' not found")
+    return {
+        'response': f"Извините, запрошенный агент '{agent_type}' недоступен. Попробуйте выбрать другого агента или используйте автоматический выбор.",
+        'confidence': 0.0,
+        'agent_type': 'error',
+        'agent_name': 'System',
+        'context_used': False,
+        'context_confidence': 0.0,
+        'cached': False,
+        'error': True
+    }
+
+
+def _load_user_context(session_id):
+    """Remembered user context, kept apart from the question so routing and caching see only the question"""
+    from user_memory import user_memory
+    from write_behind import write_behind
+
+    # Context updates of the previous turns may still be queued
+    write_behind.flush_for(session_id=session_id)
+    return user_memory.get_user_context(session_id)
+
+
+def _complete_chat_turn(user_message, result, language, session_id, user_id, response_time):
+    """Feedback registration, UserQuery persistence and user memory update; returns response JSON data"""
+    from feedback_system import feedback_collector, add_feedback_buttons_to_response
+    import user_memory  # noqa: F401  (registers the user_context writer)
+    from write_behind import write_behind
+
+    # Generate unique message ID for feedback tracking
+    message_id = str(uuid.uuid4())
+    
+    # Register interaction for ML learning (always register for feedback)
+    feedback_collector.register_interaction(
+        message_id, user_message, result.get('agent_name', ''), user_id
+    )
+    
+    # Add feedback buttons to response
+    result = add_feedback_buttons_to_response(result, message_id)
+
+    # The UserQuery row is committed now so its id can be rated right away;
+    # the user memory update goes to the write-behind queue
+    from models import UserQuery
+    from app import db
+
+    now = datetime.utcnow()
+    user_query = UserQuery(
+        message_id=message_id,
+        user_message=user_message,
+        bot_response=result['response'],
+        language=language,
+        response_time=response_time,
+        agent_type=result.get('agent_type'),
+        agent_name=result.get('agent_name'),
+        agent_confidence=result.get('confidence', 0.0),
+        context_used=result.get('context_used', False),
+        session_id=session_id,
+        ip_address=request.remote_addr,
+        user_agent=request.headers.get('User-Agent', ''),
+        created_at=now
+    )
+    try:
+        db.session.add(user_query)
+        db.session.commit()
+    except Exception as db_error:
+        db.session.rollback()
+        logger.warning(f"Database error (continuing without saving): {str(db_error)}")
+    write_behind.submit('user_context', {
+        'session_id': session_id,
+        'user_message': user_message,  # Use original message for context extraction
+        'agent_name': result.get('agent_name'),
+        'timestamp': now
+    })
+
+    logger.info(
+        f"Chat response generated in {response_time:.2f}s "
+        f"by {result.get('agent_name', 'Unknown')} agent "
+        f"(confidence: {result.get('confidence', 0):.2f}) "
+        f"for language: {language}"
+    )
+
+    response_data = {
+        'success': True,
+        'response': result['response'],
+        'response_time': response_time,
+        'agent_name': result.get('agent_name'),
+        'agent_type': result.get('agent_type'),
+        'confidence': result.get('confidence', 0.0),
+        'query_id': getattr(user_query, 'id', None),
+        'message_id': message_id,
+        'routing_method': result.get('routing_method', 'traditional'),
+        'ml_confidence': result.get('ml_confidence'),
+        'detected_language': language,  # Определенный язык
+        'feedback': result.get('feedback', {})  # Include feedback metadata
+    }
+    
+    # Exact or near-duplicate cache hit and its similarity score
+    if result.get('cache_match'):
+        response_data['cache_match'] = result['cache_match']
+
+    # Add images data if present
+    if 'images' in result:
+        response_data['images'] = result['images']
+        response_data['special_response'] = result.get('special_response', 'images')
+
+    return response_data
+
+
+def _chat_error_message(language):
+    return "Извините, произошла ошибка. Попробуйте еще раз." if language == 'ru' else "Кешіріңіз, қате орын алды. Қайталап көріңіз."
+
+
 @main_bp.route('/api/chat', methods=['POST'])
 @main_bp.route('/chat', methods=['POST'])
 def chat():
     try:
-        from models import UserQuery
-        from app import db
-        from flask import current_app
-        from feedback_system import feedback_collector, add_feedback_buttons_to_response
-        from user_memory import user_memory
-        import uuid
-
         data = request.get_json()
         if not data or 'message' not in data:
             return jsonify({'success': False, 'error': 'Сообщение не найдено'}), 400
@@ -284,18 +430,7 @@ def chat():
         session_id = session.get('session_id', str(uuid.uuid4()))
         session['session_id'] = session_id
         
-        # Автоматическое определение языка если не указан
-        language = data.get('language')
-        if not language or language == 'auto':
-            from language_detector import language_detector
-            detected_lang, confidence = language_detector.detect_language(user_message)
-            language = detected_lang
-            logger.info(f"Auto-detected language: {language} (confidence: {confidence:.2f})")
-        else:
-            # Валидация переданного языка
-            if language not in ['ru', 'kz', 'en']:
-                language = 'ru'
-        
+        language = _resolve_chat_language(user_message, data.get('language'))
         agent_type = data.get('agent')  # Updated parameter name
 
         if not user_message:
@@ -306,132 +441,156 @@ def chat():
         # Initialize router within app context
         router = initialize_agent_router()
 
-        # Get user ID for personalization and create session_id if not exists
+        # Get user ID for personalization
         user_id = session.get('user_id', 'anonymous')
-        if 'session_id' not in session:
-            session['session_id'] = str(uuid.uuid4())
         session.permanent = True
 
-        # Get user context for memory
-        user_context = user_memory.get_context_for_ai(session_id)
-        
-        # Add context to user message if exists
-        if user_context:
-            contextual_message = f"{user_context}\nСОБЩЕНИЕ ПОЛЬЗОВАТЕЛЯ: {user_message}"
-        else:
-            contextual_message = user_message
+        user_context = _load_user_context(session_id)
 
         if agent_type and agent_type != 'auto':
             # Пользователь явно выбрал агента - используем только его
-            selected_agent = None
-            for agent in router.agents:
-                if getattr(agent, "agent_type", None) and (agent.agent_type == agent_type):
-                    selected_agent = agent
-                    break
+            selected_agent = _find_manual_agent(router, agent_type)
             
             if selected_agent:
                 # Принудительно используем выбранного агента
-                result = selected_agent.process_message(contextual_message, language, user_id)
-                result['agent_type'] = selected_agent.agent_type
-                result['agent_name'] = selected_agent.name
-                result['confidence'] = 1.0  # Максимальная уверенность при ручном выборе
-                result['manually_selected'] = True
+                result = selected_agent.process_message(user_message, language, user_id, user_context)
+                result = _mark_manual_selection(result, selected_agent)
                 logger.info(f"User manually selected agent: {selected_agent.name}")
             else:
-                # Агент не найден - возвращаем ошибку
-                logger.warning(f"Requested agent type '{agent_type}' not found")
-                result = {
-                    'response': f"Извините, запрошенный агент '{agent_type}' недоступен. Попробуйте выбрать другого агента или используйте автоматический выбор.",
-                    'confidence': 0.0,
-                    'agent_type': 'error',
-                    'agent_name': 'System',
-                    'context_used': False,
-                    'context_confidence': 0.0,
-                    'cached': False,
-                    'error': True
-                }
+                result = _agent_unavailable_result(agent_type)
         else:
             # Автоматический выбор агента
-            result = router.route_message(contextual_message, language, user_id)
+            result = router.route_message(user_message, language, user_id, user_context)
 
         response_time = time.time() - start_time
 
-        # Generate unique message ID for feedback tracking
-        message_id = str(uuid.uuid4())
-        
-        # Register interaction for ML learning (always register for feedback)
-        feedback_collector.register_interaction(
-            message_id, user_message, result.get('agent_name', ''), user_id
-        )
-        
-        # Add feedback buttons to response
-        result = add_feedback_buttons_to_response(result, message_id)
-
-        # Create UserQuery within app context
-        user_query = UserQuery()
-        user_query.user_message = user_message
-        user_query.bot_response = result['response']
-        user_query.language = language
-        user_query.response_time = response_time
-        user_query.agent_type = result.get('agent_type')
-        user_query.agent_name = result.get('agent_name')
-        user_query.agent_confidence = result.get('confidence', 0.0)
-        user_query.context_used = result.get('context_used', False)
-        user_query.session_id = session_id
-        user_query.ip_address = request.remote_addr
-        user_query.user_agent = request.headers.get('User-Agent', '')
-
-        try:
-            db.session.add(user_query)
-            db.session.commit()
-            
-            # Update user memory with the interaction
-            user_memory.update_context(
-                session_id=session_id,
-                user_message=user_message,  # Use original message for context extraction
-                bot_response=result['response'],
-                agent_name=result.get('agent_name')
-            )
-            
-        except Exception as db_error:
-            logger.warning(f"Database error (continuing without saving): {str(db_error)}")
-            # Continue without saving to database
-
-        logger.info(
-            f"Chat response generated in {response_time:.2f}s "
-            f"by {result.get('agent_name', 'Unknown')} agent "
-            f"(confidence: {result.get('confidence', 0):.2f}) "
-            f"for language: {language}"
-        )
-
-        response_data = {
-            'success': True,
-            'response': result['response'],
-            'response_time': response_time,
-            'agent_name': result.get('agent_name'),
-            'agent_type': result.get('agent_type'),
-            'confidence': result.get('confidence', 0.0),
-            'query_id': getattr(user_query, 'id', None),
-            'message_id': message_id,
-            'routing_method': result.get('routing_method', 'traditional'),
-            'ml_confidence': result.get('ml_confidence'),
-            'detected_language': language,  # Определенный язык
-            'feedback': result.get('feedback', {})  # Include feedback metadata
-        }
-        
-        # Add images data if present
-        if 'images' in result:
-            response_data['images'] = result['images']
-            response_data['special_response'] = result.get('special_response', 'images')
-        
-        return jsonify(response_data)
+        return jsonify(_complete_chat_turn(user_message, result, language, session_id, user_id, response_time))
 
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
         # Use a default language if language is not defined
-        lang = locals().get('language', 'ru')
-        error_message = "Извините, произошла ошибка. Попробуйте еще раз." if lang == 'ru' else "Кешіріңіз, қате орын алды. Қайталап көріңіз."
-        return jsonify({'success': False, 'error': error_message}), 500
+        return jsonify({'success': False, 'error': _chat_error_message(locals().get('language', 'ru'))}), 500
+
+
+async def chat_async():
+    """asyncio counterpart of chat(), served on the same URLs by asgi.py
+
+    Runs inside the request context pushed by the ASGI layer. Memory lookup,
+    routing and persistence are awaited in worker threads; the LLM call holds
+    no thread while waiting, so one worker serves many concurrent chats.
+    """
+    from app_context import run_in_app_context
+
+    try:
+        data = request.get_json(silent=True)
+        if not data or 'message' not in data:
+            return jsonify({'success': False, 'error': 'Сообщение не найдено'}), 400
+
+        user_message = data['message'].strip()
+
+        session_id = session.get('session_id', str(uuid.uuid4()))
+        session['session_id'] = session_id
+
+        language = _resolve_chat_language(user_message, data.get('language'))
+        agent_type = data.get('agent')
+
+        if not user_message:
+            return jsonify({'success': False, 'error': 'Пустое сообщение'}), 400
+
+        start_time = time.time()
+        router = initialize_agent_router()
+        user_id = session.get('user_id', 'anonymous')
+        session.permanent = True
+
+        user_context = await run_in_app_context(_load_user_context, session_id)
+
+        if agent_type and agent_type != 'auto':
+            selected_agent = _find_manual_agent(router, agent_type)
+            if selected_agent:
+                result = await selected_agent.process_message_async(user_message, language, user_id, user_context)
+                result = _mark_manual_selection(result, selected_agent)
+                logger.info(f"User manually selected agent: {selected_agent.name}")
+            else:
+                result = _agent_unavailable_result(agent_type)
+        else:
+            result = await router.route_message_async(user_message, language, user_id, user_context)
+
+        response_time = time.time() - start_time
+
+        return jsonify(await run_in_app_context(
+            _complete_chat_turn, user_message, result, language, session_id, user_id, response_time
+        ))
+
+    except Exception as e:
+        logger.error(f"Error in async chat endpoint: {str(e)}")
+        return jsonify({'success': False, 'error': _chat_error_message(locals().get('language', 'ru'))}), 500
+
+
+def _sse_event(event, data):
+    """One Server-Sent Events frame with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@main_bp.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Chat over Server-Sent Events: 'agent', 'delta' (text chunks) and a final 'done' with the /api/chat payload"""
+    data = request.get_json(silent=True)
+    if not data or not (data.get('message') or '').strip():
+        return jsonify({'success': False, 'error': 'Сообщение не найдено'}), 400
+
+    user_message = data['message'].strip()
+    session_id = session.get('session_id', str(uuid.uuid4()))
+    session['session_id'] = session_id
+    session.permanent = True
+    user_id = session.get('user_id', 'anonymous')
+    language = _resolve_chat_language(user_message, data.get('language'))
+    agent_type = data.get('agent')
+
+    def generate():
+        start_time = time.time()
+        try:
+            router = initialize_agent_router()
+            user_context = _load_user_context(session_id)
+
+            selected_agent = None
+            if agent_type and agent_type != 'auto':
+                selected_agent = _find_manual_agent(router, agent_type)
+                if selected_agent is None:
+                    events = iter([('done', _agent_unavailable_result(agent_type))])
+                else:
+                    logger.info(f"User manually selected agent: {selected_agent.name}")
+                    yield _sse_event('agent', {'agent_type': selected_agent.agent_type,
+                                               'agent_name': selected_agent.name})
+                    events = selected_agent.stream_message(user_message, language, user_id, user_context)
+            else:
+                events = router.stream_message(user_message, language, user_id, user_context)
+
+            result = None
+            for kind, payload in events:
+                if kind == 'delta':
+                    yield _sse_event('delta', {'text': payload})
+                elif kind == 'agent':
+                    yield _sse_event('agent', payload)
+                elif kind == 'done':
+                    result = payload
+
+            if selected_agent is not None:
+                result = _mark_manual_selection(result, selected_agent)
+
+            # Persistence, memory and feedback run once the stream has completed
+            response_time = time.time() - start_time
+            yield _sse_event('done', _complete_chat_turn(
+                user_message, result, language, session_id, user_id, response_time
+            ))
+
+        except Exception as e:
+            logger.error(f"Error in streaming chat endpoint: {str(e)}")
+            yield _sse_event('error', {'success': False, 'error': _chat_error_message(language)})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Disable proxy buffering so deltas are flushed immediately
+    })
 
 @main_bp.route('/api/health')
 @main_bp.route('/health')
@@ -475,6 +634,19 @@ def health_check():
         }), 200
 
 
+@main_bp.route('/metrics')
+def prometheus_metrics():
+    """Server-wide metrics of all workers in the Prometheus text format"""
+    from worker_metrics import worker_metrics, load_default_collectors
+
+    try:
+        load_default_collectors()
+        return Response(worker_metrics.render_prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+    except Exception as e:
+        logger.error(f"Error rendering metrics: {str(e)}")
+        return Response(f"# metrics unavailable: {e}\n", status=500, mimetype='text/plain')
+
+
 @main_bp.route('/api/startup', methods=['POST'])
 def startup_initialization():
     """Initialize database tables after deployment startup"""
@@ -521,8 +693,19 @@ def get_agents():
 @main_bp.route('/api/rate/<int:query_id>', methods=['POST'])
 def rate_response(query_id):
     """Rate a bot response with like/dislike"""
+    from models import UserQuery
+    return _rate_query(lambda: UserQuery.query.get(query_id), query_id)
+
+
+@main_bp.route('/api/rate/message/<message_id>', methods=['POST'])
+def rate_response_by_message(message_id):
+    """Rate a bot response with like/dislike by the message_id of the chat reply"""
+    from models import UserQuery
+    return _rate_query(lambda: UserQuery.query.filter_by(message_id=message_id).first(), message_id)
+
+
+def _rate_query(find_query, query_id):
     try:
-        from models import UserQuery
         from app import db
 
         data = request.get_json()
@@ -534,7 +717,7 @@ def rate_response(query_id):
             return jsonify({'error': 'Invalid rating. Must be "like" or "dislike"'}), 400
 
         # Find the query
-        query = UserQuery.query.get(query_id)
+        query = find_query()
         if not query:
             return jsonify({'error': 'Query not found'}), 404
 
@@ -548,7 +731,7 @@ def rate_response(query_id):
             return jsonify({
                 'success': True,
                 'rating': rating,
-                'query_id': query_id
+                'query_id': query.id
             })
         except Exception as db_error:
             logger.error(f"Database error saving rating: {str(db_error)}")
@@ -783,11 +966,8 @@ def feedback_like_dislike():
         from app import db
         
         try:
-            # Find the most recent query for this session (since message_id is UUID and id is integer)
-            # We'll use session_id and timestamp to find the relevant query
-            query = UserQuery.query.filter_by(
-                session_id=session.get('session_id', '')
-            ).order_by(UserQuery.created_at.desc()).first()
+            # The rated answer is found by its message_id
+            query = UserQuery.query.filter_by(message_id=message_id).first()
             
             if query:
                 # Update the query record with rating
@@ -810,7 +990,7 @@ def feedback_like_dislike():
                 )
                 logger.info(f"Updated query {query.id} and ML router with feedback for message_id {message_id}")
             else:
-                logger.warning(f"No recent query found for session {session.get('session_id', '')}")
+                logger.warning(f"No query found for message_id {message_id}")
                 
         except Exception as e:
             logger.error(f"Error updating ML router: {str(e)}")
@@ -833,10 +1013,28 @@ def get_cache_stats():
     """Get cache statistics for monitoring"""
     try:
         from response_cache import response_cache
+        from knowledge_snapshot import knowledge_snapshot
+        from knowledge_search import knowledge_search_engine
+        from vector_store import vector_store
+        from distributed_system import performance_optimizer
+        from write_behind import write_behind
+        from statistics_rollups import statistics_rollups
+        from schedule_service import schedule_service
+        from worker_metrics import worker_metrics, load_default_collectors
+        load_default_collectors()
         stats = response_cache.get_stats()
         
         return jsonify({
             'cache_stats': stats,
+            'precompute': performance_optimizer.get_precompute_stats(),
+            'knowledge_snapshot': knowledge_snapshot.get_stats(),
+            'knowledge_search': knowledge_search_engine.get_stats(),
+            'vector_store': vector_store.get_stats(),
+            'write_behind': write_behind.get_stats(),
+            'statistics_rollups': statistics_rollups.get_stats(),
+            'schedule': schedule_service.get_stats(),
+            # cache_stats above is this worker only; these are summed over all workers
+            'server': worker_metrics.totals('bolashak_response_cache_'),
             'status': 'healthy'
         })
     except Exception as e:
@@ -848,134 +1046,14 @@ def get_cache_stats():
 def get_statistics():
     """Get real-time statistics for the homepage"""
     try:
-        from models import UserQuery, AgentKnowledgeBase, db
-        from sqlalchemy import func
-        from datetime import datetime, timedelta
-        
-        # Основная статистика
-        total_queries = UserQuery.query.count()
-        total_knowledge = AgentKnowledgeBase.query.filter_by(is_active=True).count()
-        
-        # Статистика за последние 30 дней
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        recent_queries = UserQuery.query.filter(
-            UserQuery.created_at >= thirty_days_ago
-        ).count()
-        
-        # Рейтинг удовлетворенности
-        liked_queries = UserQuery.query.filter_by(user_rating='like').count()
-        total_rated_queries = UserQuery.query.filter(UserQuery.user_rating.isnot(None)).count()
-        satisfaction_rate = round((liked_queries / total_rated_queries * 100) if total_rated_queries > 0 else 95, 1)
-        
-        # Средне время ответа
-        avg_response_time = db.session.query(
-            func.avg(UserQuery.response_time)
-        ).scalar()
-        avg_response_time = round(avg_response_time, 2) if avg_response_time else 1.5
-        
-        # Статистика агентов
-        agent_stats = db.session.query(
-            UserQuery.agent_name,
-            func.count(UserQuery.id).label('count'),
-            func.avg(UserQuery.response_time).label('avg_time'),
-            func.avg(UserQuery.agent_confidence).label('avg_confidence')
-        ).filter(
-            UserQuery.agent_name.isnot(None)
-        ).group_by(UserQuery.agent_name).all()
-        
-        # Языковая статистика
-        language_stats = db.session.query(
-            UserQuery.language,
-            func.count(UserQuery.id).label('count')
-        ).group_by(UserQuery.language).all()
-        
-        # Статистика пользователей  
-        total_users = db.session.query(func.count(func.distinct(UserQuery.session_id))).scalar() or 0
-        
-        # Активные пользователи за последние 24 часа
-        day_ago = datetime.utcnow() - timedelta(days=1)
-        active_users_24h = db.session.query(UserQuery.session_id).filter(
-            UserQuery.created_at >= day_ago
-        ).distinct().count()
-        
-        # Активные пользователи за последние 7 дней
-        week_ago = datetime.utcnow() - timedelta(days=7)
-        active_users_7d = db.session.query(UserQuery.session_id).filter(
-            UserQuery.created_at >= week_ago
-        ).distinct().count()
-        
-        # Среднее количество запросов на пользователя
-        avg_queries_per_user = round(total_queries / total_users, 1) if total_users > 0 else 0
-        
-        # Топ часов активности
-        hourly_stats = db.session.query(
-            func.extract('hour', UserQuery.created_at).label('hour'),
-            func.count(UserQuery.id).label('count')
-        ).group_by(func.extract('hour', UserQuery.created_at)).order_by(func.count(UserQuery.id).desc()).all()
-        
-        # Статистика по дням недели
-        daily_stats = db.session.query(
-            func.extract('dow', UserQuery.created_at).label('day'),
-            func.count(UserQuery.id).label('count')
-        ).group_by(func.extract('dow', UserQuery.created_at)).all()
-        
-        # Преобразуем дни недели в названия
-        day_names = {0: 'Воскресенье', 1: 'Понедельник', 2: 'Вторник', 3: 'Среда', 4: 'Четверг', 5: 'Пятница', 6: 'Суббота'}
-        daily_stats_named = [
-            {
-                'day': day_names.get(int(stat.day), f'День {int(stat.day)}'),
-                'count': stat.count
-            }
-            for stat in daily_stats
-        ]
-        
+        from statistics_rollups import statistics_rollups
+        from datetime import datetime
+
+        # Читаем материализованные агрегаты (обновляются инкрементально), а не user_queries
         return jsonify({
             'success': True,
             'timestamp': datetime.utcnow().isoformat(),
-            'statistics': {
-                'total_students': 15000,  # Константа или из другой таблицы
-                'total_queries': total_queries,
-                'recent_queries': recent_queries,
-                'total_knowledge': total_knowledge,
-                'satisfaction_rate': satisfaction_rate,
-                'avg_response_time': avg_response_time,
-                'user_stats': {
-                    'total_users': total_users,
-                    'active_users_24h': active_users_24h,
-                    'active_users_7d': active_users_7d,
-                    'avg_queries_per_user': avg_queries_per_user,
-                    'user_growth': {
-                        'daily_retention': round((active_users_24h / total_users * 100) if total_users > 0 else 0, 1),
-                        'weekly_retention': round((active_users_7d / total_users * 100) if total_users > 0 else 0, 1)
-                    }
-                },
-                'usage_patterns': {
-                    'hourly_stats': [
-                        {
-                            'hour': int(stat.hour),
-                            'count': stat.count
-                        }
-                        for stat in hourly_stats[:5]  # Топ 5 часов
-                    ],
-                    'daily_stats': daily_stats_named
-                },
-                'agent_stats': [
-                    {
-                        'name': stat.agent_name,
-                        'count': stat.count,
-                        'avg_time': round(stat.avg_time or 0, 2),
-                        'avg_confidence': round(stat.avg_confidence or 0, 2)
-                    }
-                    for stat in agent_stats
-                ],
-                'language_stats': [
-                    {
-                        'language': stat.language,
-                        'count': stat.count
-                    }
-                    for stat in language_stats
-                ]
-            }
+            'statistics': statistics_rollups.homepage_statistics()
         })
         
     except Exception as e:
@@ -1069,8 +1147,7 @@ def get_groups():
 def get_today_schedule(group_name):
     """Получить расписание на сегодня для группы"""
     try:
-        from models import Schedule
-        from app import db
+        from schedule_service import schedule_service
         from flask import session
         from datetime import date
         
@@ -1078,14 +1155,7 @@ def get_today_schedule(group_name):
         today = date.today()
         
         # Получить расписание на сегодня по названию группы
-        schedules = Schedule.query.filter(
-            Schedule.group_name == group_name,
-            db.func.date(Schedule.start_time) == today,
-            Schedule.is_active == True,
-            Schedule.is_cancelled == False
-        ).order_by(Schedule.start_time).all()
-        
-        schedule_list = [schedule.to_dict(language) for schedule in schedules]
+        schedule_list = schedule_service.day(group_name, today, language)
         
         return jsonify({
             'success': True,
@@ -1106,8 +1176,7 @@ def get_today_schedule(group_name):
 def get_tomorrow_schedule(group_name):
     """Получить расписание на завтра для группы"""
     try:
-        from models import Schedule
-        from app import db
+        from schedule_service import schedule_service
         from flask import session
         from datetime import date, timedelta
         
@@ -1115,14 +1184,7 @@ def get_tomorrow_schedule(group_name):
         tomorrow = date.today() + timedelta(days=1)
         
         # Получить расписание на завтра по названию группы
-        schedules = Schedule.query.filter(
-            Schedule.group_name == group_name,
-            db.func.date(Schedule.start_time) == tomorrow,
-            Schedule.is_active == True,
-            Schedule.is_cancelled == False
-        ).order_by(Schedule.start_time).all()
-        
-        schedule_list = [schedule.to_dict(language) for schedule in schedules]
+        schedule_list = schedule_service.day(group_name, tomorrow, language)
         
         return jsonify({
             'success': True,
@@ -1143,34 +1205,18 @@ def get_tomorrow_schedule(group_name):
 def get_week_schedule(group_name):
     """Получить расписание на неделю для группы"""
     try:
-        from models import Schedule
-        from app import db
+        from schedule_service import schedule_service, week_start
         from flask import session
         from datetime import date, timedelta
         
         language = session.get('language', 'ru')
-        today = date.today()
         
         # Получаем дату начала недели (понедельник)
-        start_of_week = today - timedelta(days=today.weekday())
+        start_of_week = week_start(date.today())
         end_of_week = start_of_week + timedelta(days=6)
         
-        # Получить расписание на неделю по названию группы
-        schedules = Schedule.query.filter(
-            Schedule.group_name == group_name,
-            db.func.date(Schedule.start_time) >= start_of_week,
-            db.func.date(Schedule.start_time) <= end_of_week,
-            Schedule.is_active == True,
-            Schedule.is_cancelled == False
-        ).order_by(Schedule.start_time).all()
-        
-        # Группируем по дням
-        schedule_by_days = {}
-        for schedule in schedules:
-            day_key = schedule.date.isoformat()
-            if day_key not in schedule_by_days:
-                schedule_by_days[day_key] = []
-            schedule_by_days[day_key].append(schedule.to_dict(language))
+        # Расписание на неделю, сгруппированное по дням
+        schedule_by_days = schedule_service.week(group_name, start_of_week, language)
         
         return jsonify({
             'success': True,
@@ -1178,7 +1224,7 @@ def get_week_schedule(group_name):
             'end_date': end_of_week.isoformat(),
             'group': group_name,
             'schedule_by_days': schedule_by_days,
-            'total_lessons': len(schedules)
+            'total_lessons': sum(len(lessons) for lessons in schedule_by_days.values())
         })
         
     except Exception as e:
@@ -1192,8 +1238,7 @@ def get_week_schedule(group_name):
 def get_schedule_by_date(group_name, date_str):
     """Получить расписание на конкретную дату для группы"""
     try:
-        from models import Schedule
-        from app import db
+        from schedule_service import schedule_service
         from flask import session
         from datetime import datetime
         
@@ -1209,14 +1254,7 @@ def get_schedule_by_date(group_name, date_str):
             }), 400
         
         # Получить расписание на указанную дату по названию группы
-        schedules = Schedule.query.filter(
-            Schedule.group_name == group_name,
-            db.func.date(Schedule.start_time) == target_date,
-            Schedule.is_active == True,
-            Schedule.is_cancelled == False
-        ).order_by(Schedule.start_time).all()
-        
-        schedule_list = [schedule.to_dict(language) for schedule in schedules]
+        schedule_list = schedule_service.day(group_name, target_date, language)
         
         return jsonify({
             'success': True,
@@ -1233,6 +1271,64 @@ def get_schedule_by_date(group_name, date_str):
             'error': 'Ошибка при получении расписания на указанную дату'
         }), 500
 
+@main_bp.route('/api/schedule/batch', methods=['POST'])
+def get_schedule_batch():
+    """Расписание нескольких групп и периодов одним ответом.
+
+    Тело: {"requests": [{"groups": ["ИТ-21-1", ...] или "group": "...",
+                         "start": "YYYY-MM-DD", "end": "YYYY-MM-DD"}, ...]}
+    (end включительно; без дат — текущая неделя)
+    """
+    try:
+        from schedule_service import schedule_service, week_start
+        from flask import session
+        from datetime import date, datetime, timedelta
+
+        max_requests, max_groups, max_days = 20, 50, 62
+        language = session.get('language', 'ru')
+        data = request.get_json(silent=True) or {}
+        items = data.get('requests') or [data]
+        if not isinstance(items, list) or len(items) > max_requests:
+            return jsonify({'success': False, 'error': f'Не более {max_requests} запросов за раз'}), 400
+
+        parsed = []
+        for item in items:
+            groups = item.get('groups') or ([item['group']] if item.get('group') else [])
+            if not groups or not isinstance(groups, list) or len(groups) > max_groups:
+                return jsonify({'success': False, 'error': f'Укажите от 1 до {max_groups} групп'}), 400
+            try:
+                start = datetime.strptime(item['start'], '%Y-%m-%d').date() if item.get('start') \
+                    else week_start(date.today())
+                end = datetime.strptime(item['end'], '%Y-%m-%d').date() if item.get('end') \
+                    else start + timedelta(days=6)
+            except (TypeError, ValueError):
+                return jsonify({'success': False, 'error': 'Неверный формат даты. Используйте YYYY-MM-DD'}), 400
+            if end < start or (end - start).days >= max_days:
+                return jsonify({'success': False, 'error': f'Период от 1 до {max_days} дней'}), 400
+            parsed.append((groups, start, end))
+
+        results = []
+        for groups, start, end in parsed:
+            by_group = schedule_service.lessons_between(groups, start, end + timedelta(days=1), language)
+            for group_name in groups:
+                schedule_by_days = by_group[group_name]
+                results.append({
+                    'group': group_name,
+                    'start_date': start.isoformat(),
+                    'end_date': end.isoformat(),
+                    'schedule_by_days': schedule_by_days,
+                    'total_lessons': sum(len(lessons) for lessons in schedule_by_days.values())
+                })
+
+        return jsonify({'success': True, 'results': results, 'total': len(results)})
+
+    except Exception as e:
+        logger.error(f"Error getting schedule batch: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': 'Ошибка при получении расписания'
+        }), 500
+
 @main_bp.route('/api/schedule/subjects', methods=['GET'])
 def get_subjects():
     """Получить список всех предметов"""
@@ -0,0 +1,320 @@
+"""
+Cross-worker Metrics Store and Prometheus Exposition
+Общие для воркеров метрики и экспорт в формате Prometheus
+
+Caches, analytics, the task processor and the write-behind queue keep their
+counters in process memory, so any stats endpoint used to describe only the
+gunicorn worker that served it. Components register a collector here; each
+worker periodically publishes its collected metrics as one row of a shared
+SQLite file (in /dev/shm when available), and /metrics merges the rows of all
+workers:
+
+- counters are summed; a worker that exits (or stops reporting) is folded
+  into a "retired" row, so server totals never go backwards;
+- gauges are summed over the workers that reported recently;
+- summaries carry a LatencySketch and are merged bucket by bucket, so p95 is
+  the server-wide p95, not an average of per-worker p95s.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from analytics_rollups import LatencySketch
+
+logger = logging.getLogger(__name__)
+
+RETIRED = 'retired'
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+@dataclass
+class MetricFamily:
+    """samples: (labels, value); a summary's value is a LatencySketch"""
+    name: str
+    type: str  # 'counter' | 'gauge' | 'summary'
+    help: str
+    samples: List[Tuple[Dict[str, str], Any]] = field(default_factory=list)
+
+    def add(self, value: Any, **labels):
+        self.samples.append(({k: str(v) for k, v in labels.items()}, value))
+        return self
+
+
+def _default_db_path() -> str:
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base_dir, 'bolashak_worker_metrics.db')
+
+
+def _sample_key(labels: Dict[str, str]) -> str:
+    return json.dumps(labels, sort_keys=True, ensure_ascii=False)
+
+
+class WorkerMetricsStore:
+    """Collectors of this process plus the shared table of every worker's last report"""
+
+    def __init__(self, path: Optional[str] = None, interval: Optional[float] = None):
+        self.path = path or os.environ.get('WORKER_METRICS_DB') or _default_db_path()
+        self.interval = interval if interval is not None else float(os.environ.get('WORKER_METRICS_INTERVAL', '15'))
+        # Gauges of a worker silent for 3 intervals are dropped; after 20 its counters are retired
+        self.stale_after = max(self.interval * 3, 5.0)
+        self.retire_after = max(self.interval * 20, 300.0)
+        self.collectors: Dict[str, Callable[[], List[MetricFamily]]] = {}
+        self._worker_id: Optional[str] = None
+        self._worker_pid: Optional[int] = None
+        self._initialized = False
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid: Optional[int] = None
+        self._stop = threading.Event()
+        self.stats = {'publishes': 0, 'aggregations': 0, 'retired_workers': 0, 'errors': 0}
+
+    def register(self, name: str, collect: Callable[[], List[MetricFamily]]):
+        self.collectors[name] = collect
+
+    @property
+    def worker_id(self) -> str:
+        # pid plus start time: a recycled pid must not overwrite a dead worker's counters
+        if self._worker_pid != os.getpid():
+            self._worker_pid = os.getpid()
+            self._worker_id = f"{self._worker_pid}-{time.time():.0f}"
+        return self._worker_id
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS worker_metrics (
+                    worker_id TEXT PRIMARY KEY,
+                    pid INTEGER,
+                    updated_at REAL NOT NULL,
+                    payload TEXT NOT NULL
+                )
+            """)
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    def collect_local(self) -> Dict[str, Dict[str, Any]]:
+        """This process's metrics as JSON-serializable families"""
+        families: Dict[str, Dict[str, Any]] = {}
+        for name, collect in list(self.collectors.items()):
+            try:
+                collected = collect()
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.warning(f"Metrics collector '{name}' failed: {e}")
+                continue
+            for family in collected:
+                target = families.setdefault(family.name, {'type': family.type, 'help': family.help, 'samples': {}})
+                for labels, value in family.samples:
+                    key = _sample_key(labels)
+                    if family.type == 'summary':
+                        value = value.to_dict()
+                        previous = target['samples'].get(key)
+                        if previous is not None:
+                            sketch = LatencySketch.from_dict(previous)
+                            sketch.merge(LatencySketch.from_dict(value))
+                            value = sketch.to_dict()
+                    elif key in target['samples']:
+                        value += target['samples'][key]
+                    target['samples'][key] = value
+        return families
+
+    def publish(self):
+        """Write this worker's current metrics to the shared table"""
+        try:
+            payload = json.dumps(self.collect_local(), ensure_ascii=False, separators=(',', ':'))
+            conn = self._connect()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO worker_metrics (worker_id, pid, updated_at, payload) VALUES (?, ?, ?, ?)",
+                    (self.worker_id, os.getpid(), time.time(), payload)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            self.stats['publishes'] += 1
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.warning(f"Failed to publish worker metrics: {e}")
+
+    def retire(self, worker_id: Optional[str] = None):
+        """Fold a worker's counters and summaries into the retired row (worker exit)"""
+        worker_id = worker_id or self.worker_id
+        if worker_id == self.worker_id:
+            self.publish()
+        try:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                self._retire_rows(conn, [worker_id])
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.warning(f"Failed to retire worker metrics: {e}")
+
+    def _retire_rows(self, conn: sqlite3.Connection, worker_ids: List[str]):
+        rows = conn.execute(
+            f"SELECT worker_id, payload FROM worker_metrics WHERE worker_id IN "
+            f"({','.join('?' * (len(worker_ids) + 1))})", [RETIRED, *worker_ids]
+        ).fetchall()
+        payloads = {worker_id: json.loads(payload) for worker_id, payload in rows}
+        leaving = [payloads[w] for w in worker_ids if w in payloads]
+        if not leaving:
+            return
+        # Gauges describe live workers only; counters and summaries accumulate
+        cumulative = [{name: family for name, family in payload.items() if family['type'] != 'gauge'}
+                      for payload in leaving]
+        retired = self._merge([payloads.get(RETIRED, {}), *cumulative])
+        conn.execute(
+            "INSERT OR REPLACE INTO worker_metrics (worker_id, pid, updated_at, payload) VALUES (?, NULL, ?, ?)",
+            (RETIRED, time.time(), json.dumps(retired, ensure_ascii=False, separators=(',', ':')))
+        )
+        conn.executemany("DELETE FROM worker_metrics WHERE worker_id = ?", [(w,) for w in worker_ids])
+        self.stats['retired_workers'] += len(leaving)
+
+    @staticmethod
+    def _merge(payloads: List[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+        merged: Dict[str, Dict[str, Any]] = {}
+        sketches: Dict[Tuple[str, str], LatencySketch] = {}
+        for payload in payloads:
+            for name, family in payload.items():
+                target = merged.setdefault(name, {'type': family['type'], 'help': family['help'], 'samples': {}})
+                for key, value in family['samples'].items():
+                    if family['type'] == 'summary':
+                        sketch = sketches.get((name, key))
+                        if sketch is None:
+                            sketch = sketches[(name, key)] = LatencySketch.from_dict(value)
+                        else:
+                            sketch.merge(LatencySketch.from_dict(value))
+                    else:
+                        target['samples'][key] = target['samples'].get(key, 0) + value
+        for (name, key), sketch in sketches.items():
+            merged[name]['samples'][key] = sketch.to_dict()
+        return merged
+
+    def aggregate(self) -> Dict[str, Any]:
+        """Server-wide metrics: this worker is published first, then every row is merged"""
+        self.publish()
+        now = time.time()
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT worker_id, updated_at, payload FROM worker_metrics").fetchall()
+            gone = [worker_id for worker_id, updated_at, _ in rows
+                    if worker_id != RETIRED and now - updated_at > self.retire_after]
+            if gone:
+                conn.execute("BEGIN IMMEDIATE")
+                self._retire_rows(conn, gone)
+                conn.commit()
+                rows = conn.execute("SELECT worker_id, updated_at, payload FROM worker_metrics").fetchall()
+        finally:
+            conn.close()
+
+        payloads = []
+        live_workers = 0
+        for worker_id, updated_at, payload in rows:
+            payload = json.loads(payload)
+            if worker_id != RETIRED and now - updated_at > self.stale_after:
+                payload = {name: family for name, family in payload.items() if family['type'] != 'gauge'}
+            elif worker_id != RETIRED:
+                live_workers += 1
+            payloads.append(payload)
+        self.stats['aggregations'] += 1
+        return {'workers': live_workers, 'families': self._merge(payloads)}
+
+    def totals(self, prefix: str = '') -> Dict[str, Any]:
+        """Aggregated metrics as plain JSON: {name: value or {labels: value}}, summaries as p50/p95/p99"""
+        aggregated = self.aggregate()
+        result: Dict[str, Any] = {'workers': aggregated['workers']}
+        for name, family in sorted(aggregated['families'].items()):
+            if not name.startswith(prefix):
+                continue
+            values = {}
+            for key, value in family['samples'].items():
+                if family['type'] == 'summary':
+                    sketch = LatencySketch.from_dict(value)
+                    value = {**sketch.percentiles(), 'count': sketch.count}
+                labels = json.loads(key)
+                values[','.join(f"{k}={v}" for k, v in labels.items())] = value
+            result[name[len(prefix):]] = values.get('', values)
+        return result
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        aggregated = self.aggregate()
+        lines = [
+            '# HELP bolashak_workers_reporting Worker processes that published metrics recently',
+            '# TYPE bolashak_workers_reporting gauge',
+            f"bolashak_workers_reporting {aggregated['workers']}"
+        ]
+        for name, family in sorted(aggregated['families'].items()):
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for key, value in sorted(family['samples'].items()):
+                labels = json.loads(key)
+                if family['type'] == 'summary':
+                    sketch = LatencySketch.from_dict(value)
+                    for q in QUANTILES:
+                        lines.append(f"{name}{_labels({**labels, 'quantile': str(q)})} {sketch.quantile(q):.6g}")
+                    lines.append(f"{name}_sum{_labels(labels)} {sketch.total:.6g}")
+                    lines.append(f"{name}_count{_labels(labels)} {sketch.count}")
+                else:
+                    lines.append(f"{name}{_labels(labels)} {value:.10g}")
+        return '\n'.join(lines) + '\n'
+
+    def start_periodic(self):
+        """Publish every `interval` seconds from a daemon thread (one per process)"""
+        if self.interval <= 0 or (self._thread is not None and self._thread_pid == os.getpid()):
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='worker-metrics')
+        self._thread_pid = os.getpid()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        self.publish()
+        while not self._stop.wait(self.interval):
+            self.publish()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'path': self.path,
+            'interval': self.interval,
+            'collectors': sorted(self.collectors)
+        }
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def load_default_collectors():
+    """Import the components that feed /metrics (each registers its collector at import time)"""
+    import analytics_engine  # noqa: F401
+    import distributed_system  # noqa: F401
+    import personalization_engine  # noqa: F401
+    import response_cache  # noqa: F401
+    import write_behind  # noqa: F401
+
+
+# Global metrics store; components register their collectors at import time
+worker_metrics = WorkerMetricsStore()
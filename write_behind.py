@@ -0,0 +1,269 @@
+"""
+Write-behind Queue for Per-turn Bookkeeping
+Отложенная пакетная запись служебных данных диалога
+
+Every chat turn used to query and commit the UserContext, then open a SQLite
+connection for the ML router row before the answer went out (the UserQuery
+row itself is still committed in the request, so its id can be rated). Those
+writes are now handed to this queue: a background thread flushes them when
+batch_size items are pending or every flush_interval seconds, one bulk
+statement and one commit per kind.
+
+Items are kept in one FIFO, and a batch is applied kind by kind in the
+order the items arrived, so the writes of a session land in the order they
+were submitted. The queue is drained on worker exit (gunicorn hook) and at
+interpreter exit. When the queue is full or disabled the write is applied
+in the caller's thread after the items queued before it. Readers of a
+session's rows call flush_for(session_id=...) so they see its last turns.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from worker_metrics import MetricFamily, worker_metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WriteHandler:
+    """apply(payloads) writes a batch of one kind; needs_app pushes a Flask app context"""
+    kind: str
+    apply: Callable[[List[Any]], None]
+    needs_app: bool = False
+
+
+class WriteBehindQueue:
+    """Batched, ordered, flush-on-exit queue of deferred writes"""
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 1.0,
+                 max_pending: int = 10000, enabled: bool = True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.enabled = enabled
+        self.handlers: Dict[str, WriteHandler] = {}
+        self._pending: deque = deque()
+        self._init_process_state()
+        self.stats = {
+            'submitted': 0,
+            'written': 0,
+            'batches': 0,
+            'applied_inline': 0,
+            'failed': 0,
+            'last_flush_ms': 0.0
+        }
+
+    def _init_process_state(self):
+        # Locks and the flusher thread do not survive fork: rebuild them in the child
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        # Reentrant: a handler may submit while its batch is being applied
+        self._flush_lock = threading.RLock()
+        self._draining = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def register(self, kind: str, apply: Callable[[List[Any]], None], needs_app: bool = False):
+        self.handlers[kind] = WriteHandler(kind, apply, needs_app)
+
+    def submit(self, kind: str, payload: Any) -> bool:
+        """Queue one write; returns False if it had to be applied inline"""
+        if kind not in self.handlers:
+            raise KeyError(f"No write-behind handler for '{kind}'")
+        if self._pid != os.getpid():
+            self._init_process_state()
+
+        self.stats['submitted'] += 1
+        if self.enabled and not self._stopping:
+            with self._cond:
+                if len(self._pending) < self.max_pending:
+                    self._pending.append((kind, payload))
+                    if len(self._pending) >= self.batch_size:
+                        self._cond.notify()
+                    self._ensure_thread()
+                    return True
+
+        # Disabled, shutting down or full: the caller pays for its own write, after
+        # everything queued before it so a session's writes still land in order
+        self.stats['applied_inline'] += 1
+        with self._flush_lock:
+            self._drain()
+            self._apply_batch([(kind, payload)])
+        return False
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True, name='write-behind')
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size and not self._stopping:
+                    # A partial batch waits up to the interval for more items
+                    self._cond.wait(self.flush_interval)
+                if self._stopping and not self._pending:
+                    return
+            self.flush()
+
+    def _take_batch(self) -> List[tuple]:
+        with self._cond:
+            count = min(len(self._pending), self.batch_size)
+            return [self._pending.popleft() for _ in range(count)]
+
+    def flush(self) -> int:
+        """Write everything queued so far; returns the number of items written"""
+        if self._pid != os.getpid():
+            self._init_process_state()
+        # One flusher at a time keeps batches (and so per-session writes) in order
+        with self._flush_lock:
+            return self._drain()
+
+    def flush_for(self, **fields) -> int:
+        """Flush if a queued (or in-flight) write has these payload fields, e.g. session_id=...
+
+        Readers of a session's rows call this first; when nothing of theirs is
+        pending it costs one scan of the queue and no commit.
+        """
+        if self._pid != os.getpid():
+            self._init_process_state()
+        with self._cond:
+            matched = any(
+                isinstance(payload, dict) and all(payload.get(key) == value for key, value in fields.items())
+                for _, payload in self._pending
+            )
+        # A batch taken by the flusher thread is no longer pending but not committed yet
+        if matched or self._draining:
+            return self.flush()
+        return 0
+
+    def _drain(self) -> int:
+        """Apply queued batches until the queue is empty (caller holds _flush_lock)"""
+        written = 0
+        self._draining += 1
+        try:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    break
+                written += self._apply_batch(batch)
+        finally:
+            self._draining -= 1
+        return written
+
+    def _apply_batch(self, batch: List[tuple]) -> int:
+        start = time.perf_counter()
+        runs: Dict[str, List[Any]] = {}
+        for kind, payload in batch:
+            runs.setdefault(kind, []).append(payload)
+
+        written = 0
+        # Kinds in order of first arrival, each kind's payloads in FIFO order
+        for kind, payloads in runs.items():
+            handler = self.handlers[kind]
+            try:
+                self._call(handler, payloads)
+                written += len(payloads)
+            except Exception as e:
+                logger.warning(f"Write-behind batch of {len(payloads)} '{kind}' failed, retrying one by one: {e}")
+                written += self._apply_one_by_one(handler, payloads)
+
+        self.stats['written'] += written
+        self.stats['batches'] += 1
+        self.stats['last_flush_ms'] = (time.perf_counter() - start) * 1000
+        return written
+
+    def _apply_one_by_one(self, handler: WriteHandler, payloads: List[Any]) -> int:
+        written = 0
+        for payload in payloads:
+            try:
+                self._call(handler, [payload])
+                written += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.warning(f"Write-behind '{handler.kind}' item dropped: {e}")
+        return written
+
+    @staticmethod
+    def _call(handler: WriteHandler, payloads: List[Any]):
+        if not handler.needs_app:
+            handler.apply(payloads)
+            return
+        from app_context import get_app
+        from models import db
+        # Own app context (and db.session) even on the inline path inside a request:
+        # a failed batch is rolled back here and never leaks into the caller's session
+        with get_app().app_context():
+            try:
+                handler.apply(payloads)
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def stop(self, timeout: float = 10.0) -> int:
+        """Stop the flusher and drain the queue (graceful shutdown); returns items written"""
+        written_before = self.stats['written']
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            thread.join(timeout)
+        self.flush()
+        self._stopping = False
+        self._thread = None
+        return self.stats['written'] - written_before
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'pending': len(self._pending),
+            'enabled': self.enabled,
+            'batch_size': self.batch_size,
+            'flush_interval': self.flush_interval,
+            'kinds': sorted(self.handlers)
+        }
+
+
+def _create_queue() -> WriteBehindQueue:
+    """Queue from WRITE_BEHIND_ENABLED / _BATCH_SIZE / _FLUSH_INTERVAL / _MAX_PENDING"""
+    enabled = os.environ.get('WRITE_BEHIND_ENABLED', '1').lower() not in ('0', 'false', 'no')
+    try:
+        return WriteBehindQueue(
+            batch_size=int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', '100')),
+            flush_interval=float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', '1.0')),
+            max_pending=int(os.environ.get('WRITE_BEHIND_MAX_PENDING', '10000')),
+            enabled=enabled
+        )
+    except ValueError:
+        logger.warning("Invalid WRITE_BEHIND_* settings, using defaults")
+        return WriteBehindQueue(enabled=enabled)
+
+
+# Global write-behind queue; writers register their handlers at import time
+write_behind = _create_queue()
+atexit.register(write_behind.stop)
+
+
+def _collect_metrics() -> List[MetricFamily]:
+    stats = write_behind.stats
+    return [
+        MetricFamily('bolashak_write_behind_items_total', 'counter', 'Deferred writes by outcome')
+        .add(stats['written'], outcome='written').add(stats['failed'], outcome='failed')
+        .add(stats['applied_inline'], outcome='inline'),
+        MetricFamily('bolashak_write_behind_batches_total', 'counter', 'Write-behind flush batches').add(stats['batches']),
+        MetricFamily('bolashak_write_behind_pending', 'gauge', 'Writes waiting for a flush').add(write_behind.pending()),
+    ]
+
+
+worker_metrics.register('write_behind', _collect_metrics)